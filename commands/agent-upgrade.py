@@ -5,7 +5,15 @@ Upgrades the local agents to use the new tools binary in a directory
 beside this script. Keeps all changed files in
 /var/lib/juju/1.25-upgrade-rollback so that they can be restored if
 needed.
+
+The upgrade has two phases. "prepare" unpacks and checks the tools and
+renders the new agent configs and init files into
+/var/lib/juju/1.25-upgrade-staging without touching the agents, so it
+can run while they are still up. "commit" moves the staged files into
+place with renames and reloads init once, preparing first if nothing
+valid is staged. With no argument both phases are run.
 """
+import hashlib
 import json
 import os
 from os import path
@@ -27,6 +35,11 @@ API_ADDRESSES = """{{range .ControllerInfo.Addrs}}{{.}}
 BASE_DIR = '/var/lib/juju'
 ROLLBACK_DIR = path.join(BASE_DIR, '1.25-upgrade-rollback')
 ROLLBACK_INIT_DIR = path.join(ROLLBACK_DIR, 'init')
+STAGING_DIR = path.join(BASE_DIR, '1.25-upgrade-staging')
+STAGING_TOOLS_DIR = path.join(STAGING_DIR, 'tools')
+STAGING_AGENTS_DIR = path.join(STAGING_DIR, 'agents')
+STAGING_INIT_DIR = path.join(STAGING_DIR, 'init')
+MANIFEST = path.join(STAGING_DIR, 'manifest.json')
 TOOLS_DIR = path.join(BASE_DIR, 'tools')
 AGENTS_DIR = path.join(BASE_DIR, 'agents')
 INIT_DIR = path.join(BASE_DIR, 'init')
@@ -140,64 +153,229 @@ def find_new_tools():
     assert len(files) == 1, 'too many tools files found: {}'.format(files)
     return path.join(UPGRADE_DIR, files[0])
 
+def tools_name(tools_path):
+    # get 2.2.3-xenial-amd64 from ~/1.25-agent-upgrade/2.2.3-xenial-amd64.tgz
+    return path.splitext(path.basename(tools_path))[0]
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def controller_digest():
+    "Identifies the controller details the configs are rendered with."
+    details = json.dumps([VERSION, CONTROLLER_TAG, CA_CERT, API_ADDRESSES])
+    return hashlib.sha256(details.encode()).hexdigest()
+
 def unpack_tools(source, dest_path):
     with tarfile.open(name=source, mode='r:gz') as contents:
-        for item in contents:
-            contents.extract(item, path=dest_path)
-            item_path = path.join(dest_path, item.name)
-            shutil.chown(item_path, 'root', 'root')
+        contents.extractall(path=dest_path)
+    for dir_path, dir_names, file_names in os.walk(dest_path):
+        for name in dir_names + file_names:
+            os.lchown(path.join(dir_path, name), 0, 0)
+
+def read_checksums():
+    "Returns the sha256 of each file upgrade-agents unpacked, or None."
+    sums_path = path.join(UPGRADE_DIR, 'SHA256SUMS')
+    if not path.exists(sums_path):
+        return None
+    sums = {}
+    with open(sums_path) as f:
+        for line in f:
+            digest, name = line.rstrip('\n').split(None, 1)
+            sums[name.lstrip('*')] = digest
+    return sums
+
+def find_unpacked_tools(tools_base, digest):
+    """Returns the checksums of the tools upgrade-agents already unpacked
+    beside the tools file, or None if there aren't any we can trust.
+    """
+    sums = read_checksums()
+    if sums is None or not path.isdir(path.join(UPGRADE_DIR, tools_base)):
+        return None
+    if sums.get(tools_base + '.tgz') != digest:
+        return None
+    prefix = tools_base + '/'
+    unpacked = dict((name, digest) for name, digest in sums.items() if name.startswith(prefix))
+    return unpacked or None
+
+def copy_tools(tools_base, sums, dest_path):
+    """Fills dest_path from the unpacked tools. Returns False if any file
+    doesn't match its recorded sha256. The files are copied rather than
+    linked, so taking ownership of them doesn't change the unpacked tree.
+    """
+    source = path.join(UPGRADE_DIR, tools_base)
+    for dir_path, dir_names, file_names in os.walk(source):
+        rel_dir = path.relpath(dir_path, source)
+        for name in dir_names + file_names:
+            rel_path = path.normpath(path.join(rel_dir, name))
+            src = path.join(dir_path, name)
+            dest = path.join(dest_path, rel_path)
+            if path.islink(src):
+                os.symlink(os.readlink(src), dest)
+            elif path.isdir(src):
+                os.mkdir(dest)
+            else:
+                shutil.copy2(src, dest)
+                if file_digest(dest) != sums.get(tools_base + '/' + rel_path):
+                    print('checksum mismatch for {}'.format(src))
+                    return False
+    for dir_path, dir_names, file_names in os.walk(dest_path):
+        for name in dir_names + file_names:
+            os.lchown(path.join(dir_path, name), 0, 0)
+    return True
+
+def verify_tools(dest_path, tools_base):
+    jujud = path.join(dest_path, 'jujud')
+    assert os.access(jujud, os.X_OK), 'no jujud found in {}'.format(dest_path)
+    version = subprocess.check_output([jujud, 'version']).decode().strip()
+    assert version == tools_base, 'new jujud reports version {}, expected {}'.format(version, tools_base)
 
 def write_tool_metadata(version, dest_path):
     with open(path.join(dest_path, 'downloaded-tools.txt'), 'w') as metadata:
         json.dump(dict(version=version, url="", size=0), metadata)
 
-def install_tools():
+def stage_tools(manifest):
     new_tools_path = find_new_tools()
-    # get 2.2.3-xenial-amd64 from ~/1.25-agent-upgrade/2.2.3-xenial-amd64.tgz
-    tools_base, _ = path.splitext(path.basename(new_tools_path))
-    dest_path = path.join(TOOLS_DIR, tools_base)
-    os.mkdir(dest_path)
-    unpack_tools(new_tools_path, dest_path)
-    write_tool_metadata(tools_base, dest_path)
-    # Make all the hook tools link to jujud.
-    make_links(dest_path, HOOK_TOOLS, path.join(dest_path, 'jujud'))
-    # Make all of the agent tools dirs link to the new version.
-    make_links(TOOLS_DIR, [convert_lxc_agent(a)[1] for a in all_agents()], dest_path)
+    tools_base = tools_name(new_tools_path)
+    digest = file_digest(new_tools_path)
+    staged_path = path.join(STAGING_TOOLS_DIR, tools_base)
+    if (manifest.get('tools') == tools_base and
+            manifest.get('tools_sha256') == digest and path.isdir(staged_path)):
+        return
+    if path.exists(STAGING_TOOLS_DIR):
+        shutil.rmtree(STAGING_TOOLS_DIR)
+    os.makedirs(staged_path)
+    # upgrade-agents unpacks the tools beside the tools file, and for
+    # containers copies them in from the host; use those if they check out.
+    unpacked = find_unpacked_tools(tools_base, digest)
+    if unpacked is None or not copy_tools(tools_base, unpacked, staged_path):
+        shutil.rmtree(staged_path)
+        os.makedirs(staged_path)
+        unpack_tools(new_tools_path, staged_path)
+    verify_tools(staged_path, tools_base)
+    write_tool_metadata(tools_base, staged_path)
+    # Make all the hook tools link to jujud where it will be installed.
+    make_links(staged_path, HOOK_TOOLS, path.join(TOOLS_DIR, tools_base, 'jujud'))
+    manifest['tools'] = tools_base
+    manifest['tools_sha256'] = digest
 
 def make_links(in_dir, names, target):
     for name in names:
         link_path = path.join(in_dir, name)
         force_symlink(target, link_path)
 
-def update_configs():
-    series = get_series()
-    need_init_reload = False
+def stage_configs(manifest, series):
+    for staging in (STAGING_AGENTS_DIR, STAGING_INIT_DIR):
+        if path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+    agents = {}
     for agent in all_agents():
-        lxc, lxd_agent = convert_lxc_agent(agent)
-        if lxc:
-            os.rename(path.join(AGENTS_DIR, agent), path.join(AGENTS_DIR, lxd_agent))
-            update_init_scripts(series, agent, lxd_agent)
-            need_init_reload = True
-            agent = lxd_agent
+        lxc, new_agent = convert_lxc_agent(agent)
+        agents[agent] = {
+            'new': new_agent,
+            'conf_sha256': file_digest(config_path(agent)),
+        }
         data = read_agent_config(agent)
-        if agent.startswith('machine-'):
-            data = update_machine_config(agent, data)
+        if new_agent.startswith('machine-'):
+            data = update_machine_config(new_agent, data)
         else:
-            data = update_unit_config(agent, data)
-        write_agent_config(agent, data)
+            data = update_unit_config(new_agent, data)
+        os.mkdir(path.join(STAGING_AGENTS_DIR, new_agent))
+        write_config_file(staged_config_path(new_agent), data)
+        if lxc:
+            stage_init_scripts(series, agent, new_agent)
+    manifest['agents'] = agents
+    manifest['series'] = series
+    manifest['controller'] = controller_digest()
+
+def read_manifest():
+    if not path.exists(MANIFEST):
+        return {}
+    with open(MANIFEST) as f:
+        return json.load(f)
+
+def write_manifest(manifest):
+    temp_path = MANIFEST + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(temp_path, MANIFEST)
+
+def is_prepared(manifest, series):
+    "Whether the staged files match the tools and the current agent configs."
+    if not manifest or manifest.get('series') != series:
+        return False
+    if manifest.get('controller') != controller_digest():
+        return False
+    new_tools_path = find_new_tools()
+    if manifest.get('tools') != tools_name(new_tools_path):
+        return False
+    if manifest.get('tools_sha256') != file_digest(new_tools_path):
+        return False
+    agents = manifest.get('agents', {})
+    if sorted(agents) != sorted(all_agents()):
+        return False
+    for agent, entry in agents.items():
+        if entry['conf_sha256'] != file_digest(config_path(agent)):
+            return False
+    return True
+
+def prepare():
+    assert not path.exists(ROLLBACK_DIR), 'saved rollback information found - aborting'
+    manifest = read_manifest()
+    # A prepare that fails part way must not leave a usable manifest.
+    if not path.isdir(STAGING_DIR):
+        os.makedirs(STAGING_DIR)
+    safe_unlink(MANIFEST)
+    stage_tools(manifest)
+    stage_configs(manifest, get_series())
+    write_manifest(manifest)
+
+def commit():
+    assert not path.exists(ROLLBACK_DIR), 'saved rollback information found - aborting'
+    series = get_series()
+    manifest = read_manifest()
+    if not is_prepared(manifest, series):
+        prepare()
+        manifest = read_manifest()
+    save_rollback_info()
+
+    tools_base = manifest['tools']
+    dest_path = path.join(TOOLS_DIR, tools_base)
+    os.rename(path.join(STAGING_TOOLS_DIR, tools_base), dest_path)
+    need_init_reload = False
+    for agent, entry in sorted(manifest['agents'].items()):
+        new_agent = entry['new']
+        # Make the agent tools dir link to the new version.
+        atomic_symlink(dest_path, path.join(TOOLS_DIR, new_agent))
+        if new_agent != agent:
+            os.rename(path.join(AGENTS_DIR, agent), path.join(AGENTS_DIR, new_agent))
+            install_init_scripts(series, agent, new_agent)
+            need_init_reload = True
+        os.rename(staged_config_path(new_agent), config_path(new_agent))
     if need_init_reload:
         reload_init(series)
+    shutil.rmtree(STAGING_DIR)
 
 def config_path(agent):
     return path.join(AGENTS_DIR, agent, 'agent.conf')
 
+def staged_config_path(agent):
+    return path.join(STAGING_AGENTS_DIR, agent, 'agent.conf')
+
 def read_agent_config(agent):
     with open(config_path(agent)) as f:
         data = yaml.load(f)
     return data
 
 def write_agent_config(agent, data):
-    with open(config_path(agent), 'w') as f:
+    write_config_file(config_path(agent), data)
+
+def write_config_file(file_path, data):
+    with open(file_path, 'w') as f:
         f.write('# format %s\n' % FILE_FORMAT)
         yaml.dump(data, stream=f, default_flow_style=False)
 
@@ -229,17 +407,22 @@ def update_unit_config(agent, data):
 
     return data
 
-def update_init_scripts(series, lxc_agent, lxd_agent):
+def stage_init_scripts(series, lxc_agent, lxd_agent):
     if series == 'trusty':
-        update_upstart_scripts(lxc_agent, lxd_agent)
+        rewrite_lxc_to_lxd(
+            path.join(UPSTART_DIR, upstart_conf(lxc_agent)),
+            path.join(STAGING_INIT_DIR, upstart_conf(lxd_agent)))
     else:
-        update_systemd_scripts(lxc_agent, lxd_agent)
+        stage_systemd_scripts(lxc_agent, lxd_agent)
 
-def update_upstart_scripts(lxc_agent, lxd_agent):
-    lxc_path = path.join(UPSTART_DIR, upstart_conf(lxc_agent))
-    lxd_path = path.join(UPSTART_DIR, upstart_conf(lxd_agent))
-    rewrite_lxc_to_lxd(lxc_path, lxd_path)
-    safe_unlink(lxc_path)
+def install_init_scripts(series, lxc_agent, lxd_agent):
+    if series == 'trusty':
+        shutil.move(
+            path.join(STAGING_INIT_DIR, upstart_conf(lxd_agent)),
+            path.join(UPSTART_DIR, upstart_conf(lxd_agent)))
+        safe_unlink(path.join(UPSTART_DIR, upstart_conf(lxc_agent)))
+    else:
+        install_systemd_scripts(lxc_agent, lxd_agent)
 
 def rewrite_lxc_to_lxd(lxc_path, lxd_path):
     "Copies contents of lxc_path file into lxd_path, converting lxc->lxd on the way"
@@ -249,34 +432,35 @@ def rewrite_lxc_to_lxd(lxc_path, lxd_path):
     with open(lxd_path, 'w') as dest:
         dest.write(updated)
 
-def update_systemd_scripts(lxc_agent, lxd_agent):
+def stage_systemd_scripts(lxc_agent, lxd_agent):
     lxc_dir = path.join(INIT_DIR, 'jujud-' + lxc_agent)
-    lxd_dir = path.join(INIT_DIR, 'jujud-' + lxd_agent)
+    staged_dir = path.join(STAGING_INIT_DIR, 'jujud-' + lxd_agent)
 
     # Create lxd versions of service file and exec-start script.
-    os.mkdir(lxd_dir)
-    lxd_service_path = path.join(lxd_dir, systemd_conf(lxd_agent))
+    os.mkdir(staged_dir)
     rewrite_lxc_to_lxd(
         path.join(lxc_dir, systemd_conf(lxc_agent)),
-        lxd_service_path)
-    lxd_exec_start = path.join(lxd_dir, 'exec-start.sh')
-    rewrite_lxc_to_lxd(path.join(lxc_dir, 'exec-start.sh'), lxd_exec_start)
-    os.chmod(lxd_exec_start, 0o755)
+        path.join(staged_dir, systemd_conf(lxd_agent)))
+    staged_exec_start = path.join(staged_dir, 'exec-start.sh')
+    rewrite_lxc_to_lxd(path.join(lxc_dir, 'exec-start.sh'), staged_exec_start)
+    os.chmod(staged_exec_start, 0o755)
 
+def install_systemd_scripts(lxc_agent, lxd_agent):
+    lxc_dir = path.join(INIT_DIR, 'jujud-' + lxc_agent)
+    lxd_dir = path.join(INIT_DIR, 'jujud-' + lxd_agent)
+    os.rename(path.join(STAGING_INIT_DIR, 'jujud-' + lxd_agent), lxd_dir)
     shutil.rmtree(lxc_dir)
 
     # Correct the link from /etc/systemd/system
     os.unlink(path.join(SYSTEMD_DIR, systemd_conf(lxc_agent)))
-    force_symlink(lxd_service_path, path.join(SYSTEMD_DIR, systemd_conf(lxd_agent)))
+    lxd_service_path = path.join(lxd_dir, systemd_conf(lxd_agent))
+    atomic_symlink(lxd_service_path, path.join(SYSTEMD_DIR, systemd_conf(lxd_agent)))
 
 def get_series():
     return subprocess.check_output(['/usr/bin/lsb_release', '-cs']).decode().strip()
 
 def main():
-    assert not path.exists(ROLLBACK_DIR), 'saved rollback information found - aborting'
-    save_rollback_info()
-    install_tools()
-    update_configs()
+    commit()
 
 def safe_unlink(location):
     # path.exists returns False for broken symlinks.
@@ -287,6 +471,13 @@ def force_symlink(target, dest):
     safe_unlink(dest)
     os.symlink(target, dest)
 
+def atomic_symlink(target, dest):
+    "Points dest at target, replacing any existing link in one rename."
+    temp_path = dest + '.tmp'
+    safe_unlink(temp_path)
+    os.symlink(target, temp_path)
+    os.rename(temp_path, dest)
+
 def upstart_conf(agent):
     return 'jujud-{}.conf'.format(agent)
 
@@ -330,6 +521,10 @@ def reload_init(series):
     subprocess.check_call(command)
 
 def rollback():
+    if not path.exists(ROLLBACK_DIR) and path.exists(STAGING_DIR):
+        # Only prepared: the agents were never changed.
+        shutil.rmtree(STAGING_DIR)
+        return
     assert path.exists(ROLLBACK_DIR), 'no rollback information found'
     series = get_series()
     need_init_reload = False
@@ -356,9 +551,11 @@ def rollback():
         backup_path = path.join(ROLLBACK_DIR, agent + '_agent.conf')
         shutil.copy(backup_path, agent_conf)
 
-    tools_base, _ = path.splitext(path.basename(find_new_tools()))
-    added_tools = path.join(TOOLS_DIR, tools_base)
-    shutil.rmtree(added_tools)
+    added_tools = path.join(TOOLS_DIR, tools_name(find_new_tools()))
+    if path.exists(added_tools):
+        shutil.rmtree(added_tools)
+    if path.exists(STAGING_DIR):
+        shutil.rmtree(STAGING_DIR)
     shutil.rmtree(ROLLBACK_DIR)
 
     if need_init_reload:
@@ -367,6 +564,10 @@ def rollback():
 if __name__ == "__main__":
     if len(sys.argv) == 2 and sys.argv[1] == "rollback":
         rollback()
+    elif len(sys.argv) == 2 and sys.argv[1] == "prepare":
+        prepare()
+    elif len(sys.argv) == 2 and sys.argv[1] == "commit":
+        commit()
     else:
         main()
     sys.exit(0)
@@ -7,12 +7,19 @@ package commands
 
 const LXCMigrationScript = `#!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
 import http.client
+import io
 import json
 import os
+import shutil
 import socket
 import subprocess
 import sys
+import threading
+import time
+import traceback
 
 try:
     import lxc
@@ -113,33 +120,193 @@ class UnixHTTPConnection(http.client.HTTPConnection):
         self.sock = sock
 
 
+# Stdout that collects the output of each thread separately while asked to,
+# so that concurrent conversions can be reported one container at a time.
+# Commands must be run with call() so that their output is collected too.
+class ThreadOutput(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, "buffer", None)
+        if buf is None:
+            return self.stream.write(data)
+        return buf.write(data)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def collect(self):
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+
+# Limit the number of rootfs copies reading or writing each block device
+class DeviceSlots(object):
+    def __init__(self, per_device):
+        self.per_device = per_device
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get_semaphore(self, device):
+        with self.lock:
+            if device not in self.semaphores:
+                self.semaphores[device] = threading.BoundedSemaphore(
+                    self.per_device)
+            return self.semaphores[device]
+
+    @contextlib.contextmanager
+    def hold(self, *paths):
+        # Devices are always taken in the same order to avoid deadlocks.
+        devices = sorted(set(os.stat(path).st_dev for path in paths
+                             if os.path.exists(path)))
+        semaphores = [self.get_semaphore(device) for device in devices]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+
+# One connection to LXD per thread, kept open between requests. A request
+# that fails on a connection LXD may have closed is only repeated when its
+# method is idempotent; others are always sent on a new connection.
+class LXDSession(object):
+    idempotent_methods = ("GET", "HEAD", "PUT", "DELETE")
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _request(self, connection, method, url, body):
+        connection.request(method, url, body)
+        r = connection.getresponse()
+        return r.status, r.read()
+
+    def request(self, method, url, body=None):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and method in self.idempotent_methods:
+            try:
+                return self._request(connection, method, url, body)
+            except (http.client.HTTPException, OSError):
+                # LXD may have closed the idle connection; reconnect.
+                connection.close()
+
+        elif connection is not None:
+            connection.close()
+
+        connection = UnixHTTPConnection(self.path)
+        self.local.connection = connection
+        try:
+            return self._request(connection, method, url, body)
+        except Exception:
+            self.local.connection = None
+            connection.close()
+            raise
+
+    def request_json(self, method, url, body=None):
+        status, data = self.request(method, url, body)
+        return json.loads(data.decode())
+
+    def container_exists(self, container_name):
+        status, data = self.request("GET",
+                                    "/1.0/containers/%s" % container_name)
+        return status != 404
+
+    # Start defining the container, returning the operation URL
+    def container_create(self, args):
+        resp = self.request_json("POST", "/1.0/containers", json.dumps(args))
+        if resp["type"] == "error":
+            raise Exception("Failed to define container: %s" % resp["error"])
+
+        return resp["operation"]
+
+    # Wait for an operation, polling with the given timeout so that a slow
+    # operation is never waited on without limit by one request.
+    def operation_wait(self, operation, timeout=30):
+        while True:
+            resp = self.request_json(
+                "GET", "%s/wait?timeout=%d" % (operation, timeout))
+            if resp["type"] == "error":
+                raise Exception("Operation failed: %s" % resp["error"])
+
+            metadata = resp.get("metadata") or {}
+            status_code = metadata.get("status_code", 200)
+            if status_code == 200:
+                return metadata
+
+            if status_code >= 400:
+                raise Exception("Operation failed: %s" %
+                                metadata.get("err", metadata.get("status")))
+
+
+# A parsed LXC configuration, indexed by key
+class LXCConfig(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.index = {}
+        for line in lines:
+            fields = line.split("=", 1)
+            self.index.setdefault(fields[0].strip(), []).append(
+                fields[-1].strip())
+
+    def get(self, key, default=None):
+        values = self.index.get(key)
+        if not values:
+            return default
+
+        return list(values)
+
+    def keys(self):
+        return [key for key in self.index
+                if key and not key.startswith("#") and key.startswith("lxc.")]
+
+
 # Fetch a config key as a list
 def config_get(config, key, default=None):
-    result = []
-    for line in config:
-        fields = line.split("=", 1)
-        if fields[0].strip() == key:
-            result.append(fields[-1].strip())
-
-    if len(result) == 0:
-        return default
-    else:
-        return result
+    return config.get(key, default)
 
 
 def config_keys(config):
-    keys = []
-    for line in config:
-        fields = line.split("=", 1)
-        cur = fields[0].strip()
-        if cur and not cur.startswith("#") and cur.startswith("lxc."):
-            keys.append(cur)
+    return config.keys()
+
 
-    return keys
+# Parsed include files, shared by the containers that include them
+include_cache = {}
+include_cache_lock = threading.Lock()
 
 
-# Parse a LXC configuration file, called recursively for includes
+def config_parse_include(path):
+    mtime = os.stat(path).st_mtime
+    with include_cache_lock:
+        cached = include_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    config = config_parse_lines(path)
+    with include_cache_lock:
+        include_cache[path] = (mtime, config)
+    return config
+
+
+# Parse a LXC configuration file
 def config_parse(path):
+    return LXCConfig(config_parse_lines(path))
+
+
+# Parse the lines of a LXC configuration file, including its includes
+def config_parse_lines(path):
     config = []
     with open(path, "r") as fd:
         for line in fd:
@@ -154,14 +321,15 @@ def config_parse(path):
                     continue
 
                 if os.path.isfile(value):
-                    config += config_parse(value)
+                    config += config_parse_include(value)
                     continue
                 elif os.path.isdir(value):
                     for entry in os.listdir(value):
                         if not entry.endswith(".conf"):
                             continue
 
-                        config += config_parse(os.path.join(value, entry))
+                        config += config_parse_include(
+                            os.path.join(value, entry))
                     continue
                 else:
                     print("Invalid include: %s", line)
@@ -187,39 +355,8 @@ def config_parse(path):
     return config
 
 
-def container_exists(lxd_socket, container_name):
-    lxd = UnixHTTPConnection(lxd_socket)
-    lxd.request("GET", "/1.0/containers/%s" % container_name)
-    if lxd.getresponse().status == 404:
-        return False
-
-    return True
-
-
-def container_create(lxd_socket, args):
-    # Define the container
-    lxd = UnixHTTPConnection(lxd_socket)
-    lxd.request("POST", "/1.0/containers", json.dumps(args))
-    r = lxd.getresponse()
-
-    # Decode the response
-    resp = json.loads(r.read().decode())
-    if resp["type"] == "error":
-        raise Exception("Failed to define container: %s" % resp["error"])
-
-    # Wait for result
-    lxd = UnixHTTPConnection(lxd_socket)
-    lxd.request("GET", "%s/wait" % resp["operation"])
-    r = lxd.getresponse()
-
-    # Decode the response
-    resp = json.loads(r.read().decode())
-    if resp["type"] == "error":
-        raise Exception("Failed to define container: %s" % resp["error"])
-
-
 # Convert a LXC container to a LXD one
-def convert_container(lxd_socket, container_name, args):
+def convert_container(lxd, container_name, args):
     print("==> Processing container: %s" % container_name)
 
     # Load the container
@@ -247,7 +384,7 @@ def convert_container(lxd_socket, container_name, args):
     if args.debug:
         print("Container configuration:")
         print(" ", end="")
-        print("\n ".join(lxc_config))
+        print("\n ".join(lxc_config.lines))
         print("")
 
     # Check for keys that have values differing from the LXD defaults.
@@ -258,7 +395,7 @@ def convert_container(lxd_socket, container_name, args):
 
     # Make sure we don't have a conflict
     print("Checking for existing containers")
-    if container_exists(lxd_socket, container_name):
+    if lxd.container_exists(container_name):
         print("Container already exists, skipping...")
         return False
 
@@ -535,13 +672,13 @@ def convert_container(lxd_socket, container_name, args):
     if args.dry_run:
         return True
 
-    if container.running:
+    if container.running and not args.live:
         print("Only stopped containers can be migrated, skipping...")
         return False
 
     try:
         print("Creating the container")
-        container_create(lxd_socket, new)
+        lxd.operation_wait(lxd.container_create(new))
     except Exception as e:
         raise
         print("Failed to create the container: %s" % e)
@@ -551,24 +688,8 @@ def convert_container(lxd_socket, container_name, args):
     lxd_rootfs = os.path.join(args.lxdpath, "containers",
                               container_name, "rootfs")
 
-    if args.move_rootfs:
-        if os.path.exists(lxd_rootfs):
-            os.rmdir(lxd_rootfs)
-
-        if subprocess.call(["mv", rootfs, lxd_rootfs]) != 0:
-            print("Failed to move the container rootfs, skipping...")
-            return False
-
-        os.mkdir(rootfs)
-    else:
-        print("Copying container rootfs")
-        if not os.path.exists(lxd_rootfs):
-            os.mkdir(lxd_rootfs)
-
-        if subprocess.call(["rsync", "-Aa", "--sparse",
-                            "--acls", "--numeric-ids", "--hard-links",
-                            "%s/" % rootfs, "%s/" % lxd_rootfs]) != 0:
-            print("Failed to transfer the container rootfs, skipping...")
+    with copy_slots.hold(rootfs, os.path.dirname(lxd_rootfs)):
+        if not transfer_rootfs(container, rootfs, lxd_rootfs, args):
             return False
 
     # Delete the source
@@ -583,6 +704,181 @@ def convert_container(lxd_socket, container_name, args):
     return True
 
 
+# Run a command, writing its output to sys.stdout rather than the
+# process' stdout so that it is collected with the rest of the
+# container's output. Returns the exit code.
+def call(cmd):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if output:
+        sys.stdout.write(output.decode("utf-8", "replace"))
+    return proc.returncode
+
+
+# Copy rootfs into lxd_rootfs. Changes to files that rsync has already
+# sent are picked up by a later call; delete removes files that have gone.
+def rsync_rootfs(rootfs, lxd_rootfs, delete=False, live=False):
+    cmd = ["rsync", "-Aa", "--sparse", "--acls", "--numeric-ids",
+           "--hard-links"]
+    if delete:
+        cmd.append("--delete")
+    cmd += ["%s/" % rootfs, "%s/" % lxd_rootfs]
+    rc = call(cmd)
+    # Files vanishing under a running container are sent by the next pass.
+    return rc == 0 or (live and rc == 24)
+
+
+# Stop the source container, returning the time it stopped or None
+def stop_container(container):
+    if not container.running:
+        return time.time()
+
+    print("Stopping the source container")
+    if not container.stop():
+        print("Failed to stop the container, skipping...")
+        return None
+
+    return time.time()
+
+
+# Move or copy the rootfs into LXD. Running containers (with --live) are
+# copied while they run and only stopped for a final pass that sends what
+# changed meanwhile; they are restarted if the transfer fails, unless their
+# rootfs was already being moved away.
+def transfer_rootfs(container, rootfs, lxd_rootfs, args):
+    was_running = container.running
+    same_device = (os.stat(rootfs).st_dev ==
+                   os.stat(os.path.dirname(lxd_rootfs)).st_dev)
+    stopped = None
+    rootfs_intact = True
+    try:
+        # A rename takes no time, so there is nothing to copy ahead of it.
+        if args.move_rootfs and same_device:
+            stopped = stop_container(container)
+            if stopped is None:
+                return False
+
+            if os.path.exists(lxd_rootfs):
+                os.rmdir(lxd_rootfs)
+
+            os.rename(rootfs, lxd_rootfs)
+            rootfs_intact = False
+            os.mkdir(rootfs)
+            stopped = None
+            return True
+
+        if not os.path.exists(lxd_rootfs):
+            os.mkdir(lxd_rootfs)
+
+        precopied = False
+        if was_running:
+            for i in range(args.precopy_passes):
+                print("Pre-copying running container rootfs (pass %d)" %
+                      (i + 1))
+                if not rsync_rootfs(rootfs, lxd_rootfs, delete=precopied,
+                                    live=True):
+                    print("Failed to transfer the container rootfs, "
+                          "skipping...")
+                    return False
+
+                precopied = True
+
+        stopped = stop_container(container)
+        if stopped is None:
+            return False
+
+        copied = False
+        if args.reflink and same_device and not precopied:
+            print("Cloning container rootfs")
+            copied = call(
+                ["cp", "-a", "--reflink=always", "%s/." % rootfs,
+                 lxd_rootfs]) == 0
+            if not copied:
+                print("Couldn't clone the rootfs, copying it instead")
+
+        if not copied:
+            if precopied:
+                print("Sending final container rootfs changes")
+            else:
+                print("Copying container rootfs")
+
+            if not rsync_rootfs(rootfs, lxd_rootfs, delete=True):
+                print("Failed to transfer the container rootfs, skipping...")
+                return False
+
+        if args.move_rootfs:
+            rootfs_intact = False
+            shutil.rmtree(rootfs)
+            os.mkdir(rootfs)
+
+        stopped_seconds = time.time() - stopped
+        stopped = None
+        if was_running:
+            print("Container was stopped for %.1fs" % stopped_seconds)
+        return True
+    finally:
+        if stopped is not None and was_running and not container.running:
+            if rootfs_intact:
+                print("Restarting the source container")
+                container.start()
+            else:
+                print("The source container rootfs was partly removed, "
+                      "leaving the container stopped")
+
+
+# Convert a container, reporting any error as a failure of that container
+# alone. Returns the result and the seconds taken.
+def convert_one(lxd, container_name, args):
+    start = time.time()
+    try:
+        result = convert_container(lxd, container_name, args)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        result = False
+
+    return result, time.time() - start
+
+
+# Convert the containers using up to args.parallel workers. The output of
+# each container is printed in one block once it is done.
+def convert_containers(lxd, container_names, args):
+    results = {}
+    if args.parallel == 1:
+        for count, container_name in enumerate(container_names):
+            if count > 0:
+                print("")
+
+            results[container_name] = convert_one(lxd, container_name,
+                                                  args)
+        return results
+
+    output = ThreadOutput(sys.stdout)
+    output_lock = threading.Lock()
+    sys.stdout = output
+
+    def convert_collected(container_name):
+        with output.collect() as buf:
+            result = convert_one(lxd, container_name, args)
+
+        with output_lock:
+            if results:
+                output.stream.write("\n")
+            output.stream.write(buf.getvalue())
+            output.stream.flush()
+            results[container_name] = result
+        return result
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.parallel) as executor:
+            list(executor.map(convert_collected, container_names))
+    finally:
+        sys.stdout = output.stream
+
+    return results
+
+
 # Argument parsing
 parser = argparse.ArgumentParser()
 parser.add_argument("--dry-run", action="store_true", default=False,
@@ -599,6 +895,19 @@ parser.add_argument("--lxcpath", type=str, default=False,
                     help="Alternate LXC path")
 parser.add_argument("--lxdpath", type=str, default="/var/lib/lxd",
                     help="Alternate LXD path")
+parser.add_argument("--live", action="store_true", default=False,
+                    help="Copy the rootfs of running containers and only "
+                         "stop them to send the final changes")
+parser.add_argument("--precopy-passes", type=int, default=2,
+                    help="Number of copies made before stopping a running "
+                         "container")
+parser.add_argument("--reflink", action="store_true", default=False,
+                    help="Clone the rootfs with reflinks when LXD is on the "
+                         "same filesystem")
+parser.add_argument("--parallel", type=int, default=1,
+                    help="Number of containers to convert at once")
+parser.add_argument("--copies-per-device", type=int, default=1,
+                    help="Number of rootfs copies at once on each device")
 parser.add_argument(dest='containers', metavar="CONTAINER", type=str,
                     help="Container to import", nargs="*")
 args = parser.parse_args()
@@ -610,6 +919,12 @@ if not os.geteuid() == 0:
 if (not args.containers and not args.all) or (args.containers and args.all):
     parser.error("You must either pass container names or --all")
 
+if args.parallel < 1 or args.copies_per_device < 1:
+    parser.error("--parallel and --copies-per-device must be at least 1")
+
+if args.precopy_passes < 0:
+    parser.error("--precopy-passes must not be negative")
+
 # Connect to LXD
 lxd_socket = os.path.join(args.lxdpath, "unix.socket")
 
@@ -618,18 +933,12 @@ if not os.path.exists(lxd_socket):
     sys.exit(1)
 
 # Run migration
-results = {}
-count = 0
-for container_name in lxc.list_containers(config_path=args.lxcpath):
-    if args.containers and container_name not in args.containers:
-        continue
-
-    if count > 0:
-        print("")
-
-    results[container_name] = convert_container(lxd_socket,
-                                                container_name, args)
-    count += 1
+copy_slots = DeviceSlots(args.copies_per_device)
+container_names = [
+    name for name in lxc.list_containers(config_path=args.lxcpath)
+    if not args.containers or name in args.containers]
+results = convert_containers(LXDSession(lxd_socket), container_names,
+                             args)
 
 # Print summary
 if not results:
@@ -638,12 +947,13 @@ if not results:
 
 print("")
 print("==> Migration summary")
-for name, result in results.items():
+for name in sorted(results):
+    result, seconds = results[name]
     if result:
-        print("%s: SUCCESS" % name)
+        print("%s: SUCCESS (%.1fs)" % (name, seconds))
     else:
-        print("%s: FAILURE" % name)
+        print("%s: FAILURE (%.1fs)" % (name, seconds))
 
-if False in results.values():
+if not all(result for result, seconds in results.values()):
     sys.exit(1)
 `
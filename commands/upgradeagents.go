@@ -9,10 +9,12 @@ import (
 	"fmt"
 	"os"
 	"path"
+	"strings"
 	"text/template"
 
 	"github.com/juju/cmd"
 	"github.com/juju/errors"
+	"github.com/juju/gnuflag"
 	"github.com/juju/utils/set"
 	"github.com/juju/utils/ssh"
 	"github.com/juju/version"
@@ -32,6 +34,16 @@ This command updates the tools symlinks for the agents, and updates their
 agent config files to specify the correct version, along with the CA Cert and
 addresses of the controller.
 
+If --prepare is specified, the new tools, agent config files and init files
+are only staged on each machine, without changing the agents, so this can be
+done before the agents are stopped. A later upgrade-agents then only moves the
+staged files into place.
+
+The new tools are copied to each host machine once for itself and its
+containers, and copied into the containers on the host's disk, so only
+containers whose hosts aren't being upgraded receive the tools over the
+network.
+
 `
 
 func newUpgradeAgentsCommand() cmd.Command {
@@ -45,6 +57,7 @@ func newUpgradeAgentsCommand() cmd.Command {
 
 type upgradeAgentsCommand struct {
 	baseClientCommand
+	prepare bool
 }
 
 func (c *upgradeAgentsCommand) Info() *cmd.Info {
@@ -56,6 +69,11 @@ func (c *upgradeAgentsCommand) Info() *cmd.Info {
 	}
 }
 
+func (c *upgradeAgentsCommand) SetFlags(f *gnuflag.FlagSet) {
+	c.baseClientCommand.SetFlags(f)
+	f.BoolVar(&c.prepare, "prepare", false, "only stage the upgrade on the machines, leaving the agents unchanged")
+}
+
 func (c *upgradeAgentsCommand) Init(args []string) error {
 	args, err := c.baseClientCommand.init(args)
 	if err != nil {
@@ -64,6 +82,13 @@ func (c *upgradeAgentsCommand) Init(args []string) error {
 	return cmd.CheckEmpty(args)
 }
 
+func (c *upgradeAgentsCommand) Run(ctx *cmd.Context) error {
+	if c.prepare {
+		c.extraOptions = append(c.extraOptions, "--prepare")
+	}
+	return c.baseClientCommand.Run(ctx)
+}
+
 var upgradeAgentsImplDoc = `
 
 upgrade-agents-impl must be executed on an API server machine of a 1.25
@@ -82,6 +107,12 @@ func newUpgradeAgentsImplCommand() cmd.Command {
 
 type upgradeAgentsImplCommand struct {
 	baseRemoteCommand
+	prepare bool
+}
+
+func (c *upgradeAgentsImplCommand) SetFlags(f *gnuflag.FlagSet) {
+	c.baseRemoteCommand.SetFlags(f)
+	f.BoolVar(&c.prepare, "prepare", false, "only stage the upgrade on the machines, leaving the agents unchanged")
 }
 
 func (c *upgradeAgentsImplCommand) Init(args []string) error {
@@ -161,14 +192,23 @@ func (c *upgradeAgentsImplCommand) Run(ctx *cmd.Context) error {
 		return errors.Trace(err)
 	}
 
+	script := "apt-get install --yes python3 python3-yaml; python3 ~/1.25-agent-upgrade/agent-upgrade.py"
+	operation := "upgrade"
+	if c.prepare {
+		script += " prepare"
+		operation = "prepare"
+	}
 	targets := flatMachineExecTargets(machines...)
-	results, err := parallelExec(targets, "apt-get install --yes python3 python3-yaml; python3 ~/1.25-agent-upgrade/agent-upgrade.py")
+	results, err := parallelExec(targets, script)
 	if err != nil {
 		return errors.Trace(err)
 	}
-	if err := reportResults(ctx, "upgrade", machines, results); err != nil {
+	if err := reportResults(ctx, operation, machines, results); err != nil {
 		return errors.Trace(err)
 	}
+	if c.prepare {
+		return nil
+	}
 
 	results, err = parallelExec(targets, connectionCheckScript)
 	if err != nil {
@@ -192,32 +232,123 @@ func (c *upgradeAgentsImplCommand) saveMachines(machines []FlatMachine) error {
 		bytes.NewBuffer(fileData)))
 }
 
+// pushTools copies the tools and upgrade script to every machine. Each
+// host receives the tools for itself and for its containers once; the
+// containers then get them from the host's disk rather than over the
+// network.
 func (c *upgradeAgentsImplCommand) pushTools(ctx *cmd.Context, ver version.Number, scriptPath string, machines []FlatMachine) error {
+	hosts := set.NewStrings()
+	for _, machine := range machines {
+		if machine.HostAddress == "" {
+			hosts.Add(machine.Address)
+		}
+	}
+	var direct, local []FlatMachine
+	containerTools := make(map[string]set.Strings)
+	for _, machine := range machines {
+		if machine.HostAddress == "" || !hosts.Contains(machine.HostAddress) {
+			direct = append(direct, machine)
+			continue
+		}
+		local = append(local, machine)
+		if containerTools[machine.HostAddress] == nil {
+			containerTools[machine.HostAddress] = set.NewStrings()
+		}
+		containerTools[machine.HostAddress].Add(seriesArch(machine))
+	}
+
 	var group errgroup.Group
-	for i := range machines {
-		machine := machines[i]
+	for i := range direct {
+		machine := direct[i]
 		group.Go(func() error {
 			return errors.Annotatef(
 				c.pushToolsToMachine(ctx, ver, scriptPath, machine),
 				"machine %s", machine.ID)
 		})
 	}
+	for hostAddress, toolsNeeded := range containerTools {
+		for _, seriesArch := range toolsNeeded.SortedValues() {
+			hostAddress, seriesArch := hostAddress, seriesArch
+			group.Go(func() error {
+				logger.Debugf("copying %s tools for containers to host %s", seriesArch, hostAddress)
+				return errors.Annotatef(
+					pushUpgradeFiles(
+						hostAddress, "", containerToolsDir(seriesArch),
+						toolsFilePath(ver, seriesArch), scriptPath),
+					"container tools on host %s", hostAddress)
+			})
+		}
+	}
 	logger.Debugf("waiting for copies to finish")
-	return group.Wait()
+	if err := group.Wait(); err != nil {
+		return errors.Trace(err)
+	}
+
+	var localGroup errgroup.Group
+	for i := range local {
+		machine := local[i]
+		localGroup.Go(func() error {
+			copied, err := copyToolsFromHost(ver, machine)
+			if err != nil {
+				return errors.Annotatef(err, "machine %s", machine.ID)
+			}
+			if copied {
+				return nil
+			}
+			logger.Debugf("container %s not found on its host, copying tools directly", machine.ID)
+			return errors.Annotatef(
+				c.pushToolsToMachine(ctx, ver, scriptPath, machine),
+				"machine %s", machine.ID)
+		})
+	}
+	logger.Debugf("waiting for container copies to finish")
+	return localGroup.Wait()
 }
 
 func (c *upgradeAgentsImplCommand) pushToolsToMachine(ctx *cmd.Context, ver version.Number, scriptPath string, machine FlatMachine) error {
+	return pushUpgradeFiles(
+		machine.Address, machine.HostAddress, "1.25-agent-upgrade",
+		toolsFilePath(ver, seriesArch(machine)), scriptPath)
+}
+
+// containerToolsDir is the directory on a host, relative to the ubuntu
+// user's home, holding the upgrade files for its containers with the given
+// series and architecture.
+func containerToolsDir(seriesArch string) string {
+	return path.Join("1.25-agent-upgrade-containers", seriesArch)
+}
+
+// unpackToolsScript unpacks the tools beside the upgrade script and
+// records checksums of everything there, so that agent-upgrade.py can use
+// the unpacked tools and copies of the directory can be verified.
+const unpackToolsScript = `
+set -e
+cd %[1]s
+rm -rf %[2]s SHA256SUMS
+mkdir %[2]s
+tar -C %[2]s -xzf %[2]s.tgz
+find %[2]s.tgz agent-upgrade.py %[2]s -type f -print0 | xargs -0 sha256sum > SHA256SUMS
+chown -R ubuntu:ubuntu .
+`
+
+// pushUpgradeFiles copies the tools and upgrade script into dir (relative
+// to the ubuntu user's home) on the machine at address, proxying through
+// hostAddress if it is set, and unpacks the tools there.
+func pushUpgradeFiles(address, hostAddress, dir, toolsPath, scriptPath string) error {
 	sshOptions := []execOption{withSystemIdentity()}
-	throttleAddress := machine.Address
-	if machine.HostAddress != "" {
-		throttleAddress = machine.HostAddress
-		sshOptions = append(sshOptions, withProxyCommandForHost(machine.HostAddress))
+	throttleAddress := address
+	if hostAddress != "" {
+		throttleAddress = hostAddress
+		sshOptions = append(sshOptions, withProxyCommandForHost(hostAddress))
 	}
 
-	logger.Debugf("making target dir for machine %s", machine.ID)
+	logger.Debugf("making target dir %s on %s", dir, address)
+	// Other series may be pushed into topDir at the same time, so only
+	// dir itself is changed recursively.
+	topDir := strings.SplitN(dir, "/", 2)[0]
 	rc, err := runViaSSH(
-		machine.Address,
-		"rm -rf 1.25-agent-upgrade; mkdir 1.25-agent-upgrade; chown ubuntu:ubuntu 1.25-agent-upgrade",
+		address,
+		fmt.Sprintf("mkdir -p %[2]s; chown ubuntu:ubuntu %[2]s; rm -rf %[1]s; mkdir -p %[1]s; chown -R ubuntu:ubuntu %[1]s", dir, topDir),
 		sshOptions...,
 	)
 	if err != nil {
@@ -226,25 +357,91 @@ func (c *upgradeAgentsImplCommand) pushToolsToMachine(ctx *cmd.Context, ver vers
 	if rc != 0 {
 		return &cmd.RcPassthroughError{Code: rc}
 	}
-	toolsPath := toolsFilePath(ver, seriesArch(machine))
 	options := defaultSSHOptions()
 	options.SetIdentities(systemIdentity)
-	if machine.HostAddress != "" {
-		options.SetProxyCommand(makeProxyCommand(machine.HostAddress)...)
+	if hostAddress != "" {
+		options.SetProxyCommand(makeProxyCommand(hostAddress)...)
 	}
-	logger.Debugf("copying upgrade script and %s to machine %s", toolsPath, machine.ID)
-	args := []string{toolsPath, scriptPath, fmt.Sprintf("ubuntu@%s:~/1.25-agent-upgrade/", machine.Address)}
+	logger.Debugf("copying upgrade script and %s to %s", toolsPath, address)
+	args := []string{toolsPath, scriptPath, fmt.Sprintf("ubuntu@%s:~/%s/", address, dir)}
 
 	throttler.Acquire(throttleAddress)
-	defer throttler.Release(throttleAddress)
-
 	err = ssh.Copy(args, &options)
+	throttler.Release(throttleAddress)
 	if err != nil {
 		return errors.Trace(err)
 	}
+
+	toolsName := strings.TrimSuffix(path.Base(toolsPath), ".tgz")
+	rc, err = runViaSSH(
+		address,
+		fmt.Sprintf(unpackToolsScript, dir, toolsName),
+		sshOptions...,
+	)
+	if err != nil {
+		return errors.Trace(err)
+	}
+	if rc != 0 {
+		return &cmd.RcPassthroughError{Code: rc}
+	}
 	return nil
 }
 
+// containerToolsScript runs on a host to give one of its containers the
+// upgrade files the host already holds. The container's rootfs is found by
+// its agent directory, and the files are copied into it and verified. They
+// are copied rather than hard linked so that changing their ownership in
+// one container doesn't affect the host or other containers. It exits with
+// containerNotFound if the container's rootfs isn't found.
+const containerToolsScript = `
+set -e
+src=/home/ubuntu/%[1]s
+rootfs=
+for candidate in /var/lib/lxd/containers/*/rootfs /var/lib/lxc/*/rootfs; do
+    if [ -d "$candidate/var/lib/juju/agents/%[2]s" -o -d "$candidate/var/lib/juju/agents/%[3]s" ]; then
+        rootfs=$candidate
+        break
+    fi
+done
+if [ -z "$rootfs" ]; then
+    exit %[4]d
+fi
+home="$rootfs/home/ubuntu"
+dest="$home/1.25-agent-upgrade"
+rm -rf "$dest"
+mkdir -p "$dest"
+cp -a "$src/." "$dest/"
+(cd "$dest" && sha256sum --quiet --strict -c SHA256SUMS)
+chown -R --reference="$home" "$dest"
+`
+
+const containerNotFound = 3
+
+// copyToolsFromHost copies the upgrade files for a container from its host's
+// disk. It returns false if the container couldn't be found on the host.
+func copyToolsFromHost(ver version.Number, machine FlatMachine) (bool, error) {
+	agent := "machine-" + strings.Replace(machine.ID, "/", "-", -1)
+	lxcAgent := strings.Replace(agent, "-lxd-", "-lxc-", -1)
+	lxdAgent := strings.Replace(agent, "-lxc-", "-lxd-", -1)
+	script := fmt.Sprintf(
+		containerToolsScript,
+		containerToolsDir(seriesArch(machine)), lxcAgent, lxdAgent, containerNotFound)
+
+	logger.Debugf("copying upgrade files on host %s for container %s", machine.HostAddress, machine.ID)
+	// runViaSSH throttles on the host.
+	rc, err := runViaSSH(machine.HostAddress, script, withSystemIdentity())
+	if err != nil {
+		return false, errors.Trace(err)
+	}
+	if rc == containerNotFound {
+		return false, nil
+	}
+	if rc != 0 {
+		return false, &cmd.RcPassthroughError{Code: rc}
+	}
+	return true, nil
+}
+
 func (c *upgradeAgentsImplCommand) writeUpgradeScript(config *scriptConfig) (string, error) {
 	tmpl, err := template.New("upgrade-script").Parse(agentUpgradeScript)
 	if err != nil {
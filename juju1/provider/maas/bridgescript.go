@@ -26,6 +26,7 @@ import re
 import shutil
 import subprocess
 import sys
+import time
 
 # These options are to be removed from a sub-interface and applied to
 # the new bridged interface.
@@ -329,6 +330,161 @@ def print_stanzas(stanzas, stream=sys.stdout):
             print(file=stream)
 
 
+def interface_stanzas(stanzas):
+    """Returns a dict of each logical interface's name to the tuple of
+    (has_auto_stanza, stanzas) describing it, where stanzas holds the
+    (definition, options) of each of its families in file order."""
+    auto = set(s.phy.name for s in stanzas if s.is_physical_interface)
+    result = {}
+    for s in stanzas:
+        if s.is_logical_interface:
+            name = s.iface.name
+            _, families = result.get(name, (None, ()))
+            result[name] = (name in auto, families + ((s.definition, tuple(s.options)),))
+    return result
+
+
+def interface_dependencies(stanzas):
+    """Returns a dict of each interface name to the names of the interfaces
+    that go down with it: its VLANs, aliases, bond slaves and the bridges
+    it is a port of."""
+    dependents = {}
+    for s in stanzas:
+        if not s.is_logical_interface:
+            continue
+        name = s.iface.name
+        if s.iface.is_alias:
+            dependents.setdefault(name.split(':')[0], set()).add(name)
+        for o in s.options:
+            words = o.split()
+            if words[0] in ('vlan-raw-device', 'bond-master'):
+                if len(words) > 1:
+                    dependents.setdefault(words[1], set()).add(name)
+            elif words[0] == 'bridge_ports':
+                for port in words[1:]:
+                    dependents.setdefault(port, set()).add(name)
+    return dependents
+
+
+def interface_prerequisites(stanzas):
+    """Returns a dict of each interface name to the names of the interfaces
+    that must be up before it: an alias's parent, a VLAN's raw device, a
+    bond's slaves and a bridge's ports."""
+    prerequisites = {}
+    for s in stanzas:
+        if not s.is_logical_interface:
+            continue
+        name = s.iface.name
+        if s.iface.is_alias:
+            prerequisites.setdefault(name, set()).add(name.split(':')[0])
+        for o in s.options:
+            words = o.split()
+            if words[0] == 'vlan-raw-device':
+                prerequisites.setdefault(name, set()).update(words[1:2])
+            elif words[0] == 'bond-master':
+                if len(words) > 1:
+                    prerequisites.setdefault(words[1], set()).add(name)
+            elif words[0] == 'bridge_ports':
+                prerequisites.setdefault(name, set()).update(words[1:])
+    return prerequisites
+
+
+def dependency_order(names, prerequisites):
+    """Returns names ordered so that each interface comes after its
+    prerequisites, otherwise keeping the order of names."""
+    position = dict((name, i) for i, name in enumerate(names))
+    ordered = []
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        for required in sorted(prerequisites.get(name, ()), key=lambda n: (position.get(n, len(names)), n)):
+            visit(required)
+        if name in position:
+            ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def changed_interfaces(old_stanzas, new_stanzas):
+    """Returns the set of interface names that need to be cycled to move
+    from old_stanzas to new_stanzas: those whose stanzas differ and every
+    interface that depends on one of them."""
+    old = interface_stanzas(old_stanzas)
+    new = interface_stanzas(new_stanzas)
+    changed = set(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+    dependents = interface_dependencies(old_stanzas)
+    for name, names in interface_dependencies(new_stanzas).items():
+        dependents.setdefault(name, set()).update(names)
+    pending = list(changed)
+    while pending:
+        for name in dependents.get(pending.pop(), ()):
+            if name not in changed:
+                changed.add(name)
+                pending.append(name)
+    return changed
+
+
+def auto_interfaces(stanzas):
+    """Returns the names with 'auto' stanzas, in file order, excluding lo."""
+    names = []
+    for s in stanzas:
+        if s.is_physical_interface and s.phy.name != 'lo' and s.phy.name not in names:
+            names.append(s.phy.name)
+    return names
+
+
+def bonded_interfaces(stanzas, names):
+    """Returns the bonds among names, and their slaves."""
+    bonds = set(s.iface.name for s in stanzas if s.is_logical_interface and s.iface.is_bonded and s.iface.name in names)
+    for s in stanzas:
+        if not s.is_logical_interface:
+            continue
+        for o in s.options:
+            words = o.split()
+            if words[0] == 'bond-master' and len(words) > 1 and words[1] in bonds:
+                bonds.add(s.iface.name)
+    return bonds
+
+
+def read_link_state(sysfs_dir, name, attribute):
+    """Returns the contents of /sys/class/net/<name>/<attribute>, or None
+    if it can't be read (e.g. the interface doesn't exist or is down)."""
+    try:
+        with open(os.path.join(sysfs_dir, name, attribute)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def wait_for_links(names, ready, sysfs_dir, timeout, interval=0.1, clock=time.time, sleep=time.sleep):
+    """Polls until ready(sysfs_dir, name) holds for every name, or timeout
+    seconds have passed. Returns the names that never became ready."""
+    deadline = clock() + timeout
+    pending = sorted(names)
+    while True:
+        pending = [name for name in pending if not ready(sysfs_dir, name)]
+        if not pending or clock() >= deadline:
+            return pending
+        sleep(interval)
+
+
+def link_is_down(sysfs_dir, name):
+    return read_link_state(sysfs_dir, name, 'operstate') in (None, 'down', 'notpresent')
+
+
+def link_has_carrier(sysfs_dir, name):
+    # Interfaces that don't exist yet (e.g. bridges whose ports have no
+    # link) can't be waited for.
+    if not os.path.isdir(os.path.join(sysfs_dir, name)):
+        return True
+    return read_link_state(sysfs_dir, name, 'carrier') == '1'
+
+
 def shell_cmd(s):
     p = subprocess.Popen(s, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = p.communicate()
@@ -363,6 +519,9 @@ def arg_parser():
     parser.add_argument('--activate', help='activate new configuration', action='store_true', default=False, required=False)
     parser.add_argument('--interface-to-bridge', help="interface to bridge", type=str, required=False)
     parser.add_argument('--bridge-name', help="bridge name", type=str, required=False)
+    parser.add_argument('--reconfigure', help="interfaces to cycle when activating", choices=['all', 'changed'], default='all', required=False)
+    parser.add_argument('--link-timeout', help="seconds to wait for links to settle", type=float, required=False, default=10)
+    parser.add_argument('--sysfs-net-dir', help=argparse.SUPPRESS, type=str, required=False, default='/sys/class/net')
     parser.add_argument('filename', help="interfaces(5) based filename")
     return parser
 
@@ -407,6 +566,10 @@ def main(args):
         if not os.path.isfile(backup_file):
             shutil.copy2(args.filename, backup_file)
 
+    if args.reconfigure == 'changed':
+        activate_changed(args, config_parser.stanzas(), stanzas)
+        return
+
     ifquery = "$(ifquery --interfaces={} --exclude=lo --list)".format(args.filename)
 
     print("**** Original configuration")
@@ -442,6 +605,51 @@ def main(args):
     print_shell_cmd("ip route show")
     print_shell_cmd("brctl show")
 
+
+def activate_changed(args, old_stanzas, new_stanzas, run=print_shell_cmd):
+    """Activates new_stanzas by cycling only the interfaces that differ from
+    old_stanzas, leaving the others (e.g. the management NIC) up."""
+    changed = changed_interfaces(old_stanzas, new_stanzas)
+    down = [name for name in auto_interfaces(old_stanzas) if name in changed]
+    down = dependency_order(down, interface_prerequisites(old_stanzas))
+    up = [name for name in auto_interfaces(new_stanzas) if name in changed]
+    up = dependency_order(up, interface_prerequisites(new_stanzas))
+
+    print("**** Original configuration")
+    run("cat {}".format(args.filename))
+    run("ifconfig -a")
+    if down:
+        # Take dependents down before the interfaces they depend on.
+        run("ifdown --interfaces={} {}".format(args.filename, " ".join(reversed(down))))
+
+    print("**** Activating new configuration")
+
+    with open(args.filename, 'w') as f:
+        print_stanzas(new_stanzas, f)
+        f.close()
+
+    if not up:
+        print("no interfaces changed")
+        return
+
+    # Bonds in 802.3ad mode race between an immediate ifdown and ifup
+    # (LP: #1269921, #1594855), so wait for them to go down.
+    bonds = bonded_interfaces(old_stanzas, down)
+    if bonds:
+        slow = wait_for_links(bonds, link_is_down, args.sysfs_net_dir, args.link_timeout)
+        if slow:
+            print("timed out waiting for {} to go down".format(" ".join(slow)))
+
+    run("cat {}".format(args.filename))
+    run("ifup --interfaces={} {}".format(args.filename, " ".join(up)))
+    no_carrier = wait_for_links(up, link_has_carrier, args.sysfs_net_dir, args.link_timeout)
+    if no_carrier:
+        print("no carrier on {}".format(" ".join(no_carrier)))
+    run("ip link show up")
+    run("ifconfig -a")
+    run("ip route show")
+    run("brctl show")
+
 # This script re-renders an interfaces(5) file to add a bridge to
 # either all active interfaces, or a specific interface.
 
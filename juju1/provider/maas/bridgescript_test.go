@@ -169,6 +169,103 @@ func (s *bridgeConfigSuite) TestBridgeScriptMatchingExistingSpecificIface2(c *gc
 	s.assertScriptWithoutPrefix(c, networkLP1532167Initial, networkLP1532167Expected, "juju-br0", "bond0")
 }
 
+func (s *bridgeConfigSuite) TestBridgeScriptReconfigureChangedLeavesUnchangedInterfacesUp(c *gc.C) {
+	for i, python := range s.pythonVersions {
+		c.Logf("test #%v using %s", i, python)
+		commands, config := s.runActivateChanged(c, python, networkDualNICInitial, "--bridge-name=juju-br0", "--interface-to-bridge=eth1")
+		c.Check(commands, jc.DeepEquals, []string{
+			"ifconfig -a",
+			"ifdown --interfaces=" + s.testConfigPath + " eth1",
+			"ifup --interfaces=" + s.testConfigPath + " eth1 juju-br0",
+			"ip link show up",
+			"ifconfig -a",
+			"ip route show",
+			"brctl show",
+		})
+		c.Check(config, jc.Contains, "iface juju-br0 inet static")
+	}
+}
+
+func (s *bridgeConfigSuite) TestBridgeScriptReconfigureChangedCyclesBondDependents(c *gc.C) {
+	for i, python := range s.pythonVersions {
+		c.Logf("test #%v using %s", i, python)
+		commands, config := s.runActivateChanged(c, python, networkStaticBondWithVLANsInitial)
+		c.Check(commands, jc.DeepEquals, []string{
+			"ifconfig -a",
+			"ifdown --interfaces=" + s.testConfigPath + " bond0.3 bond0.2 bond0 eth1 eth0",
+			"ifup --interfaces=" + s.testConfigPath + " eth0 eth1 bond0 br-bond0 bond0.2 br-bond0.2 bond0.3 br-bond0.3",
+			"ip link show up",
+			"ifconfig -a",
+			"ip route show",
+			"brctl show",
+		})
+		c.Check(config, gc.Equals, networkStaticBondWithVLANsExpected)
+	}
+}
+
+func (s *bridgeConfigSuite) TestBridgeScriptReconfigureChangedDualStack(c *gc.C) {
+	for i, python := range s.pythonVersions {
+		c.Logf("test #%v using %s", i, python)
+		commands, config := s.runActivateChanged(c, python, networkDualStackInitial, "--bridge-name=juju-br0", "--interface-to-bridge=eth1")
+		c.Check(commands, jc.DeepEquals, []string{
+			"ifconfig -a",
+			"ifdown --interfaces=" + s.testConfigPath + " eth1",
+			"ifup --interfaces=" + s.testConfigPath + " eth1 juju-br0",
+			"ip link show up",
+			"ifconfig -a",
+			"ip route show",
+			"brctl show",
+		})
+		c.Check(config, jc.Contains, "iface eth1 inet6 auto")
+	}
+}
+
+func (s *bridgeConfigSuite) TestBridgeScriptReconfigureChangedNothingToDo(c *gc.C) {
+	for i, python := range s.pythonVersions {
+		c.Logf("test #%v using %s", i, python)
+		commands, config := s.runActivateChanged(c, python, networkDHCPWithBondExpected, "--bridge-prefix=test-br-")
+		c.Check(commands, jc.DeepEquals, []string{"ifconfig -a"})
+		c.Check(config, gc.Equals, networkDHCPWithBondExpected)
+	}
+}
+
+// runActivateChanged activates initialConfig with --reconfigure=changed,
+// using stubs in place of the commands that reconfigure interfaces and a
+// fake sysfs in which every interface has carrier. It returns the stubbed
+// commands that were run and the config file written.
+func (s *bridgeConfigSuite) runActivateChanged(c *gc.C, pythonBinary, initialConfig string, args ...string) (commands []string, config string) {
+	err := ioutil.WriteFile(s.testConfigPath, []byte(initialConfig), 0644)
+	c.Assert(err, jc.ErrorIsNil)
+	stubDir := c.MkDir()
+	logPath := filepath.Join(stubDir, "commands.log")
+	for _, name := range []string{"ifup", "ifdown", "ifconfig", "ip", "brctl"} {
+		stub := fmt.Sprintf("#!/bin/sh\necho %q \"$*\" >> %q\n", name, logPath)
+		err := ioutil.WriteFile(filepath.Join(stubDir, name), []byte(stub), 0755)
+		c.Assert(err, jc.ErrorIsNil)
+	}
+	sysfsDir := c.MkDir()
+	for _, name := range []string{"eth0", "eth1"} {
+		err := os.Mkdir(filepath.Join(sysfsDir, name), 0755)
+		c.Assert(err, jc.ErrorIsNil)
+		err = ioutil.WriteFile(filepath.Join(sysfsDir, name, "carrier"), []byte("1\n"), 0644)
+		c.Assert(err, jc.ErrorIsNil)
+	}
+
+	script := fmt.Sprintf("PATH=%q:$PATH %q %q --activate --reconfigure=changed --link-timeout=1 --sysfs-net-dir=%q %s %q\n",
+		stubDir, pythonBinary, s.testPythonScript, sysfsDir, strings.Join(args, " "), s.testConfigPath)
+	c.Log(script)
+	result, err := exec.RunCommands(exec.RunParams{Commands: script})
+	c.Assert(err, jc.ErrorIsNil)
+	c.Assert(result.Code, gc.Equals, 0, gc.Commentf("stderr: %s", result.Stderr))
+
+	logged, err := ioutil.ReadFile(logPath)
+	c.Assert(err, jc.ErrorIsNil)
+	commands = strings.Split(strings.TrimSuffix(string(logged), "\n"), "\n")
+	written, err := ioutil.ReadFile(s.testConfigPath)
+	c.Assert(err, jc.ErrorIsNil)
+	return commands, strings.TrimSuffix(string(written), "\n")
+}
+
 func (s *bridgeConfigSuite) runScript(c *gc.C, pythonBinary, configFile, bridgePrefix, bridgeName, interfaceToBridge string) (output string, exitCode int) {
 	if bridgePrefix != "" {
 		bridgePrefix = fmt.Sprintf("--bridge-prefix=%q", bridgePrefix)
@@ -274,6 +371,22 @@ iface test-br-eth1 inet static
     gateway 4.3.2.1
     bridge_ports eth1`
 
+const networkDualStackInitial = `auto lo
+iface lo inet loopback
+
+auto eth0
+iface eth0 inet static
+    address 1.2.3.4
+    netmask 255.255.255.0
+    gateway 4.3.2.1
+
+auto eth1
+iface eth1 inet static
+    address 1.2.3.5
+    netmask 255.255.255.0
+
+iface eth1 inet6 auto`
+
 const networkWithAliasInitial = `auto lo
 iface lo inet loopback
 
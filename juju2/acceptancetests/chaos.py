@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from collections import defaultdict
 from contextlib import contextmanager
 from datetime import (
     datetime,
@@ -9,6 +8,7 @@ import logging
 import os
 import subprocess
 import sys
+from time import sleep
 
 from jujucharm import (
     local_charm_path,
@@ -22,6 +22,11 @@ from utility import (
 __metaclass__ = type
 
 
+# The shortest and longest waits between checks of the chaos locks.
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 16
+
+
 @contextmanager
 def background_chaos(env, client, log_dir, time):
     monkey = MonkeyRunner(env, client, enablement_timeout=time)
@@ -70,6 +75,7 @@ class MonkeyRunner:
         self.total_timeout = total_timeout
         self.expire_time = (datetime.now() + timedelta(seconds=total_timeout))
         self.monkey_ids = {}
+        self.chaos_dir = None
 
     def deploy_chaos_monkey(self):
         """Juju deploy chaos-monkey and add a relation.
@@ -136,36 +142,75 @@ class MonkeyRunner:
                 return False
         return True
 
-    def get_unit_status(self, unit_name):
-        """Return 'done' if no lock file otherwise 'running'"""
-        service_config = self.client.get_service_config('chaos-monkey')
-        logging.debug('{}'.format(service_config))
-        logging.debug('Checking if chaos is done on: {}'.format(unit_name))
-        check_cmd = '[ -f '
-        check_cmd += service_config['settings']['chaos-dir']['value']
-        check_cmd += '/chaos_monkey.' + self.monkey_ids[unit_name]
-        check_cmd += '/chaos_runner.lock'
-        check_cmd += ' ]'
-        retvar, _ = self.client.juju(
-            'run', ('--unit', unit_name, check_cmd), check=False)
-        if retvar != 0:
-            return 'done'
-        return 'running'
+    def get_chaos_dir(self):
+        """Return the chaos-monkey chaos-dir, reading the config only once."""
+        if self.chaos_dir is None:
+            service_config = self.client.get_service_config('chaos-monkey')
+            logging.debug('{}'.format(service_config))
+            self.chaos_dir = service_config['settings']['chaos-dir']['value']
+        return self.chaos_dir
+
+    def get_unit_statuses(self, unit_names):
+        """Return a dict of each unit's status.
+
+        A unit is 'running' while its lock file exists, otherwise 'done'.
+        All the units are checked with a single juju run.  A unit whose
+        check fails is 'done', so that an unreachable unit cannot keep
+        chaos from completing.
+        """
+        logging.debug('Checking if chaos is done on: {}'.format(
+            ', '.join(unit_names)))
+        cases = ''.join(
+            '{}) id={};; '.format(unit_name, self.monkey_ids[unit_name])
+            for unit_name in unit_names)
+        check_cmd = (
+            'case "$JUJU_UNIT_NAME" in {}esac; '
+            'if [ -f {}/chaos_monkey.$id/chaos_runner.lock ]; '
+            'then echo running; else echo done; fi').format(
+                cases, self.get_chaos_dir())
+        statuses = dict((unit_name, 'done') for unit_name in unit_names)
+        for result in self.client.run((check_cmd,), units=unit_names):
+            if result.get('ReturnCode', 0) != 0:
+                continue
+            statuses[result['UnitId']] = result['Stdout'].strip()
+        return statuses
 
     def wait_for_chaos(self, state='complete', timeout=300):
         if not ('complete' in state or 'start' in state):
             raise Exception('Unexpected state value: {}'.format(state))
-        for ignored in until_timeout(timeout):
-            locks = defaultdict(list)
-            for unit_name, unit in self.iter_chaos_monkey_units():
-                locks[self.get_unit_status(unit_name)].append(unit_name)
-            if state == 'complete' and locks.keys() == ['done']:
-                logging.debug(
-                    'All lock files removed, chaos complete: {}'.format(locks))
-                break
-            if state == 'start' and locks.keys() == ['running']:
-                logging.debug(
-                    'All lock files found, chaos started: {}'.format(locks))
+        wanted = 'done' if state == 'complete' else 'running'
+        unit_names = [
+            unit_name for unit_name, unit in self.iter_chaos_monkey_units()]
+        # Units are not checked again once they reach the wanted state.
+        locks = dict((unit_name, None) for unit_name in unit_names)
+        interval = MIN_POLL_INTERVAL
+        for remaining in until_timeout(timeout):
+            pending = [u for u in unit_names if locks[u] != wanted]
+            if pending:
+                statuses = self.get_unit_statuses(pending)
+                changed = False
+                for unit_name in pending:
+                    status = statuses.get(unit_name)
+                    if status != locks[unit_name]:
+                        locks[unit_name] = status
+                        changed = True
+                pending = [u for u in unit_names if locks[u] != wanted]
+            if not pending:
+                if state == 'complete':
+                    logging.debug(
+                        'All lock files removed, chaos complete: {}'.format(
+                            locks))
+                else:
+                    logging.debug(
+                        'All lock files found, chaos started: {}'.format(
+                            locks))
                 break
+            # Check often while units are changing, and back off while
+            # nothing is happening.
+            if changed:
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+            sleep(min(interval, remaining))
         else:
             raise Exception('Chaos operations did not {}.'.format(state))
@@ -254,11 +254,27 @@ def dump_juju_timings(client, log_directory):
                 client.get_juju_timings(),
                 timing_file)
             timing_file.write('\n')
+        percentiles_path = os.path.join(
+            log_directory, 'juju_command_percentiles.yaml')
+        with open(percentiles_path, 'w') as percentiles_file:
+            yaml.safe_dump(
+                client.get_juju_timing_percentiles(), percentiles_file,
+                default_flow_style=False)
     except Exception as e:
         print_now("Failed to save timings")
         print_now(str(e))
 
 
+def stream_juju_timings(client, log_directory):
+    """Write juju command timings as they complete, to survive a crash."""
+    try:
+        client.stream_juju_timings(
+            os.path.join(log_directory, 'juju_command_times.jsonl'))
+    except Exception as e:
+        print_now("Failed to stream timings")
+        print_now(str(e))
+
+
 def get_remote_machines(client, known_hosts):
     """Return a dict of machine_id to remote machines.
 
@@ -984,6 +1000,8 @@ class BootstrapManager:
     @contextmanager
     def top_context(self):
         """Context for running all juju operations in."""
+        if self.log_dir is not None:
+            stream_juju_timings(self.client, self.log_dir)
         with self.maas_machines() as machines:
             try:
                 yield machines
@@ -991,6 +1009,7 @@ class BootstrapManager:
                 # This is not done in dump_all_logs because it should be
                 # done after tear down.
                 if self.log_dir is not None:
+                    self.client.close_juju_timings_stream()
                     dump_juju_timings(self.client, self.log_dir)
 
     @contextmanager
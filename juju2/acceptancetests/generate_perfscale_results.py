@@ -121,6 +121,9 @@ def add_basic_perfscale_arguments(parser):
         '--enable-pprof',
         help='Enable pprof profile collection during test run.',
         action='store_true')
+    parser.add_argument(
+        '--pprof-interval', type=int, default=None,
+        help='Also collect pprof profiles every this many seconds.')
 
 
 def run_perfscale_test(target_test, bs_manager, args):
@@ -155,6 +158,7 @@ def run_perfscale_test(target_test, bs_manager, args):
         admin_client = client.get_controller_client()
         admin_client.wait_for_started()
         bs_end = datetime.utcnow()
+        pprof_collector = None
         try:
             apply_any_workarounds(client)
             bootstrap_timing = TimingData(bs_start, bs_end)
@@ -168,10 +172,19 @@ def run_perfscale_test(target_test, bs_manager, args):
                 machine_ids,
                 results_dir,
                 args.enable_pprof)
+            pprof_collector.set_phase('deploy')
+            if args.pprof_interval:
+                pprof_collector.start_sampling(args.pprof_interval)
             deploy_details = target_test(client, pprof_collector, args)
         finally:
-            dump_performance_metrics_logs(
-                results_dir, admin_client, machine_ids)
+            try:
+                if pprof_collector is not None:
+                    pprof_collector.set_phase('cleanup')
+                dump_performance_metrics_logs(
+                    results_dir, admin_client, machine_ids)
+            finally:
+                if pprof_collector is not None:
+                    pprof_collector.stop_sampling()
             cleanup_start = datetime.utcnow()
     # Cleanup happens when we move out of context
     cleanup_end = datetime.utcnow()
@@ -192,7 +205,8 @@ def run_perfscale_test(target_test, bs_manager, args):
         results_dir,
         deployments,
         machine_ids,
-        graph_period)
+        graph_period,
+        pprof_collector.get_profiles())
 
 
 def output_test_run_length(seconds):
@@ -271,8 +285,13 @@ def maybe_enable_ha(admin_client, args):
 
 
 def generate_reports(
-        log_dir, results_dir, deployments, machine_ids, graph_period):
-    """Generate graph image from run results for each controller in action."""
+        log_dir, results_dir, deployments, machine_ids, graph_period,
+        pprof_profiles=()):
+    """Generate graph image from run results for each controller in action.
+
+    :param pprof_profiles: Details of the pprof profiles collected, stored
+      in report-data.json.
+    """
 
     for m_id in machine_ids:
         machine_results_dir = os.path.join(
@@ -286,6 +305,7 @@ def generate_reports(
 
     details = dict(
         deployments=deployments,
+        pprof_profiles=list(pprof_profiles),
         **log_chunks
     )
 
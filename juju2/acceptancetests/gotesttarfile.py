@@ -2,12 +2,17 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+from collections import namedtuple
+import heapq
+import json
 import shutil
 import os
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import traceback
 
 from utility import (
@@ -16,6 +21,10 @@ from utility import (
 )
 
 
+PackageResult = namedtuple(
+    'PackageResult', ['package', 'shard', 'returncode', 'attempts', 'seconds'])
+
+
 class WorkingDirectory:
     """Context manager for changing the current working directory"""
     def __init__(self, working_path):
@@ -80,18 +89,37 @@ def murder_mongo():
     return run(["sudo", "killall", "-SIGABRT", "mongod"])
 
 
-def go_test_package(package, go_cmd, gopath, verbose=False):
-    """Run the package unit tests."""
+def kill_shard_mongo(shard_dir):
+    """Kill the mongod processes started by the tests of one shard.
+
+    The test mongod keeps its data beneath the shard's temp dir, so only
+    processes naming that dir are killed; other shards are unaffected.
+    The pattern is bracketed so that it does not match the pkill (or sudo)
+    command line that carries it.
+    """
+    if sys.platform == 'win32':
+        query = "name='mongod.exe' and commandline like '%{}%'".format(
+            shard_dir.replace('\\', '\\\\'))
+        return run(['wmic', 'process', 'where', query, 'call', 'terminate'])
+    return run(['sudo', 'pkill', '-SIGABRT', '-f', '[m]ongod.*' + shard_dir])
+
+
+def go_command(go_cmd, *args):
+    """Return the command to run go with args on this platform."""
+    command = [go_cmd] + list(args)
+    if sys.platform == 'win32':
+        command = ['powershell.exe', '-Command'] + command
+    return command
+
+
+def get_go_env(gopath, verbose=False):
+    """Return the environment to run the go command in."""
     # Set GOPATH and GOARCH to ensure the go command tests extracted
     # tarfile using the arch the win-agent is compiled with. The
     # default go env might be 386 used to create a win client.
     env = dict(os.environ)
     env['GOPATH'] = gopath
     env['GOARCH'] = 'amd64'
-    version_cmd = [go_cmd, 'version']
-    env_cmd = [go_cmd, 'env']
-    build_cmd = [go_cmd, 'test', '-i', './...']
-    test_cmd = [go_cmd, 'test', '-timeout=1200s', './...']
     if sys.platform == 'win32':
         # Ensure OpenSSH is never in the path for win tests.
         sane_path = [p for p in env['PATH'].split(';') if 'OpenSSH' not in p]
@@ -101,6 +129,17 @@ def go_test_package(package, go_cmd, gopath, verbose=False):
             print_now(env['PATH'])
         # GZ 2015-04-21: Short-term hack to work around case-insensitive issues
         env['Path'] = env.pop('PATH')
+    return env
+
+
+def go_test_package(package, go_cmd, gopath, verbose=False):
+    """Run the package unit tests."""
+    env = get_go_env(gopath, verbose)
+    version_cmd = [go_cmd, 'version']
+    env_cmd = [go_cmd, 'env']
+    build_cmd = [go_cmd, 'test', '-i', './...']
+    test_cmd = [go_cmd, 'test', '-timeout=1200s', './...']
+    if sys.platform == 'win32':
         tempdir = tempfile.mkdtemp(prefix="tmp-juju-test", dir=gopath)
         env['TMP'] = env['TEMP'] = tempdir
         if verbose:
@@ -134,10 +173,171 @@ def go_test_package(package, go_cmd, gopath, verbose=False):
         murder_mongo()
     return returncode
 
+
 # suppress nosetests
 go_test_package.__test__ = False
 
 
+def load_timings(timing_db):
+    """Return the recorded seconds each package took to test.
+
+    A missing or unreadable database is treated as empty.
+    """
+    if timing_db is None or not os.path.isfile(timing_db):
+        return {}
+    try:
+        with open(timing_db) as timing_file:
+            timings = json.load(timing_file)
+    except ValueError:
+        return {}
+    if not isinstance(timings, dict):
+        return {}
+    return timings
+
+
+def save_timings(timing_db, timings):
+    """Write the package timings to timing_db, replacing it atomically."""
+    temp_path = '{}.{}.tmp'.format(timing_db, os.getpid())
+    with open(temp_path, 'w') as timing_file:
+        json.dump(timings, timing_file, indent=2, sort_keys=True)
+    if sys.platform == 'win32' and os.path.exists(timing_db):
+        os.unlink(timing_db)
+    os.rename(temp_path, timing_db)
+
+
+def shard_packages(packages, timings, shards):
+    """Divide packages into at most shards lists of similar duration.
+
+    The longest packages are placed first, each in the shard with the
+    least work.  Packages without a recorded timing are assumed to take
+    the mean of the recorded ones.
+    """
+    known = [timings[p] for p in packages if p in timings]
+    default = float(sum(known)) / len(known) if known else 1.0
+    heap = [(0.0, index, []) for index in range(shards)]
+    for package in sorted(packages,
+                          key=lambda p: (-timings.get(p, default), p)):
+        load, index, shard = heapq.heappop(heap)
+        shard.append(package)
+        heapq.heappush(heap, (load + timings.get(package, default), index,
+                              shard))
+    return [entry[2] for entry in sorted(heap, key=lambda x: x[1])
+            if entry[2]]
+
+
+def list_packages(go_cmd, env, package_dir):
+    """Return the import paths of the packages under package_dir."""
+    output = subprocess.check_output(
+        go_command(go_cmd, 'list', './...'), env=env, cwd=package_dir)
+    if not isinstance(output, str):
+        output = output.decode('utf-8')
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def run_shard(index, packages, go_cmd, gopath, env, package_dir, retries,
+              output_lock, verbose=False):
+    """Test packages one at a time, retrying each failure on its own.
+
+    The shard gets a private temp dir, which is where the tests start
+    their mongod, so its mongod processes can be killed after each
+    package without disturbing the other shards.
+    :return: a list of PackageResult.
+    """
+    shard_dir = tempfile.mkdtemp(prefix='shard-{}-'.format(index), dir=gopath)
+    env = dict(env, TMPDIR=shard_dir, TMP=shard_dir, TEMP=shard_dir)
+    log_path = os.path.join(shard_dir, 'go-test.log')
+    results = []
+    for package in packages:
+        for attempt in range(1, retries + 2):
+            test_cmd = go_command(go_cmd, 'test', '-timeout=1200s', package)
+            start = time.time()
+            with open(log_path, 'w') as log_file:
+                returncode = run(test_cmd, env=env, cwd=package_dir,
+                                 stdout=log_file, stderr=subprocess.STDOUT)
+            seconds = time.time() - start
+            kill_shard_mongo(shard_dir)
+            with output_lock:
+                with open(log_path) as log_file:
+                    sys.stdout.write(log_file.read())
+                print_now('shard {}: {} {} in {:.1f}s (attempt {})'.format(
+                    index, 'ok' if returncode == 0 else 'FAIL', package,
+                    seconds, attempt))
+            if returncode == 0:
+                break
+        results.append(
+            PackageResult(package, index, returncode, attempt, seconds))
+    return results
+
+
+def go_test_shards(package, go_cmd, gopath, shards, retries=1,
+                   timing_db=None, verbose=False):
+    """Run the unit tests of each package under package in parallel shards.
+
+    Packages are divided among the shards using the durations recorded in
+    timing_db, and the durations of this run are written back to it.
+    """
+    env = get_go_env(gopath, verbose)
+    package_dir = os.path.join(gopath, 'src', package.replace('/', os.sep))
+    if verbose:
+        print_now('Building test dependencies')
+    returncode = run(go_command(go_cmd, 'test', '-i', './...'), env=env,
+                     cwd=package_dir)
+    if returncode != 0:
+        return returncode
+    packages = list_packages(go_cmd, env, package_dir)
+    timings = load_timings(timing_db)
+    plan = shard_packages(packages, timings, shards)
+    if verbose:
+        for index, shard in enumerate(plan):
+            print_now('shard {}: {}'.format(index, ' '.join(shard)))
+    output_lock = threading.Lock()
+    results = []
+    errors = []
+
+    def test_shard(index, shard):
+        try:
+            shard_results = run_shard(
+                index, shard, go_cmd, gopath, env, package_dir,
+                retries, output_lock, verbose=verbose)
+        except Exception as e:
+            with output_lock:
+                errors.append(e)
+            return
+        with output_lock:
+            results.extend(shard_results)
+
+    threads = [threading.Thread(target=test_shard, args=(index, shard))
+               for index, shard in enumerate(plan)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if verbose:
+        print_now("Killing any lingering mongo processes...")
+    murder_mongo()
+    if errors:
+        raise errors[0]
+    for result in results:
+        timings[result.package] = result.seconds
+    if timing_db is not None:
+        save_timings(timing_db, timings)
+    failed = sorted(r.package for r in results if r.returncode != 0)
+    flaky = sorted(r.package for r in results
+                   if r.returncode == 0 and r.attempts > 1)
+    if flaky:
+        print_now('Passed on retry: {}'.format(' '.join(flaky)))
+    if failed:
+        print_now('FAIL: {}'.format(' '.join(failed)))
+        return 1
+    if verbose:
+        print_now('SUCCESS')
+    return 0
+
+
+# suppress nosetests
+go_test_shards.__test__ = False
+
+
 def parse_args(args=None):
     """Return parsed args for this program."""
     parser = ArgumentParser("Run go test against the content of a tarfile.")
@@ -152,9 +352,23 @@ def parse_args(args=None):
     parser.add_argument(
         '-r', '--remove-tarfile', action='store_true', default=False,
         help='Remove the tarfile after extraction.')
+    parser.add_argument(
+        '-s', '--shards', type=int, default=None,
+        help='Test the packages in this many parallel shards instead of'
+             ' running go test once for the whole tree.')
+    parser.add_argument(
+        '--retries', type=int, default=1,
+        help='Retry each failing package this many times (with --shards).')
+    parser.add_argument(
+        '--timing-db',
+        help='A file of package test durations used to balance the shards;'
+             ' it is updated after the run.')
     parser.add_argument(
         'tarfile', help='The path to the gopath tarfile.')
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+    if parsed_args.shards is not None and parsed_args.shards < 1:
+        parser.error('--shards must be at least 1')
+    return parsed_args
 
 
 def main(argv=None):
@@ -172,8 +386,14 @@ def main(argv=None):
             untar_gopath(
                 tarfile_path, gopath, delete=args.remove_tarfile,
                 verbose=args.verbose)
-            returncode = go_test_package(
-                args.package, args.go, gopath, verbose=args.verbose)
+            if args.shards is None:
+                returncode = go_test_package(
+                    args.package, args.go, gopath, verbose=args.verbose)
+            else:
+                returncode = go_test_shards(
+                    args.package, args.go, gopath, args.shards,
+                    retries=args.retries, timing_db=args.timing_db,
+                    verbose=args.verbose)
     except Exception as e:
         print_now(str(e))
         print_now(traceback.print_exc())
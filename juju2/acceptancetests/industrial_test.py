@@ -8,6 +8,7 @@ from datetime import datetime
 from itertools import count
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import sys
@@ -16,6 +17,7 @@ from textwrap import dedent
 from deploy_stack import (
     BootstrapManager,
     client_from_config,
+    temp_juju_home,
     wait_for_state_server_to_shutdown,
     )
 from jujucharm import (
@@ -38,6 +40,7 @@ from substrate import (
     )
 from utility import (
     configure_logging,
+    ensure_dir,
     LoggedException,
     temp_dir,
     until_timeout,
@@ -88,11 +91,12 @@ class MultiIndustrialTest:
         return cls(args.env, args.new_juju_path,
                    stages, args.log_dir, args.attempts, args.attempts * 2,
                    args.new_agent_url, args.debug, args.old_stable,
-                   args.agent_stream)
+                   args.agent_stream, args.parallel, args.concurrent_attempts)
 
     def __init__(self, env, new_juju_path, stages, log_dir, attempt_count=2,
                  max_attempts=1, new_agent_url=None, debug=False,
-                 really_old_path=None, agent_stream=None):
+                 really_old_path=None, agent_stream=None, parallel=False,
+                 concurrent_attempts=1):
         self.env = env
         self.really_old_path = really_old_path
         self.new_juju_path = new_juju_path
@@ -103,6 +107,8 @@ class MultiIndustrialTest:
         self.debug = debug
         self.log_parent_dir = log_dir
         self.agent_stream = agent_stream
+        self.parallel = parallel
+        self.concurrent_attempts = concurrent_attempts
 
     def make_results(self):
         """Return a results list for use in run_tests."""
@@ -124,6 +130,8 @@ class MultiIndustrialTest:
         :return: a list of dicts describing output.
         """
         results = self.make_results()
+        if self.concurrent_attempts > 1:
+            return self.run_concurrent_tests(results)
         for unused_ in range(self.max_attempts):
             if results['results'][-1]['attempts'] >= self.attempt_count:
                 break
@@ -131,6 +139,35 @@ class MultiIndustrialTest:
             self.update_results(industrial.run_attempt(), results)
         return results
 
+    def run_concurrent_tests(self, results):
+        """Run up to concurrent_attempts attempts at once.
+
+        Each attempt uses its own model names, so this is only suitable for
+        substrates that can host several at once.
+        """
+        pool = ThreadPool(self.concurrent_attempts)
+        try:
+            started = 0
+            while started < self.max_attempts:
+                remaining = (
+                    self.attempt_count - results['results'][-1]['attempts'])
+                if remaining <= 0:
+                    break
+                batch = min(self.concurrent_attempts, remaining,
+                            self.max_attempts - started)
+                industrials = [self.make_industrial_test(started + i)
+                               for i in range(batch)]
+                started += batch
+                for run_attempt, error in pool.map(
+                        _run_attempt_catching, industrials):
+                    if error is not None:
+                        raise error
+                    self.update_results(run_attempt, results)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
     @staticmethod
     def combine_results(result_list_list):
         combine_dict = OrderedDict()
@@ -149,17 +186,29 @@ class MultiIndustrialTest:
                     )
         return {'results': combine_dict.values()}
 
-    def make_industrial_test(self):
-        """Create an IndustrialTest for this MultiIndustrialTest."""
+    def make_industrial_test(self, attempt_index=None):
+        """Create an IndustrialTest for this MultiIndustrialTest.
+
+        :param attempt_index: When running concurrent attempts, the index
+            of this attempt, used to give its models distinct names.
+        """
         stable_path = ModelClient.get_full_path()
         paths = [self.really_old_path, stable_path, self.new_juju_path]
         upgrade_sequence = [p for p in paths if p is not None]
         stage_attempts = [self.stages.factory(upgrade_sequence,
                                               self.log_parent_dir,
                                               self.agent_stream)]
-        return IndustrialTest.from_args(self.env, self.new_juju_path,
-                                        stage_attempts, self.new_agent_url,
-                                        self.debug)
+        homes_dir = os.path.join(self.log_parent_dir, 'juju-homes')
+        if attempt_index is None:
+            return IndustrialTest.from_args(
+                self.env, self.new_juju_path, stage_attempts,
+                self.new_agent_url, self.debug, parallel=self.parallel,
+                homes_dir=homes_dir)
+        return IndustrialTest.from_args(
+            self.env, self.new_juju_path, stage_attempts, self.new_agent_url,
+            self.debug, parallel=self.parallel,
+            model_suffix='-{}'.format(attempt_index), separate_homes=True,
+            homes_dir=homes_dir)
 
     def update_results(self, run_attempt, results):
         """Update results with data from run_attempt.
@@ -190,12 +239,64 @@ class MultiIndustrialTest:
                    ' | {title}\n').format(**stage)
 
 
+def _run_attempt_catching(industrial):
+    """Run an attempt in a worker thread, returning (results, exception).
+
+    run_attempt exits on failure, and SystemExit would otherwise kill the
+    worker rather than reaching the main thread.  Other exceptions are
+    logged here, because re-raising them in the main thread loses their
+    traceback.
+    """
+    try:
+        return industrial.run_attempt(), None
+    except SystemExit as e:
+        # run_attempt has already logged the cause.
+        return None, e
+    except BaseException as e:
+        logging.exception(e)
+        return None, e
+
+
+@contextmanager
+def separate_juju_homes(clients, homes_dir=None):
+    """Give each client a copy of its juju home.
+
+    This lets clients run at the same time without sharing controller and
+    model state.  If homes_dir is supplied, the copies are made in a new
+    directory beneath it and kept, so that controllers left behind by the
+    clients can still be found and cleaned up.  Otherwise they are
+    temporary.
+    """
+    if homes_dir is not None:
+        ensure_dir(homes_dir)
+    with temp_dir(homes_dir, keep=homes_dir is not None) as attempt_dir:
+        homes = []
+        for index, client in enumerate(clients):
+            new_home = os.path.join(attempt_dir, str(index))
+            shutil.copytree(client.env.juju_home, new_home, symlinks=True)
+            homes.append(temp_juju_home(client, new_home))
+        with nested_contexts(homes):
+            yield
+
+
+@contextmanager
+def nested_contexts(contexts):
+    """Enter each of contexts in turn, exiting them in reverse order."""
+    if not contexts:
+        yield
+        return
+    with contexts[0]:
+        with nested_contexts(contexts[1:]):
+            yield
+
+
 class IndustrialTest:
     """Class for running one attempt at an industrial test."""
 
     @classmethod
     def from_args(cls, env, new_juju_path, stage_attempts, new_agent_url=None,
-                  debug=False):
+                  debug=False, parallel=False, model_suffix='',
+                  separate_homes=False, homes_dir=None):
         """Return an IndustrialTest from commandline arguments.
 
         :param env: The name of the environment to base environments on.
@@ -203,31 +304,52 @@ class IndustrialTest:
         :param new_agent_url: Agent stream url for new client.
         :param stage_attemps: List of stages to attempt.
         :param debug: If True, use juju --debug logging.
+        :param parallel: If True, run the old and new clients concurrently.
+        :param model_suffix: Suffix for the model names, to distinguish
+            concurrent attempts.
+        :param separate_homes: If True, give each client its own copy of the
+            juju home, so concurrent attempts do not share one.
+        :param homes_dir: Directory to keep the copies of the juju home in.
         """
         old_client = client_from_config(env, None, debug=debug)
-        old_client.env.set_model_name(env + '-old')
+        old_client.env.set_model_name(env + '-old' + model_suffix)
         new_client = client_from_config(env, new_juju_path, debug=debug)
-        new_client.env.set_model_name(env + '-new')
+        new_client.env.set_model_name(env + '-new' + model_suffix)
         if new_agent_url is not None:
             new_client.env.update_config(
                 {'tools-metadata-url': new_agent_url})
         uniquify_local(new_client.env)
-        return cls(old_client, new_client, stage_attempts)
+        return cls(old_client, new_client, stage_attempts, parallel,
+                   separate_homes, homes_dir)
 
-    def __init__(self, old_client, new_client, stage_attempts):
+    def __init__(self, old_client, new_client, stage_attempts,
+                 parallel=False, separate_homes=False, homes_dir=None):
         """Constructor.
 
         :param old_client: An ModelClient for the old juju.
         :param new_client: A ModelClient for the new juju.
         :param stage_attemps: List of stages to attempt.
+        :param parallel: If True, run the old and new clients concurrently,
+            each with its own juju home.
+        :param separate_homes: If True, give each client its own juju home
+            even when they do not run concurrently.
+        :param homes_dir: Directory to keep the clients' own juju homes in.
+            If None, they are deleted after the attempt.
         """
         self.old_client = old_client
         self.new_client = new_client
         self.stage_attempts = stage_attempts
+        self.parallel = parallel
+        self.separate_homes = separate_homes
+        self.homes_dir = homes_dir
 
     def run_attempt(self):
         """Perform this attempt, with initial cleanup."""
         try:
+            if self.parallel or self.separate_homes:
+                with separate_juju_homes([self.old_client, self.new_client],
+                                         self.homes_dir):
+                    return list(self.run_stages())
             return list(self.run_stages())
         except CannotUpgradeToOldClient:
             raise
@@ -242,8 +364,9 @@ class IndustrialTest:
         """
         for attempt in self.stage_attempts:
             try:
-                for result in attempt.iter_test_results(self.old_client,
-                                                        self.new_client):
+                for result in attempt.iter_test_results(
+                        self.old_client, self.new_client,
+                        parallel=self.parallel):
                     yield result
             except CannotUpgradeToClient as e:
                 if e.client is not self.old_client:
@@ -319,21 +442,41 @@ class SteppedStageAttempt:
         finally:
             iterator.close()
 
-    def _iter_test_results(self, old_iter, new_iter):
+    @staticmethod
+    def _next_both(pool, old_iter, new_iter):
+        """Advance both iterators at once, returning both values.
+
+        Both iterators are allowed to finish their steps before any
+        exception is raised.
+        """
+        old_async = pool.apply_async(old_iter.next)
+        new_async = pool.apply_async(new_iter.next)
+        old_async.wait()
+        new_async.wait()
+        return old_async.get(), new_async.get()
+
+    def _iter_test_results(self, old_iter, new_iter, parallel=False):
         """Iterate through none-or-result to get result for each operation.
 
         Yield the result as a tuple of (test-id, old_result, new_result).
 
         Operations are interleaved between iterators to improve
         responsiveness; an itererator can start a long-running operation,
-        yield, then acquire the result of the operation.
+        yield, then acquire the result of the operation.  If parallel is
+        True, the iterators' steps run concurrently in worker threads.
         """
+        pool = ThreadPool(2) if parallel else None
         try:
             while True:
                 old_result = None
                 new_result = None
                 while None in (old_result, new_result):
                     try:
+                        if (pool is not None and
+                                old_result is None and new_result is None):
+                            old_result, new_result = self._next_both(
+                                pool, old_iter, new_iter)
+                            continue
                         if old_result is None:
                             old_result = old_iter.next()
                         if new_result is None:
@@ -356,6 +499,9 @@ class SteppedStageAttempt:
             logging.exception(e)
             raise LoggedException(e)
         finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
             # Shut down both iterators, including destroy-environment
             try:
                 old_iter.close()
@@ -367,11 +513,14 @@ class SteppedStageAttempt:
         """Default implementation uses get_stage_info."""
         return OrderedDict(si.as_tuple() for si in cls.get_stage_info())
 
-    def iter_test_results(self, old, new):
-        """Iterate through the results for this operation for both clients."""
+    def iter_test_results(self, old, new, parallel=False):
+        """Iterate through the results for this operation for both clients.
+
+        If parallel is True, the clients' steps run concurrently.
+        """
         old_iter = self._iter_for_result(self.iter_steps(old))
         new_iter = self._iter_for_result(self.iter_steps(new))
-        return self._iter_test_results(old_iter, new_iter)
+        return self._iter_test_results(old_iter, new_iter, parallel)
 
 
 class BootstrapAttempt(SteppedStageAttempt):
@@ -996,6 +1145,14 @@ def parse_args(args=None):
     parser.add_argument(
         '--old-stable', help='Path to a version of juju that stable can'
         ' upgrade from.')
+    parser.add_argument(
+        '--parallel', action='store_true', default=False,
+        help='Run the old and new clients concurrently, each with its own'
+        ' juju home.')
+    parser.add_argument(
+        '--concurrent-attempts', type=int, default=1,
+        help='Number of attempts to run at once, for substrates that can'
+        ' host several.')
     return parser.parse_args(args)
 
 
@@ -18,6 +18,7 @@ from __future__ import print_function
 
 from collections import (
     defaultdict,
+    deque,
     namedtuple,
     )
 from contextlib import (
@@ -29,22 +30,28 @@ from datetime import (
     timedelta,
     )
 import errno
+import hashlib
 from itertools import chain
 import json
 from locale import getpreferredencoding
 import logging
+import math
 import os
+import random
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+import weakref
 
 from dateutil.parser import parse as datetime_parse
 from dateutil import tz
 import pexpect
 import yaml
 
+import jujupy.timeout
 from jujupy.configuration import (
     get_bootstrap_config_path,
     get_environments_path,
@@ -55,6 +62,7 @@ from jujupy.configuration import (
 from jujupy.utility import (
     check_free_disk_space,
     ensure_dir,
+    get_popen_kwargs,
     get_timeout_path,
     is_ipv6_address,
     JujuResourceTimeout,
@@ -1099,7 +1107,7 @@ class Juju2Backend:
         self.feature_flags = feature_flags
         self.debug = debug
         self._timeout_path = get_timeout_path()
-        self.juju_timings = []
+        self.command_timings = CommandTimings()
         self.soft_deadline = soft_deadline
         self._ignore_soft_deadline = False
 
@@ -1135,11 +1143,23 @@ class Juju2Backend:
             debug = self.debug
         result = self.__class__(full_path, version, feature_flags, debug,
                                 self.soft_deadline)
-        # Each clone shares a reference to juju_timings allowing us to collect
-        # all commands run during a test.
-        result.juju_timings = self.juju_timings
+        # Each clone shares a reference to command_timings allowing us to
+        # collect all commands run during a test.
+        result.command_timings = self.command_timings
         return result
 
+    @property
+    def juju_timings(self):
+        """The most recent CommandTimes of all clones."""
+        return self.command_timings.records
+
+    def record_timing(self, command_time):
+        self.command_timings.add(command_time)
+
+    def get_timings(self):
+        """Return a snapshot of the CommandTimes of all clones."""
+        return self.command_timings.get_records()
+
     @property
     def version(self):
         return self._version
@@ -1180,6 +1200,12 @@ class Juju2Backend:
         return env
 
     def full_args(self, command, args, model, timeout):
+        """Return the command line for a juju command.
+
+        If timeout is not None, the command is prefixed to run under the
+        timeout script.  Only commands that cannot be supervised in-process
+        need this.
+        """
         if model is not None:
             e_arg = (self._model_flag, model)
         else:
@@ -1209,25 +1235,39 @@ class Juju2Backend:
         :return: Tuple rval, CommandTime rval being the commands exit code and
           a CommandTime object used for storing command timing data.
         """
-        args = self.full_args(command, args, model, timeout)
+        args = self.full_args(command, args, model, None)
         log.info(' '.join(args))
         env = self.shell_environ(used_feature_flags, juju_home)
         if extra_env is not None:
             env.update(extra_env)
         if check:
             call_func = subprocess.check_call
+            timed_call_func = jujupy.timeout.check_call
         else:
             call_func = subprocess.call
-        # Mutate os.environ instead of supplying env parameter so Windows can
-        # search env['PATH']
+            timed_call_func = jujupy.timeout.call
+        popen_kwargs = get_popen_kwargs(args, env)
         stderr = subprocess.PIPE if suppress_err else None
         # Keep track of commands and how long the take.
-        command_time = CommandTime(command, args, env)
-        with scoped_environ(env):
-            log.debug('Running juju with env: {}'.format(env))
-            with self._check_timeouts():
-                rval = call_func(args, stderr=stderr)
-        self.juju_timings.append(command_time)
+        command_time = CommandTime(command, args, extra_env)
+        log.debug('Running juju with env: {}'.format(env))
+        with self._check_timeouts():
+            try:
+                if timeout is None:
+                    rval = call_func(args, stderr=stderr, **popen_kwargs)
+                else:
+                    # Supervise the deadline in-process rather than starting
+                    # the timeout script in another interpreter.
+                    rval = timed_call_func(
+                        args, timeout, stderr=stderr, **popen_kwargs)
+            except subprocess.CalledProcessError as e:
+                command_time.exit_code = e.returncode
+                command_time.actual_completion()
+                self.record_timing(command_time)
+                raise
+        command_time.exit_code = rval
+        command_time.process_completion()
+        self.record_timing(command_time)
         return rval, command_time
 
     def expect(self, command, args, used_feature_flags, juju_home, model=None,
@@ -1241,51 +1281,63 @@ class Juju2Backend:
         # command + args from the returned tuple (as there could be an intial
         # timing command tacked on).
         command_string = ' '.join(quote(a) for a in args)
-        with scoped_environ(env):
-            return pexpect.spawn(command_string)
+        # pexpect searches the PATH of env for the executable.
+        return pexpect.spawn(command_string, env=env)
 
     @contextmanager
     def juju_async(self, command, args, used_feature_flags,
                    juju_home, model=None, timeout=None):
-        full_args = self.full_args(command, args, model, timeout)
+        full_args = self.full_args(command, args, model, None)
         log.info(' '.join(args))
         env = self.shell_environ(used_feature_flags, juju_home)
-        # Mutate os.environ instead of supplying env parameter so Windows can
-        # search env['PATH']
-        with scoped_environ(env):
-            with self._check_timeouts():
-                proc = subprocess.Popen(full_args)
-        yield proc
-        retcode = proc.wait()
+        popen_kwargs = get_popen_kwargs(full_args, env)
+        popen_args = full_args
+        if timeout is not None:
+            popen_args = jujupy.timeout.get_group_args(full_args)
+            popen_kwargs.update(jujupy.timeout.get_group_kwargs())
+        with self._check_timeouts():
+            proc = subprocess.Popen(popen_args, **popen_kwargs)
+        with jujupy.timeout.supervise(proc, timeout) as deadline:
+            yield proc
+            retcode = proc.wait()
+        if deadline.expired:
+            retcode = jujupy.timeout.TIMEOUT_EXIT_CODE
         if retcode != 0:
             raise subprocess.CalledProcessError(retcode, full_args)
 
     def get_juju_output(self, command, args, used_feature_flags, juju_home,
                         model=None, timeout=None, user_name=None,
                         merge_stderr=False):
-        args = self.full_args(command, args, model, timeout)
+        args = self.full_args(command, args, model, None)
         env = self.shell_environ(used_feature_flags, juju_home)
         log.debug(args)
-        # Mutate os.environ instead of supplying env parameter so
-        # Windows can search env['PATH']
-        with scoped_environ(env):
-            proc = subprocess.Popen(
-                args, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE)
-            with self._check_timeouts():
+        popen_kwargs = get_popen_kwargs(args, env)
+        popen_args = args
+        if timeout is not None:
+            popen_args = jujupy.timeout.get_group_args(args)
+            popen_kwargs.update(jujupy.timeout.get_group_kwargs())
+        proc = subprocess.Popen(
+            popen_args, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+            **popen_kwargs)
+        with self._check_timeouts():
+            with jujupy.timeout.supervise(proc, timeout) as deadline:
                 sub_output, sub_error = proc.communicate()
-            log.debug(sub_output)
-            if proc.returncode != 0:
-                log.debug(sub_error)
-                e = subprocess.CalledProcessError(
-                    proc.returncode, args, sub_output)
-                e.stderr = sub_error
-                if sub_error and (
-                    b'Unable to connect to environment' in sub_error or
-                        b'MissingOrIncorrectVersionHeader' in sub_error or
-                        b'307: Temporary Redirect' in sub_error):
-                    raise CannotConnectEnv(e)
-                raise e
+        log.debug(sub_output)
+        returncode = proc.returncode
+        if deadline.expired:
+            returncode = jujupy.timeout.TIMEOUT_EXIT_CODE
+        if returncode != 0:
+            log.debug(sub_error)
+            e = subprocess.CalledProcessError(
+                returncode, args, sub_output)
+            e.stderr = sub_error
+            if sub_error and (
+                b'Unable to connect to environment' in sub_error or
+                    b'MissingOrIncorrectVersionHeader' in sub_error or
+                    b'307: Temporary Redirect' in sub_error):
+                raise CannotConnectEnv(e)
+            raise e
         return sub_output
 
     def get_active_model(self, juju_data_dir):
@@ -1495,18 +1547,64 @@ class CommandTime:
         self.full_args = full_args
         self.envvars = envvars
         self.start = start if start else datetime.utcnow()
+        self.process_end = None
         self.end = None
+        self.exit_code = None
+        self.parse_seconds = None
+        self.timings = None
+
+    def process_completion(self, end=None):
+        """Signify that the juju process of the command has exited.
+
+        The command itself may complete later, for example once a deployed
+        application has started.  Note. ignores multiple calls after the
+        initial call.
+
+        :param end: datetime.datetime object. If None defaults to
+          datetime.datetime.utcnow()
+        """
+        if self.process_end is None:
+            self.process_end = end if end else datetime.utcnow()
+            if self.timings is not None:
+                self.timings.complete(self)
 
     def actual_completion(self, end=None):
         """Signify that actual completion time of the command.
 
-        Note. ignores multiple calls after the initial call.
+        The process must have exited too, so its end is recorded if it has
+        not been already.  Note. ignores multiple calls after the initial
+        call.
 
         :param end: datetime.datetime object. If None defaults to
           datetime.datetime.utcnow()
         """
         if self.end is None:
             self.end = end if end else datetime.utcnow()
+            self.process_completion(self.end)
+
+    @contextmanager
+    def timing_parse(self):
+        """Record how long the command's output took to parse."""
+        start = time.time()
+        yield
+        self.parse_seconds = time.time() - start
+
+    @property
+    def args_hash(self):
+        """A short digest identifying the command's arguments."""
+        joined = '\0'.join(str(arg) for arg in self.full_args)
+        return hashlib.sha1(joined.encode('utf-8')).hexdigest()[:12]
+
+    def to_record(self):
+        """Return a compact, JSON-compatible summary of this command."""
+        return {
+            'command': self.cmd,
+            'args_hash': self.args_hash,
+            'start': self.start.isoformat(),
+            'duration': self.process_seconds,
+            'exit_code': self.exit_code,
+            'parse_seconds': self.parse_seconds,
+            }
 
     @property
     def total_seconds(self):
@@ -1519,6 +1617,146 @@ class CommandTime:
             return None
         return (self.end - self.start).total_seconds()
 
+    @property
+    def process_seconds(self):
+        """Seconds the juju process of the command took to exit.
+
+        :return: Int representing number of seconds or None if the process
+          has not been seen to exit.
+        """
+        if self.process_end is None:
+            return None
+        return (self.process_end - self.start).total_seconds()
+
+
+class LatencyHistogram:
+    """Approximate latency percentiles using log-spaced buckets.
+
+    Memory use depends on the range of latencies, not the number recorded.
+    Percentiles are accurate to within one bucket, about 19%.
+    """
+
+    min_seconds = 0.001
+
+    buckets_per_doubling = 4
+
+    def __init__(self):
+        self._buckets = defaultdict(int)
+        self.count = 0
+        self.max = 0
+
+    def _get_index(self, seconds):
+        if seconds <= self.min_seconds:
+            return 0
+        return int(math.ceil(
+            math.log(seconds / self.min_seconds, 2) *
+            self.buckets_per_doubling))
+
+    def _get_upper_bound(self, index):
+        return self.min_seconds * 2 ** (
+            float(index) / self.buckets_per_doubling)
+
+    def add(self, seconds):
+        self._buckets[self._get_index(seconds)] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Return the latency that percent of samples do not exceed.
+
+        :return: The latency in seconds, or None if there are no samples.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(self._get_upper_bound(index), self.max)
+
+
+class CommandTimings:
+    """A bounded, thread-safe record of juju command timings.
+
+    The most recent CommandTimes are kept for reporting.  The latency of
+    every command's process is added to a histogram for its command and, if
+    a stream is open, written to it as a line of JSON, once the process has
+    exited.
+    """
+
+    def __init__(self, maxlen=10000):
+        self.records = deque(maxlen=maxlen)
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._stream = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['_stream'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, command_time):
+        """Add a CommandTime, completing it now if its process has exited."""
+        with self._lock:
+            self.records.append(command_time)
+        command_time.timings = self
+        if command_time.process_end is not None:
+            self.complete(command_time)
+
+    def complete(self, command_time):
+        """Record the process latency of a CommandTime."""
+        with self._lock:
+            histogram = self.histograms.get(command_time.cmd)
+            if histogram is None:
+                histogram = self.histograms[command_time.cmd] = (
+                    LatencyHistogram())
+            histogram.add(command_time.process_seconds)
+            if self._stream is not None:
+                self._stream.write(json.dumps(
+                    command_time.to_record(), sort_keys=True,
+                    default=str) + '\n')
+                self._stream.flush()
+
+    def get_records(self):
+        with self._lock:
+            return list(self.records)
+
+    def get_percentiles(self, percents=(50, 95, 99)):
+        """Return the latency percentiles of each command.
+
+        :return: A dict of command to a dict with the 'count' of completions
+            and the seconds at each percentile, e.g. 'p95'.
+        """
+        result = {}
+        with self._lock:
+            for cmd, histogram in self.histograms.items():
+                summary = {'count': histogram.count}
+                for percent in percents:
+                    summary['p{}'.format(percent)] = histogram.percentile(
+                        percent)
+                result[cmd] = summary
+        return result
+
+    def open_stream(self, path):
+        """Append completed commands to path as JSON Lines."""
+        stream = open(path, 'a')
+        with self._lock:
+            old_stream, self._stream = self._stream, stream
+        if old_stream is not None:
+            old_stream.close()
+
+    def close_stream(self):
+        with self._lock:
+            stream, self._stream = self._stream, None
+        if stream is not None:
+            stream.close()
+
 
 class CommandComplete(BaseCondition):
     """Wraps a CommandTime and gives the ability to wait_for completion."""
@@ -1559,6 +1797,104 @@ class CommandComplete(BaseCondition):
                 ' '.join(self.command_time.full_args)))
 
 
+class StatusPoller:
+    """Share status fetches among concurrent waits on one model.
+
+    Each wait asks for a status fetched after the last one it saw.  Only one
+    fetch runs at a time, and every wait that asks while it runs receives its
+    result, so each wait evaluates its own conditions against the shared
+    Status.
+
+    Fetches are paced by how fast the status changes.  While it changes,
+    fetches run back to back.  While it does not, the interval between
+    fetches grows towards max_interval.  Jitter keeps the pollers of
+    different models from fetching in lockstep.
+    """
+
+    min_interval = 0
+    initial_backoff = 1
+    max_interval = 10
+    jitter = 0.2
+
+    def __init__(self, now=time.time, sleep=time.sleep, random=random.random):
+        self._now = now
+        self._sleep = sleep
+        self._random = random
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._status = None
+        self._fetching = False
+        self._last_fetch = None
+        self.interval = self.min_interval
+
+    def get_status(self, fetch, seen=None):
+        """Return a status fetched after the one the caller last saw.
+
+        :param fetch: Callable that fetches a Status, if no fetch is running.
+        :param seen: The generation of the last status the caller saw.  If
+            None, the next status fetched is returned.
+        :return: A tuple of (generation, status).
+        """
+        with self._condition:
+            if seen is None:
+                seen = self._generation
+            while self._generation <= seen:
+                if not self._fetching:
+                    self._fetching = True
+                    break
+                self._condition.wait()
+            else:
+                return self._generation, self._status
+            delay = self._get_delay()
+        try:
+            if delay > 0:
+                self._sleep(delay)
+            self._last_fetch = self._now()
+            status = fetch()
+            with self._condition:
+                self._update_interval(status)
+                self._status = status
+                self._generation += 1
+                return self._generation, status
+        finally:
+            # On failure, another waiter will fetch instead.
+            with self._condition:
+                self._fetching = False
+                self._condition.notify_all()
+
+    def _get_delay(self):
+        if self._last_fetch is None or self.interval <= 0:
+            return 0
+        spread = self.jitter * (2 * self._random() - 1)
+        next_fetch = self._last_fetch + self.interval * (1 + spread)
+        return max(0, next_fetch - self._now())
+
+    def _update_interval(self, status):
+        if self._status is None or status.status != self._status.status:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                                max(self.initial_backoff, self.interval * 2))
+
+
+_status_pollers = weakref.WeakValueDictionary()
+_status_pollers_lock = threading.Lock()
+
+
+def get_status_poller(key):
+    """Return the StatusPoller shared by the clients of a model.
+
+    The poller lives as long as a wait holds a reference to it.
+    :param key: A hashable identifying the model.
+    """
+    with _status_pollers_lock:
+        poller = _status_pollers.get(key)
+        if poller is None:
+            poller = StatusPoller()
+            _status_pollers[key] = poller
+        return poller
+
+
 class ModelClient:
     """Wraps calls to a juju instance, associated with a single model.
 
@@ -2080,15 +2416,28 @@ class ModelClient:
         """Get the current status as a dict."""
         # GZ 2015-12-16: Pass remaining timeout into get_juju_output call.
         for ignored in until_timeout(timeout):
-            try:
-                if raw:
+            if raw:
+                try:
                     return self.get_juju_output(self._show_status, *args)
-                return self.status_class.from_text(
-                    self.get_juju_output(
-                        self._show_status, '--format', 'yaml',
-                        controller=controller).decode('utf-8'))
-            except subprocess.CalledProcessError:
-                pass
+                except subprocess.CalledProcessError:
+                    continue
+            command_time = CommandTime(
+                self._show_status, ('--format', 'yaml'))
+            try:
+                output = self.get_juju_output(
+                    self._show_status, '--format', 'yaml',
+                    controller=controller)
+            except subprocess.CalledProcessError as e:
+                command_time.actual_completion()
+                command_time.exit_code = e.returncode
+                self._backend.record_timing(command_time)
+                continue
+            command_time.actual_completion()
+            command_time.exit_code = 0
+            with command_time.timing_parse():
+                status = self.status_class.from_text(output.decode('utf-8'))
+            self._backend.record_timing(command_time)
+            return status
         raise StatusTimeout(
             'Timed out waiting for juju status to succeed')
 
@@ -2234,7 +2583,7 @@ class ModelClient:
 
     def get_juju_timings(self):
         timing_breakdown = []
-        for ct in self._backend.juju_timings:
+        for ct in self._backend.get_timings():
             timing_breakdown.append(
                 {
                     'command': ct.cmd,
@@ -2246,6 +2595,17 @@ class ModelClient:
             )
         return timing_breakdown
 
+    def get_juju_timing_percentiles(self):
+        """Return the latency percentiles of each juju command run so far."""
+        return self._backend.command_timings.get_percentiles()
+
+    def stream_juju_timings(self, path):
+        """Write each juju command to path as JSON Lines as it exits."""
+        self._backend.command_timings.open_stream(path)
+
+    def close_juju_timings_stream(self):
+        self._backend.command_timings.close_stream()
+
     def juju_async(self, command, args, include_e=True, timeout=None):
         model = self._cmd_model(include_e, controller=False)
         return self._backend.juju_async(command, args, self.used_feature_flags,
@@ -2370,6 +2730,8 @@ class ModelClient:
         """Call and yield status until the timeout is reached.
 
         Status will always be yielded once before checking the timeout.
+        Statuses are fetched through the model's StatusPoller, so concurrent
+        waits on the model share fetches.
 
         This is intended for implementing things like wait_for_started.
 
@@ -2377,11 +2739,19 @@ class ModelClient:
         :param start: If supplied, the time to count from when determining
             timeout.
         """
+        poller = self.get_status_poller()
         with self.check_timeouts():
             with self.ignore_soft_deadline():
-                yield self.get_status()
+                seen, status = poller.get_status(self.get_status)
+                yield status
                 for remaining in until_timeout(timeout, start=start):
-                    yield self.get_status()
+                    seen, status = poller.get_status(self.get_status, seen)
+                    yield status
+
+    def get_status_poller(self):
+        """Return the StatusPoller shared by the waits on this model."""
+        return get_status_poller((
+            self.env.juju_home, self.env.controller.name, self.model_name))
 
     def _wait_for_status(self, reporter, translate, exc_type=StatusNotMet,
                          timeout=1200, start=None):
@@ -2398,12 +2768,15 @@ class ModelClient:
         :param start: Optional time to count from when determining timeout.
         """
         status = None
+        seen = None
+        poller = self.get_status_poller()
         try:
             with self.check_timeouts():
                 with self.ignore_soft_deadline():
                     for _ in chain([None],
                                    until_timeout(timeout, start=start)):
-                        status = self.get_status()
+                        seen, status = poller.get_status(
+                            self.get_status, seen)
                         states = translate(status)
                         if states is None:
                             break
@@ -2421,7 +2794,7 @@ class ModelClient:
 
     def wait_for_started(self, timeout=1200, start=None):
         """Wait until all unit/machine agents are 'started'."""
-        reporter = GroupReporter(sys.stdout, 'started')
+        reporter = make_group_reporter(sys.stdout, 'started')
         return self._wait_for_status(
             reporter, Status.check_agents_started, AgentsNotStarted,
             timeout=timeout, start=start)
@@ -2442,7 +2815,7 @@ class ModelClient:
                     set(unit_states.keys()).issubset(AGENTS_READY)):
                 return None
             return unit_states
-        reporter = GroupReporter(sys.stdout, 'started')
+        reporter = make_group_reporter(sys.stdout, 'started')
         self._wait_for_status(
             reporter, status_to_subordinate_states, AgentsNotStarted,
             timeout=timeout, start=start)
@@ -2606,7 +2979,7 @@ class ModelClient:
                     return None
             return states
 
-        reporter = GroupReporter(sys.stdout, desired_state)
+        reporter = make_group_reporter(sys.stdout, desired_state)
         self._wait_for_status(reporter, status_to_ha, VotingNotEnabled,
                               timeout=timeout, start=start)
         # XXX sinzui 2014-12-04: bug 1399277 happens because
@@ -2621,11 +2994,13 @@ class ModelClient:
         :param service_count: The number of services for which to wait.
         :param timeout: The number of seconds to wait.
         """
+        poller = self.get_status_poller()
         with self.check_timeouts():
             with self.ignore_soft_deadline():
                 status = None
+                seen = None
                 for remaining in until_timeout(timeout):
-                    status = self.get_status()
+                    seen, status = poller.get_status(self.get_status, seen)
                     if status.get_service_count() >= service_count:
                         return
                 else:
@@ -2646,7 +3021,7 @@ class ModelClient:
                 return None
             unit_states.pop('unknown', None)
             return unit_states
-        reporter = GroupReporter(sys.stdout, 'active')
+        reporter = make_group_reporter(sys.stdout, 'active')
         self._wait_for_status(reporter, status_to_workloads, WorkloadsNotReady,
                               timeout=timeout, start=start)
 
@@ -2660,7 +3035,7 @@ class ModelClient:
             return self.get_status()
         # iter_blocking_state must filter out all non-blocking values, so
         # there are no "expected" values for the GroupReporter.
-        reporter = GroupReporter(sys.stdout, None)
+        reporter = make_group_reporter(sys.stdout, None)
         status = None
         try:
             for status in self.status_until(condition.timeout):
@@ -3395,3 +3770,113 @@ class GroupReporter:
         self.last_group = group
         self.ticks = 0
         self.wrap_offset = lead_length if lead_length < self.wrap_width else 0
+
+
+class CompactGroupReporter(GroupReporter):
+    """Report counts of states, for waits on models with many entities.
+
+    Each line gives the number of entities in every unexpected state, the
+    change since the previous line and a bounded sample of their names.
+    Lines are written at most once per interval, and a tick is written
+    instead when the counts have not changed.  If transitions_path is
+    supplied, every change of an entity's state is appended to it as a
+    tab-separated line of time, name, old state and new state, using '-'
+    for no state.
+    """
+
+    def __init__(self, stream, expected, sample_size=3, interval=30,
+                 transitions_path=None, now=time.time):
+        super(CompactGroupReporter, self).__init__(stream, expected)
+        self.sample_size = sample_size
+        self.interval = interval
+        self.transitions_path = transitions_path
+        self._now = now
+        self._transitions_file = None
+        self._states = {}
+        self._counts = None
+        self._pending = None
+        self._last_write = None
+
+    def finish(self):
+        if self._pending is not None:
+            self._write_counts(self._pending)
+        if self._transitions_file is not None:
+            self._transitions_file.close()
+            self._transitions_file = None
+        super(CompactGroupReporter, self).finish()
+
+    def update(self, group):
+        now = self._now()
+        self._log_transitions(group, now)
+        if (self._last_write is not None and
+                now - self._last_write < self.interval):
+            self._pending = group
+            return
+        self._pending = None
+        self._last_write = now
+        if self._get_counts(group) == self._counts:
+            self._write('.')
+        else:
+            self._write_counts(group)
+
+    def _get_counts(self, group):
+        return dict((value, len(entries)) for value, entries in group.items()
+                    if value != self.expected)
+
+    def _write_counts(self, group):
+        self._pending = None
+        counts = self._get_counts(group)
+        last_counts = self._counts if self._counts is not None else {}
+        value_listing = []
+        for value in sorted(set(counts).union(last_counts)):
+            count = counts.get(value, 0)
+            listing = '%s: %d' % (value, count)
+            if self._counts is not None:
+                listing += ' (%+d)' % (count - last_counts.get(value, 0))
+            if count > 0:
+                sample = list(group[value][:self.sample_size])
+                if count > len(sample):
+                    sample.append('+%d more' % (count - len(sample)))
+                listing += ' [%s]' % ', '.join(sample)
+            value_listing.append(listing)
+        string = ' | '.join(value_listing)
+        if self.last_group:
+            string = "\n" + string
+        self._write(string)
+        self.last_group = group
+        self._counts = counts
+
+    def _log_transitions(self, group, now):
+        if self.transitions_path is None:
+            return
+        states = {}
+        for value, entries in group.items():
+            for entry in entries:
+                states[entry] = value
+        lines = []
+        for name in sorted(set(states).union(self._states)):
+            old = self._states.get(name, '-')
+            new = states.get(name, '-')
+            if old != new:
+                lines.append('%.3f\t%s\t%s\t%s\n' % (now, name, old, new))
+        self._states = states
+        if not lines:
+            return
+        if self._transitions_file is None:
+            self._transitions_file = open(self.transitions_path, 'a')
+        self._transitions_file.write(''.join(lines))
+        self._transitions_file.flush()
+
+
+def make_group_reporter(stream, expected):
+    """Return the reporter to use for a wait, according to the environment.
+
+    If JUJU_CI_COMPACT_STATUS is set, a CompactGroupReporter is returned.
+    It appends state transitions to the file named by
+    JUJU_CI_STATUS_TRANSITIONS, if that is set.
+    """
+    if not os.environ.get('JUJU_CI_COMPACT_STATUS'):
+        return GroupReporter(stream, expected)
+    return CompactGroupReporter(
+        stream, expected,
+        transitions_path=os.environ.get('JUJU_CI_STATUS_TRANSITIONS'))
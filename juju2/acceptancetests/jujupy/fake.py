@@ -35,7 +35,10 @@ from jujupy import (
     JujuData,
     SoftDeadlineExceeded,
 )
-from jujupy.client import CommandTime
+from jujupy.client import (
+    CommandTime,
+    CommandTimings,
+    )
 
 __metaclass__ = type
 
@@ -678,7 +681,7 @@ class FakeBackend:
         self.version = version
         self.full_path = full_path
         self.debug = debug
-        self.juju_timings = {}
+        self.command_timings = CommandTimings()
         self.log = logging.getLogger('jujupy')
         self._past_deadline = past_deadline
         self._ignore_soft_deadline = False
@@ -701,6 +704,16 @@ class FakeBackend:
                               full_path, debug,
                               past_deadline=self._past_deadline)
 
+    @property
+    def juju_timings(self):
+        return self.command_timings.records
+
+    def record_timing(self, command_time):
+        self.command_timings.add(command_time)
+
+    def get_timings(self):
+        return self.command_timings.get_records()
+
     def set_feature(self, feature, enabled):
         if enabled:
             self.feature_flags.add(feature)
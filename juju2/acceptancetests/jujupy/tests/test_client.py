@@ -8,14 +8,15 @@ from datetime import (
 import json
 import logging
 import os
+import pickle
 import socket
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 import subprocess
-import sys
 from textwrap import dedent
+import threading
 import types
 
 from dateutil import tz
@@ -44,17 +45,19 @@ from jujupy.client import (
     AppError,
     BaseCondition,
     CommandTime,
+    CommandTimings,
     CommandComplete,
     CannotConnectEnv,
     ConditionList,
     Controller,
     describe_substrate,
     ErroredUnit,
+    CompactGroupReporter,
     GroupReporter,
     get_cache_path,
     get_local_root,
     get_machine_dns_name,
-    get_timeout_path,
+    get_status_poller,
     get_timeout_prefix,
     HookFailedError,
     InstallError,
@@ -64,6 +67,8 @@ from jujupy.client import (
     JujuData,
     JUJU_DEV_FEATURE_FLAGS,
     KILL_CONTROLLER,
+    LatencyHistogram,
+    make_group_reporter,
     Machine,
     MachineDown,
     MachineError,
@@ -81,6 +86,7 @@ from jujupy.client import (
     StatusError,
     StatusItem,
     StatusNotMet,
+    StatusPoller,
     StatusTimeout,
     StuckAllocatingError,
     SYSTEM,
@@ -188,6 +194,27 @@ class TestJuju2Backend(TestCase):
             full_path=None, version=None, debug=None, feature_flags=None)
         self.assertIs(cloned.juju_timings, backend.juju_timings)
 
+    def test_get_timings(self):
+        backend = Juju2Backend('/bin/path', '2.0', set(), False)
+        cloned = backend.clone(
+            full_path=None, version=None, debug=None, feature_flags=None)
+        first = CommandTime('status', ('juju', 'status'))
+        second = CommandTime('deploy', ('juju', 'deploy'))
+        backend.record_timing(first)
+        cloned.record_timing(second)
+        timings = backend.get_timings()
+        self.assertEqual([first, second], timings)
+        self.assertIsNot(timings, backend.juju_timings)
+
+    def test_pickle_replaces_timings_lock(self):
+        backend = Juju2Backend('/bin/path', '2.0', set(), False)
+        unpickled = pickle.loads(pickle.dumps(backend))
+        self.assertEqual(backend, unpickled)
+        self.assertIsNot(backend.command_timings._lock,
+                         unpickled.command_timings._lock)
+        unpickled.record_timing(CommandTime('status', ('juju', 'status')))
+        self.assertEqual(1, len(unpickled.get_timings()))
+
     def test__check_timeouts(self):
         backend = Juju2Backend('/bin/path', '2.0', set(), debug=False,
                                soft_deadline=datetime(2015, 1, 2, 3, 4, 5))
@@ -1102,7 +1129,7 @@ class TestModelClient(ClientTest):
         mock_popen.assert_called_once_with(
             ('juju', '--show-log', 'bar', '-m', 'foo:foo'),
             stdin=subprocess.PIPE, stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE)
+            stdout=subprocess.PIPE, env=client._shell_environ())
 
     def test_get_juju_output_full_cmd(self):
         env = JujuData('foo')
@@ -1123,8 +1150,8 @@ class TestModelClient(ClientTest):
             client.get_juju_output('bar', timeout=5)
         self.assertEqual(
             po_mock.call_args[0][0],
-            (sys.executable, get_timeout_path(), '5.00', '--', 'juju',
-             '--show-log', 'bar', '-m', 'foo:foo'))
+            ('setsid', 'juju', '--show-log', 'bar', '-m', 'foo:foo'))
+        self.assertNotIn('preexec_fn', po_mock.call_args[1])
 
     def test__shell_environ_juju_data(self):
         client = ModelClient(
@@ -1138,7 +1165,7 @@ class TestModelClient(ClientTest):
         client = ModelClient(env, None, '/foobar/bar')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
             return FakePopen(None, None, 0)
         with patch('subprocess.Popen', autospec=True,
                    side_effect=check_path):
@@ -1173,6 +1200,31 @@ class TestModelClient(ClientTest):
 
         with patch.object(client, 'get_juju_output', get_juju_output):
             client.get_status()
+        failed, succeeded = client._backend.get_timings()
+        self.assertEqual(1, failed.exit_code)
+        self.assertEqual(0, succeeded.exit_code)
+
+    def test_get_status_raw_retries_on_error(self):
+        client = ModelClient(JujuData('foo'), None, None)
+        with patch.object(client, 'get_juju_output', side_effect=[
+                subprocess.CalledProcessError(1, 'show-status'), 'ok'],
+                ) as gjo_mock:
+            self.assertEqual('ok', client.get_status(raw=True))
+        self.assertEqual(2, gjo_mock.call_count)
+        self.assertEqual([], client._backend.get_timings())
+
+    def test_get_status_records_timing(self):
+        client = ModelClient(JujuData('foo'), None, None)
+        with patch.object(client, 'get_juju_output',
+                          return_value=b'"hello"'):
+            client.get_status()
+        ct, = client._backend.get_timings()
+        self.assertEqual('show-status', ct.cmd)
+        self.assertEqual(0, ct.exit_code)
+        self.assertIsNotNone(ct.total_seconds)
+        self.assertIsNotNone(ct.parse_seconds)
+        self.assertEqual(
+            1, client.get_juju_timing_percentiles()['show-status']['count'])
 
     def test_get_status_raises_on_timeout_1(self):
         env = JujuData('foo')
@@ -2734,22 +2786,22 @@ class TestModelClient(ClientTest):
         with patch('subprocess.check_call') as mock:
             client.set_env_option(
                 'tools-metadata-url', 'https://example.org/juju/tools')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(
             ('juju', '--show-log', 'model-config', '-m', 'foo:foo',
-             'tools-metadata-url=https://example.org/juju/tools'), stderr=None)
+             'tools-metadata-url=https://example.org/juju/tools'),
+            env=environ, stderr=None)
 
     def test_unset_env_option(self):
         env = JujuData('foo')
         client = ModelClient(env, None, 'juju')
         with patch('subprocess.check_call') as mock:
             client.unset_env_option('tools-metadata-url')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(
             ('juju', '--show-log', 'model-config', '-m', 'foo:foo',
-             '--reset', 'tools-metadata-url'), stderr=None)
+             '--reset', 'tools-metadata-url'),
+            env=environ, stderr=None)
 
     def test__format_cloud_region(self):
         fcr = ModelClient._format_cloud_region
@@ -2836,10 +2888,9 @@ class TestModelClient(ClientTest):
         client = ModelClient(env, None, 'juju')
         with patch('subprocess.check_call') as mock:
             client.juju('foo', ('bar', 'baz'))
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(('juju', '--show-log', 'foo', '-m', 'qux:qux',
-                                 'bar', 'baz'), stderr=None)
+                                 'bar', 'baz'), env=environ, stderr=None)
 
     def test_expect_returns_pexpect_spawn_object(self):
         env = JujuData('qux')
@@ -2848,7 +2899,8 @@ class TestModelClient(ClientTest):
             process = client.expect('foo', ('bar', 'baz'))
 
         self.assertIs(process, mock.return_value)
-        mock.assert_called_once_with('juju --show-log foo -m qux:qux bar baz')
+        mock.assert_called_once_with('juju --show-log foo -m qux:qux bar baz',
+                                     env=client._shell_environ())
 
     def test_expect_uses_provided_envvar_path(self):
         from pexpect import ExceptionPexpect
@@ -2868,37 +2920,75 @@ class TestModelClient(ClientTest):
         client = ModelClient(env, None, '/foobar/baz')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
         with patch('subprocess.check_call', side_effect=check_path):
             client.juju('foo', ('bar', 'baz'))
 
     def test_juju_no_check(self):
         env = JujuData('qux')
         client = ModelClient(env, None, 'juju')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         with patch('subprocess.call') as mock:
             client.juju('foo', ('bar', 'baz'), check=False)
         mock.assert_called_with(('juju', '--show-log', 'foo', '-m', 'qux:qux',
-                                 'bar', 'baz'), stderr=None)
+                                 'bar', 'baz'), env=environ, stderr=None)
 
     def test_juju_no_check_env(self):
         env = JujuData('qux')
         client = ModelClient(env, None, '/foobar/baz')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
         with patch('subprocess.call', side_effect=check_path):
             client.juju('foo', ('bar', 'baz'), check=False)
 
     def test_juju_timeout(self):
         env = JujuData('qux')
         client = ModelClient(env, None, '/foobar/baz')
-        with patch('subprocess.check_call') as cc_mock:
+        with patch('jujupy.timeout.check_call') as cc_mock:
             client.juju('foo', ('bar', 'baz'), timeout=58)
-        self.assertEqual(cc_mock.call_args[0][0], (
-            sys.executable, get_timeout_path(), '58.00', '--', 'baz',
-            '--show-log', 'foo', '-m', 'qux:qux', 'bar', 'baz'))
+        environ = client._shell_environ()
+        cc_mock.assert_called_once_with((
+            'baz', '--show-log', 'foo', '-m', 'qux:qux', 'bar', 'baz'), 58,
+            env=environ, stderr=None)
+
+    def test_juju_records_exit_code(self):
+        client = ModelClient(JujuData('qux'), None, 'juju')
+        with patch('subprocess.call', return_value=3):
+            rval, ct = client.juju('foo', ('bar',), check=False,
+                                   extra_env={'A': 'b'})
+        self.assertEqual([ct], client._backend.get_timings())
+        self.assertEqual(3, ct.exit_code)
+        self.assertEqual({'A': 'b'}, ct.envvars)
+
+    def test_juju_records_process_latency(self):
+        client = ModelClient(JujuData('qux'), None, 'juju')
+        with temp_dir() as log_dir:
+            path = os.path.join(log_dir, 'timings.jsonl')
+            client.stream_juju_timings(path)
+            with patch('subprocess.check_call', return_value=0):
+                rval, ct = client.juju('deploy', ('cs:foo',))
+            client._backend.command_timings.close_stream()
+            with open(path) as stream_file:
+                record, = [json.loads(line) for line in stream_file]
+        # The deploy has not necessarily completed, but its process has.
+        self.assertIsNone(ct.end)
+        self.assertIsNotNone(ct.process_end)
+        self.assertEqual(
+            1, client.get_juju_timing_percentiles()['deploy']['count'])
+        self.assertEqual('deploy', record['command'])
+        self.assertEqual(0, record['exit_code'])
+        self.assertEqual(ct.process_seconds, record['duration'])
+
+    def test_juju_records_failure(self):
+        client = ModelClient(JujuData('qux'), None, 'juju')
+        error = subprocess.CalledProcessError(2, 'juju')
+        with patch('subprocess.check_call', side_effect=error):
+            with self.assertRaises(subprocess.CalledProcessError):
+                client.juju('foo', ('bar',))
+        ct, = client._backend.get_timings()
+        self.assertEqual(2, ct.exit_code)
+        self.assertIsNotNone(ct.end)
 
     def test_juju_juju_home(self):
         env = JujuData('qux')
@@ -2922,13 +3012,15 @@ class TestModelClient(ClientTest):
         extra_env = {'JUJU': '/juju', 'JUJU_HOME': client.env.juju_home}
 
         def check_env(*args, **kwargs):
-            self.assertEqual('/juju', os.environ['JUJU'])
+            self.assertEqual('/juju', kwargs['env']['JUJU'])
 
         with patch('subprocess.check_call', side_effect=check_env) as mock:
             client.juju('quickstart', ('bar', 'baz'), extra_env=extra_env)
+        environ = client._shell_environ()
+        environ.update(extra_env)
         mock.assert_called_with(
             ('juju', '--show-log', 'quickstart', '-m', 'qux:qux',
-             'bar', 'baz'), stderr=None)
+             'bar', 'baz'), env=environ, stderr=None)
 
     def test_juju_backup_with_tgz(self):
         env = JujuData('qux')
@@ -2976,7 +3068,7 @@ class TestModelClient(ClientTest):
         environ = client._shell_environ()
 
         def side_effect(*args, **kwargs):
-            self.assertEqual(environ, os.environ)
+            self.assertEqual(environ, kwargs['env'])
             return FakePopen('foojuju-backup-123-456.tar.gzbar', '', 0)
         with patch('subprocess.Popen', side_effect=side_effect):
             client.backup()
@@ -3044,7 +3136,7 @@ class TestModelClient(ClientTest):
         with patch('subprocess.Popen') as popen_class_mock:
 
             def check_environ(*args, **kwargs):
-                self.assertEqual(environ, os.environ)
+                self.assertEqual(environ, kwargs['env'])
                 return proc_mock
             popen_class_mock.side_effect = check_environ
             proc_mock.wait.return_value = 0
@@ -3104,6 +3196,16 @@ class TestModelClient(ClientTest):
         ]
         self.assertEqual(flattened_timings, expected)
 
+    def test_get_juju_timing_percentiles(self):
+        start = datetime(2017, 3, 22, 23, 36, 52, 0)
+        client = ModelClient(JujuData('foo'), None, 'my/juju/bin')
+        ct = CommandTime('command1', ['command1', 'arg1'], start=start)
+        ct.actual_completion(end=start + timedelta(seconds=2))
+        client._backend.record_timing(ct)
+        self.assertEqual(
+            {'command1': {'count': 1, 'p50': 2, 'p95': 2, 'p99': 2}},
+            client.get_juju_timing_percentiles())
+
     def test_deployer(self):
         client = ModelClient(JujuData('foo', {'type': 'local'}),
                              '1.23-series-arch', None)
@@ -5977,6 +6079,91 @@ working: 1 ....................................................................
         self.assertEqual(sio.getvalue(), changes[-1] + "\n")
 
 
+class TestCompactGroupReporter(TestCase):
+
+    def make_reporter(self, **kwargs):
+        self.now = 100.0
+        sio = StringIO()
+        reporter = CompactGroupReporter(
+            sio, 'done', now=lambda: self.now, **kwargs)
+        return sio, reporter
+
+    def test_counts_and_deltas(self):
+        sio, reporter = self.make_reporter(interval=0)
+        reporter.update({'working': ['1', '2'], 'pending': ['3']})
+        self.assertEqual('pending: 1 [3] | working: 2 [1, 2]', sio.getvalue())
+        reporter.update({'working': ['1', '3'], 'done': ['2']})
+        self.assertEqual(
+            'pending: 1 [3] | working: 2 [1, 2]\n'
+            'pending: 0 (-1) | working: 2 (+0) [1, 3]', sio.getvalue())
+        reporter.finish()
+        self.assertTrue(sio.getvalue().endswith('\n'))
+
+    def test_bounded_sample(self):
+        sio, reporter = self.make_reporter(sample_size=2)
+        reporter.update({'working': [str(n) for n in range(1000)]})
+        self.assertEqual('working: 1000 [0, 1, +998 more]', sio.getvalue())
+
+    def test_unchanged_counts_tick(self):
+        sio, reporter = self.make_reporter(interval=0)
+        reporter.update({'working': ['1', '2']})
+        reporter.update({'working': ['2', '1']})
+        self.assertEqual('working: 2 [1, 2].', sio.getvalue())
+
+    def test_rate_limited(self):
+        sio, reporter = self.make_reporter(interval=30)
+        reporter.update({'working': ['1', '2']})
+        self.now += 10
+        reporter.update({'working': ['1']})
+        self.assertEqual('working: 2 [1, 2]', sio.getvalue())
+        self.now += 20
+        reporter.update({'working': ['2']})
+        self.assertEqual(
+            'working: 2 [1, 2]\nworking: 1 (-1) [2]', sio.getvalue())
+
+    def test_finish_writes_pending(self):
+        sio, reporter = self.make_reporter(interval=30)
+        reporter.update({'working': ['1', '2']})
+        reporter.update({'working': ['1'], 'done': ['2']})
+        reporter.finish()
+        self.assertEqual(
+            'working: 2 [1, 2]\nworking: 1 (-1) [1]\n', sio.getvalue())
+
+    def test_transitions(self):
+        with temp_dir() as log_dir:
+            path = os.path.join(log_dir, 'transitions')
+            sio, reporter = self.make_reporter(transitions_path=path)
+            reporter.update({'working': ['1', '2']})
+            self.now += 1.5
+            reporter.update({'working': ['1'], 'done': ['2']})
+            reporter.update({'working': ['1'], 'done': ['2']})
+            reporter.update({'done': ['2']})
+            reporter.finish()
+            with open(path) as transitions_file:
+                transitions = transitions_file.read()
+        self.assertEqual(
+            '100.000\t1\t-\tworking\n'
+            '100.000\t2\t-\tworking\n'
+            '101.500\t2\tworking\tdone\n'
+            '101.500\t1\tworking\t-\n', transitions)
+
+
+class TestMakeGroupReporter(TestCase):
+
+    def test_default(self):
+        reporter = make_group_reporter(StringIO(), 'done')
+        self.assertIs(type(reporter), GroupReporter)
+        self.assertEqual('done', reporter.expected)
+
+    def test_compact(self):
+        os.environ['JUJU_CI_COMPACT_STATUS'] = '1'
+        os.environ['JUJU_CI_STATUS_TRANSITIONS'] = 'transitions.log'
+        reporter = make_group_reporter(StringIO(), 'done')
+        self.assertIs(type(reporter), CompactGroupReporter)
+        self.assertEqual('done', reporter.expected)
+        self.assertEqual('transitions.log', reporter.transitions_path)
+
+
 class AssessParseStateServerFromErrorTestCase(TestCase):
 
     def test_parse_new_state_server_from_error(self):
@@ -6124,6 +6311,23 @@ class TestCommandTime(TestCase):
         ct.actual_completion(end=utcnow)
         self.assertEqual(ct.end, utcnow)
 
+    def test_process_completion(self):
+        start = datetime(2017, 3, 22, 23, 36, 52)
+        ct = CommandTime('cmd', [], start=start)
+        ct.process_completion(end=start + timedelta(seconds=2))
+        ct.process_completion(end=start + timedelta(seconds=3))
+        self.assertEqual(2, ct.process_seconds)
+        self.assertIsNone(ct.end)
+        ct.actual_completion(end=start + timedelta(seconds=5))
+        self.assertEqual(2, ct.process_seconds)
+        self.assertEqual(5, ct.total_seconds)
+
+    def test_actual_completion_ends_process(self):
+        start = datetime(2017, 3, 22, 23, 36, 52)
+        ct = CommandTime('cmd', [], start=start)
+        ct.actual_completion(end=start + timedelta(seconds=2))
+        self.assertEqual(2, ct.process_seconds)
+
     def test_total_seconds_returns_None_when_not_complete(self):
         ct = CommandTime('cmd', [])
         self.assertEqual(ct.total_seconds, None)
@@ -6137,6 +6341,252 @@ class TestCommandTime(TestCase):
             ct.actual_completion()
         self.assertEqual(ct.total_seconds, 1)
 
+    def test_to_record(self):
+        start = datetime(2017, 3, 22, 23, 36, 52)
+        ct = CommandTime('cmd', ['juju', 'cmd'], envvars={'A': 'b'},
+                         start=start)
+        ct.actual_completion(end=start + timedelta(seconds=2))
+        ct.exit_code = 1
+        ct.parse_seconds = 0.5
+        self.assertEqual({
+            'command': 'cmd',
+            'args_hash': ct.args_hash,
+            'start': '2017-03-22T23:36:52',
+            'duration': 2,
+            'exit_code': 1,
+            'parse_seconds': 0.5,
+            }, ct.to_record())
+
+    def test_args_hash(self):
+        ct = CommandTime('cmd', ['juju', 'cmd', 'a'])
+        self.assertEqual(12, len(ct.args_hash))
+        self.assertEqual(
+            ct.args_hash, CommandTime('cmd', ('juju', 'cmd', 'a')).args_hash)
+        self.assertNotEqual(
+            ct.args_hash, CommandTime('cmd', ['juju', 'cmd a']).args_hash)
+
+    def test_timing_parse(self):
+        ct = CommandTime('cmd', [])
+        with patch('time.time', side_effect=[10.0, 10.25]):
+            with ct.timing_parse():
+                pass
+        self.assertEqual(0.25, ct.parse_seconds)
+
+
+class TestLatencyHistogram(TestCase):
+
+    def test_percentile_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_percentile(self):
+        histogram = LatencyHistogram()
+        for seconds in range(1, 101):
+            histogram.add(seconds)
+        self.assertEqual(100, histogram.count)
+        # Results are the upper bound of a bucket, within about 19%.
+        for percent in (50, 95, 99):
+            result = histogram.percentile(percent)
+            self.assertGreaterEqual(result, percent)
+            self.assertLess(result, percent * 1.19)
+        self.assertEqual(100, histogram.percentile(100))
+
+    def test_percentile_capped_by_max(self):
+        histogram = LatencyHistogram()
+        histogram.add(3)
+        self.assertEqual(3, histogram.percentile(99))
+
+    def test_tiny_latencies(self):
+        histogram = LatencyHistogram()
+        histogram.add(0)
+        histogram.add(0.0001)
+        self.assertEqual(0.0001, histogram.percentile(50))
+
+
+class TestCommandTimings(TestCase):
+
+    def make_command_time(self, cmd='cmd', seconds=1, exit_code=0):
+        start = datetime(2017, 3, 22, 23, 36, 52)
+        ct = CommandTime(cmd, ['juju', cmd], start=start)
+        ct.exit_code = exit_code
+        ct.actual_completion(end=start + timedelta(seconds=seconds))
+        return ct
+
+    def test_records_bounded(self):
+        timings = CommandTimings(maxlen=2)
+        cts = [self.make_command_time(seconds=s) for s in range(3)]
+        for ct in cts:
+            timings.add(ct)
+        self.assertEqual(cts[1:], timings.get_records())
+        self.assertEqual(3, timings.get_percentiles()['cmd']['count'])
+
+    def test_add_incomplete_completes_later(self):
+        timings = CommandTimings()
+        ct = CommandTime('cmd', ['juju', 'cmd'])
+        timings.add(ct)
+        self.assertEqual({}, timings.get_percentiles())
+        ct.process_completion()
+        self.assertEqual(1, timings.get_percentiles()['cmd']['count'])
+        ct.actual_completion()
+        self.assertEqual(1, timings.get_percentiles()['cmd']['count'])
+
+    def test_get_percentiles(self):
+        timings = CommandTimings()
+        timings.add(self.make_command_time('status', 2))
+        timings.add(self.make_command_time('deploy', 30))
+        self.assertEqual({
+            'status': {'count': 1, 'p50': 2, 'p95': 2, 'p99': 2},
+            'deploy': {'count': 1, 'p50': 30, 'p95': 30, 'p99': 30},
+            }, timings.get_percentiles())
+
+    def test_stream(self):
+        timings = CommandTimings()
+        with temp_dir() as log_dir:
+            path = os.path.join(log_dir, 'timings.jsonl')
+            timings.open_stream(path)
+            first = self.make_command_time('status', 2)
+            timings.add(first)
+            second = CommandTime('deploy', ['juju', 'deploy'])
+            timings.add(second)
+            with open(path) as stream_file:
+                self.assertEqual(1, len(stream_file.readlines()))
+            second.actual_completion()
+            timings.close_stream()
+            timings.add(self.make_command_time('status', 3))
+            with open(path) as stream_file:
+                records = [json.loads(line) for line in stream_file]
+        self.assertEqual([first.to_record(), second.to_record()], records)
+
+    def test_pickle(self):
+        timings = CommandTimings()
+        with temp_dir() as log_dir:
+            timings.open_stream(os.path.join(log_dir, 'timings.jsonl'))
+            timings.add(self.make_command_time())
+            unpickled = pickle.loads(pickle.dumps(timings))
+            timings.close_stream()
+        self.assertIsNone(unpickled._stream)
+        unpickled.add(self.make_command_time())
+        self.assertEqual(2, len(unpickled.get_records()))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestStatusPoller(TestCase):
+
+    def make_poller(self):
+        clock = FakeClock()
+        poller = StatusPoller(now=clock, sleep=clock.sleep,
+                              random=lambda: 0.5)
+        poller.max_interval = 10
+        return poller, clock
+
+    def test_get_status(self):
+        poller, clock = self.make_poller()
+        status = Status({'machines': {}}, '')
+        self.assertEqual((1, status), poller.get_status(lambda: status))
+        self.assertEqual([], clock.sleeps)
+
+    def test_get_status_fetches_after_seen(self):
+        poller, clock = self.make_poller()
+        statuses = [Status({'machines': {}}, ''),
+                    Status({'machines': {'0': {}}}, '')]
+        fetch = Mock(side_effect=statuses)
+        seen, status = poller.get_status(fetch)
+        self.assertEqual((2, statuses[1]), poller.get_status(fetch, seen))
+        self.assertEqual(2, fetch.call_count)
+
+    def test_get_status_shares_fetch(self):
+        poller, clock = self.make_poller()
+        status = Status({'machines': {}}, '')
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            fetching.set()
+            release.wait()
+            return status
+
+        results = []
+        fetcher = threading.Thread(
+            target=lambda: results.append(poller.get_status(slow_fetch)))
+        fetcher.start()
+        fetching.wait()
+        other_fetch = Mock()
+        waiter = threading.Thread(
+            target=lambda: results.append(poller.get_status(other_fetch)))
+        waiter.start()
+        release.set()
+        fetcher.join()
+        waiter.join()
+        self.assertEqual([(1, status), (1, status)], results)
+        self.assertEqual(0, other_fetch.call_count)
+
+    def test_get_status_backs_off_while_unchanged(self):
+        poller, clock = self.make_poller()
+        status = Status({'machines': {}}, '')
+        seen = None
+        for x in range(7):
+            seen, result = poller.get_status(lambda: status, seen)
+        self.assertEqual([1, 2, 4, 8, 10], clock.sleeps)
+
+    def test_get_status_resets_interval_on_change(self):
+        poller, clock = self.make_poller()
+        statuses = [Status({'machines': {}}, ''),
+                    Status({'machines': {}}, ''),
+                    Status({'machines': {}}, ''),
+                    Status({'machines': {'0': {}}}, ''),
+                    Status({'machines': {'0': {}}}, '')]
+        fetch = Mock(side_effect=statuses)
+        seen = None
+        for x in range(5):
+            seen, result = poller.get_status(fetch, seen)
+        self.assertEqual([1, 2], clock.sleeps)
+
+    def test_get_status_jitter(self):
+        poller, clock = self.make_poller()
+        poller._random = lambda: 1
+        status = Status({'machines': {}}, '')
+        seen, result = poller.get_status(lambda: status)
+        seen, result = poller.get_status(lambda: status, seen)
+        poller.get_status(lambda: status, seen)
+        self.assertEqual(1, len(clock.sleeps))
+        self.assertAlmostEqual(1.2, clock.sleeps[0])
+
+    def test_get_status_fetch_error(self):
+        poller, clock = self.make_poller()
+        status = Status({'machines': {}}, '')
+        fetch = Mock(side_effect=[StatusTimeout(), status])
+        with self.assertRaises(StatusTimeout):
+            poller.get_status(fetch)
+        self.assertEqual((1, status), poller.get_status(fetch))
+
+
+class TestGetStatusPoller(TestCase):
+
+    def test_get_status_poller(self):
+        poller = get_status_poller(('home', 'ctrl', 'model'))
+        self.assertIs(poller, get_status_poller(('home', 'ctrl', 'model')))
+        self.assertIsNot(poller, get_status_poller(('home', 'ctrl', 'foo')))
+
+    def test_clients_share_poller(self):
+        client = fake_juju_client()
+        clone = client.clone()
+        other = client.clone(env=client.env.clone('other'))
+        poller = client.get_status_poller()
+        self.assertIs(poller, clone.get_status_poller())
+        self.assertIsNot(poller, other.get_status_poller())
+
 
 class TestCommandComplete(TestCase):
 
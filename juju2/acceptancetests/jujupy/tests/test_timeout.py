@@ -3,18 +3,27 @@ from contextlib import contextmanager
 import datetime
 import random
 from signal import SIGTERM
-from unittest import TestCase
+import subprocess
+import sys
+from unittest import (
+    skipIf,
+    TestCase,
+    )
 
 from mock import (
     call,
+    Mock,
     patch,
     )
 
+from jujupy import timeout
 from jujupy.timeout import (
     main,
     parse_args,
+    Reaper,
     run_command,
     signals,
+    supervise,
     )
 from tests import parse_error
 
@@ -97,3 +106,118 @@ class TestRunCommand(TestCase):
         self.assertEqual(utn_mock.mock_calls, [call(), call(), call()])
         po_mock.return_value.send_signal.assert_called_once_with(SIGTERM)
         po_mock.return_value.wait.assert_called_once_with()
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestReaper(TestCase):
+
+    def make_reaper(self):
+        clock = FakeClock()
+        reaper = Reaper(now=clock)
+        # Avoid starting the reaper thread; tests call expire_due directly.
+        reaper._thread = object()
+        return reaper, clock
+
+    def test_expire_due(self):
+        reaper, clock = self.make_reaper()
+        proc = Mock(pid=1234, returncode=None)
+        deadline = reaper.watch(proc, 5, SIGTERM)
+        with patch('os.killpg', autospec=True) as kpg_mock:
+            self.assertEqual(reaper.expire_due(), 5)
+            clock.now += 5
+            self.assertIs(reaper.expire_due(), None)
+        kpg_mock.assert_called_once_with(1234, SIGTERM)
+        self.assertIs(deadline.expired, True)
+
+    def test_expire_due_earliest_first(self):
+        reaper, clock = self.make_reaper()
+        reaper.watch(Mock(pid=1, returncode=None), 10, SIGTERM)
+        reaper.watch(Mock(pid=2, returncode=None), 5, SIGTERM)
+        with patch('os.killpg', autospec=True) as kpg_mock:
+            clock.now += 6
+            self.assertEqual(reaper.expire_due(), 4)
+        kpg_mock.assert_called_once_with(2, SIGTERM)
+
+    def test_expire_due_cancelled(self):
+        reaper, clock = self.make_reaper()
+        deadline = reaper.watch(Mock(pid=1, returncode=None), 5, SIGTERM)
+        reaper.cancel(deadline)
+        with patch('os.killpg', autospec=True) as kpg_mock:
+            self.assertIs(reaper.expire_due(), None)
+            clock.now += 5
+            self.assertIs(reaper.expire_due(), None)
+        self.assertEqual(kpg_mock.call_count, 0)
+        self.assertIs(deadline.expired, False)
+
+    def test_expire_due_reaped(self):
+        reaper, clock = self.make_reaper()
+        deadline = reaper.watch(Mock(pid=1, returncode=0), 5, SIGTERM)
+        clock.now += 5
+        with patch('os.killpg', autospec=True) as kpg_mock:
+            reaper.expire_due()
+        self.assertEqual(kpg_mock.call_count, 0)
+        self.assertIs(deadline.expired, False)
+
+
+class TestSupervise(TestCase):
+
+    def test_supervise_none(self):
+        reaper = Mock()
+        proc = Mock()
+        with supervise(proc, None, reaper=reaper) as deadline:
+            pass
+        self.assertIs(deadline.expired, False)
+        self.assertEqual(reaper.mock_calls, [])
+
+    def test_supervise_cancels(self):
+        reaper = Mock()
+        proc = Mock()
+        with supervise(proc, 5, SIGTERM, reaper=reaper) as deadline:
+            reaper.watch.assert_called_once_with(proc, 5, SIGTERM)
+        self.assertIs(deadline, reaper.watch.return_value)
+        reaper.cancel.assert_called_once_with(deadline)
+
+
+class TestTimedCommands(TestCase):
+
+    def python(self, code):
+        return [sys.executable, '-c', code]
+
+    def test_call(self):
+        self.assertEqual(
+            timeout.call(self.python('import sys; sys.exit(3)'), 60), 3)
+
+    def test_call_timeout(self):
+        self.assertEqual(timeout.call(
+            self.python('import time; time.sleep(60)'), 0.2), 124)
+
+    def test_check_call(self):
+        self.assertEqual(timeout.check_call(self.python('pass'), 60), 0)
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            timeout.check_call(self.python('import sys; sys.exit(3)'), 60)
+        self.assertEqual(ctx.exception.returncode, 3)
+
+    def test_check_output(self):
+        self.assertEqual(timeout.check_output(
+            self.python('print("hello")'), 60).strip(), b'hello')
+
+    def test_check_output_timeout(self):
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            timeout.check_output(
+                self.python('import time; time.sleep(60)'), 0.2)
+        self.assertEqual(ctx.exception.returncode, 124)
+
+    @skipIf(sys.platform == 'win32', 'Process groups are posix-only.')
+    def test_start_new_group(self):
+        proc = timeout.start(self.python('import os; print(os.getpgrp())'),
+                             stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        self.assertEqual(int(output), proc.pid)
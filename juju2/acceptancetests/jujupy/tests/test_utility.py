@@ -6,6 +6,7 @@ from contextlib import contextmanager
 import errno
 import os
 import socket
+import stat
 
 from mock import (
     patch,
@@ -16,6 +17,8 @@ from tests import (
     )
 import jujupy.utility
 from jujupy.utility import (
+    find_executable,
+    get_popen_kwargs,
     is_ipv6_address,
     quote,
     scoped_environ,
@@ -157,6 +160,63 @@ class TestScopedEnviron(TestCase):
         self.assertNotEqual(os.environ, new_environ)
 
 
+def make_executable(directory, name):
+    path = os.path.join(directory, name)
+    with open(path, 'w'):
+        pass
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+
+class TestFindExecutable(TestCase):
+
+    def test_find_executable(self):
+        with temp_dir() as first:
+            with temp_dir() as second:
+                path = make_executable(second, 'juju')
+                environ = {'PATH': os.pathsep.join([first, second])}
+                self.assertEqual(path, find_executable('juju', environ))
+
+    def test_find_executable_first_on_path(self):
+        with temp_dir() as first:
+            with temp_dir() as second:
+                path = make_executable(first, 'juju')
+                make_executable(second, 'juju')
+                environ = {'PATH': os.pathsep.join([first, second])}
+                self.assertEqual(path, find_executable('juju', environ))
+
+    def test_find_executable_not_found(self):
+        with temp_dir() as first:
+            self.assertIs(None, find_executable('juju', {'PATH': first}))
+        self.assertIs(None, find_executable('juju', {}))
+
+    def test_find_executable_path(self):
+        self.assertEqual('/foo/juju', find_executable('/foo/juju', {}))
+
+    def test_find_executable_windows_extension(self):
+        with temp_dir() as first:
+            path = make_executable(first, 'juju.exe')
+            environ = {'PATH': first, 'PATHEXT': '.COM;.exe'}
+            with patch('sys.platform', 'win32'):
+                self.assertEqual(path, find_executable('juju', environ))
+            self.assertIs(None, find_executable('juju', environ))
+
+
+class TestGetPopenKwargs(TestCase):
+
+    def test_get_popen_kwargs(self):
+        with temp_dir() as first:
+            path = make_executable(first, 'juju')
+            environ = {'PATH': first}
+            self.assertEqual({'env': environ, 'executable': path},
+                             get_popen_kwargs(('juju', 'status'), environ))
+
+    def test_get_popen_kwargs_not_found(self):
+        environ = {'PATH': ''}
+        self.assertEqual({'env': environ},
+                         get_popen_kwargs(('juju', 'status'), environ))
+
+
 class TestTempDir(TestCase):
 
     def test_temp_dir(self):
@@ -7,7 +7,6 @@ from datetime import (
 import json
 import os
 import subprocess
-import sys
 from textwrap import dedent
 
 from mock import (
@@ -76,7 +75,6 @@ from tests import (
     TestCase
     )
 from jujupy.utility import (
-    get_timeout_path,
     temp_dir,
     )
 
@@ -728,8 +726,8 @@ class TestEnvJujuClient1X(ClientTest):
             client.get_juju_output('bar', timeout=5)
         self.assertEqual(
             po_mock.call_args[0][0],
-            (sys.executable, get_timeout_path(), '5.00', '--', 'juju',
-             '--show-log', 'bar', '-e', 'foo'))
+            ('setsid', 'juju', '--show-log', 'bar', '-e', 'foo'))
+        self.assertNotIn('preexec_fn', po_mock.call_args[1])
 
     def test__shell_environ_juju_home(self):
         client = EnvJujuClient1X(
@@ -744,7 +742,7 @@ class TestEnvJujuClient1X(ClientTest):
         client = EnvJujuClient1X(env, None, '/foobar/bar')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
             return FakePopen(None, None, 0)
         with patch('subprocess.Popen', autospec=True,
                    side_effect=check_path):
@@ -1405,23 +1403,22 @@ class TestEnvJujuClient1X(ClientTest):
         with patch('subprocess.check_call') as mock:
             client.set_env_option(
                 'tools-metadata-url', 'https://example.org/juju/tools')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(
             ('juju', '--show-log', 'set-env', '-e', 'foo',
              'tools-metadata-url=https://example.org/juju/tools'),
-            stderr=None)
+            env=environ, stderr=None)
 
     def test_unset_env_option(self):
         env = SimpleEnvironment('foo')
         client = EnvJujuClient1X(env, None, 'juju')
         with patch('subprocess.check_call') as mock:
             client.unset_env_option('tools-metadata-url')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(
             ('juju', '--show-log', 'set-env', '-e', 'foo',
-             'tools-metadata-url='), stderr=None)
+             'tools-metadata-url='),
+            env=environ, stderr=None)
 
     @contextmanager
     def run_model_defaults_test(self, operation_name):
@@ -1471,47 +1468,46 @@ class TestEnvJujuClient1X(ClientTest):
         client = EnvJujuClient1X(env, None, 'juju')
         with patch('subprocess.check_call') as mock:
             client.juju('foo', ('bar', 'baz'))
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         mock.assert_called_with(('juju', '--show-log', 'foo', '-e', 'qux',
-                                 'bar', 'baz'), stderr=None)
+                                 'bar', 'baz'), env=environ, stderr=None)
 
     def test_juju_env(self):
         env = SimpleEnvironment('qux')
         client = EnvJujuClient1X(env, None, '/foobar/baz')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
         with patch('subprocess.check_call', side_effect=check_path):
             client.juju('foo', ('bar', 'baz'))
 
     def test_juju_no_check(self):
         env = SimpleEnvironment('qux')
         client = EnvJujuClient1X(env, None, 'juju')
-        environ = dict(os.environ)
-        environ['JUJU_HOME'] = client.env.juju_home
+        environ = client._shell_environ()
         with patch('subprocess.call') as mock:
             client.juju('foo', ('bar', 'baz'), check=False)
         mock.assert_called_with(('juju', '--show-log', 'foo', '-e', 'qux',
-                                 'bar', 'baz'), stderr=None)
+                                 'bar', 'baz'), env=environ, stderr=None)
 
     def test_juju_no_check_env(self):
         env = SimpleEnvironment('qux')
         client = EnvJujuClient1X(env, None, '/foobar/baz')
 
         def check_path(*args, **kwargs):
-            self.assertRegexpMatches(os.environ['PATH'], r'/foobar\:')
+            self.assertRegexpMatches(kwargs['env']['PATH'], r'/foobar\:')
         with patch('subprocess.call', side_effect=check_path):
             client.juju('foo', ('bar', 'baz'), check=False)
 
     def test_juju_timeout(self):
         env = SimpleEnvironment('qux')
         client = EnvJujuClient1X(env, None, '/foobar/baz')
-        with patch('subprocess.check_call') as cc_mock:
+        with patch('jujupy.timeout.check_call') as cc_mock:
             client.juju('foo', ('bar', 'baz'), timeout=58)
-        self.assertEqual(cc_mock.call_args[0][0], (
-            sys.executable, get_timeout_path(), '58.00', '--', 'baz',
-            '--show-log', 'foo', '-e', 'qux', 'bar', 'baz'))
+        environ = client._shell_environ()
+        cc_mock.assert_called_once_with((
+            'baz', '--show-log', 'foo', '-e', 'qux', 'bar', 'baz'), 58,
+            env=environ, stderr=None)
 
     def test_juju_juju_home(self):
         env = SimpleEnvironment('qux')
@@ -1535,20 +1531,22 @@ class TestEnvJujuClient1X(ClientTest):
         extra_env = {'JUJU': '/juju', 'JUJU_HOME': client.env.juju_home}
 
         def check_env(*args, **kwargs):
-            self.assertEqual('/juju', os.environ['JUJU'])
+            self.assertEqual('/juju', kwargs['env']['JUJU'])
 
         with patch('subprocess.check_call', side_effect=check_env) as mock:
             client.juju('quickstart', ('bar', 'baz'), extra_env=extra_env)
+        environ = client._shell_environ()
+        environ.update(extra_env)
         mock.assert_called_with(
             ('juju', '--show-log', 'quickstart', '-e', 'qux', 'bar', 'baz'),
-            stderr=None)
+            env=environ, stderr=None)
 
     def test_juju_backup_with_tgz(self):
         env = SimpleEnvironment('qux')
         client = EnvJujuClient1X(env, None, '/foobar/baz')
 
         def check_env(*args, **kwargs):
-            self.assertEqual(os.environ['JUJU_ENV'], 'qux')
+            self.assertEqual(kwargs['env']['JUJU_ENV'], 'qux')
             return 'foojuju-backup-24.tgzz'
         with patch('subprocess.check_output',
                    side_effect=check_env) as co_mock:
@@ -1589,7 +1587,7 @@ class TestEnvJujuClient1X(ClientTest):
         environ['JUJU_ENV'] = client.env.environment
 
         def side_effect(*args, **kwargs):
-            self.assertEqual(environ, os.environ)
+            self.assertEqual(environ, kwargs['env'])
             return 'foojuju-backup-123-456.tar.gzbar'
         with patch('subprocess.check_output', side_effect=side_effect):
             client.backup()
@@ -1652,7 +1650,7 @@ class TestEnvJujuClient1X(ClientTest):
         with patch('subprocess.Popen') as popen_class_mock:
 
             def check_environ(*args, **kwargs):
-                self.assertEqual(environ, os.environ)
+                self.assertEqual(environ, kwargs['env'])
                 return proc_mock
             popen_class_mock.side_effect = check_environ
             proc_mock.wait.return_value = 0
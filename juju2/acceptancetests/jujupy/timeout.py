@@ -16,12 +16,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-"""A Python implementation of the *nix utility for use on all platforms."""
+"""A Python implementation of the *nix utility for use on all platforms.
+
+The module also supervises deadlines in-process, so that library code can
+time out commands without starting this script in another interpreter.
+"""
 from argparse import ArgumentParser
-from itertools import chain
+from contextlib import contextmanager
+import errno
+from heapq import (
+    heappop,
+    heappush,
+    )
+from itertools import (
+    chain,
+    count,
+    )
+import os
 import signal
 import subprocess
 import sys
+import threading
 import time
 
 from utility import until_timeout
@@ -43,6 +58,9 @@ else:
         x.startswith('SIG') and x not in ('SIG_DFL', 'SIG_IGN'))
 
 
+TIMEOUT_EXIT_CODE = 124
+
+
 def parse_args(argv=None):
     parser = ArgumentParser()
     parser.add_argument('duration', type=float)
@@ -75,7 +93,187 @@ def run_command(duration, timeout_signal, command):
     else:
         proc.send_signal(timeout_signal)
         proc.wait()
-        return 124
+        return TIMEOUT_EXIT_CODE
+
+
+def get_group_args(args):
+    """Return Popen args that start a command in a new process group.
+
+    Signalling the group on timeout also reaches the command's children.
+    On posix the command is run via setsid(1) rather than with a preexec_fn,
+    because a preexec_fn can deadlock the child when other threads are
+    running under Python 2.  setsid execs the command in place, so the
+    process id is also the group id.
+    """
+    if sys.platform == 'win32':
+        return tuple(args)
+    return ('setsid',) + tuple(args)
+
+
+def get_group_kwargs():
+    """Return Popen keyword arguments for a command from get_group_args."""
+    if sys.platform == 'win32':
+        # support CTRL_BREAK
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {}
+
+
+def signal_group(proc, signal_value):
+    """Send a signal to the process group started for proc."""
+    if sys.platform == 'win32':
+        # CTRL_BREAK_EVENT is delivered to the whole group.
+        proc.send_signal(signal_value)
+        return
+    try:
+        os.killpg(proc.pid, signal_value)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class Deadline:
+    """The time by which a supervised process must exit."""
+
+    def __init__(self, proc, when, timeout_signal):
+        self.proc = proc
+        self.when = when
+        self.timeout_signal = timeout_signal
+        self.expired = False
+        self.cancelled = False
+
+    def expire(self):
+        """Signal the process if it has not been reaped yet."""
+        if self.proc.returncode is not None:
+            return
+        signal_group(self.proc, self.timeout_signal)
+        self.expired = True
+
+
+class Reaper:
+    """Signal supervised processes whose deadlines have passed.
+
+    A single daemon thread serves every supervised process.  It sleeps until
+    the earliest deadline instead of polling each process.
+    """
+
+    def __init__(self, now=time.time):
+        self._now = now
+        self._condition = threading.Condition()
+        self._deadlines = []
+        self._counter = count()
+        self._thread = None
+
+    def watch(self, proc, duration, timeout_signal=signal.SIGTERM):
+        """Signal proc if it is still running after duration seconds.
+
+        :return: the Deadline, which must be cancelled once proc exits.
+        """
+        deadline = Deadline(proc, self._now() + duration, timeout_signal)
+        with self._condition:
+            heappush(self._deadlines,
+                     (deadline.when, next(self._counter), deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='timeout-reaper')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return deadline
+
+    def cancel(self, deadline):
+        """Stop supervising the process of a deadline."""
+        with self._condition:
+            deadline.cancelled = True
+
+    def expire_due(self):
+        """Signal the processes whose deadlines have passed.
+
+        Must be called with the condition held.
+        :return: The seconds until the next deadline, or None if there is
+            none.
+        """
+        now = self._now()
+        while self._deadlines:
+            when, _, deadline = self._deadlines[0]
+            if when > now and not deadline.cancelled:
+                return when - now
+            heappop(self._deadlines)
+            if not deadline.cancelled:
+                deadline.expire()
+        return None
+
+    def _run(self):
+        with self._condition:
+            while True:
+                self._condition.wait(self.expire_due())
+
+
+_reaper = Reaper()
+
+
+@contextmanager
+def supervise(proc, duration, timeout_signal=signal.SIGTERM, reaper=None):
+    """Signal proc's process group if it outlives duration seconds.
+
+    proc should have been started with get_group_args() and
+    get_group_kwargs().  If the caller is
+    interrupted, SIGINT is forwarded to the group, since it no longer shares
+    the terminal's foreground group.  If duration is None, proc is not
+    supervised.
+    :return: A context manager providing the Deadline.
+    """
+    if duration is None:
+        yield Deadline(proc, None, timeout_signal)
+        return
+    if reaper is None:
+        reaper = _reaper
+    deadline = reaper.watch(proc, duration, timeout_signal)
+    try:
+        yield deadline
+    except KeyboardInterrupt:
+        if sys.platform != 'win32' and proc.returncode is None:
+            signal_group(proc, signal.SIGINT)
+        raise
+    finally:
+        reaper.cancel(deadline)
+
+
+def start(args, **kwargs):
+    """Start a command in a new process group (Popen args)."""
+    kwargs.update(get_group_kwargs())
+    return subprocess.Popen(get_group_args(args), **kwargs)
+
+
+def call(args, duration, timeout_signal=signal.SIGTERM, **kwargs):
+    """Like subprocess.call, but signal the command after duration seconds.
+
+    :return: exit status of the command, 124 if the command was signalled.
+    """
+    proc = start(args, **kwargs)
+    with supervise(proc, duration, timeout_signal) as deadline:
+        returncode = proc.wait()
+    if deadline.expired:
+        return TIMEOUT_EXIT_CODE
+    return returncode
+
+
+def check_call(args, duration, timeout_signal=signal.SIGTERM, **kwargs):
+    """Like subprocess.check_call, but signal the command after duration."""
+    returncode = call(args, duration, timeout_signal, **kwargs)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return 0
+
+
+def check_output(args, duration, timeout_signal=signal.SIGTERM, **kwargs):
+    """Like subprocess.check_output, but signal the command after duration."""
+    proc = start(args, stdout=subprocess.PIPE, **kwargs)
+    with supervise(proc, duration, timeout_signal) as deadline:
+        output = proc.communicate()[0]
+    returncode = TIMEOUT_EXIT_CODE if deadline.expired else proc.returncode
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args, output)
+    return output
 
 
 def main(args=None):
@@ -193,6 +193,47 @@ def temp_yaml_file(yaml_dict, encoding="utf-8"):
         os.unlink(temp_file.name)
 
 
+def find_executable(name, environ=None):
+    """Return the path to an executable, searching the PATH of environ.
+
+    Popen searches its own PATH on Windows, even when given an env, so
+    commands run with another environment must be resolved first.
+
+    :param name: The executable name or path.
+    :param environ: The environment to search.  Defaults to os.environ.
+    :return: The path to the executable, or None if it was not found.
+    """
+    if environ is None:
+        environ = os.environ
+    if os.path.dirname(name) != '':
+        return name
+    extensions = ['']
+    if sys.platform == 'win32':
+        extensions.extend(
+            environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(';'))
+    for directory in environ.get('PATH', '').split(os.pathsep):
+        if directory == '':
+            continue
+        for extension in extensions:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def get_popen_kwargs(args, env):
+    """Return Popen arguments to run args in the environment env.
+
+    The environment is passed to the subprocess rather than set on os.environ,
+    so that commands may be run from several threads.
+    """
+    kwargs = {'env': env}
+    executable = find_executable(args[0], env)
+    if executable is not None:
+        kwargs['executable'] = executable
+    return kwargs
+
+
 def get_timeout_path():
     import jujupy.timeout
     return os.path.abspath(jujupy.timeout.__file__)
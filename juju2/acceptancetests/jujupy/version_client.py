@@ -49,7 +49,7 @@ from jujupy.client import (
     )
 from jujupy.utility import (
     ensure_deleted,
-    scoped_environ,
+    get_popen_kwargs,
     split_address_port,
     )
 
@@ -253,12 +253,10 @@ class EnvJujuClient1X(ModelClientRC):
         # juju-backup does not support the -e flag.
         environ['JUJU_ENV'] = self.env.environment
         try:
-            # Mutate os.environ instead of supplying env parameter so Windows
-            # can search env['PATH']
-            with scoped_environ(environ):
-                args = ['juju', 'backup']
-                log.info(' '.join(args))
-                output = subprocess.check_output(args)
+            args = ['juju', 'backup']
+            log.info(' '.join(args))
+            output = subprocess.check_output(
+                args, **get_popen_kwargs(args, environ))
         except subprocess.CalledProcessError as e:
             log.info(e.output)
             raise
@@ -5,6 +5,9 @@ from __future__ import print_function
 from datetime import datetime
 import logging
 import os
+import threading
+import time
+
 import requests
 
 from utility import get_unit_ipaddress
@@ -116,7 +119,10 @@ class PPROFCollector:
 
     FILE_TIMESTAMP = '%y%m%d-%H%M%S'
 
-    def __init__(self, client, machine_ids, logs_dir, active=False):
+    INDEX_TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, client, machine_ids, logs_dir, active=False,
+                 phase='bootstrap'):
         """Collector of pprof profiles from a machine.
 
         Defaults to being non-active meaning that any attempt to collect a
@@ -127,11 +133,16 @@ class PPROFCollector:
         (Note. first time going active will result in the introspection charm
         being deployed to the `machine_id.)
 
+        Profiles are collected from all machines at the same time, and each
+        one collected is recorded in `profiles` with its timestamp and the
+        test phase it was collected in.
+
         :param client: ModelClient to use to communicate with machine_ids.
         :param machine_ids: List of machine IDs to have collections for.
         :param logs_dir: Directory in which to store profile data.
         :param active: Bool indicating wherever to enable collection of data or
           not.
+        :param phase: Name of the current phase of the test.
 
         """
         if not isinstance(machine_ids, list):
@@ -141,6 +152,7 @@ class PPROFCollector:
         self._noop_collectors = []
         self._active = active
 
+        self._logs_dir = logs_dir
         self._cpu_profile_path = os.path.join(logs_dir, 'cpu_profile')
         os.makedirs(self._cpu_profile_path)
         self._heap_profile_path = os.path.join(logs_dir, 'heap_profile')
@@ -152,6 +164,12 @@ class PPROFCollector:
         self._client = client
         self._machine_ids = machine_ids
 
+        self.phase = phase
+        self.profiles = []
+        self._profiles_lock = threading.Lock()
+        self._collections = 0
+        self._sampler = None
+
         if self._active:
             self.set_active()
         else:
@@ -175,44 +193,129 @@ class PPROFCollector:
         self._collectors = self._noop_collectors
         self._active = False
 
-    def _get_profile_file_path(self, dir_path, machine_id):
-        """Given a directory create a timestamped file path."""
-        ts_file = datetime.utcnow().strftime(self.FILE_TIMESTAMP)
+    def set_phase(self, phase):
+        """Record profiles collected from now on as part of `phase`."""
+        log.info('PPROF collection phase: {}'.format(phase))
+        self.phase = phase
+
+    def get_profiles(self):
+        """Return the details of the profiles collected, oldest first."""
+        with self._profiles_lock:
+            return sorted(self.profiles, key=lambda p: p['timestamp'])
+
+    def _get_profile_file_path(self, dir_path, machine_id, timestamp,
+                               collection):
+        """Given a directory create a timestamped file path.
+
+        The collection number keeps profiles started within the same second,
+        such as a sample and an explicit collection, from overwriting each
+        other.
+        """
+        ts_file = timestamp.strftime(self.FILE_TIMESTAMP)
         return os.path.join(
             dir_path,
-            'machine-{}-{}.pprof'.format(
+            'machine-{}-{}-{}.pprof'.format(
                 machine_id,
-                ts_file))
+                ts_file,
+                collection))
+
+    def _collect_all(self, profile, method_name, dir_path, seconds):
+        """Collect a profile from every machine concurrently.
+
+        All the machines are sampled over the same period, so their profiles
+        can be compared.  The first error encountered is raised once every
+        collection has finished.
+        """
+        timestamp = datetime.utcnow()
+        phase = self.phase
+        with self._profiles_lock:
+            self._collections += 1
+            collection = self._collections
+        errors = []
+
+        def collect(collector):
+            filepath = self._get_profile_file_path(
+                dir_path, collector.machine_id, timestamp, collection)
+            try:
+                getattr(collector, method_name)(filepath, seconds)
+            except Exception as e:
+                log.error('Failed to collect {} profile from machine {}: '
+                          '{}'.format(profile, collector.machine_id, e))
+                errors.append(e)
+                return
+            if collector in self._active_collectors:
+                self._add_profile(
+                    profile, collector.machine_id, filepath, seconds,
+                    timestamp, phase)
+
+        threads = [threading.Thread(target=collect, args=(collector,))
+                   for collector in self._collectors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _add_profile(self, profile, machine_id, filepath, seconds, timestamp,
+                     phase):
+        with self._profiles_lock:
+            self.profiles.append({
+                'timestamp': timestamp.strftime(self.INDEX_TIMESTAMP),
+                'phase': phase,
+                'profile': profile,
+                'machine_id': machine_id,
+                'seconds': seconds,
+                'path': os.path.relpath(filepath, self._logs_dir),
+                })
 
     def collect_profile(self, seconds=5):
         """Collect `seconds` worth of CPU profile."""
-        for collector in self._collectors:
-            collector.collect_profile(
-                self._get_profile_file_path(
-                    self._cpu_profile_path,
-                    collector.machine_id,
-                ),
-                seconds
-            )
+        self._collect_all(
+            'cpu', 'collect_profile', self._cpu_profile_path, seconds)
 
     def collect_heap(self, seconds=5):
         """Collect `seconds` worth of heap profile."""
-        for collector in self._collectors:
-            collector.collect_heap(
-                self._get_profile_file_path(
-                    self._heap_profile_path,
-                    collector.machine_id,
-                ),
-                seconds
-            )
+        self._collect_all(
+            'heap', 'collect_heap', self._heap_profile_path, seconds)
 
     def collect_goroutines(self, seconds=5):
         """Collect `seconds` worth of goroutines profile."""
-        for collector in self._collectors:
-            collector.collect_goroutines(
-                self._get_profile_file_path(
-                    self._goroutines_path,
-                    collector.machine_id,
-                ),
-                seconds
-            )
+        self._collect_all(
+            'goroutines', 'collect_goroutines', self._goroutines_path,
+            seconds)
+
+    def start_sampling(self, interval, seconds=5):
+        """Collect CPU, heap and goroutine profiles every `interval` seconds.
+
+        Sampling runs in a background thread until stop_sampling is called.
+        Errors are logged rather than raised.
+        """
+        if self._sampler is not None:
+            raise ValueError('PPROF sampling already started.')
+        stop = threading.Event()
+
+        def sample():
+            while not stop.is_set():
+                started = time.time()
+                for collect in (self.collect_profile, self.collect_heap,
+                                self.collect_goroutines):
+                    try:
+                        collect(seconds)
+                    except Exception:
+                        log.exception('PPROF sampling failed.')
+                stop.wait(max(0, interval - (time.time() - started)))
+
+        thread = threading.Thread(target=sample, name='pprof-sampler')
+        thread.daemon = True
+        thread.start()
+        self._sampler = thread, stop
+
+    def stop_sampling(self):
+        """Stop background sampling, waiting for any sample in progress."""
+        if self._sampler is None:
+            return
+        thread, stop = self._sampler
+        stop.set()
+        thread.join()
+        self._sampler = None
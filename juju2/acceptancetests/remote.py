@@ -9,6 +9,7 @@ import zlib
 import winrm
 
 import jujupy
+import jujupy.timeout
 import utility
 
 
@@ -201,7 +202,8 @@ class SSHRemote(_Remote):
 
     def _run_subprocess(self, command):
         if self.timeout:
-            command = jujupy.get_timeout_prefix(self.timeout) + tuple(command)
+            return jujupy.timeout.check_output(
+                command, self.timeout, stdin=subprocess.PIPE)
         return subprocess.check_output(command, stdin=subprocess.PIPE)
 
 
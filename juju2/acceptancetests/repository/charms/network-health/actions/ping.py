@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import os
 import sys
@@ -18,6 +19,10 @@ from charmhelpers.core.hookenv import (
 )
 
 
+DEFAULT_TIMEOUT = 5
+DEFAULT_PARALLEL = 32
+
+
 def main():
     targets = hookenv.action_get('targets')
     hookenv.log("Got: {}".format(targets))
@@ -27,18 +32,33 @@ def main():
     targets = targets.replace(')', '}')
     hookenv.log('Parsed to: {}'.format(targets))
     targets = json.loads(targets)
-    results = {}
+    timeout = action_get('timeout') or DEFAULT_TIMEOUT
+    parallel = action_get('parallel') or DEFAULT_PARALLEL
+    action_set({'results': ping_targets(targets, timeout, parallel)})
+
+
+def ping_targets(targets, timeout, parallel):
+    """Ping the public address of each unit in targets concurrently, at most
+    parallel at a time, returning a dict of unit name to success.
+    """
+    if not targets:
+        return {}
     # Get unit names from targets dict and ping their public address
-    for target, ip in targets.items():
-        results[target] = ping_check(ip)
-    action_set({'results': results})
+    names = list(targets)
+    with ThreadPoolExecutor(max_workers=min(parallel, len(names))) as pool:
+        checks = pool.map(
+            lambda name: ping_check(targets[name], timeout), names)
+        return dict(zip(names, checks))
 
 
-def ping_check(target):
+def ping_check(target, timeout=DEFAULT_TIMEOUT):
     # If ping returns anything but success, return False
+    command = ['ping', '-c', '1', '-W', str(int(timeout)), target]
     try:
-        subprocess.check_output("ping -c 1 " + target, shell=True)
-    except subprocess.CalledProcessError as e:
+        # Allow a little longer than ping's own deadline for name lookup.
+        subprocess.check_output(command, timeout=timeout + 5)
+    except (subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as e:
         hookenv.log('Ping to target {} failed for exception {}'.format(target,
                                                                        e))
         return False
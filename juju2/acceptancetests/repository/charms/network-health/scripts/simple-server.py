@@ -9,10 +9,21 @@ SERVE_FILE_PATH = 'SIMPLE_HTTP_SERVER_INDEX_FILE'
 
 class SimpleRequestHandler(http.server.SimpleHTTPRequestHandler):
     """Simple request handler that always returns file supplied by env var."""
+    # Don't let a client that stops talking hold its thread forever.
+    timeout = 30
+
     def translate_path(self, path):
         return os.environ[SERVE_FILE_PATH]
 
 
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server that handles each connection in its own thread, so a slow
+    client doesn't hold up everyone else's checks."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
 def parse_args(argv):
     parser = argparse.ArgumentParser(description="Simple http server.")
     parser.add_argument('--file-path', help='Path to file to serve.')
@@ -27,7 +38,7 @@ def main(argv=None):
     server_details = ("", args.port)
     Handler = SimpleRequestHandler
     os.environ[SERVE_FILE_PATH] = args.file_path
-    httpd = socketserver.TCPServer(server_details, Handler)
+    httpd = ThreadedHTTPServer(server_details, Handler)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
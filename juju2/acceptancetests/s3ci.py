@@ -3,17 +3,20 @@ from __future__ import print_function
 
 from argparse import ArgumentParser
 from ConfigParser import ConfigParser
+import errno
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import sys
+import threading
 
 from boto.s3.connection import S3Connection
 
 from download_juju import (
-    download_files,
     filter_keys,
+    get_md5,
     )
 from jujuci import (
     acquire_binary,
@@ -23,7 +26,12 @@ from jujuci import (
 from jujupy import get_juju_home
 from utility import configure_logging
 
+__metaclass__ = type
+
+
 JUJU_QA_DATA = 'juju-qa-data'
+DEFAULT_WORKERS = 4
+PART_SIZE = 8 * 1024 * 1024
 
 
 def parse_args(args=None):
@@ -63,6 +71,13 @@ def parse_args(args=None):
         subparser.add_argument(
             'workspace', nargs='?', default='.',
             help='The directory to download into')
+        subparser.add_argument(
+            '--cache-dir', default=os.path.join(get_juju_home(), 's3ci'),
+            help='Directory for the index of build files.  Default to s3ci '
+                 'in juju home.')
+        subparser.add_argument(
+            '--workers', type=int, default=DEFAULT_WORKERS,
+            help='The number of parts to download at once.')
     for subparser in [parser_get_juju_bin, parser_get, parser_get_summary]:
         subparser.add_argument(
             '--config', default=default_config,
@@ -87,67 +102,257 @@ def get_job_path(revision_build, job):
     return 'juju-ci/products/version-{}/{}'.format(revision_build, job)
 
 
+def get_build_path(revision_build, job, build):
+    return '{}/build-{}/'.format(get_job_path(revision_build, job), build)
+
+
 class PackageNotFound(Exception):
     """Raised when a package cannot be found."""
 
 
-def find_package_key(bucket, revision_build):
+class ChecksumMismatch(Exception):
+    """Raised when a downloaded file does not match its key."""
+
+
+def list_builds(bucket, revision_build, job):
+    """Return the numbers of a job's builds, oldest first.
+
+    The builds are listed by their common prefixes, without listing their
+    files.
+    """
+    prefix = get_job_path(revision_build, job) + '/'
+    builds = []
+    for entry in bucket.list(prefix, delimiter='/'):
+        match = re.match(r'build-(\d+)/$', entry.name[len(prefix):])
+        if match is None:
+            logging.debug('not a build: {}'.format(entry.name))
+            continue
+        builds.append(int(match.group(1)))
+    return sorted(builds)
+
+
+class BuildIndex:
+    """An index of the files in builds, cached in a local directory.
+
+    An index is stored per revision build and job.  A build is only listed
+    again if a cached listing has no match, since its files may not all
+    have been uploaded when it was listed.
+    """
+
+    def __init__(self, cache_dir=None):
+        """Constructor.
+
+        :param cache_dir: The directory to store indexes in.  If None, they
+            are kept in memory only.
+        """
+        self.cache_dir = cache_dir
+        self._indexes = {}
+
+    def _get_path(self, revision_build, job):
+        return os.path.join(
+            self.cache_dir, '{}-{}.json'.format(revision_build, job))
+
+    def _load(self, revision_build, job):
+        index = self._indexes.get((revision_build, job))
+        if index is not None:
+            return index
+        index = {}
+        if self.cache_dir is not None:
+            try:
+                with open(self._get_path(revision_build, job)) as index_file:
+                    index = json.load(index_file)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            except ValueError:
+                logging.warning('Ignoring corrupt index for {} {}'.format(
+                    revision_build, job))
+        self._indexes[(revision_build, job)] = index
+        return index
+
+    def _save(self, revision_build, job, index):
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._get_path(revision_build, job)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(temp_path, path)
+
+    def find_keys(self, bucket, revision_build, job, build, predicate):
+        """Return the keys in a build whose path satisfies predicate.
+
+        The path is relative to the build.
+        """
+        index = self._load(revision_build, job)
+        prefix = get_build_path(revision_build, job, build)
+        entries = index.get(str(build))
+        if entries is not None:
+            keys = [self._make_key(bucket, entry) for entry in entries]
+            found = [k for k in keys if predicate(k.name[len(prefix):])]
+            if found:
+                return found
+        keys = list(bucket.list(prefix))
+        index[str(build)] = [
+            {'name': k.name, 'etag': k.etag, 'size': k.size} for k in keys]
+        self._save(revision_build, job, index)
+        return [k for k in keys if predicate(k.name[len(prefix):])]
+
+    @staticmethod
+    def _make_key(bucket, entry):
+        key = bucket.new_key(entry['name'])
+        key.etag = entry['etag']
+        key.size = entry['size']
+        return key
+
+
+def find_package_key(bucket, revision_build, index=None):
     namer = JobNamer.factory()
     job = namer.get_build_binary_job()
-    prefix = get_job_path(revision_build, job)
-    keys = bucket.list(prefix)
     suffix = PackageNamer.factory().get_release_package_suffix()
-    filtered = [
-        (k, f) for k, f in filter_keys(keys, suffix)
-        if f.startswith('juju-core_')]
-    if len(filtered) == 0:
-        raise PackageNotFound('Package could not be found.')
-    return sorted(filtered, key=lambda x: int(
-        re.search(r'build-(\d+)/', x[0].name).group(1)))[-1]
+    if index is None:
+        index = BuildIndex()
+
+    def is_package(path):
+        filename = os.path.basename(path)
+        return filename.startswith('juju-core_') and filename.endswith(suffix)
 
+    for build in reversed(list_builds(bucket, revision_build, job)):
+        keys = index.find_keys(bucket, revision_build, job, build, is_package)
+        if keys:
+            return next(filter_keys(keys[-1:], suffix))
+    raise PackageNotFound('Package could not be found.')
 
-def fetch_juju_binary(bucket, revision_build, workspace):
-    package_key, filename = find_package_key(bucket, revision_build)
+
+def fetch_juju_binary(bucket, revision_build, workspace, index=None,
+                      workers=DEFAULT_WORKERS):
+    package_key, filename = find_package_key(bucket, revision_build, index)
     logging.info('Selected: %s', package_key.name)
-    download_files([package_key], workspace)
-    package_path = os.path.join(workspace, filename)
+    package_path, = download_keys([package_key], workspace, workers)
     logging.info('Extracting: %s', package_path)
     return acquire_binary(package_path, workspace)
 
 
-def find_file_keys(bucket, revision_build, job, file_regex):
-    prefix = get_job_path(revision_build, job)
-    keys = bucket.list(prefix)
-    by_build = {}
-    for key in keys:
-        logging.debug('looking at {}'.format(key.name))
-        match = re.search('^/build-(\d+)', key.name[len(prefix):])
-        if match is None:
-            logging.debug('job name is not /{}/'.format(job))
-            continue
-        build = int(match.group(1))
-        by_build.setdefault(build, []).append(key)
+def find_file_keys(bucket, revision_build, job, file_regex, index=None):
     # We can't use last successful build, because we don't know what builds
     # are successful, so use last build and require it to be successful.
-    last_build = max(by_build.keys())
-    build_keys = by_build[last_build]
-    filtered = []
-    full_prefix = '{}/build-{}/'.format(prefix, last_build)
-    for key in build_keys:
-        path = key.name[len(full_prefix):]
-        if re.match(file_regex, path):
-            filtered.append(key)
-    return filtered
-
-
-def fetch_files(bucket, revision_build, job, file_pattern, workspace):
-    file_keys = find_file_keys(bucket, revision_build, job, file_pattern)
-    out_files = [os.path.join(workspace, k.name.split('/')[-1])
-                 for k in file_keys]
+    builds = list_builds(bucket, revision_build, job)
+    if index is None:
+        index = BuildIndex()
+    return index.find_keys(
+        bucket, revision_build, job, builds[-1],
+        lambda path: re.match(file_regex, path))
+
+
+def fetch_files(bucket, revision_build, job, file_pattern, workspace,
+                index=None, workers=DEFAULT_WORKERS):
+    file_keys = find_file_keys(
+        bucket, revision_build, job, file_pattern, index)
     for key in file_keys:
         logging.info('Selected: %s', key.name)
-    download_files(file_keys, workspace)
-    return out_files
+    return download_keys(file_keys, workspace, workers)
+
+
+def is_downloaded(key, path):
+    """Return True if the file at path has the size and md5 of key.
+
+    Keys uploaded in parts do not have the md5 of their content as their
+    etag, so only their size is compared.
+    """
+    if os.path.getsize(path) != key.size:
+        return False
+    etag = key.etag.strip('"')
+    return '-' in etag or get_md5(path) == etag
+
+
+def download_keys(keys, dst_dir, workers=DEFAULT_WORKERS, part_size=PART_SIZE):
+    """Download keys into dst_dir, several ranges at a time.
+
+    Files already in dst_dir that match their keys are not downloaded.
+    Each file is downloaded beside its destination and is only renamed into
+    place once its size and checksum have been verified.  Partial downloads
+    are removed on failure.  boto connections are not thread-safe, so each
+    worker downloads through its own connection.
+
+    :return: The paths of the files in dst_dir.
+    """
+    paths = []
+    downloads = []
+    tasks = []
+    try:
+        for key in keys:
+            dst_path = os.path.join(dst_dir, key.name.split('/')[-1])
+            paths.append(dst_path)
+            if os.path.isfile(dst_path) and is_downloaded(key, dst_path):
+                logging.info(
+                    'Matching local file found: {}'.format(dst_path))
+                continue
+            temp_path = dst_path + '.part'
+            downloads.append((key, temp_path, dst_path))
+            with open(temp_path, 'wb'):
+                pass
+            if key.size <= part_size:
+                tasks.append((key, temp_path, None))
+                continue
+            for start in range(0, key.size, part_size):
+                end = min(start + part_size, key.size) - 1
+                tasks.append((key, temp_path, (start, end)))
+        if tasks:
+            local = threading.local()
+
+            def download_range(task):
+                buckets = getattr(local, 'buckets', None)
+                if buckets is None:
+                    buckets = local.buckets = {}
+                bucket = task[0].bucket
+                if bucket.name not in buckets:
+                    buckets[bucket.name] = clone_bucket(bucket)
+                _download_range(buckets[bucket.name], task)
+
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                for ignored in pool.imap_unordered(download_range, tasks):
+                    pass
+            finally:
+                pool.terminate()
+                pool.join()
+        for key, temp_path, dst_path in downloads:
+            if not is_downloaded(key, temp_path):
+                raise ChecksumMismatch(
+                    'Download does not match {}'.format(key.name))
+            os.rename(temp_path, dst_path)
+    except BaseException:
+        for key, temp_path, dst_path in downloads:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        raise
+    return paths
+
+
+def clone_bucket(bucket):
+    """Return bucket through a new connection with the same credentials."""
+    conn = bucket.connection
+    new_conn = S3Connection(conn.aws_access_key_id,
+                            conn.aws_secret_access_key)
+    return new_conn.get_bucket(bucket.name, validate=False)
+
+
+def _download_range(bucket, task):
+    key, path, byte_range = task
+    # Keys hold the state of their request, so each download needs its own.
+    task_key = bucket.new_key(key.name)
+    if byte_range is None:
+        logging.info('Copying file: {} -> {}'.format(key.name, path))
+        task_key.get_contents_to_filename(path)
+        return
+    start, end = byte_range
+    content = task_key.get_contents_as_string(
+        headers={'Range': 'bytes={}-{}'.format(start, end)})
+    with open(path, 'r+b') as part_file:
+        part_file.seek(start)
+        part_file.write(content)
 
 
 def main():
@@ -173,13 +378,15 @@ def get_qa_data_bucket(config):
 
 def get_juju_bin(args):
     bucket = get_qa_data_bucket(args.config)
-    print(fetch_juju_binary(bucket, args.revision_build, args.workspace))
+    print(fetch_juju_binary(bucket, args.revision_build, args.workspace,
+                            BuildIndex(args.cache_dir), args.workers))
 
 
 def cmd_get(args):
     bucket = get_qa_data_bucket(args.config)
     for path in fetch_files(bucket, args.revision_build, args.job,
-                            args.file_pattern, args.workspace):
+                            args.file_pattern, args.workspace,
+                            BuildIndex(args.cache_dir), args.workers):
         print(path)
 
 
@@ -20,7 +20,10 @@ except ImportError:
     from unittest.mock import patch
 import yaml
 
-from jujupy.client import CommandTime
+from jujupy.client import (
+    CommandTime,
+    StatusPoller,
+    )
 import utility
 
 
@@ -63,6 +66,11 @@ class TestCase(unittest.TestCase):
         self.addCleanup(setattr, os, "environ", os.environ)
         os.environ = dict(self.test_environ)
 
+        # Tests repeat statuses without delay; waits must not pace polling.
+        self.addCleanup(
+            setattr, StatusPoller, "max_interval", StatusPoller.max_interval)
+        StatusPoller.max_interval = 0
+
         setup_test_logging(self, self.log_level)
 
     def assertIsTrue(self, expr, msg=None):
@@ -180,6 +180,8 @@ def assess_bootstrap_cxt(juju_version=None):
         juju_version = '1.25.5'
     call_cxt = patch('subprocess.call')
     cc_cxt = patch('subprocess.check_call')
+    tc_cxt = patch('jujupy.timeout.call')
+    tcc_cxt = patch('jujupy.timeout.check_call')
     gv_cxt = patch('jujupy.ModelClient.get_version',
                    side_effect=lambda cls: juju_version)
     gjo_cxt = patch('jujupy.ModelClient.get_juju_output', autospec=True,
@@ -187,7 +189,7 @@ def assess_bootstrap_cxt(juju_version=None):
     imc_cxt = patch('jujupy.ModelClient.iter_model_clients',
                     autospec=True, return_value=[])
     env_cxt = temp_env({'environments': {'bar': {'type': 'foo'}}})
-    with call_cxt, cc_cxt, gv_cxt, gjo_cxt, env_cxt, imc_cxt:
+    with call_cxt, cc_cxt, tc_cxt, tcc_cxt, gv_cxt, gjo_cxt, env_cxt, imc_cxt:
         yield
 
 
@@ -163,69 +163,46 @@ class TestRunChaosMonkey(FakeHomeTestCase):
         }
         self.assertEqual(expected, monkey_units)
 
-    def test_get_unit_status(self):
-        def output(*args, **kwargs):
-            status = yaml.safe_dump({
-                'machines': {
-                    '0': {'agent-state': 'started'}
-                },
-                'applications': {
-                    'jenkins': {
-                        'units': {
-                            'foo': {
-                                'subordinates': {
-                                    'chaos-monkey/0': {'baz': 'qux'},
-                                    'not-chaos/0': {'qwe': 'rty'},
-                                }
-                            },
-                            'bar': {
-                                'subordinates': {
-                                    'chaos-monkey/1': {'abc': '123'},
-                                }
-                            }
-                        }
-                    }
-                }
-            })
-            charm_config = yaml.safe_dump({
-                'charm': {'jenkins'},
-                'service': {'jenkins'},
-                'settings': {
-                    'chaos-dir': {
-                        'default': 'true',
-                        'description': 'bla bla',
-                        'type': 'string',
-                        'value': '/tmp/charm-dir',
-                    }
-                }
-            })
-            output = {
-                ('status',): status,
-                ('config', 'chaos-monkey'): charm_config,
-                }
-            return output[args]
+    def test_get_unit_statuses(self):
         client = ModelClient(JujuData('foo', {}), None, '/foo')
         monkey_runner = MonkeyRunner('foo', client, service='jenkins')
         monkey_runner.monkey_ids = {
             'chaos-monkey/0': 'workspace0',
-            'chaos-monkey/1': 'workspace1'
+            'chaos-monkey/1': 'workspace1',
+            'chaos-monkey/2': 'workspace2',
         }
-        with patch.object(client, 'get_juju_output', side_effect=output,
-                          autospec=True):
-            with patch('subprocess.call', autospec=True,
-                       return_value=0) as call_mock:
-                for unit_name in ['chaos-monkey/1', 'chaos-monkey/0']:
-                    self.assertEqual(monkey_runner.get_unit_status(unit_name),
-                                     'running')
-            self.assertEqual(call_mock.call_count, 2)
-        with patch.object(client, 'get_juju_output', side_effect=output,
-                          autospec=True):
-            with patch('subprocess.call', autospec=True,
-                       return_value=1) as call_mock:
-                for unit_name in ['chaos-monkey/1', 'chaos-monkey/0']:
-                    self.assertEqual(monkey_runner.get_unit_status(unit_name),
-                                     'done')
-            self.assertEqual(call_mock.call_count, 2)
+        monkey_runner.chaos_dir = '/tmp/charm-dir'
+        results = [
+            {'UnitId': 'chaos-monkey/0', 'Stdout': 'running\n'},
+            {'UnitId': 'chaos-monkey/1', 'Stdout': 'done\n'},
+            {'UnitId': 'chaos-monkey/2', 'Stdout': '', 'ReturnCode': 1},
+        ]
+        with patch.object(client, 'run', autospec=True,
+                          return_value=results) as run_mock:
+            statuses = monkey_runner.get_unit_statuses(
+                ['chaos-monkey/0', 'chaos-monkey/1', 'chaos-monkey/2'])
+        self.assertEqual(
+            {'chaos-monkey/0': 'running', 'chaos-monkey/1': 'done',
+             'chaos-monkey/2': 'done'},
+            statuses)
+        run_mock.assert_called_once_with(
+            ('case "$JUJU_UNIT_NAME" in '
+             'chaos-monkey/0) id=workspace0;; '
+             'chaos-monkey/1) id=workspace1;; '
+             'chaos-monkey/2) id=workspace2;; esac; '
+             'if [ -f /tmp/charm-dir/chaos_monkey.$id/chaos_runner.lock ]; '
+             'then echo running; else echo done; fi',),
+            units=['chaos-monkey/0', 'chaos-monkey/1', 'chaos-monkey/2'])
+
+    def test_get_chaos_dir_reads_config_once(self):
+        client = ModelClient(JujuData('foo', {}), None, '/foo')
+        monkey_runner = MonkeyRunner('foo', client, service='jenkins')
+        config = {'settings': {'chaos-dir': {'value': '/tmp/charm-dir'}}}
+        with patch.object(client, 'get_service_config', autospec=True,
+                          return_value=config) as gsc_mock:
+            self.assertEqual('/tmp/charm-dir', monkey_runner.get_chaos_dir())
+            self.assertEqual('/tmp/charm-dir', monkey_runner.get_chaos_dir())
+        gsc_mock.assert_called_once_with('chaos-monkey')
 
 
 class TestUnleashOnce(FakeHomeTestCase):
@@ -453,19 +430,56 @@ class TestWaitForChaos(FakeHomeTestCase):
         units = [('blib', 'blab')]
         with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
                           return_value=units) as ic_mock:
-            with patch.object(runner, 'get_unit_status',
-                              autospec=True, return_value='done') as us_mock:
-                returned = runner.wait_for_chaos()
+            with patch.object(runner, 'get_unit_statuses', autospec=True,
+                              return_value={'blib': 'done'}) as us_mock:
+                with patch('chaos.sleep', autospec=True) as sleep_mock:
+                    returned = runner.wait_for_chaos()
         self.assertEqual(returned, None)
         self.assertEqual(ic_mock.call_count, 1)
-        self.assertEqual(us_mock.call_count, 1)
+        us_mock.assert_called_once_with(['blib'])
+        self.assertEqual(sleep_mock.call_count, 0)
+
+    def test_wait_for_chaos_complete_failed_check(self):
+        client = ModelClient(JujuData('foo', {}), None, '/foo')
+        runner = MonkeyRunner('foo', client)
+        runner.monkey_ids = {'cm/0': 'workspace0', 'cm/1': 'workspace1'}
+        runner.chaos_dir = '/tmp/charm-dir'
+        results = [
+            {'UnitId': 'cm/0', 'Stdout': 'done\n'},
+            {'UnitId': 'cm/1', 'Stdout': '', 'ReturnCode': 1},
+            ]
+        with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
+                          return_value=[('cm/0', {}), ('cm/1', {})]):
+            with patch.object(client, 'run', autospec=True,
+                              return_value=results) as run_mock:
+                with patch('chaos.sleep', autospec=True) as sleep_mock:
+                    runner.wait_for_chaos()
+        self.assertEqual(1, run_mock.call_count)
+        self.assertEqual(0, sleep_mock.call_count)
+
+    def test_wait_for_chaos_start_failed_check(self):
+        client = ModelClient(JujuData('foo', {}), None, '/foo')
+        runner = MonkeyRunner('foo', client)
+        runner.monkey_ids = {'cm/0': 'workspace0'}
+        runner.chaos_dir = '/tmp/charm-dir'
+        results = [{'UnitId': 'cm/0', 'Stdout': '', 'ReturnCode': 1}]
+        with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
+                          return_value=[('cm/0', {})]):
+            with patch.object(client, 'run', autospec=True,
+                              return_value=results):
+                with patch('chaos.sleep', autospec=True):
+                    with self.assertRaisesRegexp(
+                            Exception, 'Chaos operations did not start.'):
+                        runner.wait_for_chaos(state='start', timeout=0.01)
 
     def test_wait_for_chaos_complete_timesout(self):
         client = ModelClient(JujuData('foo', {}), None, '/foo')
         runner = MonkeyRunner('foo', client)
-        with self.assertRaisesRegexp(
-                Exception, 'Chaos operations did not complete.'):
-            runner.wait_for_chaos(timeout=0)
+        with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
+                          return_value=[]):
+            with self.assertRaisesRegexp(
+                    Exception, 'Chaos operations did not complete.'):
+                runner.wait_for_chaos(timeout=0)
 
     def test_wait_for_chaos_started(self):
         client = ModelClient(JujuData('foo', {}), None, '/foo')
@@ -473,13 +487,56 @@ class TestWaitForChaos(FakeHomeTestCase):
         units = [('blib', 'blab')]
         with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
                           return_value=units) as ic_mock:
-            with patch.object(runner, 'get_unit_status',
-                              autospec=True,
-                              return_value='running') as us_mock:
+            with patch.object(runner, 'get_unit_statuses', autospec=True,
+                              return_value={'blib': 'running'}) as us_mock:
                 returned = runner.wait_for_chaos(state='start')
         self.assertEqual(returned, None)
         self.assertEqual(ic_mock.call_count, 1)
-        self.assertEqual(us_mock.call_count, 1)
+        us_mock.assert_called_once_with(['blib'])
+
+    def test_wait_for_chaos_polls_only_pending_units(self):
+        client = ModelClient(JujuData('foo', {}), None, '/foo')
+        runner = MonkeyRunner('foo', client)
+        units = [('cm/0', {}), ('cm/1', {}), ('cm/2', {})]
+        polls = [
+            {'cm/0': 'done', 'cm/1': 'running', 'cm/2': 'running'},
+            {'cm/1': 'running', 'cm/2': 'running'},
+            {'cm/1': 'running', 'cm/2': 'running'},
+            {'cm/1': 'done', 'cm/2': 'running'},
+            {'cm/2': 'done'},
+        ]
+        with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
+                          return_value=units) as ic_mock:
+            with patch.object(runner, 'get_unit_statuses', autospec=True,
+                              side_effect=polls) as us_mock:
+                with patch('chaos.sleep', autospec=True) as sleep_mock:
+                    runner.wait_for_chaos()
+        self.assertEqual(ic_mock.call_count, 1)
+        self.assertEqual([
+            call(['cm/0', 'cm/1', 'cm/2']),
+            call(['cm/1', 'cm/2']),
+            call(['cm/1', 'cm/2']),
+            call(['cm/1', 'cm/2']),
+            call(['cm/2']),
+            ], us_mock.call_args_list)
+        # The interval backs off while nothing changes and resets when
+        # a unit changes state.
+        self.assertEqual(
+            [1, 2, 4, 1], [c[0][0] for c in sleep_mock.call_args_list])
+
+    def test_wait_for_chaos_backoff_is_capped(self):
+        client = ModelClient(JujuData('foo', {}), None, '/foo')
+        runner = MonkeyRunner('foo', client)
+        polls = [{'cm/0': 'running'}] * 8 + [{'cm/0': 'done'}]
+        with patch.object(runner, 'iter_chaos_monkey_units', autospec=True,
+                          return_value=[('cm/0', {})]):
+            with patch.object(runner, 'get_unit_statuses', autospec=True,
+                              side_effect=polls):
+                with patch('chaos.sleep', autospec=True) as sleep_mock:
+                    runner.wait_for_chaos()
+        self.assertEqual(
+            [1, 2, 4, 8, 16, 16, 16, 16],
+            [c[0][0] for c in sleep_mock.call_args_list])
 
     def test_wait_for_chaos_unexpected_state(self):
         client = ModelClient(JujuData('foo', {}), None, '/foo')
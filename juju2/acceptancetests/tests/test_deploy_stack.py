@@ -60,7 +60,6 @@ from jujupy import (
     fake_juju_client_optional_jes,
     get_cache_path,
     get_juju_home,
-    get_timeout_prefix,
     JujuData,
     KILL_CONTROLLER,
     ModelClient,
@@ -232,11 +231,10 @@ class DeployStackTestCase(FakeHomeTestCase):
         second_start = datetime(2017, 3, 22, 23, 40, 51, 0)
         env = JujuData('foo', {'type': 'bar'})
         client = ModelClient(env, None, None)
-        client._backend.juju_timings.extend([
-            CommandTime('command1', ['command1', 'arg1'], start=first_start),
-            CommandTime(
-                'command2', ['command2', 'arg1', 'arg2'], start=second_start)
-        ])
+        client._backend.record_timing(
+            CommandTime('command1', ['command1', 'arg1'], start=first_start))
+        client._backend.record_timing(CommandTime(
+            'command2', ['command2', 'arg1', 'arg2'], start=second_start))
         client._backend.juju_timings[0].actual_completion(end=first_end)
         expected = [
             {
@@ -259,7 +257,13 @@ class DeployStackTestCase(FakeHomeTestCase):
             with open(os.path.join(fake_dir,
                       'juju_command_times.yaml')) as out_file:
                 file_data = yaml.load(out_file)
+            with open(os.path.join(fake_dir,
+                      'juju_command_percentiles.yaml')) as out_file:
+                percentiles = yaml.safe_load(out_file)
         self.assertEqual(file_data, expected)
+        self.assertEqual(
+            {'command1': {'count': 1, 'p50': 2, 'p95': 2, 'p99': 2}},
+            percentiles)
 
     def test_check_token(self):
         env = JujuData('foo', {'type': 'local'})
@@ -665,10 +669,10 @@ class DumpEnvLogsTestCase(FakeHomeTestCase):
         # then downloaded in the order that they will be created
         # to ensure errors do not prevent some logs from being retrieved.
         with patch('deploy_stack.wait_for_port', autospec=True):
-            with patch('subprocess.check_output') as cc_mock:
+            with patch('jujupy.timeout.check_output') as cc_mock:
                 copy_remote_logs(remote_from_address('10.10.0.1'), '/foo')
         self.assertEqual(
-            (get_timeout_prefix(120) + (
+            ([
                 'ssh',
                 '-o', 'User ubuntu',
                 '-o', 'UserKnownHostsFile /dev/null',
@@ -685,20 +689,20 @@ class DumpEnvLogsTestCase(FakeHomeTestCase):
                 ' /etc/network/interfaces'
                 ' /etc/environment'
                 ' /home/ubuntu/ifconfig.log'
-                ),),
+                ], 120),
             cc_mock.call_args_list[0][0])
         self.assertEqual(
-            (get_timeout_prefix(120) + (
+            ([
                 'ssh',
                 '-o', 'User ubuntu',
                 '-o', 'UserKnownHostsFile /dev/null',
                 '-o', 'StrictHostKeyChecking no',
                 '-o', 'PasswordAuthentication no',
                 '10.10.0.1',
-                'ifconfig > /home/ubuntu/ifconfig.log'),),
+                'ifconfig > /home/ubuntu/ifconfig.log'], 120),
             cc_mock.call_args_list[1][0])
         self.assertEqual(
-            (get_timeout_prefix(120) + (
+            ([
                 'scp', '-rC',
                 '-o', 'User ubuntu',
                 '-o', 'UserKnownHostsFile /dev/null',
@@ -714,7 +718,7 @@ class DumpEnvLogsTestCase(FakeHomeTestCase):
                 '10.10.0.1:/etc/network/interfaces',
                 '10.10.0.1:/etc/environment',
                 '10.10.0.1:/home/ubuntu/ifconfig.log',
-                '/foo'),),
+                '/foo'], 120),
             cc_mock.call_args_list[2][0])
 
     def test_copy_remote_logs_windows(self):
@@ -736,7 +740,8 @@ class DumpEnvLogsTestCase(FakeHomeTestCase):
             else:
                 raise subprocess.CalledProcessError('scp error', 'output')
 
-        with patch('subprocess.check_output', side_effect=remote_op) as co:
+        with patch('jujupy.timeout.check_output',
+                   side_effect=remote_op) as co:
             with patch('deploy_stack.wait_for_port', autospec=True):
                 copy_remote_logs(remote_from_address('10.10.0.1'), '/foo')
         self.assertEqual(3, co.call_count)
@@ -1219,7 +1224,8 @@ class TestTestUpgrade(FakeHomeTestCase):
         'juju', '--show-log', 'model-config', '-m', 'foo:controller',
         'agent-metadata-url')
     LIST_MODELS = (
-        'juju', '--show-log', 'list-models', '-c', 'foo', '--format', 'yaml')
+        'setsid', 'juju', '--show-log', 'list-models', '-c', 'foo',
+        '--format', 'yaml')
 
     @classmethod
     def upgrade_output(cls, args, **kwargs):
@@ -2194,6 +2200,18 @@ class TestBootstrapManager(FakeHomeTestCase):
                     pass
         djt_mock.assert_called_once_with(bs_manager.client, bs_manager.log_dir)
 
+    def test_top_context_streams_timings(self):
+        with self.make_bootstrap_manager() as bs_manager:
+            with bs_manager.top_context():
+                command_time = CommandTime('status', ['juju', 'status'])
+                command_time.actual_completion()
+                bs_manager.client._backend.record_timing(command_time)
+            stream_path = os.path.join(
+                bs_manager.log_dir, 'juju_command_times.jsonl')
+            with open(stream_path) as stream_file:
+                records = [json.loads(line) for line in stream_file]
+        self.assertEqual(['status'], [r['command'] for r in records])
+
     def test_top_context_dumps_timings_on_exception(self):
         with self.make_bootstrap_manager() as bs_manager:
             with patch('deploy_stack.dump_juju_timings') as djt_mock:
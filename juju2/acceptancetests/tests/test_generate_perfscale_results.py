@@ -28,6 +28,7 @@ def get_default_args(**kwargs):
         temp_env_name='an-env-mod',
         enable_ha=False,
         enable_pprof=False,
+        pprof_interval=None,
         debug=False,
         agent_stream=None,
         agent_url=None,
@@ -125,6 +126,65 @@ class TestRunPerfscaleTest(TestCase):
             noop_test.assert_called_once_with(
                 client, pprof_collector, get_default_args())
 
+    def test_samples_pprof_by_phase(self):
+        client = fake_juju_client()
+        with temp_dir() as juju_home:
+            client.env.juju_home = juju_home
+            bs_manager = make_bootstrap_manager(client)
+            bs_manager.log_dir = os.path.join(juju_home, 'log-dir')
+            os.mkdir(bs_manager.log_dir)
+
+            timing = gpr.TimingData(datetime.utcnow(), datetime.utcnow())
+            deploy_details = gpr.DeployDetails('test', dict(), timing)
+            pprof_collector = Mock()
+            pprof_collector.get_profiles.return_value = ['profile']
+
+            def target_test(client, pprof_collector, args):
+                pprof_collector.set_phase.assert_called_once_with('deploy')
+                return deploy_details
+
+            with patch.object(gpr, 'dump_performance_metrics_logs',
+                              autospec=True):
+                with patch.object(
+                        gpr, 'generate_reports', autospec=True) as m_gr:
+                    with patch.object(
+                            gpr, 'PPROFCollector', autospec=True) as p_pc:
+                        p_pc.return_value = pprof_collector
+                        gpr.run_perfscale_test(
+                            target_test,
+                            bs_manager,
+                            get_default_args(pprof_interval=300))
+
+        self.assertEqual([
+            call.set_phase('deploy'),
+            call.start_sampling(300),
+            call.set_phase('cleanup'),
+            call.stop_sampling(),
+            ], [c for c in pprof_collector.method_calls
+                if c[0] != 'get_profiles'])
+        self.assertEqual(['profile'], m_gr.call_args[0][5])
+
+    def test_stops_sampling_when_dumping_logs_fails(self):
+        client = fake_juju_client()
+        with temp_dir() as juju_home:
+            client.env.juju_home = juju_home
+            bs_manager = make_bootstrap_manager(client)
+            bs_manager.log_dir = os.path.join(juju_home, 'log-dir')
+            os.mkdir(bs_manager.log_dir)
+            pprof_collector = Mock()
+
+            with patch.object(gpr, 'dump_performance_metrics_logs',
+                              autospec=True, side_effect=ValueError):
+                with patch.object(
+                        gpr, 'PPROFCollector', autospec=True) as p_pc:
+                    p_pc.return_value = pprof_collector
+                    with self.assertRaises(SystemExit):
+                        gpr.run_perfscale_test(
+                            Mock(), bs_manager,
+                            get_default_args(pprof_interval=300))
+
+        pprof_collector.stop_sampling.assert_called_once_with()
+
 
 class TestGetControllerMachines(TestCase):
 
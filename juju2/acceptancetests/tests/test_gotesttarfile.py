@@ -1,16 +1,25 @@
+import json
 from mock import patch
 import os
 import shutil
+import subprocess
 import tarfile
+import threading
 from unittest import TestCase
 
 from gotesttarfile import (
     go_test_package,
+    go_test_shards,
+    load_timings,
     main,
     parse_args,
     run,
+    run_shard,
+    save_timings,
+    shard_packages,
     untar_gopath,
 )
+from tests import parse_error
 from utility import temp_dir
 
 
@@ -150,6 +159,21 @@ class GotesttarfileTestCase(TestCase):
         self.assertEqual('github/foo', args.package)
         self.assertTrue(args.remove_tarfile)
         self.assertEqual('juju.tar.gz', args.tarfile)
+        self.assertIsNone(args.shards)
+        self.assertEqual(1, args.retries)
+        self.assertIsNone(args.timing_db)
+
+    def test_parse_args_shards(self):
+        args = parse_args(['-s', '4', '--retries', '2', '--timing-db',
+                           'timings.json', 'juju.tar.gz'])
+        self.assertEqual(4, args.shards)
+        self.assertEqual(2, args.retries)
+        self.assertEqual('timings.json', args.timing_db)
+
+    def test_parse_args_shards_at_least_one(self):
+        with parse_error(self) as stderr:
+            parse_args(['-s', '0', 'juju.tar.gz'])
+        self.assertIn('--shards must be at least 1', stderr.getvalue())
 
     def test_main(self):
         with patch('gotesttarfile.untar_gopath', autospec=True) as ug_mock:
@@ -166,3 +190,164 @@ class GotesttarfileTestCase(TestCase):
         args, kwargs = gt_mock.call_args
         self.assertEqual(('github.com/juju/juju', 'go', gopath), args)
         self.assertFalse(kwargs['verbose'])
+
+    def test_main_shards(self):
+        with patch('gotesttarfile.untar_gopath', autospec=True) as ug_mock:
+            with patch('gotesttarfile.go_test_shards',
+                       autospec=True, return_value=0) as gs_mock:
+                returncode = main(['-s', '3', '--timing-db', 'timings.json',
+                                   '/juju.tar.gz'])
+        self.assertEqual(0, returncode)
+        gopath = ug_mock.call_args[0][1]
+        gs_mock.assert_called_once_with(
+            'github.com/juju/juju', 'go', gopath, 3, retries=1,
+            timing_db='timings.json', verbose=False)
+
+
+class TestShardPackages(TestCase):
+
+    def test_balances_by_timing(self):
+        timings = {'a': 10, 'b': 6, 'c': 5, 'd': 4, 'e': 1}
+        self.assertEqual(
+            [['a'], ['b', 'e'], ['c', 'd']],
+            shard_packages(['e', 'd', 'c', 'b', 'a'], timings, 3))
+
+    def test_unknown_packages_take_mean(self):
+        timings = {'a': 10, 'b': 2}
+        self.assertEqual(
+            [['a'], ['c', 'b']], shard_packages(['a', 'b', 'c'], timings, 2))
+
+    def test_fewer_packages_than_shards(self):
+        self.assertEqual([['a']], shard_packages(['a'], {}, 4))
+
+
+class TestTimings(TestCase):
+
+    def test_round_trip(self):
+        with temp_dir() as base_dir:
+            timing_db = os.path.join(base_dir, 'timings.json')
+            self.assertEqual({}, load_timings(timing_db))
+            save_timings(timing_db, {'a': 1.5})
+            save_timings(timing_db, {'a': 2.5, 'b': 1})
+            self.assertEqual({'a': 2.5, 'b': 1}, load_timings(timing_db))
+            self.assertEqual(['timings.json'], os.listdir(base_dir))
+
+    def test_load_corrupt(self):
+        with temp_dir() as base_dir:
+            timing_db = os.path.join(base_dir, 'timings.json')
+            with open(timing_db, 'w') as timing_file:
+                timing_file.write('{')
+            self.assertEqual({}, load_timings(timing_db))
+        self.assertEqual({}, load_timings(None))
+
+
+def fake_go_test(results):
+    """Return a fake run that fails go test per package as in results."""
+    calls = []
+
+    def fake_run(command, **kwargs):
+        calls.append((command, kwargs))
+        if command[:2] == ['go', 'test'] and command[-1] in results:
+            kwargs['stdout'].write('output of {}\n'.format(command[-1]))
+            return results[command[-1]].pop(0)
+        return 0
+
+    return fake_run, calls
+
+
+class TestRunShard(TestCase):
+
+    def test_run_shard(self):
+        fake_run, calls = fake_go_test({'a': [1, 0], 'b': [0]})
+        env = {'GOPATH': 'foo'}
+        with temp_dir() as gopath:
+            with patch('gotesttarfile.run', side_effect=fake_run):
+                with patch('sys.stdout'):
+                    results = run_shard(
+                        2, ['a', 'b'], 'go', gopath, env, 'pkg-dir', 1,
+                        threading.Lock())
+        self.assertEqual(
+            [('a', 2, 0, 2), ('b', 2, 0, 1)],
+            [(r.package, r.shard, r.returncode, r.attempts) for r in results])
+        test_calls = [c for c in calls if c[0][0] == 'go']
+        self.assertEqual(
+            [['go', 'test', '-timeout=1200s', p] for p in ['a', 'a', 'b']],
+            [c[0] for c in test_calls])
+        test_env = test_calls[0][1]['env']
+        shard_dir = test_env['TMPDIR']
+        self.assertEqual(gopath, os.path.dirname(shard_dir))
+        self.assertTrue(os.path.basename(shard_dir).startswith('shard-2-'))
+        self.assertEqual(shard_dir, test_env['TMP'])
+        self.assertEqual('foo', test_env['GOPATH'])
+        self.assertEqual('pkg-dir', test_calls[0][1]['cwd'])
+        self.assertEqual(subprocess.STDOUT, test_calls[0][1]['stderr'])
+        kill_calls = [c[0] for c in calls if c[0][0] == 'sudo']
+        self.assertEqual(
+            [['sudo', 'pkill', '-SIGABRT', '-f',
+              '[m]ongod.*' + shard_dir]] * 3,
+            kill_calls)
+
+    def test_run_shard_gives_up(self):
+        fake_run, calls = fake_go_test({'a': [1, 1, 1]})
+        with temp_dir() as gopath:
+            with patch('gotesttarfile.run', side_effect=fake_run):
+                with patch('sys.stdout'):
+                    results = run_shard(
+                        0, ['a'], 'go', gopath, {}, 'pkg-dir', 2,
+                        threading.Lock())
+        self.assertEqual([1], [r.returncode for r in results])
+        self.assertEqual([3], [r.attempts for r in results])
+
+
+class TestGoTestShards(TestCase):
+
+    def run_shards(self, results, timing_db=None):
+        fake_run, calls = fake_go_test(results)
+        with temp_dir() as gopath:
+            with patch('gotesttarfile.run', side_effect=fake_run):
+                with patch('gotesttarfile.list_packages', autospec=True,
+                           return_value=sorted(results)) as lp_mock:
+                    with patch('sys.stdout'):
+                        returncode = go_test_shards(
+                            'github.com/juju/juju', 'go', gopath, 2,
+                            timing_db=timing_db)
+        package_dir = os.path.join(
+            gopath, 'src', 'github.com', 'juju', 'juju')
+        self.assertEqual(package_dir, lp_mock.call_args[0][2])
+        return returncode, calls
+
+    def test_go_test_shards(self):
+        with temp_dir() as base_dir:
+            timing_db = os.path.join(base_dir, 'timings.json')
+            with open(timing_db, 'w') as timing_file:
+                json.dump({'a': 100, 'old': 3}, timing_file)
+            returncode, calls = self.run_shards(
+                {'a': [0], 'b': [1, 0], 'c': [0]}, timing_db)
+            timings = load_timings(timing_db)
+        self.assertEqual(0, returncode)
+        self.assertEqual(['go', 'test', '-i', './...'], calls[0][0])
+        self.assertEqual(['sudo', 'killall', '-SIGABRT', 'mongod'],
+                         calls[-1][0])
+        self.assertEqual(['a', 'b', 'c', 'old'], sorted(timings))
+        self.assertNotEqual(100, timings['a'])
+        test_envs = set(c[1]['env']['TMPDIR'] for c in calls
+                        if c[0][:2] == ['go', 'test'] and c[0][2] != '-i')
+        self.assertEqual(2, len(test_envs))
+
+    def test_go_test_shards_failure(self):
+        returncode, calls = self.run_shards({'a': [0], 'b': [1, 1]})
+        self.assertEqual(1, returncode)
+
+    def test_go_test_shards_build_failure(self):
+        def fake_run(command, **kwargs):
+            return 2
+
+        with temp_dir() as gopath:
+            with patch('gotesttarfile.run', side_effect=fake_run) as run_mock:
+                with patch('gotesttarfile.list_packages',
+                           autospec=True) as lp_mock:
+                    returncode = go_test_shards(
+                        'github.com/juju/juju', 'go', gopath, 2)
+        self.assertEqual(2, returncode)
+        self.assertEqual(1, run_mock.call_count)
+        self.assertEqual(0, lp_mock.call_count)
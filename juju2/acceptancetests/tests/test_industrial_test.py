@@ -12,9 +12,12 @@ from tempfile import (
     NamedTemporaryFile,
     )
 from textwrap import dedent
+from threading import Event
+import traceback
 
 from boto.ec2.securitygroup import SecurityGroup
 from mock import (
+    ANY,
     call,
     MagicMock,
     patch,
@@ -53,7 +56,6 @@ from jujuconfig import get_euca_env
 from jujupy import (
     ModelClient,
     EnvJujuClient1X,
-    get_timeout_prefix,
     JujuData,
     KVM_MACHINE,
     LXC_MACHINE,
@@ -242,6 +244,15 @@ class TestParseArgs(TestCase):
         args = parse_args(['rai', 'new-juju', QUICK, 'log-dir'])
         self.assertIs(args.old_stable, None)
 
+    def test_parse_args_parallel(self):
+        args = parse_args(['rai', 'new-juju', QUICK, 'log-dir'])
+        self.assertIs(args.parallel, False)
+        self.assertEqual(args.concurrent_attempts, 1)
+        args = parse_args(['rai', 'new-juju', QUICK, 'log-dir', '--parallel',
+                           '--concurrent-attempts', '3'])
+        self.assertIs(args.parallel, True)
+        self.assertEqual(args.concurrent_attempts, 3)
+
     def test_parse_args_agent_stream(self):
         args = parse_args(['rai', 'new-juju', QUICK, 'log-dir',
                            '--agent-stream', 'asdf'])
@@ -275,7 +286,7 @@ class FakeStepAttempt:
     def get_bootstrap_client(self, client):
         return client
 
-    def iter_test_results(self, old, new):
+    def iter_test_results(self, old, new, parallel=False):
         return iter(self.result)
 
     def iter_steps(self, client):
@@ -332,7 +343,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', attempts=7, suite=[DENSITY],
             log_dir='log-dir', new_agent_url=None, debug=False,
-            old_stable=None, agent_stream=None)
+            old_stable=None, agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo'):
             mit = MultiIndustrialTest.from_args(args, QUICK)
         self.assertEqual(mit.env, 'foo')
@@ -346,7 +358,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='bar', new_juju_path='new-path2', attempts=6, suite=[FULL],
             log_dir='log-dir2', new_agent_url=None, debug=False,
-            old_stable=None, agent_stream=None)
+            old_stable=None, agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('bar'):
             mit = MultiIndustrialTest.from_args(args, FULL)
         self.assertEqual(mit.env, 'bar')
@@ -364,7 +377,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', log_dir='log-dir',
             attempts=7, new_agent_url=None, debug=False, old_stable=None,
-            agent_stream=None)
+            agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo', {'type': 'maas'}):
             mit = MultiIndustrialTest.from_args(args, DENSITY)
         self.assertEqual(
@@ -374,7 +388,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', log_dir='log-dir',
             attempts=7, new_agent_url=None, debug=False, old_stable=None,
-            agent_stream=None)
+            agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo', {'type': 'maas'}):
             mit = MultiIndustrialTest.from_args(args, DENSITY)
             self.assertEqual(mit.debug, False)
@@ -386,14 +401,16 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', log_dir='log-dir',
             attempts=7, new_agent_url=None, debug=False,
-            old_stable='really-old-path', agent_stream=None)
+            old_stable='really-old-path', agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo'):
             mit = MultiIndustrialTest.from_args(args, FULL)
         self.assertEqual(mit.really_old_path, 'really-old-path')
         args = Namespace(
             env='bar', new_juju_path='new-path2', log_dir='log-dir',
             attempts=6, new_agent_url=None, debug=False, old_stable=None,
-            agent_stream=None)
+            agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('bar'):
             mit = MultiIndustrialTest.from_args(args, FULL)
         self.assertIs(mit.really_old_path, None)
@@ -402,7 +419,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', log_dir='log-dir',
             attempts=7, new_agent_url=None, debug=False, old_stable=None,
-            agent_stream='foo-stream')
+            agent_stream='foo-stream',
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo', {'type': 'maas'}):
             mit = MultiIndustrialTest.from_args(args, DENSITY)
             self.assertEqual(mit.debug, False)
@@ -414,7 +432,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', attempts=7,
             log_dir='log-dir', new_agent_url=None, debug=False,
-            old_stable=None, agent_stream=None)
+            old_stable=None, agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo'):
             mit = MultiIndustrialTest.from_args(args, DENSITY)
         self.assertEqual(
@@ -424,7 +443,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', attempts=7,
             log_dir='log-dir', new_agent_url=None, debug=False,
-            old_stable=None, agent_stream=None)
+            old_stable=None, agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo'):
             mit = MultiIndustrialTest.from_args(args, BACKUP)
         self.assertEqual(
@@ -434,7 +454,8 @@ class TestMultiIndustrialTest(TestCase):
         args = Namespace(
             env='foo', new_juju_path='new-path', attempts=7,
             log_dir='log-dir', new_agent_url='http://example.net',
-            debug=False, old_stable=None, agent_stream=None)
+            debug=False, old_stable=None, agent_stream=None,
+            parallel=False, concurrent_attempts=1)
         with temp_env('foo'):
             mit = MultiIndustrialTest.from_args(args, suite=QUICK)
         self.assertEqual(mit.new_agent_url, 'http://example.net')
@@ -551,6 +572,36 @@ class TestMultiIndustrialTest(TestCase):
         self.assertEqual([mit.stages], [sa.attempt_list for sa in
                          industrial.stage_attempts])
 
+    def test_make_industrial_test_attempt_index(self):
+        mit = MultiIndustrialTest('foo-env', 'bar-path', AttemptSuiteFactory([
+            DestroyEnvironmentAttempt]), 'log-dir', 5, parallel=True)
+        with self.patch_client(
+            lambda x, y=None, debug=False: fake_juju_client(
+                JujuData(x, {}, juju_home=''), full_path=y)):
+            industrial = mit.make_industrial_test(1)
+        self.assertEqual('foo-env-old-1',
+                         industrial.old_client.env.environment)
+        self.assertEqual('foo-env-new-1',
+                         industrial.new_client.env.environment)
+        self.assertIs(True, industrial.parallel)
+        self.assertIs(True, industrial.separate_homes)
+        self.assertEqual(os.path.join('log-dir', 'juju-homes'),
+                         industrial.homes_dir)
+
+    def test_make_industrial_test_attempt_index_not_parallel(self):
+        mit = MultiIndustrialTest('foo-env', 'bar-path', AttemptSuiteFactory([
+            DestroyEnvironmentAttempt]), 'log-dir', 5)
+        with self.patch_client(
+            lambda x, y=None, debug=False: fake_juju_client(
+                JujuData(x, {}, juju_home=''), full_path=y)):
+            industrial = mit.make_industrial_test(1)
+            sequential = mit.make_industrial_test()
+        self.assertIs(False, industrial.parallel)
+        self.assertIs(True, industrial.separate_homes)
+        self.assertIs(False, sequential.separate_homes)
+        self.assertEqual(os.path.join('log-dir', 'juju-homes'),
+                         sequential.homes_dir)
+
     def test_make_industrial_test_new_agent_url(self):
         mit = MultiIndustrialTest('foo-env', 'bar-path',
                                   AttemptSuiteFactory([]), 'log-dir',
@@ -711,6 +762,83 @@ class TestMultiIndustrialTest(TestCase):
              'report_on': True},
             ]})
 
+    def test_run_tests_concurrent(self):
+        log_dir = use_context(self, temp_dir())
+        mit = MultiIndustrialTest('foo-env', 'bar-path', AttemptSuiteFactory([
+            FakeAttemptClass('foo', True, True, new_path='bar-path'),
+            FakeAttemptClass('bar', True, False, new_path='bar-path'),
+            ]), log_dir, 5, 10, concurrent_attempts=2)
+        juju_home = use_context(self, temp_dir())
+        homes = set()
+
+        def side_effect(env, full_path=None, debug=False):
+            client = fake_juju_client(None, full_path, debug)
+            client.env.juju_home = juju_home
+            return client
+
+        def run_stages(industrial):
+            homes.update([industrial.old_client.env.juju_home,
+                          industrial.new_client.env.juju_home])
+            return real_run_stages(industrial)
+
+        real_run_stages = IndustrialTest.run_stages
+
+        with self.patch_client(side_effect):
+            with patch('industrial_test.BootstrapManager',
+                       side_effect=fake_bootstrap_manager):
+                with patch.object(mit, 'make_industrial_test',
+                                  wraps=mit.make_industrial_test) as mit_mock:
+                    with patch.object(IndustrialTest, 'run_stages',
+                                      run_stages):
+                        results = mit.run_tests()
+        # Every client of every attempt had its own copy of the juju home.
+        self.assertEqual(20, len(homes))
+        self.assertNotIn(juju_home, homes)
+        # As in serial runs, attempts continue until the last stage has
+        # enough of them, or max_attempts is reached.
+        self.assertEqual([call(i) for i in range(10)],
+                         mit_mock.call_args_list)
+        self.assertEqual(
+            [(r['test_id'], r['attempts'], r['new_failures'])
+             for r in results['results']],
+            [('bootstrap', 5, 0), ('prepare-suite', 5, 0), ('foo-id', 5, 0),
+             ('bar-id', 5, 5), ('destroy-env', 0, 0),
+             ('substrate-clean', 0, 0)])
+
+    def test_run_tests_concurrent_reraises(self):
+        mit = MultiIndustrialTest('foo-env', 'bar-path',
+                                  AttemptSuiteFactory([]), 'log-dir', 2, 2,
+                                  concurrent_attempts=2)
+        industrial = MagicMock()
+        industrial.run_attempt.side_effect = SystemExit(1)
+        with patch.object(mit, 'make_industrial_test',
+                          return_value=industrial):
+            with patch('logging.exception', autospec=True) as le_mock:
+                with self.assertRaises(SystemExit):
+                    mit.run_tests()
+        self.assertEqual(0, le_mock.call_count)
+
+    def test_run_tests_concurrent_logs_traceback(self):
+        mit = MultiIndustrialTest('foo-env', 'bar-path',
+                                  AttemptSuiteFactory([]), 'log-dir', 2, 2,
+                                  concurrent_attempts=2)
+        industrial = MagicMock()
+        error = ValueError('foo')
+        industrial.run_attempt.side_effect = error
+        tracebacks = []
+
+        def exception(msg):
+            tracebacks.append(traceback.format_exc())
+
+        with patch.object(mit, 'make_industrial_test',
+                          return_value=industrial):
+            with patch('logging.exception', autospec=True,
+                       side_effect=exception) as le_mock:
+                with self.assertRaises(ValueError):
+                    mit.run_tests()
+        self.assertEqual([call(error)] * 2, le_mock.call_args_list)
+        self.assertIn('run_attempt', tracebacks[0])
+
     def test_run_tests_max_attempts_less_than_attempt_count(self):
         log_dir = use_context(self, temp_dir())
         mit = MultiIndustrialTest(
@@ -987,6 +1115,65 @@ class TestIndustrialTest(JujuPyTestCase):
         with self.assertRaises(CannotUpgradeToOldClient):
             list(industrial.run_stages())
 
+    def check_separate_homes(self, parallel, separate_homes, homes_dir=None):
+        juju_home = use_context(self, temp_dir())
+        with open(os.path.join(juju_home, 'clouds.yaml'), 'w') as f:
+            f.write('clouds: {}\n')
+        os.makedirs(os.path.join(juju_home, 'ssh'))
+        with open(os.path.join(juju_home, 'ssh', 'juju_id_rsa'), 'w') as f:
+            f.write('key\n')
+        old_client = fake_juju_client()
+        new_client = fake_juju_client()
+        old_client.env.juju_home = juju_home
+        new_client.env.juju_home = juju_home
+        homes = []
+
+        class StubAttempt:
+
+            def iter_test_results(self, old, new, parallel=False):
+                homes.extend([old.env.juju_home, new.env.juju_home])
+                for home in homes:
+                    with open(os.path.join(home, 'clouds.yaml')) as f:
+                        self.test_case.assertEqual('clouds: {}\n', f.read())
+                    with open(os.path.join(home, 'ssh', 'juju_id_rsa')) as f:
+                        self.test_case.assertEqual('key\n', f.read())
+                yield ('foo-id', parallel, True)
+
+        attempt = StubAttempt()
+        attempt.test_case = self
+        industrial = IndustrialTest(old_client, new_client, [attempt],
+                                    parallel=parallel,
+                                    separate_homes=separate_homes,
+                                    homes_dir=homes_dir)
+        self.assertEqual([('foo-id', parallel, True)],
+                         industrial.run_attempt())
+        self.assertEqual(2, len(set(homes)))
+        self.assertNotIn(juju_home, homes)
+        self.assertEqual(juju_home, old_client.env.juju_home)
+        self.assertEqual(juju_home, new_client.env.juju_home)
+        return homes
+
+    def test_run_attempt_parallel_uses_separate_homes(self):
+        homes = self.check_separate_homes(parallel=True, separate_homes=False)
+        self.assertFalse(any(os.path.exists(home) for home in homes))
+
+    def test_run_attempt_separate_homes(self):
+        homes = self.check_separate_homes(parallel=False, separate_homes=True)
+        self.assertFalse(any(os.path.exists(home) for home in homes))
+
+    def test_run_attempt_keeps_homes_in_homes_dir(self):
+        log_dir = use_context(self, temp_dir())
+        homes_dir = os.path.join(log_dir, 'juju-homes')
+        homes = self.check_separate_homes(parallel=True, separate_homes=False,
+                                          homes_dir=homes_dir)
+        self.assertTrue(all(os.path.isdir(home) for home in homes))
+        self.assertEqual(
+            set([homes_dir]),
+            set(os.path.dirname(os.path.dirname(home)) for home in homes))
+        self.check_separate_homes(parallel=True, separate_homes=False,
+                                  homes_dir=homes_dir)
+        self.assertEqual(2, len(os.listdir(homes_dir)))
+
     def test_run_attempt(self):
         old_client = fake_juju_client()
         new_client = fake_juju_client()
@@ -1113,6 +1300,29 @@ class TestSteppedStageAttempt(JujuPyTestCase):
         self.assertEqual(ValueError('Test id mismatch: foo-id bar-id').args,
                          exc.exception.exception.args)
 
+    def test__iter_test_results_parallel(self):
+        old_started = Event()
+        new_started = Event()
+
+        def steps(started, other_started):
+            # Each step can only see the other running if they run at once.
+            started.set()
+            concurrent = other_started.wait(5)
+            yield None
+            yield {'test_id': 'foo-id', 'result': concurrent}
+
+        class StubSA(SteppedStageAttempt):
+
+            @staticmethod
+            def get_test_info():
+                return {'foo-id': {'title': 'foo-id'}}
+
+        self.assertEqual(
+            list(StubSA()._iter_test_results(
+                steps(old_started, new_started),
+                steps(new_started, old_started), parallel=True)),
+            [('foo-id', True, True)])
+
     def test__iter_test_results_many(self):
         old_iter = (x for x in [
             None, {'test_id': 'foo-id', 'result': True},
@@ -1239,12 +1449,13 @@ class TestDestroyEnvironmentAttempt(JujuPyTestCase):
         with patch.object(client, 'get_jes_command',
                           return_value='kill-controller'):
             with patch.object(destroy_env, 'get_security_groups') as gsg_mock:
-                with patch('subprocess.call', return_value=0) as mock_cc:
+                with patch('jujupy.timeout.call', return_value=0) as mock_cc:
                     self.assertEqual(iterator.next(), {
                         'test_id': 'destroy-env', 'result': True})
         gsg_mock.assert_called_once_with(client)
-        assert_juju_call(self, mock_cc, client, get_timeout_prefix(600) + (
-            'juju', '--show-log', 'kill-controller', 'steve', '-y'))
+        mock_cc.assert_called_once_with(
+            ('juju', '--show-log', 'kill-controller', 'steve', '-y'), 600,
+            env=ANY, stderr=None)
         self.assertEqual(iterator.next(), {'test_id': 'substrate-clean'})
         with patch.object(destroy_env, 'check_security_groups') as csg_mock:
             self.assertEqual(iterator.next(),
@@ -1258,12 +1469,13 @@ class TestDestroyEnvironmentAttempt(JujuPyTestCase):
         self.assertEqual({'test_id': 'destroy-env'}, iterator.next())
         with patch.object(client, 'is_jes_enabled', return_value=False):
             with patch.object(destroy_env, 'get_security_groups') as gsg_mock:
-                with patch('subprocess.call', return_value=0) as mock_cc:
+                with patch('jujupy.timeout.call', return_value=0) as mock_cc:
                     self.assertEqual(iterator.next(), {
                         'test_id': 'destroy-env', 'result': True})
         gsg_mock.assert_called_once_with(client)
-        assert_juju_call(self, mock_cc, client, get_timeout_prefix(600) + (
-            'juju', '--show-log', 'destroy-environment', 'steve', '-y'))
+        mock_cc.assert_called_once_with(
+            ('juju', '--show-log', 'destroy-environment', 'steve', '-y'), 600,
+            env=ANY, stderr=None)
         self.assertEqual(iterator.next(), {'test_id': 'substrate-clean'})
         with patch.object(destroy_env, 'check_security_groups') as csg_mock:
             self.assertEqual(iterator.next(),
@@ -1273,7 +1485,7 @@ class TestDestroyEnvironmentAttempt(JujuPyTestCase):
     def test_iter_test_results(self):
         client = FakeModelClient()
         destroy_env = DestroyEnvironmentAttempt()
-        with patch('subprocess.call'):
+        with patch('jujupy.timeout.call'):
             with patch.object(client, 'get_jes_command',
                               return_value='kill-controller'):
                 output = list(destroy_env.iter_test_results(client, client))
@@ -1285,7 +1497,7 @@ class TestDestroyEnvironmentAttempt(JujuPyTestCase):
         destroy_env = DestroyEnvironmentAttempt()
         iterator = iter_steps_validate_info(self, destroy_env, client)
         self.assertEqual({'test_id': 'destroy-env'}, iterator.next())
-        with patch('subprocess.call', return_value=1) as mock_cc:
+        with patch('jujupy.timeout.call', return_value=1) as mock_cc:
             with patch.object(client, 'get_jes_command',
                               return_value='kill-controller'):
                 with patch.object(destroy_env,
@@ -1305,15 +1517,16 @@ class TestDestroyEnvironmentAttempt(JujuPyTestCase):
         destroy_env = DestroyEnvironmentAttempt()
         iterator = iter_steps_validate_info(self, destroy_env, client)
         self.assertEqual({'test_id': 'destroy-env'}, iterator.next())
-        with patch('subprocess.call', return_value=1) as mock_cc:
+        with patch('jujupy.timeout.call', return_value=1) as mock_cc:
             with patch.object(client, 'is_jes_enabled', return_value=False):
                 with patch.object(destroy_env,
                                   'get_security_groups') as gsg_mock:
                     self.assertEqual(iterator.next(), {
                         'test_id': 'destroy-env', 'result': False})
         gsg_mock.assert_called_once_with(client)
-        assert_juju_call(self, mock_cc, client, get_timeout_prefix(600) + (
-            'juju', '--show-log', 'destroy-environment', 'steve', '-y'))
+        mock_cc.assert_called_once_with(
+            ('juju', '--show-log', 'destroy-environment', 'steve', '-y'), 600,
+            env=ANY, stderr=None)
         with self.assertRaises(StopIteration):
             iterator.next()
 
@@ -3,7 +3,8 @@
 from contextlib import contextmanager
 from datetime import datetime
 import os
-from mock import call, patch, Mock, mock_open
+import threading
+from mock import ANY, call, patch, Mock, mock_open
 
 import pprof_collector as pc
 from tests import TestCase
@@ -158,7 +159,7 @@ class TestPPROFCollector(TestCase):
     def test_collect_profile(self):
         client = Mock()
         log_dir = '/test/logs/dir'
-        file_name = 'machine-42-170130-092626.pprof'
+        file_name = 'machine-42-170130-092626-1.pprof'
         profile_log = os.path.join(log_dir, 'cpu_profile', file_name)
         with patch.object(pc.os, 'makedirs', autospec=True):
             with patch.object(pc, 'NoopCollector', autospec=True) as m_nc:
@@ -177,7 +178,7 @@ class TestPPROFCollector(TestCase):
     def test_collect_heap(selfm):
         client = Mock()
         log_dir = '/test/logs/dir'
-        file_name = 'machine-42-170130-092626.pprof'
+        file_name = 'machine-42-170130-092626-1.pprof'
         profile_log = os.path.join(log_dir, 'heap_profile', file_name)
         with patch.object(pc.os, 'makedirs', autospec=True):
             with patch.object(pc, 'NoopCollector', autospec=True) as m_nc:
@@ -196,7 +197,7 @@ class TestPPROFCollector(TestCase):
     def test_collect_goroutines(selfm):
         client = Mock()
         log_dir = '/test/logs/dir'
-        file_name = 'machine-42-170130-092626.pprof'
+        file_name = 'machine-42-170130-092626-1.pprof'
         profile_log = os.path.join(log_dir, 'goroutines_profile', file_name)
         with patch.object(pc.os, 'makedirs', autospec=True):
             with patch.object(pc, 'NoopCollector', autospec=True) as m_nc:
@@ -211,3 +212,100 @@ class TestPPROFCollector(TestCase):
         collector._collectors[0].collect_goroutines.assert_called_once_with(
             profile_log, 5
         )
+
+    @contextmanager
+    def active_collector(self, machine_ids):
+        log_dir = '/test/logs/dir'
+        with patch.object(pc.os, 'makedirs', autospec=True):
+            with patch.object(pc, 'ActiveCollector', autospec=True) as m_ac:
+                m_ac.side_effect = lambda client, m_id: Mock(machine_id=m_id)
+                collector = pc.PPROFCollector(
+                    Mock(), machine_ids, log_dir, active=True)
+                yield collector
+
+    def test_collect_profile_concurrently(self):
+        with self.active_collector(['0', '1', '2']) as collector:
+            started = []
+            all_started = threading.Event()
+            overlapped = []
+
+            def collect_profile(filepath, seconds):
+                # Every machine should be collecting at the same time.
+                started.append(filepath)
+                if len(started) == 3:
+                    all_started.set()
+                overlapped.append(all_started.wait(10))
+
+            for active in collector._collectors:
+                active.collect_profile.side_effect = collect_profile
+            collector.collect_profile()
+        self.assertEqual([True, True, True], overlapped)
+        for active in collector._collectors:
+            active.collect_profile.assert_called_once_with(ANY, 5)
+
+    def test_indexes_profiles(self):
+        with self.active_collector(['0', '1']) as collector:
+            with patch.object(pc, 'datetime') as p_dt:
+                p_dt.utcnow.return_value = datetime(
+                    2017, 1, 30, 9, 26, 26, 587930)
+                collector.collect_heap(10)
+                collector.set_phase('deploy')
+                collector.collect_profile()
+        self.assertEqual(
+            [('bootstrap', 'heap', '0'), ('bootstrap', 'heap', '1'),
+             ('deploy', 'cpu', '0'), ('deploy', 'cpu', '1')],
+            sorted((p['phase'], p['profile'], p['machine_id'])
+                   for p in collector.get_profiles()))
+        self.assertIn({
+            'timestamp': '2017-01-30 09:26:26',
+            'phase': 'bootstrap',
+            'profile': 'heap',
+            'machine_id': '0',
+            'seconds': 10,
+            'path': 'heap_profile/machine-0-170130-092626-1.pprof',
+            }, collector.get_profiles())
+
+    def test_collections_in_one_second_use_distinct_files(self):
+        with self.active_collector(['0']) as collector:
+            with patch.object(pc, 'datetime') as p_dt:
+                p_dt.utcnow.return_value = datetime(
+                    2017, 1, 30, 9, 26, 26, 587930)
+                collector.collect_heap()
+                collector.collect_heap()
+        self.assertEqual(
+            ['heap_profile/machine-0-170130-092626-1.pprof',
+             'heap_profile/machine-0-170130-092626-2.pprof'],
+            sorted(p['path'] for p in collector.get_profiles()))
+
+    def test_inactive_profiles_not_indexed(self):
+        with patch.object(pc.os, 'makedirs', autospec=True):
+            collector = pc.PPROFCollector(Mock(), ['0'], '/test/logs/dir')
+        collector.collect_profile()
+        self.assertEqual([], collector.get_profiles())
+
+    def test_collect_raises_after_all_machines(self):
+        with self.active_collector(['0', '1']) as collector:
+            error = ValueError('failed')
+            collector._collectors[0].collect_profile.side_effect = error
+            with self.assertRaises(ValueError):
+                collector.collect_profile()
+        self.assertEqual(
+            ['1'], [p['machine_id'] for p in collector.get_profiles()])
+
+    def test_sampling(self):
+        with self.active_collector(['0']) as collector:
+            sampled = threading.Event()
+            collector._collectors[0].collect_goroutines.side_effect = (
+                lambda filepath, seconds: sampled.set())
+            collector.start_sampling(3600, seconds=1)
+            self.assertTrue(sampled.wait(10))
+            with self.assertRaises(ValueError):
+                collector.start_sampling(3600)
+            collector.stop_sampling()
+            collector.stop_sampling()
+        self.assertEqual(
+            ['cpu', 'heap', 'goroutines'],
+            [p['profile'] for p in collector.get_profiles()])
+        active = collector._collectors[0]
+        self.assertEqual(1, active.collect_profile.call_count)
+        self.assertEqual(1, active.collect_heap.call_count)
@@ -3,7 +3,6 @@
 from mock import patch
 import os
 import subprocess
-import sys
 
 import winrm
 
@@ -19,7 +18,6 @@ from remote import (
 )
 import tests
 from utility import (
-    get_timeout_path,
     temp_dir,
 )
 
@@ -302,13 +300,9 @@ class TestRemote(tests.FakeHomeTestCase):
     def test_run_subprocess_timeout(self):
         remote = remote_from_address("10.55.60.1")
         remote.timeout = 63
-        with patch("subprocess.check_output", autospec=True) as mock_co:
+        with patch("jujupy.timeout.check_output", autospec=True) as mock_co:
             remote.cat("/a/file")
-        mock_co.assert_called_once_with((
-            sys.executable,
-            get_timeout_path(),
-            "63.00",
-            "--",
+        mock_co.assert_called_once_with([
             "ssh",
             "-o", "User ubuntu",
             "-o", "UserKnownHostsFile /dev/null",
@@ -316,7 +310,7 @@ class TestRemote(tests.FakeHomeTestCase):
             "-o", "PasswordAuthentication no",
             "10.55.60.1",
             "cat", "/a/file",
-            ),
+            ], 63,
             stdin=subprocess.PIPE,
         )
 
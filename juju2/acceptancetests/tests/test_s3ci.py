@@ -2,20 +2,21 @@ from argparse import Namespace
 from ConfigParser import NoOptionError
 from contextlib import contextmanager
 import errno
+import hashlib
+import json
 import os
 from StringIO import StringIO
 import sys
 from tempfile import NamedTemporaryFile
 from textwrap import dedent
+import threading
 from unittest import (
     skipIf,
     TestCase
     )
 
-from boto.s3.bucket import Bucket
-from boto.s3.key import Key as S3Key
 from mock import (
-    create_autospec,
+    Mock,
     patch,
     )
 
@@ -25,6 +26,10 @@ from jujuci import (
     )
 from jujupy import get_juju_home
 from s3ci import (
+    BuildIndex,
+    ChecksumMismatch,
+    clone_bucket,
+    download_keys,
     fetch_files,
     fetch_juju_binary,
     find_file_keys,
@@ -32,6 +37,7 @@ from s3ci import (
     get_job_path,
     get_s3_credentials,
     JUJU_QA_DATA,
+    list_builds,
     main,
     PackageNotFound,
     parse_args,
@@ -49,10 +55,11 @@ class TestParseArgs(TestCase):
 
     def test_get_juju_bin_defaults(self):
         default_config = os.path.join(get_juju_home(), 'juju-qa.s3cfg')
+        default_cache = os.path.join(get_juju_home(), 's3ci')
         args = parse_args(['get-juju-bin', '3275'])
         self.assertEqual(Namespace(
             command='get-juju-bin', config=default_config, revision_build=3275,
-            workspace='.', verbose=0),
+            workspace='.', verbose=0, cache_dir=default_cache, workers=4),
             args)
 
     def test_get_juju_bin_workspace(self):
@@ -72,10 +79,12 @@ class TestParseArgs(TestCase):
 
     def test_get_defaults(self):
         default_config = os.path.join(get_juju_home(), 'juju-qa.s3cfg')
+        default_cache = os.path.join(get_juju_home(), 's3ci')
         args = parse_args(['get', '3275', 'job-foo', 'files-bar'])
         self.assertEqual(Namespace(
             command='get', config=default_config, revision_build=3275,
-            job='job-foo', file_pattern='files-bar', workspace='.', verbose=0),
+            job='job-foo', file_pattern='files-bar', workspace='.', verbose=0,
+            cache_dir=default_cache, workers=4),
             args)
 
     def test_get_workspace(self):
@@ -140,10 +149,7 @@ class TestGetS3Credentials(TestCase):
 
 
 def mock_key(revision_build, job, build, file_path):
-    key = create_autospec(S3Key, instance=True)
-    key.name = '{}/build-{}/{}'.format(
-        get_job_path(revision_build, job), build, file_path)
-    return key
+    return FakeKey(revision_build, job, build, file_path)
 
 
 def mock_package_key(revision_build, build=27, distro_release=None):
@@ -155,16 +161,6 @@ def mock_package_key(revision_build, build=27, distro_release=None):
     return mock_key(revision_build, job, build, package)
 
 
-def mock_bucket(keys):
-    bucket = create_autospec(Bucket, instance=True)
-
-    def list_bucket(prefix):
-        return [key for key in keys if key.name.startswith(prefix)]
-
-    bucket.list.side_effect = list_bucket
-    return bucket
-
-
 def get_key_filename(key):
     return key.name.split('/')[-1]
 
@@ -179,11 +175,14 @@ class TestFindPackageKey(StrictTestCase):
 
     def test_find_package_key(self):
         key = mock_package_key(390)
-        bucket = mock_bucket([key])
+        bucket = FakeBucket([key])
         namer = JobNamer.factory()
         job = namer.get_build_binary_job()
         found_key, filename = find_package_key(bucket, 390)
-        bucket.list.assert_called_once_with(get_job_path(390, job))
+        self.assertEqual([
+            (get_job_path(390, job) + '/', '/'),
+            (get_job_path(390, job) + '/build-27/', None),
+            ], bucket.list_calls)
         self.assertIs(key, found_key)
         self.assertEqual(filename, get_key_filename(key))
 
@@ -230,8 +229,9 @@ class TestFetchJujuBinary(StrictTestCase):
             with patch('jujuci.extract_deb', autospec=True,
                        side_effect=extract) as ed_mock:
                 extracted = fetch_juju_binary(bucket, 275, workspace)
-        local_deb = os.path.join(workspace, filename)
-        key.get_contents_to_filename.assert_called_once_with(local_deb)
+            local_deb = os.path.join(workspace, filename)
+            with open(local_deb) as deb_file:
+                self.assertEqual(key.content, deb_file.read())
         eb_dir = os.path.join(workspace, 'extracted-bin')
         ed_mock.assert_called_once_with(local_deb, eb_dir)
         self.assertEqual(os.path.join(eb_dir, 'bin', 'juju'), extracted)
@@ -242,6 +242,8 @@ class TestFetchFiles(StrictTestCase):
     def setUp(self):
         use_context(self, patch('utility.get_deb_arch', return_value='amd65',
                                 autospec=True))
+        use_context(self, patch('s3ci.clone_bucket', autospec=True,
+                                side_effect=lambda bucket: bucket))
 
     def test_fetch_files(self):
         key = mock_key(275, 'job-foo', 27, 'file-pattern')
@@ -249,26 +251,84 @@ class TestFetchFiles(StrictTestCase):
         with temp_dir() as workspace:
             downloaded = fetch_files(bucket, 275, 'job-foo', 'file-pat+ern',
                                      workspace)
-        local_file = os.path.join(workspace, 'file-pattern')
-        key.get_contents_to_filename.assert_called_once_with(local_file)
+            local_file = os.path.join(workspace, 'file-pattern')
+            with open(local_file) as downloaded_file:
+                self.assertEqual(key.content, downloaded_file.read())
         key_copy = os.path.join(workspace, local_file)
         self.assertEqual([key_copy], downloaded)
 
 
 class FakeKey:
 
-    def __init__(self, revision_build, job, build, file_path):
-        job_path = get_job_path(revision_build, job)
-        self.name = '{}/build-{}/{}'.format(job_path, build, file_path)
+    def __init__(self, revision_build, job, build, file_path, content=None,
+                 name=None):
+        if name is None:
+            job_path = get_job_path(revision_build, job)
+            name = '{}/build-{}/{}'.format(job_path, build, file_path)
+        self.name = name
+        if content is None:
+            content = 'content of {}'.format(self.name)
+        self.content = content
+        self.bucket = None
+        self.size = len(content)
+        self.etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        self.requests = []
+
+    def get_contents_to_filename(self, filename):
+        self.requests.append(None)
+        if self.bucket is not None:
+            self.bucket.downloads.append(self.name)
+        with open(filename, 'wb') as key_file:
+            key_file.write(self.content)
+
+    def get_contents_as_string(self, headers=None):
+        start, end = [int(x) for x in
+                      headers['Range'][len('bytes='):].split('-')]
+        self.bucket.ranges.append((self.name, start, end))
+        return self.content[start:end + 1]
+
+
+class FakePrefix:
+
+    def __init__(self, name):
+        self.name = name
 
 
 class FakeBucket:
+    """A stand-in for a boto Bucket."""
 
-    def __init__(self, keys):
+    def __init__(self, keys, name=JUJU_QA_DATA):
         self.keys = keys
-
-    def list(self, prefix):
-        return [key for key in self.keys if key.name.startswith(prefix)]
+        self.name = name
+        for key in keys:
+            key.bucket = self
+        self.list_calls = []
+        self.ranges = []
+        self.downloads = []
+
+    def list(self, prefix, delimiter=None):
+        self.list_calls.append((prefix, delimiter))
+        keys = [key for key in self.keys if key.name.startswith(prefix)]
+        if delimiter is None:
+            return keys
+        entries = []
+        seen = set()
+        for key in keys:
+            head, sep, tail = key.name[len(prefix):].partition(delimiter)
+            if not sep:
+                entries.append(key)
+            elif head not in seen:
+                seen.add(head)
+                entries.append(FakePrefix(prefix + head + sep))
+        return entries
+
+    def new_key(self, name):
+        for key in self.keys:
+            if key.name == name:
+                new_key = FakeKey(None, None, None, None, key.content, name)
+                new_key.bucket = self
+                return new_key
+        raise AssertionError('No such key: {}'.format(name))
 
 
 class TestFindFileKeys(StrictTestCase):
@@ -311,6 +371,182 @@ class TestFindFileKeys(StrictTestCase):
         self.assertEqual([match_key], filtered)
 
 
+class TestListBuilds(StrictTestCase):
+
+    def test_list_builds(self):
+        bucket = FakeBucket([
+            FakeKey(275, 'job-foo', 10, 'file'),
+            FakeKey(275, 'job-foo', 9, 'file'),
+            FakeKey(275, 'job-foo', 9, 'dir/file'),
+            FakeKey(275, 'job-foo-1-8', 11, 'file'),
+            FakeKey(None, None, None, None,
+                    name=get_job_path(275, 'job-foo') + '/not-a-build'),
+            ])
+        self.assertEqual([9, 10], list_builds(bucket, 275, 'job-foo'))
+        self.assertEqual(
+            [(get_job_path(275, 'job-foo') + '/', '/')], bucket.list_calls)
+
+
+class TestBuildIndex(StrictTestCase):
+
+    def test_find_keys_cached(self):
+        key = FakeKey(275, 'job-foo', 27, 'file-pattern')
+        bucket = FakeBucket([key])
+        with temp_dir() as cache_dir:
+            index = BuildIndex(cache_dir)
+            found = index.find_keys(bucket, 275, 'job-foo', 27,
+                                    lambda path: path == 'file-pattern')
+            self.assertEqual([key], found)
+            self.assertEqual(1, len(bucket.list_calls))
+            with open(os.path.join(cache_dir, '275-job-foo.json')) as f:
+                self.assertEqual({'27': [{
+                    'name': key.name, 'etag': key.etag, 'size': key.size,
+                    }]}, json.load(f))
+            found, = BuildIndex(cache_dir).find_keys(
+                bucket, 275, 'job-foo', 27,
+                lambda path: path == 'file-pattern')
+        self.assertEqual(1, len(bucket.list_calls))
+        self.assertEqual(
+            (key.name, key.etag, key.size),
+            (found.name, found.etag, found.size))
+
+    def test_find_keys_lists_again_without_match(self):
+        bucket = FakeBucket([FakeKey(275, 'job-foo', 27, 'other')])
+        index = BuildIndex()
+        self.assertEqual([], index.find_keys(
+            bucket, 275, 'job-foo', 27, lambda path: path == 'file'))
+        late_key = FakeKey(275, 'job-foo', 27, 'file')
+        late_key.bucket = bucket
+        bucket.keys.append(late_key)
+        self.assertEqual([late_key], index.find_keys(
+            bucket, 275, 'job-foo', 27, lambda path: path == 'file'))
+        self.assertEqual(2, len(bucket.list_calls))
+
+    def test_corrupt_index_ignored(self):
+        key = FakeKey(275, 'job-foo', 27, 'file')
+        bucket = FakeBucket([key])
+        with temp_dir() as cache_dir:
+            with open(os.path.join(cache_dir, '275-job-foo.json'), 'w') as f:
+                f.write('{')
+            found = BuildIndex(cache_dir).find_keys(
+                bucket, 275, 'job-foo', 27, lambda path: True)
+        self.assertEqual([key], found)
+
+
+class TestCloneBucket(TestCase):
+
+    def test_clone_bucket(self):
+        bucket = Mock()
+        bucket.name = 'bucket-foo'
+        bucket.connection.aws_access_key_id = 'access'
+        bucket.connection.aws_secret_access_key = 'secret'
+        with patch('s3ci.S3Connection', autospec=True) as sc_mock:
+            clone = clone_bucket(bucket)
+        sc_mock.assert_called_once_with('access', 'secret')
+        sc_mock.return_value.get_bucket.assert_called_once_with(
+            'bucket-foo', validate=False)
+        self.assertIs(sc_mock.return_value.get_bucket.return_value, clone)
+
+
+class TestDownloadKeys(StrictTestCase):
+
+    def setUp(self):
+        super(TestDownloadKeys, self).setUp()
+        self.clone_threads = []
+
+        def fake_clone(bucket):
+            self.clone_threads.append(threading.current_thread())
+            return bucket
+
+        use_context(self, patch('s3ci.clone_bucket', autospec=True,
+                                side_effect=fake_clone))
+
+    def test_download_ranges(self):
+        content = ''.join(chr(n % 256) for n in range(1000))
+        key = FakeKey(275, 'job-foo', 27, 'big', content)
+        bucket = FakeBucket([key])
+        with temp_dir() as workspace:
+            paths = download_keys([key], workspace, workers=3, part_size=300)
+            with open(os.path.join(workspace, 'big'), 'rb') as f:
+                self.assertEqual(content, f.read())
+            self.assertEqual(['big'], os.listdir(workspace))
+        self.assertEqual([os.path.join(workspace, 'big')], paths)
+        self.assertEqual(
+            [(key.name, 0, 299), (key.name, 300, 599), (key.name, 600, 899),
+             (key.name, 900, 999)], sorted(bucket.ranges))
+
+    def test_connection_per_worker(self):
+        content = ''.join(chr(n % 256) for n in range(1000))
+        key = FakeKey(275, 'job-foo', 27, 'big', content)
+        FakeBucket([key])
+        with temp_dir() as workspace:
+            download_keys([key], workspace, workers=3, part_size=100)
+        self.assertNotEqual([], self.clone_threads)
+        self.assertEqual(len(self.clone_threads), len(set(self.clone_threads)))
+        self.assertNotIn(threading.current_thread(), self.clone_threads)
+
+    def test_range_error_removes_part(self):
+        content = ''.join(chr(n % 256) for n in range(1000))
+        key = FakeKey(275, 'job-foo', 27, 'big', content)
+        small_key = FakeKey(275, 'job-foo', 27, 'small')
+        bucket = FakeBucket([key, small_key])
+
+        def fail_range(headers=None):
+            raise IOError('range failed')
+
+        def new_key(name):
+            new_key = FakeKey(None, None, None, None, key.content, name)
+            new_key.bucket = bucket
+            new_key.get_contents_as_string = fail_range
+            return new_key
+
+        with temp_dir() as workspace:
+            with patch.object(bucket, 'new_key', side_effect=new_key):
+                with self.assertRaisesRegexp(IOError, 'range failed'):
+                    download_keys([small_key, key], workspace,
+                                  part_size=300)
+            self.assertEqual([], os.listdir(workspace))
+
+    def test_download_small(self):
+        key = FakeKey(275, 'job-foo', 27, 'small')
+        bucket = FakeBucket([key])
+        with temp_dir() as workspace:
+            download_keys([key], workspace)
+            with open(os.path.join(workspace, 'small')) as f:
+                self.assertEqual(key.content, f.read())
+        self.assertEqual([key.name], bucket.downloads)
+
+    def test_skips_matching_file(self):
+        key = FakeKey(275, 'job-foo', 27, 'small')
+        bucket = FakeBucket([key])
+        with temp_dir() as workspace:
+            with open(os.path.join(workspace, 'small'), 'w') as f:
+                f.write(key.content)
+            paths = download_keys([key], workspace)
+        self.assertEqual([], bucket.downloads)
+        self.assertEqual([os.path.join(workspace, 'small')], paths)
+
+    def test_checksum_mismatch(self):
+        key = FakeKey(275, 'job-foo', 27, 'small')
+        FakeBucket([key])
+        key.etag = '"{}"'.format(hashlib.md5('other').hexdigest())
+        with temp_dir() as workspace:
+            with self.assertRaises(ChecksumMismatch):
+                download_keys([key], workspace)
+            self.assertEqual([], os.listdir(workspace))
+
+    def test_multipart_etag_checks_size(self):
+        key = FakeKey(275, 'job-foo', 27, 'small')
+        FakeBucket([key])
+        key.etag = '"0123456789abcdef-2"'
+        with temp_dir() as workspace:
+            download_keys([key], workspace)
+            self.assertEqual(['small'], os.listdir(workspace))
+            key.size += 1
+            with self.assertRaises(ChecksumMismatch):
+                download_keys([key], workspace)
+
+
 class TestMain(StrictTestCase):
 
     @contextmanager
@@ -341,8 +577,11 @@ class TestMain(StrictTestCase):
         s3c_mock.assert_called_once_with('fake_username', 'fake_pass')
         gb_mock = s3c_mock.return_value.get_bucket
         gb_mock.assert_called_once_with(JUJU_QA_DATA)
-        gbj_mock.assert_called_once_with(gb_mock.return_value, 28,
-                                         'bar-workspace')
+        self.assertEqual((gb_mock.return_value, 28, 'bar-workspace'),
+                         gbj_mock.call_args[0][:3])
+        index = gbj_mock.call_args[0][3]
+        self.assertEqual(os.path.join(get_juju_home(), 's3ci'),
+                         index.cache_dir)
         self.assertEqual('gjb\n', stdout.getvalue())
 
     def test_main_args_get(self):
@@ -359,6 +598,8 @@ class TestMain(StrictTestCase):
         s3c_mock.assert_called_once_with('fake_username', 'fake_pass')
         gb_mock = s3c_mock.return_value.get_bucket
         gb_mock.assert_called_once_with(JUJU_QA_DATA)
-        ff_mock.assert_called_once_with(gb_mock.return_value, 28,
-                                        'foo-job', 'bar-file', 'bar-workspace')
+        self.assertEqual(
+            (gb_mock.return_value, 28, 'foo-job', 'bar-file', 'bar-workspace'),
+            ff_mock.call_args[0][:5])
+        self.assertEqual(4, ff_mock.call_args[0][6])
         self.assertEqual('ff\ngg\n', stdout.getvalue())
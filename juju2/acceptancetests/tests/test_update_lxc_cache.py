@@ -1,9 +1,14 @@
-from mock import patch
+from mock import (
+    call,
+    patch,
+    )
 import os
 from StringIO import StringIO
+import subprocess
 from unittest import TestCase
 
 from update_lxc_cache import (
+    get_push_bwlimit,
     INDEX,
     INDEX_PATH,
     INSTALL_SCRIPT,
@@ -11,9 +16,13 @@ from update_lxc_cache import (
     main,
     parse_args,
     PUT_SCRIPT,
-    System
+    System,
+    update_hosts,
+    )
+from utility import (
+    file_digest,
+    temp_dir,
     )
-from utility import temp_dir
 
 
 INDEX_DATA = """\
@@ -66,6 +75,15 @@ class UpdateLxcCacheTestCase(TestCase):
         self.assertEqual('default', args.variant)
         self.assertTrue(args.verbose)
         self.assertTrue(args.dry_run)
+        self.assertEqual(4, args.workers)
+        self.assertIsNone(args.bwlimit)
+
+    def test_parse_args_workers_bwlimit(self):
+        args = parse_args(
+            ['--workers', '2', '--bwlimit', '1000', 'user@host', 'trusty',
+             'ppc64el', './workspace'])
+        self.assertEqual(2, args.workers)
+        self.assertEqual(1000, args.bwlimit)
 
     @patch('update_lxc_cache.LxcCache.save_index', autospec=True)
     @patch('update_lxc_cache.LxcCache.put_lxc_data', autospec=True)
@@ -87,9 +105,65 @@ class UpdateLxcCacheTestCase(TestCase):
             lxc_cache, 'ubuntu', 'trusty', 'ppc64el', 'default')
         gl_mock.assert_called_with(lxc_cache, 'system')
         pl_mock.assert_called_with(
-            lxc_cache, 'user@host', 'system', 'rootfs_path', 'meta_path')
+            lxc_cache, 'user@host', 'system', 'rootfs_path', 'meta_path',
+            bwlimit=None)
         si_mock.assert_called_with(lxc_cache, 'data')
 
+    @patch('update_lxc_cache.LxcCache.save_index', autospec=True)
+    @patch('update_lxc_cache.update_hosts', autospec=True)
+    def test_main_many(self, uh_mock, si_mock):
+        remote_data = INDEX_DATA.replace(
+            'ppc64el;default;20154', 'ppc64el;default;20159').replace(
+            'arm64;default;201501', 'arm64;default;201509')
+        remote_systems = make_systems(remote_data)
+        with temp_dir() as workspace:
+            make_local_cache(workspace)
+            with patch('update_lxc_cache.LxcCache.init_systems',
+                       autospec=True,
+                       side_effect=[(make_systems(), INDEX_DATA),
+                                    (remote_systems, remote_data)]):
+                rc = main(['--bwlimit', '100', 'a@host,b@host', 'trusty',
+                           'ppc64el,armhf,arm64', workspace])
+        self.assertEqual(0, rc)
+        lxc_cache, user_hosts, systems, workers, bwlimit = (
+            uh_mock.call_args[0])
+        self.assertEqual(['a@host', 'b@host'], user_hosts)
+        self.assertEqual([
+            remote_systems[('ubuntu', 'trusty', 'ppc64el', 'default')],
+            remote_systems[('ubuntu', 'trusty', 'arm64', 'default')],
+            ], systems)
+        self.assertEqual((4, 100), (workers, bwlimit))
+        si_mock.assert_called_once_with(lxc_cache, remote_data)
+
+    def test_update_hosts(self):
+        systems = make_systems()
+        system_a = systems[('ubuntu', 'trusty', 'ppc64el', 'default')]
+        system_b = systems[('ubuntu', 'trusty', 'armhf', 'default')]
+        lxc_cache = LxcCache('workspace')
+
+        def get_lxc_data(system):
+            return system.arch + '/rootfs', system.arch + '/meta'
+
+        with patch.object(lxc_cache, 'get_lxc_data', autospec=True,
+                          side_effect=get_lxc_data) as gl_mock:
+            with patch.object(lxc_cache, 'put_lxc_data',
+                              autospec=True) as pl_mock:
+                update_hosts(lxc_cache, ['a@host', 'b@host'],
+                             [system_a, system_b], 3, bwlimit=900)
+        self.assertEqual(2, gl_mock.call_count)
+        self.assertItemsEqual([
+            call(host, system, system.arch + '/rootfs',
+                 system.arch + '/meta', bwlimit=300)
+            for host in ['a@host', 'b@host']
+            for system in [system_a, system_b]
+            ], pl_mock.call_args_list)
+
+    def test_get_push_bwlimit(self):
+        self.assertIsNone(get_push_bwlimit(None, 4, 8))
+        self.assertEqual(250, get_push_bwlimit(1000, 4, 8))
+        self.assertEqual(500, get_push_bwlimit(1000, 4, 2))
+        self.assertEqual(1, get_push_bwlimit(2, 4, 8))
+
 
 class LxcCacheTestCase(TestCase):
 
@@ -153,6 +227,20 @@ class LxcCacheTestCase(TestCase):
         is_mock.assert_called_with(
             'https://images.linuxcontainers.org/meta/1.0/index-system')
 
+    def test_get_updates_reads_remote_index_once(self):
+        systems = make_systems()
+        with temp_dir() as workspace:
+            lxc_cache = LxcCache(workspace)
+            with patch.object(lxc_cache, 'init_systems', autospec=True,
+                              return_value=(systems, INDEX_DATA)) as is_mock:
+                lxc_cache.get_updates('ubuntu', 'trusty', 'ppc64el',
+                                      'default')
+                new_system, new_data = lxc_cache.get_updates(
+                    'ubuntu', 'trusty', 'armhf', 'default')
+        self.assertEqual(
+            systems[('ubuntu', 'trusty', 'armhf', 'default')], new_system)
+        self.assertEqual(1, is_mock.call_count)
+
     def test_get_updates_found(self):
         remote_data = INDEX_DATA.replace(
             'ppc64el;default;20154', 'ppc64el;default;20159')
@@ -178,7 +266,9 @@ class LxcCacheTestCase(TestCase):
             make_local_cache(workspace)
             lxc_cache = LxcCache(workspace)
             with patch.object(lxc_cache, 'download', autospec=True) as d_mock:
-                rootfs_path, meta_path = lxc_cache.get_lxc_data(system)
+                with patch.object(lxc_cache, 'uncompress',
+                                  autospec=True) as u_mock:
+                    rootfs_path, meta_path = lxc_cache.get_lxc_data(system)
             image_path = os.path.join(
                 workspace, 'images/ubuntu/trusty/ppc64el/default/20154/')
             self.assertTrue(os.path.isdir(image_path))
@@ -194,6 +284,8 @@ class LxcCacheTestCase(TestCase):
             'https://images.linuxcontainers.org'
             '/images/ubuntu/trusty/ppc64el/default/20154/meta.tar.xz',
             meta_path)
+        u_mock.assert_called_once_with(
+            rootfs_path, os.path.join(image_path, 'rootfs.tar'))
 
     def test_put_lxc_data(self):
         systems = make_systems()
@@ -201,16 +293,106 @@ class LxcCacheTestCase(TestCase):
         with patch('subprocess.check_call', autospec=True) as cc_mock:
             lxc_cache = LxcCache('workspace')
             lxc_cache.put_lxc_data(
-                'user@host', system, '/rootfs_path', '/meta_path')
+                'user@host', system, '/image/rootfs.tar.xz', '/meta_path')
+        cache_path = '/var/cache/lxc/download/ubuntu/trusty/ppc64el/default'
+        staging = '.lxc-cache-staging/ubuntu/trusty/ppc64el/default'
         put_script = PUT_SCRIPT.format(
-            user_host='user@host', rootfs_path='/rootfs_path',
-            meta_path='/meta_path')
+            user_host='user@host', rootfs_tar_path='/image/rootfs.tar',
+            meta_path='/meta_path', lxc_cache=cache_path, staging=staging,
+            rootfs='rootfs.tar.xz', rootfs_tar='rootfs.tar',
+            meta='meta.tar.xz', bwlimit='')
         cc_mock.assert_any_call([put_script], shell=True)
-        cache_path = '/var/cache/lxc/download/ubuntu/trusty/ppc64el/default'
+        self.assertIn(
+            'rsync /image/rootfs.tar /meta_path user@host:{}/'.format(
+                staging), put_script)
+        self.assertIn(
+            'xz -dc {1}/rootfs.tar.xz > ~/{0}/rootfs.tar.part'.format(
+                staging, cache_path), put_script)
         install_script = INSTALL_SCRIPT.format(
-            user_host='user@host', lxc_cache=cache_path,
-            rootfs='rootfs.tar.xz', meta='meta.tar.xz')
+            user_host='user@host', lxc_cache=cache_path, staging=staging,
+            rootfs='rootfs.tar.xz', rootfs_tar='rootfs.tar',
+            meta='meta.tar.xz')
         cc_mock.assert_any_call([install_script], shell=True)
+        self.assertIn(
+            'xz -c ~/{0}/rootfs.tar > ~/{0}/rootfs.tar.xz'.format(staging),
+            install_script)
+        self.assertIn(
+            'sudo mv ~/{0}/rootfs.tar.xz {1}'.format(staging, cache_path),
+            install_script)
+
+    def test_put_lxc_data_bwlimit(self):
+        systems = make_systems()
+        system = systems[('ubuntu', 'trusty', 'ppc64el', 'default')]
+        with patch('subprocess.check_call', autospec=True) as cc_mock:
+            lxc_cache = LxcCache('workspace')
+            lxc_cache.put_lxc_data(
+                'user@host', system, '/image/rootfs.tar.xz', '/meta_path',
+                bwlimit=250)
+        put_script = cc_mock.call_args_list[0][0][0][0]
+        self.assertIn('rsync --bwlimit=250 /image/rootfs.tar', put_script)
+
+    def test_uncompress(self):
+        with temp_dir() as workspace:
+            rootfs_tar_path = os.path.join(workspace, 'rootfs.tar')
+            rootfs_path = os.path.join(workspace, 'rootfs.tar.xz')
+            with open(rootfs_tar_path, 'w') as f:
+                f.write('rootfs')
+            subprocess.check_call(['xz', rootfs_tar_path])
+            lxc_cache = LxcCache(workspace)
+            lxc_cache.uncompress(rootfs_path, rootfs_tar_path)
+            with open(rootfs_tar_path) as f:
+                self.assertEqual('rootfs', f.read())
+            self.assertEqual(['rootfs.tar', 'rootfs.tar.xz'],
+                             sorted(os.listdir(workspace)))
+
+    def test_get_lxc_data_shares_identical_files(self):
+        systems = make_systems()
+        system_a = systems[('ubuntu', 'trusty', 'ppc64el', 'default')]
+        system_b = systems[('ubuntu', 'trusty', 'armhf', 'default')]
+
+        def download(location, path):
+            with open(path, 'w') as f:
+                f.write(os.path.basename(path))
+
+        with temp_dir() as workspace:
+            lxc_cache = LxcCache(workspace)
+            with patch.object(lxc_cache, 'download', autospec=True,
+                              side_effect=download):
+                with patch.object(lxc_cache, 'uncompress', autospec=True):
+                    rootfs_a, meta_a = lxc_cache.get_lxc_data(system_a)
+                    rootfs_b, meta_b = lxc_cache.get_lxc_data(system_b)
+            object_path = lxc_cache.get_object_path(file_digest(rootfs_a))
+            self.assertTrue(os.path.samefile(rootfs_a, rootfs_b))
+            self.assertTrue(os.path.samefile(rootfs_a, object_path))
+            self.assertFalse(os.path.samefile(rootfs_a, meta_a))
+            self.assertEqual(3, os.stat(object_path).st_nlink)
+            with open(rootfs_b) as f:
+                self.assertEqual('rootfs.tar.xz', f.read())
+
+    def test_prune(self):
+        systems = make_systems()
+        system = systems[('ubuntu', 'trusty', 'ppc64el', 'default')]
+        old_system = system._replace(
+            version='20150', path=system.path.replace('20154', '20150'))
+
+        def download(location, path):
+            with open(path, 'w') as f:
+                f.write(location)
+
+        with temp_dir() as workspace:
+            lxc_cache = LxcCache(workspace)
+            with patch.object(lxc_cache, 'download', autospec=True,
+                              side_effect=download):
+                with patch.object(lxc_cache, 'uncompress', autospec=True):
+                    old_rootfs, old_meta = lxc_cache.get_lxc_data(old_system)
+                    rootfs, meta = lxc_cache.get_lxc_data(system)
+            old_object = lxc_cache.get_object_path(file_digest(old_rootfs))
+            lxc_cache.prune([system])
+            self.assertFalse(os.path.exists(old_rootfs))
+            self.assertFalse(os.path.exists(old_object))
+            self.assertTrue(os.path.isfile(rootfs))
+            self.assertTrue(os.path.isfile(
+                lxc_cache.get_object_path(file_digest(rootfs))))
 
     def test_save_index(self):
         with temp_dir() as workspace:
@@ -233,6 +415,7 @@ class LxcCacheTestCase(TestCase):
                     file_path = os.path.join(workspace, 'rootfs.tar.xz')
                     lxc_cache.download('url', file_path)
             self.assertTrue(os.path.isfile(file_path))
+            self.assertEqual(['rootfs.tar.xz'], os.listdir(workspace))
             with open(file_path) as f:
                 data = f.read()
         self.assertEqual('rootfs.tar.xz', data)
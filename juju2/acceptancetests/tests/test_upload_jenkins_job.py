@@ -1,10 +1,17 @@
 from argparse import Namespace
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+    )
 from ConfigParser import NoOptionError
+from contextlib import contextmanager
 import json
+import threading
 from time import sleep
 from unittest import TestCase
 
 from mock import patch, MagicMock, call
+import requests
 from tempfile import NamedTemporaryFile
 
 from jujuci import (
@@ -165,6 +172,31 @@ class TestJenkinsBuild(TestCase):
         self.assertIs(build_status, False)
         self.assertEqual(gbd_mock.mock_calls, create_build_data_calls())
 
+    def test_artifacts_stream(self):
+        content = 'x' * (3 * 1024 * 1024 + 1)
+        with jenkins_stand_in({'/job/1/artifact/logs/a.log': content}) as (
+                url, requested):
+            build_info = {'url': url + '/job/1/', 'artifacts': [
+                {'relativePath': 'logs/a.log', 'fileName': 'a.log'}]}
+            j = JenkinsBuild(fake_credentials(), JOB_NAME, url, build_info)
+            artifacts = list(j.artifacts(stream=True))
+            self.assertEqual([], requested)
+            (filename, chunks), = artifacts
+            chunks = list(chunks)
+        self.assertEqual('a.log', filename)
+        self.assertEqual(['/job/1/artifact/logs/a.log'], requested)
+        self.assertEqual(content, ''.join(chunks))
+        self.assertEqual(4, len(chunks))
+
+    def test_artifacts_stream_error(self):
+        with jenkins_stand_in({}) as (url, requested):
+            build_info = {'url': url + '/job/1/', 'artifacts': [
+                {'relativePath': 'a.log', 'fileName': 'a.log'}]}
+            j = JenkinsBuild(fake_credentials(), JOB_NAME, url, build_info)
+            (filename, chunks), = j.artifacts(stream=True)
+            with self.assertRaises(requests.HTTPError):
+                list(chunks)
+
 
 class TestS3(TestCase):
     def test_factory(self):
@@ -181,6 +213,20 @@ class TestS3(TestCase):
         g_mock.assert_called_once_with()
         j_mock.assert_called_once_with(cred[0], cred[1])
 
+    def test_clone(self):
+        bucket = MagicMock()
+        bucket.name = 'buck'
+        s3 = S3('dir', 'access', 'secret', None, bucket)
+        with patch('upload_jenkins_job.S3Connection',
+                   autospec=True) as sc_mock:
+            clone = s3.clone()
+        sc_mock.assert_called_once_with('access', 'secret')
+        sc_mock.return_value.get_bucket.assert_called_once_with('buck')
+        self.assertEqual('dir', clone.dir)
+        self.assertIs(sc_mock.return_value, clone.conn)
+        self.assertIs(sc_mock.return_value.get_bucket.return_value,
+                      clone.bucket)
+
     def test_store(self):
         b_mock = MagicMock()
         s3 = S3('/comp-test', 'fake', 'fake', None, b_mock)
@@ -189,6 +235,59 @@ class TestS3(TestCase):
         (b_mock.new_key.return_value.set_contents_from_string.
             assert_called_once_with('fake data', headers=None))
 
+    def test_store_stream_small(self):
+        bucket = FakeBucket()
+        s3 = S3('/comp-test', 'fake', 'fake', None, bucket)
+        status = s3.store_stream('foo', ['ab', 'cd'], part_size=5)
+        self.assertIs(True, status)
+        self.assertEqual({'/comp-test/foo': 'abcd'}, bucket.objects)
+        self.assertEqual([], bucket.uploads)
+
+    def test_store_stream_empty(self):
+        bucket = FakeBucket()
+        s3 = S3('/comp-test', 'fake', 'fake', None, bucket)
+        self.assertIs(False, s3.store_stream('foo', iter([])))
+        self.assertEqual({}, bucket.objects)
+
+    def test_store_stream_multipart(self):
+        bucket = FakeBucket()
+        s3 = S3('/comp-test', 'fake', 'fake', None, bucket)
+        headers = {'Content-Type': 'text/plain'}
+        status = s3.store_stream(
+            'foo', iter(['abc', 'defg', 'hi', 'j']), headers=headers,
+            part_size=4)
+        self.assertIs(True, status)
+        self.assertEqual({'/comp-test/foo': 'abcdefghij'}, bucket.objects)
+        upload, = bucket.uploads
+        self.assertEqual(['abcdefg', 'hij'], upload.parts)
+        self.assertEqual(headers, upload.headers)
+        self.assertEqual('completed', upload.state)
+
+    def test_store_stream_multipart_error(self):
+        def chunks():
+            yield 'abcd'
+            yield 'efgh'
+            raise ValueError('failed')
+
+        bucket = FakeBucket()
+        s3 = S3('/comp-test', 'fake', 'fake', None, bucket)
+        with self.assertRaises(ValueError):
+            s3.store_stream('foo', chunks(), part_size=4)
+        upload, = bucket.uploads
+        self.assertEqual('cancelled', upload.state)
+        self.assertEqual({}, bucket.objects)
+
+    def test_list_names(self):
+        bucket = FakeBucket()
+        bucket.objects.update({
+            '/comp-test/1-result-results.json': '{}',
+            '/comp-test/1-log-a.log': 'a',
+            '/comp-test-2/2-result-results.json': '{}',
+            })
+        s3 = S3('/comp-test', 'fake', 'fake', None, bucket)
+        self.assertEqual(
+            set(['1-result-results.json', '1-log-a.log']), s3.list_names())
+
 
 class TestS3Uploader(TestCase):
 
@@ -212,33 +311,38 @@ class TestS3Uploader(TestCase):
             self._make_upload(file_prefix=BUILD_NUM))
         h = S3Uploader(s3_mock, jenkins_mock)
         h.upload()
-        self.assertEqual(s3_mock.store.mock_calls, [
-            call(filename, json.dumps(
+        self.assertEqual(s3_mock.mock_calls, [
+            call.clone(),
+            call.store_stream(
+                '{}-log-filename'.format(BUILD_NUM), 'artifact data 1',
+                headers={"Content-Type": "application/octet-stream"}),
+            call.store('{}-console-consoleText.txt'.format(BUILD_NUM),
+                       'console text',
+                       headers={"Content-Type": "text/plain; charset=utf8"}),
+            call.store(filename, json.dumps(
                 {"build_info": BUILD_NUM, "number": "2222"}, indent=4),
-                headers={"Content-Type": "application/json"}),
-            call('{}-console-consoleText.txt'.format(BUILD_NUM),
-                 'console text',
-                 headers={"Content-Type": "text/plain; charset=utf8"}),
-            call('{}-log-filename'.format(BUILD_NUM), 'artifact data 1',
-                 headers={"Content-Type": "application/octet-stream"})])
+                headers={"Content-Type": "application/json"})])
 
     def test_upload_unique_id(self):
         filename, s3_mock, jenkins_mock = self._make_upload(file_prefix='9999')
         h = S3Uploader(s3_mock, jenkins_mock, unique_id='9999')
         h.upload()
-        self.assertEqual(s3_mock.store.mock_calls, [
-            call(filename,
-                 ('{\n    "origin_number": 2222, \n    "build_info": 1277, \n '
-                  '   "number": 9999\n}'),
-                 headers={"Content-Type": "application/json"}),
-            call('9999-console-consoleText.txt', 'console text',
-                 headers={"Content-Type": "text/plain; charset=utf8"}),
-            call('9999-log-filename', 'artifact data 1',
-                 headers={"Content-Type": "application/octet-stream"})])
+        self.assertEqual(s3_mock.mock_calls, [
+            call.clone(),
+            call.store_stream(
+                '9999-log-filename', 'artifact data 1',
+                headers={"Content-Type": "application/octet-stream"}),
+            call.store('9999-console-consoleText.txt', 'console text',
+                       headers={"Content-Type": "text/plain; charset=utf8"}),
+            call.store(filename,
+                       ('{\n    "origin_number": 2222, \n    "build_info": '
+                        '1277, \n    "number": 9999\n}'),
+                       headers={"Content-Type": "application/json"})])
 
     def _make_upload(self, file_prefix):
         filename = '{}-result-results.json'.format(file_prefix)
         s3_mock = MagicMock()
+        s3_mock.clone.return_value = s3_mock
         jenkins_mock = MagicMock()
         jenkins_mock.get_last_completed_build_number.return_value = BUILD_NUM
         jenkins_mock.get_build_number.return_value = BUILD_NUM
@@ -259,6 +363,58 @@ class TestS3Uploader(TestCase):
         self.assertEqual(jenkins_mock.set_build_number.mock_calls,
                          [call(1), call(2), call(3)])
 
+    def test_upload_all_test_results_skips_uploaded(self):
+        s3_mock = MagicMock()
+        s3_mock.list_names.return_value = set([
+            '1-result-results.json', '2-log-a.log', '3-result-results.json'])
+        jenkins_mock = MagicMock()
+        jenkins_mock.get_last_completed_build_number.return_value = 4
+        jenkins_mock.get_build_info.return_value = BUILD_INFO
+        h = S3Uploader(s3_mock, jenkins_mock)
+        h.upload_all_test_results()
+        self.assertEqual(jenkins_mock.set_build_number.mock_calls,
+                         [call(2), call(4)])
+
+    def test_upload_all_test_results_unique_id_uploads_all(self):
+        s3_mock = MagicMock()
+        s3_mock.list_names.return_value = set(['9-result-results.json'])
+        jenkins_mock = MagicMock()
+        jenkins_mock.get_last_completed_build_number.return_value = 2
+        jenkins_mock.get_build_info.return_value = dict(BUILD_INFO)
+        h = S3Uploader(s3_mock, jenkins_mock, unique_id='9')
+        h.upload_all_test_results()
+        self.assertEqual(jenkins_mock.set_build_number.mock_calls,
+                         [call(1), call(2)])
+
+    def test_upload_artifacts_streams_concurrently(self):
+        files = dict(('/job/7/artifact/{}.log'.format(n), n * 1000)
+                     for n in 'abcde')
+        bucket = FakeBucket()
+        s3 = S3('dir', 'fake', 'fake', None, bucket)
+        threads = set()
+
+        def get_bucket(name):
+            # Each connection must only be used by the thread that made it.
+            threads.add(threading.current_thread())
+            self.assertEqual('buck', name)
+            return bucket
+
+        with jenkins_stand_in(files) as (url, requested):
+            build_info = {'url': url + '/job/7/', 'number': 7, 'artifacts': [
+                {'relativePath': '{}.log'.format(n),
+                 'fileName': '{}.log'.format(n)} for n in 'abcde']}
+            j = JenkinsBuild(fake_credentials(), JOB_NAME, url, build_info)
+            h = S3Uploader(s3, j, workers=3)
+            with patch('upload_jenkins_job.S3Connection',
+                       autospec=True) as sc_mock:
+                sc_mock.return_value.get_bucket.side_effect = get_bucket
+                h.upload_artifacts()
+        self.assertEqual(
+            dict(('dir/7-log-{}.log'.format(n), n * 1000) for n in 'abcde'),
+            bucket.objects)
+        self.assertEqual(len(threads), sc_mock.call_count)
+        self.assertNotIn(threading.current_thread(), threads)
+
     def test_upload_test_results(self):
         filename, headers, s3_mock, jenkins_mock = (
             self._make_upload_test_results(file_prefix=BUILD_NUM))
@@ -352,8 +508,8 @@ class TestS3Uploader(TestCase):
         calls = [call(filename, 'artifact data 1', headers=headers),
                  call(filename, 'artifact data 2', headers=headers),
                  call(filename, 'artifact data 3', headers=headers)]
-        self.assertEqual(s3_mock.store.mock_calls, calls)
-        jenkins_mock.artifacts.assert_called_once_with()
+        self.assertItemsEqual(s3_mock.store_stream.mock_calls, calls)
+        jenkins_mock.artifacts.assert_called_once_with(stream=True)
 
     def test_upload_artifacts_unique_id(self):
         filename, headers, s3_mock, jenkins_mock = (
@@ -363,8 +519,8 @@ class TestS3Uploader(TestCase):
         calls = [call(filename, 'artifact data 1', headers=headers),
                  call(filename, 'artifact data 2', headers=headers),
                  call(filename, 'artifact data 3', headers=headers)]
-        self.assertEqual(s3_mock.store.mock_calls, calls)
-        jenkins_mock.artifacts.assert_called_once_with()
+        self.assertItemsEqual(s3_mock.store_stream.mock_calls, calls)
+        jenkins_mock.artifacts.assert_called_once_with(stream=True)
 
     def test_upload_artifacts_content_type(self):
 
@@ -381,8 +537,8 @@ class TestS3Uploader(TestCase):
                                'Content-Encoding': 'gzip'}),
                  call('1277-log-foo.svg', 'artifact data 2',
                       headers={'Content-Type': 'image/svg+xml'})]
-        self.assertEqual(s3_mock.store.mock_calls, calls)
-        jenkins_mock.artifacts.assert_called_once_with()
+        self.assertItemsEqual(s3_mock.store_stream.mock_calls, calls)
+        jenkins_mock.artifacts.assert_called_once_with(stream=True)
 
     def test_upload_artifacts_file_ext(self):
 
@@ -400,13 +556,16 @@ class TestS3Uploader(TestCase):
                  headers={'Content-Type': 'image/svg+xml'}),
             call('1277-log-result.json', 'artifact data 3',
                  headers={'Content-Type': 'application/json'})]
-        self.assertEqual(s3_mock.store.mock_calls, calls)
-        jenkins_mock.artifacts.assert_called_once_with()
+        self.assertItemsEqual(s3_mock.store_stream.mock_calls, calls)
+        jenkins_mock.artifacts.assert_called_once_with(stream=True)
 
     def _make_upload_artifacts(self, file_prefix):
         filename = '{}-log-filename'.format(file_prefix)
         headers = {"Content-Type": "application/octet-stream"}
         s3_mock = MagicMock()
+        # Create the child mocks before they are called from several threads.
+        s3_mock.clone.return_value = s3_mock
+        s3_mock.store_stream.return_value = True
         jenkins_mock = MagicMock()
         jenkins_mock.get_build_number.return_value = BUILD_NUM
         jenkins_mock.artifacts.return_value = fake_artifacts(4)
@@ -490,10 +649,10 @@ class TestS3Uploader(TestCase):
                         h.jenkins_build.get_last_completed_build_number(),
                         BUILD_NUM)
         self.assertEqual(s3_mock.store.mock_calls, [
+            call('1277-console-consoleText.txt', Response.text,
+                 headers={"Content-Type": "text/plain; charset=utf8"}),
             call('1277-result-results.json', json.dumps(build_info, indent=4),
                  headers={"Content-Type": "application/json"}),
-            call('1277-console-consoleText.txt', Response.text,
-                 headers={"Content-Type": "text/plain; charset=utf8"})
         ])
         self.assertEqual(gjd_mock.mock_calls, [
             call(None, cred, None),
@@ -595,7 +754,7 @@ class OtherTests(TestCase):
             all=False, artifact_file_ext=None, build_number=1277,
             jenkins_job=JOB_NAME, latest=False, password=None,
             s3_bucket=BUCKET, s3_directory=DIRECTORY, unique_id=None,
-            user=None, no_prefixes=False))
+            user=None, no_prefixes=False, workers=4))
 
     def test_get_args_artifact_file_ext(self):
         args = get_args([JOB_NAME, str(BUILD_NUM), BUCKET, DIRECTORY,
@@ -694,6 +853,94 @@ access_key = fake_username
 """
 
 
+class FakeMultiPartUpload:
+
+    def __init__(self, bucket, key_name, headers):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.headers = headers
+        self.parts = []
+        self.state = 'started'
+
+    def upload_part_from_file(self, fp, part_num):
+        assert part_num == len(self.parts) + 1
+        self.parts.append(fp.read())
+
+    def complete_upload(self):
+        self.state = 'completed'
+        self.bucket.objects[self.key_name] = ''.join(self.parts)
+
+    def cancel_upload(self):
+        self.state = 'cancelled'
+
+
+class FakeKey:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_string(self, data, headers=None):
+        self.bucket.objects[self.name] = data
+
+
+class FakeBucket:
+    """A stand-in for a boto bucket that stores objects in memory."""
+
+    def __init__(self, name='buck'):
+        self.name = name
+        self.objects = {}
+        self.uploads = []
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        upload = FakeMultiPartUpload(self, key_name, headers)
+        self.uploads.append(upload)
+        return upload
+
+    def list(self, prefix=''):
+        return [FakeKey(self, name) for name in sorted(self.objects)
+                if name.startswith(prefix)]
+
+
+@contextmanager
+def jenkins_stand_in(files):
+    """Serve files over HTTP from a local stand-in for Jenkins.
+
+    :param files: A dict of URL path to content.
+    :return: The base URL and a list of the paths requested.
+    """
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            requested.append(self.path)
+            content = files.get(self.path)
+            if content is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_port), requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def fake_artifacts(max=4):
     for x in range(1, max):
         yield "filename", "artifact data %s" % x
@@ -6,6 +6,7 @@ from datetime import (
     datetime,
     timedelta,
     )
+import hashlib
 import json
 import logging
 import os
@@ -31,6 +32,7 @@ from utility import (
     assert_dict_is_subset,
     as_literal_address,
     extract_deb,
+    file_digest,
     _find_candidates,
     find_candidates,
     find_latest_branch_candidates,
@@ -264,6 +266,17 @@ class TestExtractDeb(TestCase):
         cc_mock.assert_called_once_with(['dpkg', '-x', 'foo', 'bar'])
 
 
+class TestFileDigest(TestCase):
+
+    def test_file_digest(self):
+        with temp_dir() as base:
+            path = os.path.join(base, 'bar.json')
+            with open(path, 'w') as f:
+                f.write('one\ntwo')
+            digest = file_digest(path, chunk_size=3)
+        self.assertEqual(hashlib.sha256(b'one\ntwo').hexdigest(), digest)
+
+
 class TestGetDebArch(TestCase):
 
     def test_get_deb_arch(self):
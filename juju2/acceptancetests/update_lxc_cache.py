@@ -6,6 +6,7 @@ from __future__ import print_function
 from argparse import ArgumentParser
 from collections import namedtuple
 import errno
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import traceback
@@ -13,33 +14,65 @@ import shutil
 import subprocess
 import urllib2
 
+from utility import file_digest
+
 
 SITE = 'https://images.linuxcontainers.org'
 INDEX_PATH = 'meta/1.0'
 INDEX = 'index-system'
 ROOTFS = 'rootfs.tar.xz'
+ROOTFS_TAR = 'rootfs.tar'
 META = 'meta.tar.xz'
 LXC_CACHE = '/var/cache/lxc/download'
+STAGING = '.lxc-cache-staging'
+OBJECTS = 'objects'
+DEFAULT_WORKERS = 4
 
 
 System = namedtuple(
     'System', ['dist', 'release', 'arch', 'variant', 'version', 'path'])
 
 
+# The staged copies of the last upload are kept on the host so that rsync
+# only sends the blocks that differ from them.  A small change to an image
+# changes most of its compressed rootfs, so the rootfs is staged and sent
+# uncompressed, and compressed again on the host.  The installed files seed
+# the staging dir the first time.
 PUT_SCRIPT = """\
-scp {rootfs_path} {meta_path} {user_host}:~/
+ssh {user_host} bash <<"EOT"
+mkdir -p ~/{staging}
+if [ ! -f ~/{staging}/{rootfs_tar} -a -f {lxc_cache}/{rootfs} ]; then
+    xz -dc {lxc_cache}/{rootfs} > ~/{staging}/{rootfs_tar}.part &&
+        mv ~/{staging}/{rootfs_tar}.part ~/{staging}/{rootfs_tar}
+fi
+if [ ! -f ~/{staging}/{meta} -a -f {lxc_cache}/{meta} ]; then
+    cp {lxc_cache}/{meta} ~/{staging}/{meta}
+fi
+EOT
+rsync {bwlimit}{rootfs_tar_path} {meta_path} {user_host}:{staging}/
 """
 
 INSTALL_SCRIPT = """\
 ssh {user_host} bash <<"EOT"
+set -e
+xz -c ~/{staging}/{rootfs_tar} > ~/{staging}/{rootfs}
 sudo mkdir -p {lxc_cache}
-sudo mv ~/{rootfs} ~/{meta} {lxc_cache}
+sudo mv ~/{staging}/{rootfs} {lxc_cache}
+sudo cp ~/{staging}/{meta} {lxc_cache}
 sudo chown -R root:root  {lxc_cache}
 sudo tar -C {lxc_cache} -xf {lxc_cache}/meta.tar.xz
 EOT
 """
 
 
+def get_push_bwlimit(bwlimit, workers, pushes):
+    """Return the KiB/s each push may use to keep the total under bwlimit."""
+    if bwlimit is None:
+        return None
+    concurrent = max(1, min(workers, pushes))
+    return max(1, bwlimit // concurrent)
+
+
 class LxcCache:
     """Manage the LXC download template cache."""
 
@@ -50,6 +83,7 @@ class LxcCache:
         self.dry_run = dry_run
         local_path = os.path.join(self.workspace, INDEX_PATH, INDEX)
         self.systems, ignore = self.init_systems(local_path)
+        self.remote = None
 
     def init_systems(self, location):
         """Return a tuple of the dict of lxc Systems and the source data.
@@ -87,8 +121,10 @@ class LxcCache:
         """
         key = (dist, release, arch, variant)
         old_system = self.systems.get(key)
-        url = '%s/%s/%s' % (SITE, INDEX_PATH, INDEX)
-        new_systems, data = self.init_systems(url)
+        if self.remote is None:
+            url = '%s/%s/%s' % (SITE, INDEX_PATH, INDEX)
+            self.remote = self.init_systems(url)
+        new_systems, data = self.remote
         new_system = new_systems[key]
         if not old_system or new_system.version > old_system.version:
             if self.verbose:
@@ -103,6 +139,7 @@ class LxcCache:
     def get_lxc_data(self, system):
         """Download the system image and meta data.
 
+        The image is also uncompressed beside itself, for uploading.
         Return a tuple of the image and meta data paths.
         """
         image_path = os.path.join(self.workspace, system.path[1:])
@@ -114,39 +151,129 @@ class LxcCache:
         rootfs_path = os.path.join(image_path, ROOTFS)
         rootfs_url = '%s%s%s' % (SITE, system.path, ROOTFS)
         self.download(rootfs_url, rootfs_path)
+        self.add_to_store(rootfs_path)
+        rootfs_tar_path = os.path.join(image_path, ROOTFS_TAR)
+        self.uncompress(rootfs_path, rootfs_tar_path)
+        self.add_to_store(rootfs_tar_path)
         meta_path = os.path.join(image_path, META)
         meta_url = '%s%s%s' % (SITE, system.path, META)
         self.download(meta_url, meta_path)
+        self.add_to_store(meta_path)
         return rootfs_path, meta_path
 
     def download(self, location, path):
-        """Download a large binary from location to the specified path."""
-        chunk = 16 * 1024
+        """Download a large binary from location to the specified path.
+
+        The file is written beside path and renamed when it is complete.
+        """
+        chunk = 1024 * 1024
         if not self.dry_run:
             request = urllib2.Request(location)
             response = urllib2.urlopen(request)
             if response.getcode() == 200:
-                with open(path, 'wb') as f:
+                part_path = '%s.part' % path
+                with open(part_path, 'wb') as f:
                     shutil.copyfileobj(response, f, chunk)
+                os.rename(part_path, path)
                 if self.verbose:
                     print('Downloaded %s' % location)
 
-    def put_lxc_data(self, user_host, system, rootfs_path, meta_path):
+    def uncompress(self, path, uncompressed_path):
+        """Write the xz-uncompressed content of path to uncompressed_path.
+
+        The file is written beside uncompressed_path and renamed when it is
+        complete.
+        """
+        if self.dry_run or not os.path.isfile(path):
+            return
+        part_path = '%s.part' % uncompressed_path
+        with open(part_path, 'wb') as f:
+            subprocess.check_call(['xz', '-dc', path], stdout=f)
+        os.rename(part_path, uncompressed_path)
+
+    def get_object_path(self, digest):
+        """Return the path of the stored file with the sha256 digest."""
+        return os.path.join(self.workspace, OBJECTS, digest[:2], digest)
+
+    def add_to_store(self, path):
+        """Store the file at path by content, sharing identical files.
+
+        The file becomes a hard link to the stored object; when the object
+        already exists the file's own copy is released.
+        """
+        if self.dry_run or not os.path.isfile(path):
+            return
+        object_path = self.get_object_path(file_digest(path))
+        object_dir = os.path.dirname(object_path)
+        try:
+            os.makedirs(object_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(path, object_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            temp_path = '%s.link' % path
+            os.link(object_path, temp_path)
+            os.rename(temp_path, path)
+            if self.verbose:
+                print('Reusing stored copy of %s' % path)
+
+    def prune(self, systems):
+        """Remove the older images of systems and unused stored objects."""
+        if self.dry_run:
+            return
+        for system in systems:
+            image_path = os.path.join(self.workspace, system.path[1:])
+            versions_dir = os.path.dirname(os.path.normpath(image_path))
+            if not os.path.isdir(versions_dir):
+                continue
+            for version in os.listdir(versions_dir):
+                if version != system.version:
+                    shutil.rmtree(os.path.join(versions_dir, version))
+        objects_dir = os.path.join(self.workspace, OBJECTS)
+        for dir_path, dir_names, file_names in os.walk(objects_dir):
+            for name in file_names:
+                object_path = os.path.join(dir_path, name)
+                if os.stat(object_path).st_nlink == 1:
+                    os.unlink(object_path)
+                    if self.verbose:
+                        print('Removed unused %s' % name)
+
+    def put_lxc_data(self, user_host, system, rootfs_path, meta_path,
+                     bwlimit=None):
         """Install the lxc image and meta data on the host.
 
-        The user on the host must have password-less sudo.
+        The uncompressed image beside rootfs_path is uploaded, so that only
+        the blocks that changed since the last upload are sent.  The upload
+        is limited to bwlimit KiB/s when it is not None.  The user on the
+        host must have password-less sudo.
         """
         lxc_cache = os.path.join(
             LXC_CACHE, system.dist, system.release, system.arch,
             system.variant)
+        staging = os.path.join(
+            STAGING, system.dist, system.release, system.arch, system.variant)
+        if bwlimit is None:
+            bwlimit_option = ''
+        else:
+            bwlimit_option = '--bwlimit=%d ' % bwlimit
+        rootfs_tar_path = os.path.join(
+            os.path.dirname(rootfs_path), ROOTFS_TAR)
         put_script = PUT_SCRIPT.format(
-            user_host=user_host, rootfs_path=rootfs_path, meta_path=meta_path)
+            user_host=user_host, rootfs_tar_path=rootfs_tar_path,
+            meta_path=meta_path, lxc_cache=lxc_cache, staging=staging,
+            rootfs=ROOTFS, rootfs_tar=ROOTFS_TAR, meta=META,
+            bwlimit=bwlimit_option)
         if not self.dry_run:
             subprocess.check_call([put_script], shell=True)
             if self.verbose:
-                print("Uploaded %s and %s" % (ROOTFS, META))
+                print("Uploaded %s and %s" % (ROOTFS_TAR, META))
         install_script = INSTALL_SCRIPT.format(
-            user_host=user_host, lxc_cache=lxc_cache, rootfs=ROOTFS, meta=META)
+            user_host=user_host, lxc_cache=lxc_cache, staging=staging,
+            rootfs=ROOTFS, rootfs_tar=ROOTFS_TAR, meta=META)
         if not self.dry_run:
             subprocess.check_call([install_script], shell=True)
             if self.verbose:
@@ -179,30 +306,70 @@ def parse_args(argv=None):
     parser.add_argument(
         '--variant', default="default", help="The variant to update.")
     parser.add_argument(
-        'user_host', help='The user@host to update.')
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='The number of downloads or uploads to run at once.')
+    parser.add_argument(
+        '--bwlimit', type=int, default=None,
+        help='The total KiB/s that uploads to the hosts may use.')
+    parser.add_argument(
+        'user_host',
+        help='The user@host to update; separate several with commas.')
     parser.add_argument(
-        'release', help='The release to update.')
+        'release',
+        help='The release to update; separate several with commas.')
     parser.add_argument(
-        'arch', help='The architecture of the remote host')
+        'arch',
+        help='The architecture of the remote host; separate several with'
+             ' commas.')
     parser.add_argument(
         'workspace', help='The path to the local dir to stage the update.')
     args = parser.parse_args(argv)
     return args
 
 
+def update_hosts(lxc_cache, user_hosts, systems, workers, bwlimit=None):
+    """Download the systems' images in parallel, then push them to hosts.
+
+    The pushes also run in parallel, sharing bwlimit KiB/s between them.
+    """
+    pool = ThreadPool(workers)
+    try:
+        lxc_data = pool.map(lxc_cache.get_lxc_data, systems)
+        pushes = [
+            (user_host, system, rootfs_path, meta_path)
+            for user_host in user_hosts
+            for system, (rootfs_path, meta_path) in zip(systems, lxc_data)]
+        push_bwlimit = get_push_bwlimit(bwlimit, workers, len(pushes))
+
+        def push(args):
+            lxc_cache.put_lxc_data(*args, bwlimit=push_bwlimit)
+
+        pool.map(push, pushes)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main(argv):
     """Update the lxc download template cache for hosts on closed networks."""
     args = parse_args(argv)
     try:
         lxc_cache = LxcCache(
             args.workspace, verbose=args.verbose, dry_run=args.dry_run)
-        new_system, data = lxc_cache.get_updates(
-            args.dist, args.release, args.arch, args.variant)
-        if new_system:
-            rootfs_path, meta_path = lxc_cache.get_lxc_data(new_system)
-            lxc_cache.put_lxc_data(
-                args.user_host, new_system, rootfs_path, meta_path)
+        new_systems = []
+        for release in args.release.split(','):
+            for arch in args.arch.split(','):
+                new_system, new_data = lxc_cache.get_updates(
+                    args.dist, release, arch, args.variant)
+                if new_system:
+                    new_systems.append(new_system)
+                    data = new_data
+        if new_systems:
+            update_hosts(
+                lxc_cache, args.user_host.split(','), new_systems,
+                args.workers, args.bwlimit)
             lxc_cache.save_index(data)
+            lxc_cache.prune(new_systems)
     except Exception as e:
         print(e)
         print(getattr(e, 'output', ''))
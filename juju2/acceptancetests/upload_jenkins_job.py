@@ -3,10 +3,13 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+from io import BytesIO
 import json
 from mimetypes import MimeTypes
+from multiprocessing.pool import ThreadPool
 import os
 import sys
+import threading
 from time import sleep
 import urlparse
 
@@ -30,6 +33,10 @@ __metaclass__ = type
 
 CONSOLE_TEXT = 'consoleText'
 RESULT_RESULTS = 'result-results.json'
+CHUNK_SIZE = 1024 * 1024
+# S3 requires every part but the last to be at least 5 MiB.
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 4
 
 
 class JenkinsBuild:
@@ -107,9 +114,11 @@ class JenkinsBuild:
             self.jenkins_url, self.credentials, self.job_name)
         return job_info['lastCompletedBuild']['number']
 
-    def artifacts(self):
+    def artifacts(self, stream=False):
         """
         Returns the filename and the content of artifacts
+        :param stream: If True, the content is an iterator of chunks that
+        only requests the artifact when iterated.
         :return: filename and artifacts content
         :rtype: tuple
         """
@@ -118,9 +127,22 @@ class JenkinsBuild:
         auth = HTTPBasicAuth(self.credentials.user, self.credentials.password)
         for path, filename in relative_paths:
             url = self._get_artifact_url(path)
+            if stream:
+                yield filename, self._iter_artifact(url, auth)
+                continue
             content = requests.get(url, auth=auth).content
             yield filename, content
 
+    @staticmethod
+    def _iter_artifact(url, auth):
+        response = requests.get(url, auth=auth, stream=True)
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                yield chunk
+        finally:
+            response.close()
+
     def _get_artifact_url(self, relative_path):
         """
         :return: List of artifact URLs
@@ -154,6 +176,16 @@ class S3:
         bucket = conn.get_bucket(bucket)
         return cls(directory, access_key, secret_key, conn, bucket)
 
+    def clone(self):
+        """
+        Returns an S3 for the same directory with its own connection.
+        boto connections are not thread-safe, so each thread needs one.
+        :rtype: S3
+        """
+        conn = S3Connection(self.access_key, self.secret_key)
+        bucket = conn.get_bucket(self.bucket.name)
+        return S3(self.dir, self.access_key, self.secret_key, conn, bucket)
+
     def store(self, filename, data, headers=None):
         """
         Stores an object in S3.
@@ -169,6 +201,53 @@ class S3:
         key.set_contents_from_string(data, headers=headers)
         return True
 
+    def store_stream(self, filename, chunks, headers=None,
+                     part_size=PART_SIZE):
+        """
+        Stores an object in S3 from an iterable of chunks.
+
+        At most part_size bytes are held in memory.  Larger objects are
+        stored with a multipart upload, which is cancelled on error.
+        :param filename: filename of the object
+        :param chunks: An iterable of strings to store in S3
+        :rtype: bool
+        """
+        chunks = iter(chunks)
+        part = self._read_part(chunks, part_size)
+        if len(part) < part_size:
+            return self.store(filename, part, headers=headers)
+        path = os.path.join(self.dir, filename)
+        upload = self.bucket.initiate_multipart_upload(path, headers=headers)
+        try:
+            part_num = 1
+            while part:
+                upload.upload_part_from_file(BytesIO(part), part_num)
+                part = self._read_part(chunks, part_size)
+                part_num += 1
+        except BaseException:
+            upload.cancel_upload()
+            raise
+        upload.complete_upload()
+        return True
+
+    @staticmethod
+    def _read_part(chunks, part_size):
+        buf = BytesIO()
+        for chunk in chunks:
+            buf.write(chunk)
+            if buf.tell() >= part_size:
+                break
+        return buf.getvalue()
+
+    def list_names(self):
+        """
+        Returns the filenames of the objects stored in the directory.
+        :rtype: set
+        """
+        prefix = os.path.join(self.dir, '')
+        return set(key.name[len(prefix):]
+                   for key in self.bucket.list(prefix=prefix))
+
 
 class S3Uploader:
     """
@@ -176,17 +255,18 @@ class S3Uploader:
     """
 
     def __init__(self, s3, jenkins_build, unique_id=None, no_prefixes=False,
-                 artifact_file_ext=None):
+                 artifact_file_ext=None, workers=DEFAULT_WORKERS):
         self.s3 = s3
         self.jenkins_build = jenkins_build
         self.unique_id = unique_id
         self.no_prefixes = no_prefixes
         self.artifact_file_ext = artifact_file_ext
+        self.workers = workers
 
     @classmethod
     def factory(cls, credentials, jenkins_job, build_number, bucket,
                 directory, unique_id=None, no_prefixes=False,
-                artifact_file_ext=None):
+                artifact_file_ext=None, workers=DEFAULT_WORKERS):
         """
         Creates S3Uploader.
         :param credentials: Jenkins credential
@@ -196,6 +276,7 @@ class S3Uploader:
         :param directory: S3 directory name
         :param artifact_file_ext: List of artifact file extentions. If set,
         only artifact with these ejections will be uploaded.
+        :param workers: The number of artifacts to upload at once.
         :rtype: S3Uploader
         """
         s3 = S3.factory(bucket, directory)
@@ -205,16 +286,18 @@ class S3Uploader:
             build_number=build_number)
         return cls(s3, jenkins_build,
                    unique_id=unique_id, no_prefixes=no_prefixes,
-                   artifact_file_ext=artifact_file_ext)
+                   artifact_file_ext=artifact_file_ext, workers=workers)
 
     def upload(self):
         """Uploads Jenkins job results, console logs and artifacts to S3.
 
+        The results are uploaded last, so that their presence shows the
+        build was uploaded completely.
         :return: None
         """
-        self.upload_test_results()
-        self.upload_console_log()
         self.upload_artifacts()
+        self.upload_console_log()
+        self.upload_test_results()
 
     def upload_by_build_number(self, build_number=None, pause_time=120,
                                timeout=600):
@@ -241,13 +324,25 @@ class S3Uploader:
     def upload_all_test_results(self):
         """
         Uploads all the test results to S3. It starts with the build_number 1
+        Builds whose results are already in S3 are skipped, so an interrupted
+        upload can be resumed.
         :return: None
         """
         latest_build_num = self.jenkins_build.get_last_completed_build_number()
+        uploaded = self.s3.list_names()
         for build_number in range(1, latest_build_num + 1):
+            if self._is_uploaded(build_number, uploaded):
+                continue
             self.jenkins_build.set_build_number(build_number)
             self.upload()
 
+    def _is_uploaded(self, build_number, uploaded):
+        # Without build number prefixes, builds share the same filenames.
+        if self.unique_id or self.no_prefixes:
+            return False
+        return self._create_filename(
+            RESULT_RESULTS, build_number) in uploaded
+
     def upload_last_completed_test_result(self):
         """Upload the latest test result to S3."""
         latest_build_num = self.jenkins_build.get_last_completed_build_number()
@@ -285,18 +380,41 @@ class S3Uploader:
         return headers
 
     def upload_artifacts(self):
-        for filename, content in self.jenkins_build.artifacts():
+        """Stream the artifacts from Jenkins to S3, several at a time.
+
+        Each worker thread uploads through its own clone of the S3.
+        """
+        uploads = []
+        for filename, chunks in self.jenkins_build.artifacts(stream=True):
             if self.artifact_file_ext:
                 if os.path.splitext(filename)[1] not in self.artifact_file_ext:
                     continue
-            filename = self._create_filename(filename)
+            uploads.append((self._create_filename(filename), chunks))
+        if not uploads:
+            return
+        local = threading.local()
+
+        def upload_artifact(upload):
+            s3 = getattr(local, 's3', None)
+            if s3 is None:
+                s3 = local.s3 = self.s3.clone()
+            filename, chunks = upload
             headers = self.make_headers(filename)
-            self.s3.store(filename, content, headers=headers)
+            s3.store_stream(filename, chunks, headers=headers)
+
+        pool = ThreadPool(min(self.workers, len(uploads)))
+        try:
+            for ignored in pool.imap_unordered(upload_artifact, uploads):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
 
-    def _create_filename(self, filename):
+    def _create_filename(self, filename, build_number=None):
         """
         Creates filename based on the combination of the job ID and the
         filename
+        :param build_number: The build number, if not the current build's.
         :return: Filename
         :rtype: str
         """
@@ -309,7 +427,9 @@ class S3Uploader:
             filename = 'log-' + filename
         if self.unique_id:
             return "{}-{}".format(self.unique_id, filename)
-        return str(self.jenkins_build.get_build_number()) + '-' + filename
+        if build_number is None:
+            build_number = self.jenkins_build.get_build_number()
+        return str(build_number) + '-' + filename
 
 
 def get_s3_access():
@@ -342,6 +462,9 @@ def get_args(argv=None):
         '--artifact-file-ext', nargs='+',
         help='Artifacts include file extentions. If set, only files with '
              'these extentions will be uploaded.')
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='The number of artifacts to upload at once.')
     add_credential_args(parser)
     args = parser.parse_args(argv)
     args.all = False
@@ -363,7 +486,8 @@ def main(argv=None):
     uploader = S3Uploader.factory(
         cred, args.jenkins_job, args.build_number, args.s3_bucket,
         args.s3_directory, unique_id=args.unique_id,
-        no_prefixes=args.no_prefixes, artifact_file_ext=args.artifact_file_ext)
+        no_prefixes=args.no_prefixes, artifact_file_ext=args.artifact_file_ext,
+        workers=args.workers)
     if args.build_number:
         print('Uploading build number {:d}.'.format(args.build_number))
         uploader.upload()
@@ -4,6 +4,7 @@ from datetime import (
     timedelta,
     )
 import errno
+import hashlib
 import json
 import logging
 import os
@@ -388,6 +389,15 @@ def extract_deb(package_path, directory):
     subprocess.check_call(['dpkg', '-x', package_path, directory])
 
 
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the sha256 hexdigest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def run_command(command, dry_run=False, verbose=False):
     """Optionally execute a command and maybe print the output."""
     if verbose:
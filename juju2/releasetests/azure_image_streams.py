@@ -16,6 +16,7 @@ from simplestreams import mirrors
 from simplestreams import util
 
 from build_package import juju_series
+from utils import iter_parallel
 
 
 CANONICAL = 'Canonical'
@@ -35,6 +36,10 @@ IMAGE_SPEC = [
 ]
 
 
+# The number of Azure locations to query at once.
+MAX_LOCATION_WORKERS = 16
+
+
 ITEM_NAMES = {
     "australiaeast": "auee1i3",
     "australiasoutheast": "ause1i3",
@@ -144,18 +149,6 @@ def parse_id(item_id):
     return sku, version
 
 
-def arm_image_exists(client, location, full_spec):
-    """Return True if the full_spec exists on Azure-ARM, else False."""
-    try:
-        client.virtual_machine_images.get(location, *full_spec)
-    except CloudError as e:
-        if e.message != 'Artifact: VMImage was not found.':
-            raise
-        return False
-    else:
-        return True
-
-
 def convert_item_to_arm(item, urn, endpoint, region):
     """Return the ARM equivalent of an item, given a urn + endpoint."""
     data = dict(item.data)
@@ -178,12 +171,109 @@ def sku_version_items(items):
     return sort_items
 
 
-def convert_cloud_images_items(client, locations, items):
+def list_image_versions(client, location, publisher, offer, sku,
+                        cache=None, refresh=False):
+    """Return the names of the versions of an image in a location.
+
+    Fresh listings are taken from the cache, if supplied.  If refresh is
+    True, the versions are always listed, and the cache is updated.
+    """
+    key = ['azure-versions', location, publisher, offer, sku]
+    if cache is not None and not refresh:
+        versions = cache.get(key)
+        if versions is not None:
+            return versions
+    versions = [v.name for v in client.virtual_machine_images.list(
+        location, publisher, offer, sku)]
+    if cache is not None:
+        cache.put(key, versions)
+    return versions
+
+
+def list_skus(client, location, publisher, offer, cache=None):
+    """Return the names of the skus of an offer in a location.
+
+    Fresh listings are taken from the cache, if supplied.
+    """
+    key = ['azure-skus', location, publisher, offer]
+    if cache is not None:
+        skus = cache.get(key)
+        if skus is not None:
+            return skus
+    skus = [s.name for s in client.virtual_machine_images.list_skus(
+        location, publisher, offer)]
+    if cache is not None:
+        cache.put(key, skus)
+    return skus
+
+
+class ImageVersionIndex:
+    """An in-memory index of the image versions in Azure locations.
+
+    Each (location, publisher, offer, sku) is listed once, so that checking
+    whether an image exists does not require an API call.  Versions missing
+    from a cached listing are checked against a fresh listing, in case they
+    were published since it was cached.
+    """
+
+    def __init__(self, client, cache=None):
+        self.client = client
+        self.cache = cache
+        self.versions = {}
+        self.refreshed = set()
+
+    def load(self, specs):
+        """Concurrently list the versions of each (location, *spec).
+
+        :param specs: An iterable of (location, publisher, offer, sku).
+        """
+        specs = set(specs).difference(self.versions)
+        if self.cache is None:
+            self.refreshed.update(specs)
+
+        def list_versions(spec):
+            return list_image_versions(self.client, *spec, cache=self.cache)
+
+        for spec, versions, error in iter_parallel(
+                list_versions, sorted(specs), MAX_LOCATION_WORKERS):
+            if error is not None:
+                if getattr(error, 'status_code', None) != 404:
+                    raise error
+                versions = []
+            self.versions[spec] = frozenset(versions)
+
+    def refresh(self, spec):
+        """List the versions of (location, *spec), bypassing the cache."""
+        try:
+            versions = list_image_versions(self.client, *spec,
+                                           cache=self.cache, refresh=True)
+        except Exception as error:
+            if getattr(error, 'status_code', None) != 404:
+                raise
+            versions = []
+        self.versions[spec] = frozenset(versions)
+        self.refreshed.add(spec)
+
+    def exists(self, location, full_spec):
+        """Return True if the full_spec exists in the location.
+
+        :param full_spec: A tuple of (publisher, offer, sku, version).
+        """
+        spec = (location,) + tuple(full_spec[:-1])
+        self.load([spec])
+        if (full_spec[-1] not in self.versions[spec] and
+                spec not in self.refreshed):
+            self.refresh(spec)
+        return full_spec[-1] in self.versions[spec]
+
+
+def convert_cloud_images_items(client, locations, items, cache=None):
     """Convert cloud-images Azure data to Azure-ARM data."""
     arm_items = []
     endpoint = client.config.base_url
     location_map = dict((l.display_name, l.name) for l in locations)
     unknown_locations = set()
+    candidates = []
     for sku, version, item in sku_version_items(items):
         location_display_name = item.data['region']
         location = location_map.get(location_display_name)
@@ -191,8 +281,14 @@ def convert_cloud_images_items(client, locations, items):
             unknown_locations.add(location_display_name)
             continue
         full_spec = (CANONICAL, UBUNTU_SERVER, sku, version)
+        candidates.append((location, full_spec, item))
+    index = ImageVersionIndex(client, cache)
+    index.load((location,) + full_spec[:-1]
+               for location, full_spec, item in candidates)
+    for location, full_spec, item in candidates:
+        sku, version = full_spec[2:]
         urn = ':'.join(full_spec)
-        if not arm_image_exists(client, location, full_spec):
+        if not index.exists(location, full_spec):
             if (sku, version) not in EXPECTED_MISSING:
                 raise MissingImage('{} not in {}\n'.format(urn, location))
             continue
@@ -203,35 +299,41 @@ def convert_cloud_images_items(client, locations, items):
     return arm_items, unknown_locations
 
 
-def make_spec_items(client, full_spec, locations):
+def make_spec_items(client, full_spec, locations, cache=None):
     """Return Items for all versions this spec in all Azure locations.
 
     full_spec is the spec to use for looking up versions.
     locations is a list of Azure Locations.
+    Locations are queried concurrently.
     """
     endpoint = client.config.base_url
     spec = full_spec[1:]
-    location_versions = {}
-    for location in locations:
+
+    def list_versions(location):
         logger().debug('Retrieving image data in {}'.format(
             location.display_name))
-        try:
-            versions = client.virtual_machine_images.list(location.name,
-                                                          *spec)
-        except CloudError:
+        return list_image_versions(client, location.name, *spec,
+                                   cache=cache)
+
+    location_versions = {}
+    for location, versions, error in iter_parallel(
+            list_versions, locations, MAX_LOCATION_WORKERS):
+        if error is not None:
+            if not isinstance(error, CloudError):
+                raise error
             template = 'Could not find {} {} {} in {location}'
             logger().warning(template.format(
                 *spec, location=location.display_name))
             continue
         for version in versions:
             location_versions.setdefault(
-                version.name, set()).add(location.name)
+                version, set()).add(location.name)
     lv2 = sorted(location_versions.items(), key=lambda x: [
         int(ns) for ns in x[0].split('.')])
+    # Sort in theoretical version number order, not lexicographically
+    width = len('{}'.format(len(lv2)))
     for num, (version, v_locations) in enumerate(lv2):
-        # Sort in theoretical version number order, not lexicographically
-        width = len('{}'.format(len(versions)))
-        for location in v_locations:
+        for location in sorted(v_locations):
             version_name = '{:0{}d}'.format(num, width)
             yield make_item(version_name, version, full_spec, location,
                             endpoint)
@@ -296,20 +398,22 @@ class ItemList(mirrors.BasicMirrorWriter):
         self.items.append(dict_to_item(data))
 
 
-def make_azure_items(all_credentials):
+def make_azure_items(all_credentials, cache=None):
     """Make simplestreams Items for existing Azure images.
 
     All versions of all images matching IMAGE_SPEC will be returned.
 
     all_credentials is a dict of credentials in the credentials.yaml
     structure, used to create Azure credentials.
+    cache is an optional ListingCache for image listings.
     """
     subscription_id, credentials = get_azure_credentials(all_credentials)
     sub_client = SubscriptionClient(credentials)
     client = ComputeManagementClient(credentials, subscription_id)
-    locations = sub_client.subscriptions.list_locations(subscription_id)
-    items = find_ubuntu_items(client, locations)
-    items.extend(find_spec_items(client, locations))
+    locations = list(
+        sub_client.subscriptions.list_locations(subscription_id))
+    items = find_ubuntu_items(client, locations, cache)
+    items.extend(find_spec_items(client, locations, cache))
     return items
 
 
@@ -337,36 +441,36 @@ def make_ubuntu_item(endpoint, location_name, sku_name):
                      endpoint, stream=stream, release=release)
 
 
-def find_ubuntu_items(client, locations):
+def find_ubuntu_items(client, locations, cache=None):
     """Make simplestreams Items for existing Azure images.
 
     All versions of all images matching IMAGE_SPEC will be returned.
-
-    all_credentials is a dict of credentials in the credentials.yaml
-    structure, used to create Azure credentials.
+    Locations are queried concurrently.
     """
+    def list_ubuntu_skus(location):
+        return list_skus(client, location.name, CANONICAL, UBUNTU_SERVER,
+                         cache)
+
     items = []
-    for location in locations:
-        skus = client.virtual_machine_images.list_skus(
-            location.name, CANONICAL, UBUNTU_SERVER)
+    for location, skus, error in iter_parallel(
+            list_ubuntu_skus, locations, MAX_LOCATION_WORKERS):
+        if error is not None:
+            raise error
         for sku in skus:
             item = make_ubuntu_item(client.config.base_url, location.name,
-                                    sku.name)
+                                    sku)
             if item is None:
                 continue
             items.append(item)
     return items
 
 
-def find_spec_items(client, locations):
+def find_spec_items(client, locations, cache=None):
     """Make simplestreams Items for existing Azure images.
 
     All versions of all images matching IMAGE_SPEC will be returned.
-
-    all_credentials is a dict of credentials in the credentials.yaml
-    structure, used to create Azure credentials.
     """
     items = []
     for full_spec in IMAGE_SPEC:
-        items.extend(make_spec_items(client, full_spec, locations))
+        items.extend(make_spec_items(client, full_spec, locations, cache))
     return items
@@ -2,8 +2,10 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+from collections import namedtuple
 from copy import deepcopy
 from datetime import datetime
+import json
 import logging
 import os
 import sys
@@ -11,19 +13,24 @@ from textwrap import dedent
 import yaml
 
 from boto import ec2
+
+from utils import (
+    iter_parallel,
+    ListingCache,
+    )
 # Done early to prevent Simplestreams from messing with the log configuration.
 logging.basicConfig(level=logging.INFO)
-from simplestreams.generate_simplestreams import (
+from simplestreams.generate_simplestreams import (  # noqa: E402
     FileNamer,
     generate_index,
     items2content_trees,
     json_dump,
 )
-from simplestreams.json2streams import (
+from simplestreams.json2streams import (  # noqa: E402
     Item,
     JujuFileNamer,
 )
-from simplestreams import util
+from simplestreams import util  # noqa: E402
 
 log = logging.getLogger(
     "requests.packages.urllib3.connectionpool").setLevel(logging.WARNING)
@@ -32,6 +39,22 @@ AWS = 'aws'
 AZURE = 'azure'
 ALL = 'all'
 
+CENTOS_IMAGE_FILTERS = {
+    'owner_alias': 'aws-marketplace',
+    'product_code': 'aw0evgkw8e5c1q413zgy5pjce',
+    # 'name': 'CentOS Linux 7*',
+    }
+# Seconds to wait for a single region's image listing.
+DEFAULT_REGION_TIMEOUT = 300
+DEFAULT_CACHE_TTL = 3600
+MAX_REGION_WORKERS = 16
+
+CachedRegion = namedtuple('CachedRegion', ['name', 'endpoint'])
+
+CachedImage = namedtuple('CachedImage', [
+    'id', 'name', 'architecture', 'virtualization_type', 'root_device_type',
+    'region'])
+
 
 class WindowsFriendlyNamer(JujuFileNamer):
 
@@ -41,10 +64,12 @@ class WindowsFriendlyNamer(JujuFileNamer):
 
 
 def get_parameters(argv=None):
-    """Return streams, creds_filename for this invocation.
+    """Return streams, creds_filename, aws, azure, cache, region_timeout.
 
     streams is the directory to write streams into.
     creds_filename is the filename to get credentials from.
+    cache is a ListingCache for image listings, or None.
+    region_timeout is the number of seconds to wait for each region.
     """
     parser = ArgumentParser(description=dedent("""
         Query cloud API and write image streams.  AWS is written by default,
@@ -57,6 +82,14 @@ def get_parameters(argv=None):
                         help='The cloud to generate streams for.',
                         choices={ALL, AWS, AZURE})
     parser.add_argument('streams', help='The directory to write streams to.')
+    parser.add_argument(
+        '--cache-dir', help='A directory to cache image listings in.')
+    parser.add_argument(
+        '--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+        help='Seconds before a cached image listing is refreshed.')
+    parser.add_argument(
+        '--region-timeout', type=int, default=DEFAULT_REGION_TIMEOUT,
+        help='Seconds to wait for the images of a region.')
     args = parser.parse_args(argv)
     try:
         juju_data = os.environ['JUJU_DATA']
@@ -67,7 +100,11 @@ def get_parameters(argv=None):
     creds_filename = os.path.join(juju_data, 'credentials.yaml')
     azure = args.cloud in {AZURE, ALL}
     aws = args.cloud in {AWS, ALL}
-    return args.streams, creds_filename, aws, azure
+    cache = None
+    if args.cache_dir is not None:
+        cache = ListingCache(args.cache_dir, args.cache_ttl)
+    return (args.streams, creds_filename, aws, azure, cache,
+            args.region_timeout)
 
 
 def make_aws_credentials(creds):
@@ -109,14 +146,71 @@ def iter_region_connection(credentials, china_credentials):
             yield region.connect(**credentials)
 
 
-def iter_centos_images(credentials, china_credentials):
-    """Iterate through CentOS 7 images in standard AWS and AWS China."""
-    for conn in iter_region_connection(credentials, china_credentials):
-        images = conn.get_all_images(filters={
-            'owner_alias': 'aws-marketplace',
-            'product_code': 'aw0evgkw8e5c1q413zgy5pjce',
-            # 'name': 'CentOS Linux 7*',
-        })
+def image_to_dict(image):
+    """Convert a Boto image to a dict suitable for ListingCache."""
+    return {
+        'id': image.id,
+        'name': image.name,
+        'architecture': image.architecture,
+        'virtualization_type': image.virtualization_type,
+        'root_device_type': image.root_device_type,
+        'region': {
+            'name': image.region.name,
+            'endpoint': image.region.endpoint,
+            },
+        }
+
+
+def image_from_dict(image_dict):
+    """Convert an image_to_dict dict to an object usable by make_item."""
+    image_dict = dict(image_dict)
+    image_dict['region'] = CachedRegion(**image_dict['region'])
+    return CachedImage(**image_dict)
+
+
+def get_region_images(conn, cache=None):
+    """Return the CentOS 7 images for the region of conn.
+
+    Fresh listings are taken from the cache, if supplied.  Otherwise the
+    region is queried and the cache updated.
+    """
+    key = ['aws', conn.region.name, CENTOS_IMAGE_FILTERS]
+    if cache is not None:
+        image_dicts = cache.get(key)
+        if image_dicts is not None:
+            return [image_from_dict(i) for i in image_dicts]
+    images = conn.get_all_images(filters=CENTOS_IMAGE_FILTERS)
+    if cache is not None:
+        if cache.put(key, [image_to_dict(i) for i in images]):
+            logging.info('Images changed in {}'.format(conn.region.name))
+    return images
+
+
+def iter_centos_images(credentials, china_credentials, cache=None,
+                       region_timeout=DEFAULT_REGION_TIMEOUT):
+    """Iterate through CentOS 7 images in standard AWS and AWS China.
+
+    Regions are queried concurrently.  If a region fails or exceeds
+    region_timeout, a stale cached listing is used when available.
+    """
+    connections = iter_region_connection(credentials, china_credentials)
+
+    def get_images(conn):
+        return get_region_images(conn, cache)
+
+    for conn, images, error in iter_parallel(
+            get_images, connections, MAX_REGION_WORKERS, region_timeout):
+        if error is not None:
+            image_dicts = None
+            if cache is not None:
+                image_dicts = cache.get(
+                    ['aws', conn.region.name, CENTOS_IMAGE_FILTERS],
+                    max_age=float('inf'))
+            if image_dicts is None:
+                raise error
+            logging.warning('Using cached images for {}: {!r}'.format(
+                conn.region.name, error))
+            images = [image_from_dict(i) for i in image_dicts]
         for image in images:
             yield image
 
@@ -223,48 +317,101 @@ def write_item_streams(items, out_dir):
         'path', 'sha256', 'md5', 'size', 'virt', 'root_store', 'id'])
 
 
+def dump_json_streaming(out, data, stream_key, stream_items, indent=2):
+    """Write data as JSON, with data[stream_key] taken from stream_items.
+
+    stream_items is an iterable of (name, value) in sorted name order, so
+    that only one value needs to be in memory at a time.  The output matches
+    json.dumps(data, indent=indent, sort_keys=True, separators=(',', ': ')).
+    """
+    encoder = json.JSONEncoder(
+        indent=indent, sort_keys=True, separators=(',', ': '))
+    pad = ' ' * indent
+
+    def write_value(value, level):
+        for chunk in encoder.iterencode(value):
+            out.write(chunk.replace('\n', '\n' + pad * level))
+
+    out.write('{')
+    keys = sorted(set(data).union([stream_key]))
+    for num, key in enumerate(keys):
+        if num != 0:
+            out.write(',')
+        out.write('\n{}{}: '.format(pad, json.dumps(key)))
+        if key != stream_key:
+            write_value(data[key], 1)
+            continue
+        out.write('{')
+        empty = True
+        for name, value in stream_items:
+            if not empty:
+                out.write(',')
+            out.write('\n{}{}: '.format(pad * 2, json.dumps(name)))
+            write_value(value, 2)
+            empty = False
+        if not empty:
+            out.write('\n' + pad)
+        out.write('}')
+    out.write('\n}\n')
+
+
+def iter_condensed_products(tree, sticky):
+    """Yield (name, product) for each product in tree, condensed.
+
+    Each product is copied and condensed on its own, so the input is not
+    modified and only one copy is held at a time.
+    """
+    for name in sorted(tree['products']):
+        product_tree = {'products': {name: deepcopy(tree['products'][name])}}
+        util.products_condense(product_tree, sticky=sticky)
+        yield name, product_tree['products'][name]
+
+
 def write_juju_streams(out_d, trees, updated, sticky):
     # Based on simplestreams.json2streams.write_juju_streams +
     # simplestreams.generate_simplestreams.write_streams,
-    # but allows sticky to be specified.
+    # but allows sticky to be specified, and writes each content file
+    # product by product.
     namer = WindowsFriendlyNamer
     index = generate_index(trees, updated, namer)
-    to_write = [(namer.get_index_path(), index,)]
-    # Don't let products_condense modify the input
-    trees = deepcopy(trees)
+    index_filename = os.path.join(out_d, namer.get_index_path())
+    util.mkdir_p(os.path.dirname(index_filename))
+    json_dump(index, index_filename)
+    out_filenames = [index_filename]
     for content_id in trees:
-        util.products_condense(
-            trees[content_id], sticky=sticky)
-        content = trees[content_id]
-        to_write.append((index['index'][content_id]['path'], content,))
-    out_filenames = []
-    for (outfile, data) in to_write:
-        filef = os.path.join(out_d, outfile)
+        tree = trees[content_id]
+        filef = os.path.join(out_d, index['index'][content_id]['path'])
         util.mkdir_p(os.path.dirname(filef))
-        json_dump(data, filef)
+        with open(filef, 'w') as out:
+            dump_json_streaming(out, tree, 'products',
+                                iter_condensed_products(tree, sticky))
         out_filenames.append(filef)
     return out_filenames
 
 
-def make_aws_items(all_credentials, now):
+def make_aws_items(all_credentials, now, cache=None,
+                   region_timeout=DEFAULT_REGION_TIMEOUT):
     credentials = make_aws_credentials(all_credentials['aws'])
     china_credentials = make_aws_credentials(all_credentials['aws-china'])
     return [make_item(i, now) for i in
-            iter_centos_images(credentials, china_credentials)]
+            iter_centos_images(credentials, china_credentials, cache,
+                               region_timeout)]
 
 
 def main():
-    streams, creds_filename, aws, azure = get_parameters()
+    streams, creds_filename, aws, azure, cache, region_timeout = (
+        get_parameters())
     with open(creds_filename) as creds_file:
         all_credentials = yaml.safe_load(creds_file)['credentials']
     now = datetime.utcnow()
     items = []
     if aws:
-        items.extend(make_aws_items(all_credentials, now))
+        items.extend(make_aws_items(all_credentials, now, cache,
+                                    region_timeout))
     if azure:
         # Avoid breakage for aws streams if azure libs not installed.
         from azure_image_streams import make_azure_items
-        items.extend(make_azure_items(all_credentials))
+        items.extend(make_azure_items(all_credentials, cache))
     write_item_streams(items, streams)
 
 
@@ -4,11 +4,19 @@ from __future__ import print_function
 
 from argparse import ArgumentParser
 import difflib
+import hashlib
+import json
 import os
 import sys
 import traceback
 import urllib2
 
+from utils import file_digest
+from validate_streams import (
+    diff_digests,
+    stream_digests,
+    )
+
 
 __metaclass__ = type
 
@@ -31,14 +39,54 @@ def get_remote_file(url):
     return content
 
 
+def diff_streams(local_stream, remote_stream):
+    """Return a list of the differences between two stream documents.
+
+    Items are compared by key and digest, so unchanged items cost no more
+    than their digest.  Added and removed items are relative to local.
+    """
+    lines = []
+    for key in sorted(set(local_stream).union(remote_stream)):
+        if key in ('products', 'index'):
+            continue
+        local_value = local_stream.get(key)
+        remote_value = remote_stream.get(key)
+        if local_value != remote_value:
+            lines.append('~ {}: {!r} -> {!r}'.format(
+                key, local_value, remote_value))
+    added, removed, changed = diff_digests(
+        stream_digests(local_stream), stream_digests(remote_stream))
+    for prefix, keys in (('-', removed), ('+', added), ('~', changed)):
+        lines.extend('{} {}'.format(prefix, ' '.join(k)) for k in keys)
+    if len(lines) == 0:
+        lines.append('~ Only the formatting differs.')
+    return lines
+
+
 def diff_files(local, remote):
     """Return the difference of a local and a remote file.
 
+    Identical files are detected by digest.  Stream documents are compared
+    by content id and item digest; other files get a unified diff.
+
     :return: a tuple of identical (True, None) or different (False, str).
     """
+    remote_content = get_remote_file(remote)
+    if file_digest(local) == hashlib.sha256(remote_content).hexdigest():
+        return True, None
+    try:
+        with open(local, 'r') as f:
+            local_stream = json.load(f)
+        remote_stream = json.loads(remote_content)
+    except ValueError:
+        local_stream = remote_stream = None
+    if isinstance(local_stream, dict) and isinstance(remote_stream, dict):
+        diff_lines = ['--- {}'.format(local), '+++ {}'.format(remote)]
+        diff_lines.extend(diff_streams(local_stream, remote_stream))
+        return False, '\n'.join(diff_lines)
     with open(local, 'r') as f:
         local_lines = f.read().splitlines()
-    remote_lines = get_remote_file(remote).splitlines()
+    remote_lines = remote_content.splitlines()
     diff_gen = difflib.unified_diff(local_lines, remote_lines, local, remote)
     diff = '\n'.join(list(diff_gen))
     if diff:
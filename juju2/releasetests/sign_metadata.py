@@ -1,6 +1,9 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
+import json
+import os
 from os import listdir
 from os.path import (
     basename,
@@ -11,26 +14,145 @@ from os.path import (
 from tempfile import NamedTemporaryFile
 
 from lprelease import run
+from utils import (
+    file_digest,
+    iter_parallel,
+    )
 
 
-def sign_metadata(signing_key, meta_dir, signing_passphrase_file=None):
+DEFAULT_WORKERS = 4
+
+
+def sign_metadata(signing_key, meta_dir, signing_passphrase_file=None,
+                  workers=DEFAULT_WORKERS, manifest_path=None):
+    """Sign the json files in meta_dir.
+
+    Files that are unchanged since they were last signed with signing_key,
+    according to the manifest at manifest_path, keep their signatures.  The
+    other files are signed concurrently by up to workers gpg processes.
+    Without a manifest, every file is signed and existing signatures are an
+    error.  The manifest must not be in meta_dir, which is published.
+    """
     key_option, gpg_options = get_gpg_options(
         signing_key, signing_passphrase_file)
+    manifest = {}
+    if manifest_path is not None:
+        manifest = load_manifest(manifest_path)
+    to_sign = []
     for meta_file in get_meta_files(meta_dir):
-        with NamedTemporaryFile() as temp_file:
-            meta_file_path = join(meta_dir, meta_file)
-            update_file_content(meta_file_path, temp_file.name)
-            meta_basename = basename(meta_file).replace('.json', '.sjson')
-            output_file = join(meta_dir, meta_basename)
-            ensure_no_file(output_file)
+        entry = manifest.get(meta_file)
+        if is_signed(meta_dir, meta_file, signing_key, entry):
+            continue
+        if entry is None:
+            ensure_no_file(join(meta_dir, get_sjson_name(meta_file)))
+            ensure_no_file(join(meta_dir, get_gpg_name(meta_file)))
+        to_sign.append(meta_file)
+
+    def sign(meta_file):
+        return sign_file(
+            meta_dir, meta_file, signing_key, key_option, gpg_options)
+
+    errors = []
+    try:
+        for meta_file, entry, error in iter_parallel(sign, to_sign, workers):
+            if error is not None:
+                errors.append(error)
+                # Signatures may be partly written; allow them to be
+                # replaced on the next run.
+                manifest[meta_file] = {'key': signing_key}
+            else:
+                manifest[meta_file] = entry
+    finally:
+        if manifest_path is not None:
+            save_manifest(manifest_path, manifest)
+    if errors:
+        raise errors[0]
+
+
+def sign_file(meta_dir, meta_file, signing_key, key_option, gpg_options):
+    """Write the .sjson and .json.gpg signatures of meta_file.
+
+    Signatures are written to temporary files and then renamed into place.
+    :return: the manifest entry for meta_file.
+    """
+    meta_file_path = join(meta_dir, meta_file)
+    with NamedTemporaryFile() as temp_file:
+        update_file_content(meta_file_path, temp_file.name)
+        json_digest = file_digest(meta_file_path)
+        sjson_file = join(meta_dir, get_sjson_name(meta_file))
+        with atomic_output(sjson_file) as output_file:
             cmd = 'gpg {} --clearsign {} -o {} {}'.format(
                 gpg_options, key_option, output_file, temp_file.name)
             run(cmd.split())
-            output_file = join(meta_dir, '{}.gpg'.format(meta_file))
-            ensure_no_file(output_file)
-            cmd = 'gpg {} --detach-sign {} -o {} {}'.format(
-                gpg_options, key_option, output_file, meta_file_path)
-            run(cmd.split())
+    gpg_file = join(meta_dir, get_gpg_name(meta_file))
+    with atomic_output(gpg_file) as output_file:
+        cmd = 'gpg {} --detach-sign {} -o {} {}'.format(
+            gpg_options, key_option, output_file, meta_file_path)
+        run(cmd.split())
+    return {
+        'key': signing_key,
+        'json': json_digest,
+        'sjson': file_digest(sjson_file),
+        'gpg': file_digest(gpg_file),
+        }
+
+
+def get_temp_path(file_path):
+    """Return a hidden path beside file_path, unique to this process."""
+    return join(os.path.dirname(file_path), '.{}.{}.tmp'.format(
+        basename(file_path), os.getpid()))
+
+
+@contextmanager
+def atomic_output(file_path):
+    """Provide a temporary path that replaces file_path on success."""
+    temp_path = get_temp_path(file_path)
+    if isfile(temp_path):
+        os.unlink(temp_path)
+    try:
+        yield temp_path
+    except Exception:
+        if isfile(temp_path):
+            os.unlink(temp_path)
+        raise
+    os.rename(temp_path, file_path)
+
+
+def get_sjson_name(meta_file):
+    return basename(meta_file).replace('.json', '.sjson')
+
+
+def get_gpg_name(meta_file):
+    return '{}.gpg'.format(meta_file)
+
+
+def is_signed(meta_dir, meta_file, signing_key, entry):
+    """Return True if the manifest entry matches the files on disk."""
+    if entry is None or entry.get('key') != signing_key:
+        return False
+    paths = {
+        'json': join(meta_dir, meta_file),
+        'sjson': join(meta_dir, get_sjson_name(meta_file)),
+        'gpg': join(meta_dir, get_gpg_name(meta_file)),
+        }
+    for name, path in paths.items():
+        if not isfile(path) or file_digest(path) != entry.get(name):
+            return False
+    return True
+
+
+def load_manifest(manifest_path):
+    """Return the dict of meta file to signed digests, or {} if missing."""
+    if not isfile(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest_path, manifest):
+    with atomic_output(manifest_path) as temp_path:
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
 
 
 def update_file_content(mete_file, dst_file):
@@ -66,10 +188,22 @@ def parse_args(argv=None):
     parser.add_argument('signing_key', help='Key to sign with.')
     parser.add_argument(
         '-p', '--signing-passphrase-file', help='Signing passphrase file path.')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=DEFAULT_WORKERS,
+        help='The number of files to sign at once.')
+    parser.add_argument(
+        '--manifest',
+        help='Record the digests of signed files here, outside the metadata'
+             ' directory, so unchanged files are not signed again.')
     args = parser.parse_args(argv)
     if not isdir(args.metadata_dir):
         parser.error(
             'Invalid metadata directory path {}'.format(args.metadata_dir))
+    meta_dir = join(os.path.abspath(args.metadata_dir), '')
+    if (args.manifest is not None and
+            os.path.abspath(args.manifest).startswith(meta_dir)):
+        parser.error(
+            'The manifest must be outside the metadata directory.')
     if (args.signing_passphrase_file and
             not isfile(args.signing_passphrase_file)):
         parser.error(
@@ -81,4 +215,4 @@ def parse_args(argv=None):
 if __name__ == '__main__':
     args = parse_args()
     sign_metadata(args.signing_key, args.metadata_dir,
-                  args.signing_passphrase_file)
+                  args.signing_passphrase_file, args.workers, args.manifest)
@@ -9,13 +9,15 @@ from mock import (
 from msrestazure.azure_exceptions import CloudError
 
 from azure_image_streams import (
-    arm_image_exists,
     CANONICAL,
     convert_cloud_images_items,
     convert_item_to_arm,
     find_ubuntu_items,
     get_azure_credentials,
     IMAGE_SPEC,
+    ImageVersionIndex,
+    list_image_versions,
+    list_skus,
     make_spec_items,
     MissingImage,
     make_item,
@@ -27,6 +29,11 @@ from azure_image_streams import (
     )
 from simplestreams.json2streams import Item
 
+from utils import (
+    ListingCache,
+    temp_dir,
+    )
+
 
 def make_all_credentials():
     return {'azure': {'credentials': {
@@ -121,33 +128,6 @@ class TestParseID(TestCase):
         self.assertEqual('12.04.201409240', version)
 
 
-def force_missing(client):
-    client.virtual_machine_images.get.side_effect = CloudError(
-        Mock(), 'Artifact: VMImage was not found.')
-
-
-class TestArmImageExists(TestCase):
-
-    def test_image_exists(self):
-        client = Mock()
-        self.assertTrue(arm_image_exists(client, 'foo', ()))
-        client.virtual_machine_images.get.assert_called_once_with('foo')
-
-    def test_image_missing(self):
-        client = Mock()
-        force_missing(client)
-        self.assertFalse(arm_image_exists(client, 'foo', ()))
-        client.virtual_machine_images.get.assert_called_once_with('foo')
-
-    def test_other_error(self):
-        client = Mock()
-        client.virtual_machine_images.get.side_effect = CloudError(
-            Mock(), 'Other error')
-        with self.assertRaises(CloudError):
-            arm_image_exists(client, 'foo', ())
-        client.virtual_machine_images.get.assert_called_once_with('foo')
-
-
 def make_old_item(item_id=None, region=None):
     if region is None:
         region = 'Westeros'
@@ -196,23 +176,42 @@ def make_item_expected(item_id=None, region=None, endpoint=None):
 
 class TestConvertCloudImagesItems(TestCase):
 
-    def make_locations_client(self, expected_item):
+    def make_locations_client(self, expected_item, full_spec):
         locations = [mock_location('westeros', 'Westeros')]
         client = Mock()
         client.config.base_url = expected_item.data['endpoint']
+        client.virtual_machine_images.list.return_value = [
+            mock_version(full_spec[-1])]
         return locations, client
 
     def test_convert_cloud_images_items(self):
         old_item, full_spec, expected_item = make_item_expected()
-        locations, client = self.make_locations_client(expected_item)
+        locations, client = self.make_locations_client(expected_item,
+                                                       full_spec)
         arm_items, unknown_locations = convert_cloud_images_items(
             client, locations, [old_item])
-        client.virtual_machine_images.get.assert_called_once_with(
-            'westeros', *full_spec)
+        client.virtual_machine_images.list.assert_called_once_with(
+            'westeros', *full_spec[:-1])
+        self.assertEqual(0, client.virtual_machine_images.get.call_count)
         self.assertEqual([
             expected_item], arm_items)
         self.assertEqual(set(), unknown_locations)
 
+    def test_one_listing_per_sku(self):
+        old_item, full_spec, expected_item = make_item_expected()
+        old_item2, full_spec2, expected_item2 = make_item_expected(
+            item_id=make_id(build_number='.5'))
+        self.assertEqual(full_spec[:-1], full_spec2[:-1])
+        locations, client = self.make_locations_client(expected_item,
+                                                       full_spec)
+        client.virtual_machine_images.list.return_value.append(
+            mock_version(full_spec2[-1]))
+        arm_items, unknown_locations = convert_cloud_images_items(
+            client, locations, [old_item, old_item2])
+        client.virtual_machine_images.list.assert_called_once_with(
+            'westeros', *full_spec[:-1])
+        self.assertEqual([expected_item, expected_item2], arm_items)
+
     def test_unknown_location(self):
         old_item = make_old_item()
         locations = []
@@ -226,18 +225,131 @@ class TestConvertCloudImagesItems(TestCase):
         old_item, full_spec, expected_item = make_item_expected(
             item_id='b39f27a8b8c64d52b05eac6a62ebad85__Ubuntu-12_04_2-LTS'
             '-amd64-server-20121218-en-us-30GB')
-        locations, client = self.make_locations_client(expected_item)
+        locations, client = self.make_locations_client(expected_item,
+                                                       full_spec)
         with self.assertRaises(UnexpectedImage):
             convert_cloud_images_items(client, locations, [old_item])
 
     def test_missing_image(self):
         old_item, full_spec, expected_item = make_item_expected()
-        locations, client = self.make_locations_client(expected_item)
-        force_missing(client)
+        locations, client = self.make_locations_client(expected_item,
+                                                       full_spec)
+        client.virtual_machine_images.list.return_value = []
         with self.assertRaises(MissingImage):
             convert_cloud_images_items(client, locations, [old_item])
-        client.virtual_machine_images.get.assert_called_once_with(
-            'westeros', *full_spec)
+        client.virtual_machine_images.list.assert_called_once_with(
+            'westeros', *full_spec[:-1])
+
+    def test_missing_sku(self):
+        old_item, full_spec, expected_item = make_item_expected()
+        locations, client = self.make_locations_client(expected_item,
+                                                       full_spec)
+        client.virtual_machine_images.list.side_effect = CloudError(
+            Mock(status_code=404), 'Artifact: VMImage was not found.')
+        with self.assertRaises(MissingImage):
+            convert_cloud_images_items(client, locations, [old_item])
+
+
+class TestListImageVersions(TestCase):
+
+    def test_list_image_versions(self):
+        client = mock_compute_client(['1', '2'])
+        versions = list_image_versions(client, 'westeros', 'foo', 'bar',
+                                       'baz')
+        self.assertEqual(['1', '2'], versions)
+        client.virtual_machine_images.list.assert_called_once_with(
+            'westeros', 'foo', 'bar', 'baz')
+
+    def test_cache(self):
+        client = mock_compute_client(['1', '2'])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            list_image_versions(client, 'westeros', 'foo', 'bar', 'baz',
+                                cache)
+            versions = list_image_versions(client, 'westeros', 'foo', 'bar',
+                                           'baz', cache)
+        self.assertEqual(['1', '2'], versions)
+        self.assertEqual(1, client.virtual_machine_images.list.call_count)
+
+    def test_refresh(self):
+        client = mock_compute_client(['1'])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            list_image_versions(client, 'westeros', 'foo', 'bar', 'baz',
+                                cache)
+            client.virtual_machine_images.list.return_value.append(
+                mock_version('2'))
+            versions = list_image_versions(client, 'westeros', 'foo', 'bar',
+                                           'baz', cache, refresh=True)
+            self.assertEqual(['1', '2'], versions)
+            versions = list_image_versions(client, 'westeros', 'foo', 'bar',
+                                           'baz', cache)
+        self.assertEqual(['1', '2'], versions)
+        self.assertEqual(2, client.virtual_machine_images.list.call_count)
+
+
+class TestListSkus(TestCase):
+
+    def test_cache(self):
+        client = mock_compute_client([])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            list_skus(client, 'westeros', 'foo', 'bar', cache)
+            skus = list_skus(client, 'westeros', 'foo', 'bar', cache)
+        self.assertEqual(['12.04.2-LTS'], skus)
+        client.virtual_machine_images.list_skus.assert_called_once_with(
+            'westeros', 'foo', 'bar')
+
+
+class TestImageVersionIndex(TestCase):
+
+    def test_exists(self):
+        client = mock_compute_client(['1', '2'])
+        index = ImageVersionIndex(client)
+        index.load([('westeros', 'foo', 'bar', 'baz'),
+                    ('essos', 'foo', 'bar', 'baz')])
+        self.assertIs(True, index.exists('westeros', ('foo', 'bar', 'baz',
+                                                      '1')))
+        self.assertIs(False, index.exists('westeros', ('foo', 'bar', 'baz',
+                                                       '3')))
+        self.assertIs(True, index.exists('essos', ('foo', 'bar', 'baz',
+                                                   '2')))
+        self.assertEqual(2, client.virtual_machine_images.list.call_count)
+
+    def test_exists_loads_on_demand(self):
+        client = mock_compute_client(['1'])
+        index = ImageVersionIndex(client)
+        self.assertIs(True, index.exists('westeros', ('foo', 'bar', 'baz',
+                                                      '1')))
+        self.assertIs(True, index.exists('westeros', ('foo', 'bar', 'baz',
+                                                      '1')))
+        client.virtual_machine_images.list.assert_called_once_with(
+            'westeros', 'foo', 'bar', 'baz')
+
+    def test_exists_refreshes_stale_cache(self):
+        client = mock_compute_client(['1'])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            list_image_versions(client, 'westeros', 'foo', 'bar', 'baz',
+                                cache)
+            client.virtual_machine_images.list.return_value.append(
+                mock_version('2'))
+            index = ImageVersionIndex(client, cache)
+            self.assertIs(True, index.exists('westeros', ('foo', 'bar', 'baz',
+                                                          '2')))
+            self.assertIs(False, index.exists('westeros', ('foo', 'bar',
+                                                           'baz', '3')))
+            self.assertEqual(['1', '2'], list_image_versions(
+                client, 'westeros', 'foo', 'bar', 'baz', cache))
+        self.assertEqual(2, client.virtual_machine_images.list.call_count)
+
+    def test_other_error(self):
+        client = mock_compute_client([])
+        client.virtual_machine_images.list.side_effect = CloudError(
+            Mock(status_code=403), 'Other error')
+        index = ImageVersionIndex(client)
+        with self.assertRaises(CloudError):
+            index.load([('westeros', 'foo', 'bar', 'baz')])
 
 
 class TestMakeItem(TestCase):
@@ -339,6 +451,27 @@ class TestMakeSpecItems(TestCase):
         self.assertEqual(expected_calls,
                          client.virtual_machine_images.list.mock_calls)
 
+    def test_multiple_locations(self):
+        client = mock_compute_client(['1', '2'])
+        locations = [mock_location('canadaeast', 'Canada East'),
+                     mock_location('westus', 'West US')]
+        items = list(make_spec_items(client, IMAGE_SPEC[0], locations))
+        self.assertEqual(
+            [('0', 'caee1i3'), ('0', 'usww1i3'), ('1', 'caee1i3'),
+             ('1', 'usww1i3')],
+            [(i.version_name, i.item_name) for i in items])
+        self.assertEqual(2, client.virtual_machine_images.list.call_count)
+
+    def test_missing_location(self):
+        client = mock_compute_client(['1'])
+        client.virtual_machine_images.list.side_effect = CloudError(
+            Mock(status_code=404), 'Not found')
+        locations = [mock_location('canadaeast', 'Canada East')]
+        with patch('azure_image_streams.logger') as logger_mock:
+            items = list(make_spec_items(client, IMAGE_SPEC[0], locations))
+        self.assertEqual([], items)
+        self.assertEqual(1, logger_mock.return_value.warning.call_count)
+
 
 class TestMakeAzureItems(TestCase):
 
@@ -1,8 +1,10 @@
 from contextlib import contextmanager
 from datetime import datetime
 import json
+from multiprocessing import TimeoutError
 import os
 from StringIO import StringIO
+import threading
 from unittest import TestCase
 
 from mock import (
@@ -11,8 +13,14 @@ from mock import (
     )
 
 from make_image_streams import (
+    CENTOS_IMAGE_FILTERS,
+    dump_json_streaming,
+    get_region_images,
+    image_from_dict,
+    image_to_dict,
     is_china,
     iter_centos_images,
+    iter_condensed_products,
     iter_region_connection,
     get_parameters,
     make_aws_credentials,
@@ -21,7 +29,10 @@ from make_image_streams import (
     make_item_name,
     write_item_streams,
     )
-from utils import temp_dir
+from utils import (
+    ListingCache,
+    temp_dir,
+    )
 
 
 class TestIsChina(TestCase):
@@ -136,6 +147,130 @@ class IterCentosImages(TestCase):
         self.assertEqual(east_imgs + west_imgs, imgs)
         irc_mock.assert_called_once_with(aws, aws_cn)
 
+    def test_regions_queried_concurrently(self):
+        rendezvous = Rendezvous(2)
+        conns = [
+            FakeEC2Connection('us-east-1', ['east'], block=rendezvous),
+            FakeEC2Connection('us-west-1', ['west'], block=rendezvous),
+            ]
+        with patch('make_image_streams.iter_region_connection',
+                   return_value=conns, autospec=True):
+            imgs = list(iter_centos_images({}, {}, region_timeout=10))
+        self.assertEqual(['east', 'west'], imgs)
+        self.assertTrue(rendezvous.all_arrived.is_set())
+
+    def test_timeout_no_cache(self):
+        block = threading.Event()
+        conn = FakeEC2Connection('us-east-1', ['east'], block=block)
+        try:
+            with patch('make_image_streams.iter_region_connection',
+                       return_value=[conn], autospec=True):
+                with self.assertRaises(TimeoutError):
+                    list(iter_centos_images({}, {}, region_timeout=0.01))
+        finally:
+            block.set()
+
+    def test_timeout_uses_stale_cache(self):
+        now = [1000]
+        image = make_mock_image(region_name='us-east-1')
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60, now=lambda: now[0])
+            cache.put(['aws', 'us-east-1', CENTOS_IMAGE_FILTERS],
+                      [image_to_dict(image)])
+            now[0] += 61
+            block = threading.Event()
+            conn = FakeEC2Connection('us-east-1', [], block=block)
+            try:
+                with patch('make_image_streams.iter_region_connection',
+                           return_value=[conn], autospec=True):
+                    with patch('logging.warning'):
+                        imgs = list(iter_centos_images(
+                            {}, {}, cache, region_timeout=0.01))
+            finally:
+                block.set()
+        self.assertEqual([image_from_dict(image_to_dict(image))], imgs)
+
+    def test_error_uses_stale_cache(self):
+        image = make_mock_image(region_name='us-east-1')
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 0)
+            cache.put(['aws', 'us-east-1', CENTOS_IMAGE_FILTERS],
+                      [image_to_dict(image)])
+            conn = FakeEC2Connection('us-east-1', [], error=IOError('boom'))
+            with patch('make_image_streams.iter_region_connection',
+                       return_value=[conn], autospec=True):
+                with patch('logging.warning'):
+                    imgs = list(iter_centos_images({}, {}, cache))
+        self.assertEqual([image_from_dict(image_to_dict(image))], imgs)
+
+
+class FakeEC2Connection:
+    """A local stand-in for a regional EC2 API connection."""
+
+    def __init__(self, region_name, images, block=None, error=None):
+        self.region = make_mock_region(region_name, name=region_name)
+        self.images = images
+        self.block = block
+        self.error = error
+        self.calls = []
+
+    def get_all_images(self, filters):
+        self.calls.append(filters)
+        if self.block is not None:
+            self.block.wait()
+        if self.error is not None:
+            raise self.error
+        return self.images
+
+
+class Rendezvous:
+    """Block callers of wait until the expected number have arrived."""
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        self.lock = threading.Lock()
+        self.all_arrived = threading.Event()
+
+    def wait(self):
+        with self.lock:
+            self.arrived += 1
+            if self.arrived == self.parties:
+                self.all_arrived.set()
+        self.all_arrived.wait(5)
+
+
+class TestGetRegionImages(TestCase):
+
+    def test_no_cache(self):
+        conn = FakeEC2Connection('us-east-1', ['east-1'])
+        self.assertEqual(['east-1'], get_region_images(conn))
+        self.assertEqual([CENTOS_IMAGE_FILTERS], conn.calls)
+
+    def test_cache(self):
+        image = make_mock_image(region_name='us-east-1')
+        image.region.endpoint = 'ec2.us-east-1.amazonaws.com'
+        conn = FakeEC2Connection('us-east-1', [image])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            self.assertEqual([image], get_region_images(conn, cache))
+            cached = get_region_images(conn, cache)
+        self.assertEqual(1, len(conn.calls))
+        self.assertEqual([image_from_dict(image_to_dict(image))], cached)
+        self.assertEqual('us-east-1', cached[0].region.name)
+        self.assertEqual(make_item(image, datetime(2001, 2, 3)),
+                         make_item(cached[0], datetime(2001, 2, 3)))
+
+    def test_stale_cache(self):
+        now = [1000]
+        conn = FakeEC2Connection('us-east-1', [])
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60, now=lambda: now[0])
+            get_region_images(conn, cache)
+            now[0] += 61
+            get_region_images(conn, cache)
+        self.assertEqual(2, len(conn.calls))
+
 
 class TestMakeAWSCredentials(TestCase):
 
@@ -238,17 +373,29 @@ class TestGetParameters(TestCase):
 
     def test_happy_path(self):
         with patch.dict(os.environ, {'JUJU_DATA': 'foo'}):
-            streams, creds_filename, aws, azure = get_parameters(['all',
-                                                                  'bar'])
+            streams, creds_filename, aws, azure, cache, region_timeout = (
+                get_parameters(['all', 'bar']))
         self.assertEqual(creds_filename, 'foo/credentials.yaml')
         self.assertEqual(streams, 'bar')
         self.assertTrue(aws)
         self.assertTrue(azure)
+        self.assertIs(None, cache)
+        self.assertEqual(300, region_timeout)
+
+    def test_cache(self):
+        with patch.dict(os.environ, {'JUJU_DATA': 'foo'}):
+            streams, creds_filename, aws, azure, cache, region_timeout = (
+                get_parameters(['all', 'bar', '--cache-dir', 'baz',
+                                '--cache-ttl', '60', '--region-timeout',
+                                '30']))
+        self.assertEqual('baz', cache.cache_dir)
+        self.assertEqual(60, cache.ttl)
+        self.assertEqual(30, region_timeout)
 
     def test_azure(self):
         with patch.dict(os.environ, {'JUJU_DATA': 'foo'}):
-            streams, creds_filename, aws, azure = get_parameters(['azure',
-                                                                  'bar'])
+            streams, creds_filename, aws, azure, cache, region_timeout = (
+                get_parameters(['azure', 'bar']))
         self.assertEqual(creds_filename, 'foo/credentials.yaml')
         self.assertEqual(streams, 'bar')
         self.assertFalse(aws)
@@ -256,8 +403,8 @@ class TestGetParameters(TestCase):
 
     def test_aws(self):
         with patch.dict(os.environ, {'JUJU_DATA': 'foo'}):
-            streams, creds_filename, aws, azure = get_parameters(['aws',
-                                                                  'bar'])
+            streams, creds_filename, aws, azure, cache, region_timeout = (
+                get_parameters(['aws', 'bar']))
         self.assertEqual(creds_filename, 'foo/credentials.yaml')
         self.assertEqual(streams, 'bar')
         self.assertTrue(aws)
@@ -314,6 +461,47 @@ class TestMakeAwsItems(TestCase):
                           make_item(west_image, now)], items)
 
 
+class TestDumpJsonStreaming(TestCase):
+
+    def dump(self, data):
+        out = StringIO()
+        dump_json_streaming(out, data, 'products',
+                            sorted(data['products'].items()))
+        return out.getvalue()
+
+    def test_matches_json_dumps(self):
+        data = {
+            'content_id': 'foo',
+            'products': {
+                'b': {'versions': {'1': {'items': {'x': {'y': 'z\n'}}}}},
+                'a': {'arch': 'amd64', 'versions': {}},
+                },
+            'updated': 'now',
+            }
+        self.assertEqual(
+            json.dumps(data, indent=2, sort_keys=True,
+                       separators=(',', ': ')) + '\n',
+            self.dump(data))
+
+    def test_no_products(self):
+        self.assertEqual('{\n  "products": {}\n}\n',
+                         self.dump({'products': {}}))
+
+
+class TestIterCondensedProducts(TestCase):
+
+    def test_input_unchanged(self):
+        tree = {'products': {'foo': {'versions': {'1': {'items': {
+            'a': {'arch': 'amd64', 'id': '1'},
+            'b': {'arch': 'amd64', 'id': '2'},
+            }}}}}}
+        original = json.loads(json.dumps(tree))
+        products = list(iter_condensed_products(tree, ['id']))
+        self.assertEqual(original, tree)
+        self.assertEqual(['foo'], [name for name, product in products])
+        self.assertEqual('amd64', products[0][1]['arch'])
+
+
 class TestWriteItemStreams(TestCase):
 
     def test_write_item_streams(self):
@@ -1,3 +1,4 @@
+import json
 from mock import patch
 import os
 import re
@@ -7,6 +8,7 @@ from unittest import TestCase
 from publish_streams import (
     CPCS,
     diff_files,
+    diff_streams,
     get_remote_file,
     main,
     parse_args,
@@ -76,6 +78,55 @@ class PublishStreamsTestCase(TestCase):
             '+four',
             normalized_diff)
 
+    @patch('publish_streams.get_remote_file', autospec=True)
+    def test_diff_files_streams(self, gr_mock):
+        local_stream = {'updated': 'now', 'content_id': 'foo', 'products': {
+            'bar': {'versions': {'1': {'items': {
+                'baz': {'sha256': 'a'}, 'qux': {'sha256': 'b'},
+                }}}}}}
+        remote_stream = json.loads(json.dumps(local_stream))
+        remote_stream['updated'] = 'later'
+        items = remote_stream['products']['bar']['versions']['1']['items']
+        items['baz']['sha256'] = 'c'
+        del items['qux']
+        gr_mock.return_value = json.dumps(remote_stream)
+        with temp_dir() as base:
+            local_path = os.path.join(base, 'bar.json')
+            with open(local_path, 'w') as local_file:
+                json.dump(local_stream, local_file)
+            identical, diff = diff_files(local_path, 'http://foo/bar.json')
+        self.assertFalse(identical)
+        self.assertEqual([
+            '--- {}'.format(local_path),
+            '+++ http://foo/bar.json',
+            "~ updated: u'now' -> u'later'",
+            '- foo bar 1 qux',
+            '~ foo bar 1 baz',
+            ], diff.splitlines())
+
+    def test_diff_streams_formatting(self):
+        self.assertEqual(['~ Only the formatting differs.'],
+                         diff_streams({'index': {}}, {'index': {}}))
+
+    def test_diff_streams_product_attribute(self):
+        local_stream = {'content_id': 'foo', 'products': {'bar': {
+            'arch': 'amd64', 'versions': {'1': {
+                'version': '2.0', 'items': {'baz': {'sha256': 'a'}}}}}}}
+        remote_stream = json.loads(json.dumps(local_stream))
+        remote_stream['products']['bar']['arch'] = 'arm64'
+        self.assertEqual(['~ foo bar 1 baz'],
+                         diff_streams(local_stream, remote_stream))
+        remote_stream = json.loads(json.dumps(local_stream))
+        remote_stream['products']['bar']['versions']['1']['version'] = '2.1'
+        self.assertEqual(['~ foo bar 1 baz'],
+                         diff_streams(local_stream, remote_stream))
+
+    def test_diff_streams_index(self):
+        self.assertEqual(
+            ['+ bar', '~ foo'],
+            diff_streams({'index': {'foo': {'path': 'a'}}},
+                         {'index': {'foo': {'path': 'b'}, 'bar': {}}}))
+
     @patch('publish_streams.diff_files', autospec=True)
     def test_verify_metadata(self, df_mock):
         df_mock.return_value = (True, None)
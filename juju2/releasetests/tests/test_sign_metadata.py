@@ -1,5 +1,6 @@
 from argparse import Namespace
 from contextlib import contextmanager
+from os import listdir
 from os.path import(
     join,
     isfile,
@@ -17,6 +18,8 @@ from mock import (
 from sign_metadata import (
     get_gpg_options,
     get_meta_files,
+    get_temp_path,
+    load_manifest,
     sign_metadata,
     parse_args,
     update_file_content,
@@ -92,9 +95,11 @@ class TestSignMetaData(TestCase):
         gpg_file = '{}.gpg'.format(meta_file)
         calls = [
             call(['gpg', '--no-tty', '--clearsign', '--default-key',
-                  'thedude@example.com', '-o', signed_file, temp_file.name]),
+                  'thedude@example.com', '-o', get_temp_path(signed_file),
+                  temp_file.name]),
             call(['gpg', '--no-tty', '--detach-sign', '--default-key',
-                  'thedude@example.com', '-o', gpg_file, meta_file])]
+                  'thedude@example.com', '-o', get_temp_path(gpg_file),
+                  meta_file])]
         self.assertEqual(smr.mock_calls, calls)
         ntf.assert_called_once_with()
 
@@ -115,13 +120,109 @@ class TestSignMetaData(TestCase):
         calls = [
             call(['gpg', '--no-use-agent', '--no-tty', '--passphrase-file',
                   'passphrase_file', '--clearsign', '--default-key',
-                  'thedude@example.com', '-o', signed_file, temp_file.name]),
+                  'thedude@example.com', '-o', get_temp_path(signed_file),
+                  temp_file.name]),
             call(['gpg', '--no-use-agent', '--no-tty', '--passphrase-file',
                   'passphrase_file', '--detach-sign', '--default-key',
-                  'thedude@example.com', '-o', gpg_file, meta_file])]
+                  'thedude@example.com', '-o', get_temp_path(gpg_file),
+                  meta_file])]
         self.assertEqual(smr.mock_calls, calls)
         ntf.assert_called_once_with()
 
+    @contextmanager
+    def meta_and_manifest(self):
+        with temp_dir() as meta_dir:
+            with temp_dir() as state_dir:
+                yield meta_dir, join(state_dir, 'signed-digests.json')
+
+    def test_sign_metadata_skips_unchanged(self):
+        with patch('sign_metadata.run', autospec=True,
+                   side_effect=self.fake_gpg) as smr:
+            with self.meta_and_manifest() as (meta_dir, manifest_path):
+                write_file(join(meta_dir, 'index.json'), self.content)
+                write_file(join(meta_dir, 'other.json'), self.content)
+                sign_metadata('thedude@example.com', meta_dir,
+                              manifest_path=manifest_path)
+                self.assertEqual(4, smr.call_count)
+                manifest = load_manifest(manifest_path)
+                sign_metadata('thedude@example.com', meta_dir,
+                              manifest_path=manifest_path)
+                self.assertEqual(4, smr.call_count)
+                write_file(join(meta_dir, 'other.json'), '{}')
+                sign_metadata('thedude@example.com', meta_dir,
+                              manifest_path=manifest_path)
+                self.assertEqual(6, smr.call_count)
+                self.verify_signed_content(meta_dir)
+                with open(join(meta_dir, 'other.sjson')) as other:
+                    self.assertIn('{}', other.read())
+                self.assertEqual(
+                    ['index.json', 'index.json.gpg', 'index.sjson',
+                     'other.json', 'other.json.gpg', 'other.sjson'],
+                    sorted(listdir(meta_dir)))
+        self.assertEqual(['index.json', 'other.json'], sorted(manifest))
+        self.assertEqual('thedude@example.com', manifest['index.json']['key'])
+
+    def test_sign_metadata_without_manifest(self):
+        with patch('sign_metadata.run', autospec=True,
+                   side_effect=self.fake_gpg):
+            with temp_dir() as meta_dir:
+                write_file(join(meta_dir, 'index.json'), self.content)
+                sign_metadata('thedude@example.com', meta_dir)
+                self.assertEqual(
+                    ['index.json', 'index.json.gpg', 'index.sjson'],
+                    sorted(listdir(meta_dir)))
+                with self.assertRaisesRegexp(ValueError,
+                                             'file already exists'):
+                    sign_metadata('thedude@example.com', meta_dir)
+
+    def test_sign_metadata_new_key(self):
+        with patch('sign_metadata.run', autospec=True,
+                   side_effect=self.fake_gpg) as smr:
+            with self.meta_and_manifest() as (meta_dir, manifest_path):
+                write_file(join(meta_dir, 'index.json'), self.content)
+                sign_metadata('thedude@example.com', meta_dir,
+                              manifest_path=manifest_path)
+                sign_metadata('walter@example.com', meta_dir,
+                              manifest_path=manifest_path)
+        self.assertEqual(4, smr.call_count)
+
+    def test_sign_metadata_unknown_signature(self):
+        with patch('sign_metadata.run', autospec=True,
+                   side_effect=self.fake_gpg) as smr:
+            with temp_dir() as meta_dir:
+                write_file(join(meta_dir, 'index.json'), self.content)
+                write_file(join(meta_dir, 'index.sjson'), 'foo')
+                with self.assertRaisesRegexp(ValueError,
+                                             'file already exists'):
+                    sign_metadata('thedude@example.com', meta_dir)
+        self.assertEqual(0, smr.call_count)
+
+    def test_sign_metadata_failure(self):
+        failures = ['gpg failed']
+
+        def fail_detach(args):
+            self.fake_gpg(args)
+            if '--detach-sign' in args and failures:
+                raise Exception(failures.pop())
+
+        with patch('sign_metadata.run', autospec=True,
+                   side_effect=fail_detach):
+            with self.meta_and_manifest() as (meta_dir, manifest_path):
+                write_file(join(meta_dir, 'index.json'), self.content)
+                with self.assertRaisesRegexp(Exception, 'gpg failed'):
+                    sign_metadata('thedude@example.com', meta_dir,
+                                  manifest_path=manifest_path)
+                self.assertFalse(isfile(join(meta_dir, 'index.json.gpg')))
+                self.assertEqual(
+                    {'index.json': {'key': 'thedude@example.com'}},
+                    load_manifest(manifest_path))
+                self.assertEqual(
+                    ['index.json', 'index.sjson'], sorted(listdir(meta_dir)))
+                # The partly signed file is replaced on the next run.
+                sign_metadata('thedude@example.com', meta_dir,
+                              manifest_path=manifest_path)
+                self.verify_signed_content(meta_dir)
+
     def verify_signed_content(self, meta_dir):
         file_path = join(meta_dir, 'index.sjson')
         with open(file_path) as i:
@@ -158,7 +259,7 @@ class TestSignMetaData(TestCase):
             args = parse_args([metadata_dir, 's_key'])
         self.assertEqual(args, Namespace(
             signing_key='s_key', signing_passphrase_file=None,
-            metadata_dir=metadata_dir))
+            metadata_dir=metadata_dir, workers=4, manifest=None))
 
     def test_parse_args_signing_passphrase_file(self):
         with temp_dir() as metadata_dir:
@@ -167,7 +268,13 @@ class TestSignMetaData(TestCase):
                                    '--signing-passphrase-file', pass_file.name])
         self.assertEqual(args, Namespace(
             signing_key='s_key', signing_passphrase_file=pass_file.name,
-            metadata_dir=metadata_dir))
+            metadata_dir=metadata_dir, workers=4, manifest=None))
+
+    def test_parse_args_manifest(self):
+        with temp_dir() as metadata_dir:
+            args = parse_args([metadata_dir, 's_key',
+                               '--manifest', 'signed-digests.json'])
+        self.assertEqual('signed-digests.json', args.manifest)
 
     def test_parse_args_error(self):
         with parse_error(self) as stderr:
@@ -184,6 +291,12 @@ class TestSignMetaData(TestCase):
                             'fake/file/'])
         self.assertIn("Invalid passphrase file path ", stderr.getvalue())
 
+        with parse_error(self) as stderr:
+            with temp_dir() as metadata_dir:
+                parse_args([metadata_dir, 's_key', '--manifest',
+                            join(metadata_dir, 'streams', 'digests.json')])
+        self.assertIn("manifest must be outside", stderr.getvalue())
+
 
 @contextmanager
 def parse_error(test_case):
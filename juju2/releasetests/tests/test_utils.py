@@ -0,0 +1,136 @@
+import hashlib
+import json
+from multiprocessing import TimeoutError
+import os
+import threading
+import time
+from unittest import TestCase
+
+from utils import (
+    file_digest,
+    iter_parallel,
+    ListingCache,
+    temp_dir,
+    )
+
+
+class TestIterParallel(TestCase):
+
+    def test_results_in_order(self):
+        results = list(iter_parallel(lambda x: x * 2, [3, 1, 2], 2))
+        self.assertEqual([(3, 6, None), (1, 2, None), (2, 4, None)], results)
+
+    def test_no_items(self):
+        self.assertEqual([], list(iter_parallel(lambda x: x, [], 2)))
+
+    def test_error(self):
+        error = ValueError('foo')
+
+        def func(item):
+            if item == 2:
+                raise error
+            return item
+
+        results = list(iter_parallel(func, [1, 2, 3], 3))
+        self.assertEqual([(1, 1, None), (2, None, error), (3, 3, None)],
+                         results)
+
+    def test_timeout(self):
+        block = threading.Event()
+
+        def func(item):
+            if item == 'slow':
+                block.wait()
+            return item
+
+        try:
+            results = list(iter_parallel(func, ['fast', 'slow'], 2, 0.01))
+        finally:
+            block.set()
+        self.assertEqual(('fast', 'fast', None), results[0])
+        self.assertEqual(('slow', None), results[1][:2])
+        self.assertIsInstance(results[1][2], TimeoutError)
+
+    def test_timeout_per_item(self):
+        def func(item):
+            time.sleep(0.2)
+            return item
+
+        results = list(iter_parallel(func, [1, 2, 3, 4], 1, 0.5))
+        self.assertEqual([(1, 1, None), (2, 2, None), (3, 3, None),
+                          (4, 4, None)], results)
+
+    def test_timeout_frees_worker(self):
+        block = threading.Event()
+
+        def func(item):
+            if item == 'slow':
+                block.wait()
+            return item
+
+        try:
+            results = list(iter_parallel(func, ['slow', 'fast'], 1, 0.01))
+        finally:
+            block.set()
+        self.assertEqual(('slow', None), results[0][:2])
+        self.assertIsInstance(results[0][2], TimeoutError)
+        self.assertEqual(('fast', 'fast', None), results[1])
+
+
+class TestFileDigest(TestCase):
+
+    def test_file_digest(self):
+        with temp_dir() as base:
+            path = os.path.join(base, 'bar.json')
+            with open(path, 'w') as f:
+                f.write('one\ntwo')
+            digest = file_digest(path, chunk_size=3)
+        self.assertEqual(hashlib.sha256('one\ntwo').hexdigest(), digest)
+
+
+class TestListingCache(TestCase):
+
+    def test_get_missing(self):
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            self.assertIs(None, cache.get(['foo']))
+
+    def test_put_get(self):
+        with temp_dir() as cache_dir:
+            cache = ListingCache(os.path.join(cache_dir, 'cache'), 60)
+            self.assertIs(True, cache.put(['foo', {'a': 'b'}], [1, 2]))
+            self.assertEqual([1, 2], cache.get(['foo', {'a': 'b'}]))
+            self.assertIs(None, cache.get(['foo', {'a': 'c'}]))
+            self.assertEqual(1, len(os.listdir(cache.cache_dir)))
+
+    def test_ttl(self):
+        now = [1000]
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60, now=lambda: now[0])
+            cache.put('foo', 'bar')
+            now[0] += 60
+            self.assertEqual('bar', cache.get('foo'))
+            now[0] += 1
+            self.assertIs(None, cache.get('foo'))
+            self.assertEqual('bar', cache.get('foo', max_age=float('inf')))
+
+    def test_put_unchanged(self):
+        now = [1000]
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60, now=lambda: now[0])
+            cache.put('foo', {'bar': 'baz'})
+            now[0] += 100
+            self.assertIs(False, cache.put('foo', {'bar': 'baz'}))
+            self.assertEqual({'bar': 'baz'}, cache.get('foo'))
+            self.assertIs(True, cache.put('foo', {'bar': 'qux'}))
+            with open(cache.get_path('foo')) as cache_file:
+                entry = json.load(cache_file)
+        self.assertEqual(1100, entry['timestamp'])
+        self.assertEqual('foo', entry['key'])
+
+    def test_corrupt_entry(self):
+        with temp_dir() as cache_dir:
+            cache = ListingCache(cache_dir, 60)
+            with open(cache.get_path('foo'), 'w') as cache_file:
+                cache_file.write('{')
+            self.assertIs(None, cache.get('foo'))
@@ -1,5 +1,9 @@
-from mock import patch
+from mock import (
+    Mock,
+    patch,
+    )
 import json
+import os
 from unittest import TestCase
 
 from utils import (
@@ -12,10 +16,18 @@ from validate_streams import (
     check_expected_unchanged,
     check_agents_content,
     compare_agents,
+    compare_agents_indexed,
+    diff_digests,
     find_agents,
+    item_digest,
+    iter_stream_items,
+    load_digest_index,
     main,
+    make_digest_index,
     parse_args,
     reconcile_aliases,
+    save_digest_index,
+    stream_digests,
 )
 
 
@@ -103,6 +115,73 @@ class ValidateStreams(TestCase):
             '1.20.8-trusty-amd64', '1.20.8-trusty-i386']
         self.assertEqual(expected, agents.keys())
 
+    def test_iter_stream_items(self):
+        products = make_products_data(['1.20.7'])
+        items = dict(iter_stream_items(products))
+        agents = make_agents_data('trusty', 'i386', ['1.20.7'])
+        key = ('com.ubuntu.juju:released:agents',
+               'com.ubuntu.juju:trusty:i386', '20140919',
+               '1.20.7-trusty-i386')
+        self.assertEqual(2, len(items))
+        self.assertEqual(agents['1.20.7-trusty-i386']['path'],
+                         items[key]['path'])
+
+    def test_iter_stream_items_index(self):
+        index = {'format': 'index:1.0', 'index': {'foo': {'path': 'bar'}}}
+        self.assertEqual([(('foo',), {'path': 'bar'})],
+                         list(iter_stream_items(index)))
+
+    def test_iter_stream_items_expand(self):
+        products = make_products_data(['1.20.7'])
+        product = products['products']['com.ubuntu.juju:trusty:i386']
+        product['pubname'] = 'juju-trusty-i386'
+        product['versions']['20140919']['label'] = 'release'
+        key = ('com.ubuntu.juju:released:agents',
+               'com.ubuntu.juju:trusty:i386', '20140919',
+               '1.20.7-trusty-i386')
+        item = dict(iter_stream_items(products, expand=True))[key]
+        self.assertEqual('juju-trusty-i386', item['pubname'])
+        self.assertEqual('release', item['label'])
+        self.assertEqual('1.20.7', item['version'])
+        self.assertNotIn('versions', item)
+        self.assertNotIn('items', item)
+        self.assertNotIn('pubname', dict(iter_stream_items(products))[key])
+
+    def test_stream_digests_product_attributes(self):
+        products = make_products_data(['1.20.7'])
+        product = products['products']['com.ubuntu.juju:trusty:i386']
+        product['pubname'] = 'juju-trusty-i386'
+        old_digests = stream_digests(products)
+        product['pubname'] = 'juju-xenial-i386'
+        added, removed, changed = diff_digests(
+            old_digests, stream_digests(products))
+        self.assertEqual([], added)
+        self.assertEqual([], removed)
+        self.assertEqual([('com.ubuntu.juju:released:agents',
+                           'com.ubuntu.juju:trusty:i386', '20140919',
+                           '1.20.7-trusty-i386')], changed)
+
+    def test_item_digest(self):
+        self.assertEqual(item_digest({'a': 1, 'b': [2, 3]}),
+                         item_digest({'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(item_digest({'a': 1}), item_digest({'a': 2}))
+
+    def test_diff_digests(self):
+        products = make_products_data(['1.20.7', '1.20.8'])
+        old_digests = stream_digests(products)
+        product = products['products']['com.ubuntu.juju:trusty:amd64']
+        items = product['versions']['20140919']['items']
+        del items['1.20.7-trusty-amd64']
+        items['1.20.8-trusty-amd64']['size'] = 1
+        items['1.20.9-trusty-amd64'] = dict(items['1.20.8-trusty-amd64'])
+        added, removed, changed = diff_digests(
+            old_digests, stream_digests(products))
+        prefix = ('com.ubuntu.juju:released:agents',
+                  'com.ubuntu.juju:trusty:amd64', '20140919')
+        self.assertEqual([prefix + ('1.20.9-trusty-amd64',)], added)
+        self.assertEqual([prefix + ('1.20.7-trusty-amd64',)], removed)
+        self.assertEqual([prefix + ('1.20.8-trusty-amd64',)], changed)
+
     def test_check_devel_not_stable(self):
         # devel agents cannot ever got to proposed and release.
         old_agents = make_agents_data('trusty', 'amd64', ['1.20.7', '1.20.8'])
@@ -316,3 +395,109 @@ class ValidateStreams(TestCase):
                 returncode = main(
                     ['script', '--added', '1.2.3', 'released', 'old', 'new'])
         self.assertEqual(1, returncode)
+
+
+def write_products(path, versions):
+    with open(path, 'w') as f:
+        json.dump(make_products_data(versions), f)
+
+
+class DigestIndex(TestCase):
+
+    def test_make_digest_index(self):
+        agents = make_agents_data('trusty', 'amd64', ['1.20.7'])
+        index = make_digest_index(agents)
+        self.assertEqual(['1.20.7-trusty-amd64'], index.keys())
+        self.assertEqual('1.20.7', index['1.20.7-trusty-amd64']['version'])
+        self.assertEqual(64, len(index['1.20.7-trusty-amd64']['digest']))
+
+    def test_load_digest_index(self):
+        with temp_dir() as wd:
+            json_path = os.path.join(wd, 'json')
+            index_path = os.path.join(wd, 'index')
+            write_products(json_path, ['1.20.7'])
+            index = load_digest_index(json_path, index_path)
+            self.assertTrue(os.path.exists(index_path))
+            with patch('validate_streams.find_agents',
+                       autospec=True) as fa_mock:
+                cached = load_digest_index(json_path, index_path)
+        self.assertEqual(0, fa_mock.call_count)
+        self.assertEqual(index, cached)
+        self.assertEqual(2, len(index))
+
+    def test_load_digest_index_stale(self):
+        with temp_dir() as wd:
+            json_path = os.path.join(wd, 'json')
+            index_path = os.path.join(wd, 'index')
+            write_products(json_path, ['1.20.7'])
+            save_digest_index(json_path, index_path, {})
+            write_products(json_path, ['1.20.7', '1.20.8'])
+            os.utime(json_path, (0, 0))
+            index = load_digest_index(json_path, index_path)
+        self.assertEqual(4, len(index))
+
+    def test_compare_agents_indexed(self):
+        old_agents = make_agents_data('trusty', 'amd64', ['1.20.7', '1.20.8'])
+        new_agents = make_agents_data(
+            'trusty', 'amd64', ['1.20.7', '1.20.8', '1.20.9'])
+        get_old_agents = Mock(return_value=old_agents)
+        errors, diff = compare_agents_indexed(
+            make_digest_index(old_agents), new_agents,
+            make_digest_index(new_agents), 'proposed', get_old_agents,
+            added='1.20.9')
+        self.assertIs(None, errors)
+        self.assertEqual({
+            'added': ['1.20.9-trusty-amd64'],
+            'removed': [],
+            'changed': {},
+            }, diff)
+        self.assertEqual(0, get_old_agents.call_count)
+
+    def test_compare_agents_indexed_changed(self):
+        old_agents = make_agents_data('trusty', 'amd64', ['1.20.7', '1.20.8'])
+        new_agents = make_agents_data('trusty', 'amd64', ['1.20.7', '1.20.8'])
+        new_agents['1.20.7-trusty-amd64']['sha256'] = 'bad_sum'
+        new_agents['1.20.8-trusty-amd64']['new_key'] = 'value'
+        errors, diff = compare_agents_indexed(
+            make_digest_index(old_agents), new_agents,
+            make_digest_index(new_agents), 'proposed', lambda: old_agents)
+        self.assertEqual(
+            ['Tool 1.20.7-trusty-amd64 sha256 changed from '
+             'valid_sum to bad_sum'],
+            errors)
+        self.assertEqual(
+            {'1.20.7-trusty-amd64': {'sha256': ['valid_sum', 'bad_sum']}},
+            diff['changed'])
+
+    def test_compare_agents_indexed_missing(self):
+        old_agents = make_agents_data('trusty', 'amd64', ['1.20.7', '1.20.8'])
+        new_agents = make_agents_data('trusty', 'amd64', ['1.20.8'])
+        errors, diff = compare_agents_indexed(
+            make_digest_index(old_agents), new_agents,
+            make_digest_index(new_agents), 'proposed', lambda: old_agents)
+        self.assertEqual(
+            ["These agents are missing: ['1.20.7-trusty-amd64']"], errors)
+        self.assertEqual(['1.20.7-trusty-amd64'], diff['removed'])
+
+    def test_main_indexed(self):
+        with temp_dir() as wd:
+            old_json = os.path.join(wd, 'old.json')
+            new_json = os.path.join(wd, 'new.json')
+            old_index = os.path.join(wd, 'old.index')
+            new_index = os.path.join(wd, 'new.index')
+            report = os.path.join(wd, 'report.json')
+            write_products(old_json, ['1.20.7'])
+            write_products(new_json, ['1.20.7', '1.20.8'])
+            returncode = main([
+                'script', '--added', '1.20.8', '--old-index', old_index,
+                '--new-index', new_index, '--report', report, 'proposed',
+                old_json, new_json])
+            self.assertTrue(os.path.exists(old_index))
+            self.assertTrue(os.path.exists(new_index))
+            with open(report) as report_file:
+                report_data = json.load(report_file)
+        self.assertEqual(0, returncode)
+        self.assertEqual(
+            ['1.20.8-trusty-amd64', '1.20.8-trusty-i386'],
+            report_data['added'])
+        self.assertEqual([], report_data['errors'])
@@ -1,9 +1,19 @@
 from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import json
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import os
 import random
 import shutil
 import string
-from tempfile import mkdtemp
+from tempfile import (
+    mkdtemp,
+    mkstemp,
+    )
+import threading
+import time
 
 
 @contextmanager
@@ -49,3 +59,179 @@ def get_random_hex_string(size=64):
 def write_file(path, contents):
     with open(path, 'w') as f:
         f.write(contents)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the sha256 hexdigest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_parallel(func, items, max_workers, timeout=None):
+    """Yield (item, result, error) for func(item), run on a thread pool.
+
+    Results are yielded in the order of items.  If func raises, result is
+    None and error is the exception.  If timeout is supplied, each call
+    must finish within timeout seconds of its own start, or error is a
+    TimeoutError.  A call that times out is abandoned, so that the items
+    queued behind it can start.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return
+    if timeout is not None:
+        for result in _iter_parallel_timeout(func, items, max_workers,
+                                             timeout):
+            yield result
+        return
+    pool = ThreadPool(max(1, min(max_workers, len(items))))
+    try:
+        pending = [(i, pool.apply_async(func, (i,))) for i in items]
+        for item, async_result in pending:
+            try:
+                result = async_result.get()
+            except Exception as e:
+                yield item, None, e
+            else:
+                yield item, result, None
+    finally:
+        pool.terminate()
+
+
+class _TimedCall:
+    """A call of func(item) on its own thread, holding a worker slot."""
+
+    def __init__(self, func, item, slots):
+        self.func = func
+        self.item = item
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.released = False
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.start_time = None
+        self.result = None
+        self.error = None
+
+    def start(self):
+        self.start_time = time.time()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        self.started.set()
+
+    def run(self):
+        try:
+            self.result = self.func(self.item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+            self.release()
+
+    def release(self):
+        """Free the worker slot, once."""
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.slots.release()
+
+
+def _iter_parallel_timeout(func, items, max_workers, timeout):
+    slots = threading.Semaphore(max(1, max_workers))
+    calls = [_TimedCall(func, item, slots) for item in items]
+    stopped = threading.Event()
+
+    def start_calls():
+        for call in calls:
+            slots.acquire()
+            if stopped.is_set():
+                slots.release()
+                return
+            call.start()
+
+    starter = threading.Thread(target=start_calls)
+    starter.daemon = True
+    starter.start()
+    try:
+        for call in calls:
+            call.started.wait()
+            remaining = call.start_time + timeout - time.time()
+            if not call.done.wait(max(0, remaining)):
+                call.release()
+                yield call.item, None, TimeoutError()
+            elif call.error is not None:
+                yield call.item, None, call.error
+            else:
+                yield call.item, call.result, None
+    finally:
+        stopped.set()
+        slots.release()
+
+
+class ListingCache:
+    """An on-disk cache of API listings.
+
+    Entries are keyed by any JSON-serializable value, such as a region name
+    and the filters used for the query.  Entries older than ttl seconds are
+    stale, but remain available to callers that can tolerate them.
+    """
+
+    def __init__(self, cache_dir, ttl, now=time.time):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.now = now
+
+    def get_path(self, key):
+        digest = hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(digest))
+
+    def load(self, key):
+        """Return the (timestamp, digest, data) entry for key, or None."""
+        try:
+            with open(self.get_path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry['timestamp'], entry['digest'], entry['data']
+
+    def get(self, key, max_age=None):
+        """Return the cached data for key, or None if missing or too old.
+
+        :param max_age: The maximum age in seconds.  Defaults to the ttl.
+            Use float('inf') to accept stale data.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        entry = self.load(key)
+        if entry is None:
+            return None
+        timestamp, digest, data = entry
+        if self.now() - timestamp > max_age:
+            return None
+        return data
+
+    def put(self, key, data):
+        """Store data for key.
+
+        Returns True if the data differs from the previous entry.  Unchanged
+        data only has its timestamp refreshed.
+        """
+        serialized = json.dumps(data, sort_keys=True)
+        digest = hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+        entry = self.load(key)
+        changed = entry is None or entry[1] != digest
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.get_path(key)
+        fd, temp_path = mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({'timestamp': self.now(), 'digest': digest,
+                       'key': key, 'data': data}, cache_file)
+        os.rename(temp_path, path)
+        return changed
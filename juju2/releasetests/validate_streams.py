@@ -3,9 +3,12 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+import hashlib
 import json
+import os
 import re
 import sys
+from tempfile import mkstemp
 import traceback
 
 
@@ -16,19 +19,122 @@ TESTING = 'testing'
 PURPOSES = (RELEASE, PROPOSED, DEVEL, TESTING)
 
 
+def iter_product_items(stream, expand=False):
+    """Yield (key, item) for each item in a products document.
+
+    key is a tuple of (content_id, product_name, version_name, item_name).
+    If expand is True, each item also has the attributes that were condensed
+    into its product and version, as simplestreams would expand it.
+    """
+    content_id = stream.get('content_id', '')
+    for product_name, product in stream['products'].items():
+        for version_name, version in product['versions'].items():
+            if not isinstance(version, dict):
+                continue
+            for item_name, item in version['items'].items():
+                if expand:
+                    item = expand_item(product, version, item)
+                yield (content_id, product_name, version_name,
+                       item_name), item
+
+
+def expand_item(product, version, item):
+    """Return item with the attributes of its product and version."""
+    expanded = dict(
+        (k, v) for k, v in product.items() if k != 'versions')
+    expanded.update((k, v) for k, v in version.items() if k != 'items')
+    expanded.update(item)
+    return expanded
+
+
+def iter_stream_items(stream, expand=False):
+    """Yield (key, item) for each item in a products or index document.
+
+    Index entries are keyed by a tuple of (content_id,).  Product items
+    are expanded if expand is True.
+    """
+    if 'products' in stream:
+        for key, item in iter_product_items(stream, expand):
+            yield key, item
+    for content_id, entry in stream.get('index', {}).items():
+        yield (content_id,), entry
+
+
+def item_digest(item):
+    """Return a digest of the canonical JSON form of an item."""
+    canonical = json.dumps(item, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def stream_digests(stream):
+    """Return a dict of item key to item_digest for a stream document.
+
+    Items are digested in their expanded form, so a change to an attribute
+    condensed into a product or version changes the digests of its items.
+    """
+    return dict((key, item_digest(item))
+                for key, item in iter_stream_items(stream, expand=True))
+
+
+def diff_digests(old_digests, new_digests):
+    """Return sorted lists of the added, removed and changed keys."""
+    added = sorted(set(new_digests).difference(old_digests))
+    removed = sorted(set(old_digests).difference(new_digests))
+    changed = sorted(k for k, v in old_digests.items()
+                     if k in new_digests and new_digests[k] != v)
+    return added, removed, changed
+
+
 def find_agents(file_path):
     with open(file_path) as f:
         stream = json.load(f)
     agents = {}
-    for name, product in stream['products'].items():
-        versions = product['versions']
-        for version in versions.values():
-            if isinstance(version, dict):
-                items = version['items']
-                agents.update(items)
+    for key, item in iter_product_items(stream):
+        agents[key[-1]] = item
     return agents
 
 
+def make_digest_index(agents):
+    """Return a dict of agent name to its version and item_digest."""
+    return dict(
+        (name, {'version': agent['version'], 'digest': item_digest(agent)})
+        for name, agent in agents.items())
+
+
+def get_index_source(json_path):
+    """Return the size and mtime that identify a version of json_path."""
+    stat = os.stat(json_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def save_digest_index(json_path, index_path, index):
+    """Atomically write the digest index of json_path to index_path."""
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    fd, temp_path = mkstemp(dir=index_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as index_file:
+        json.dump({'source': get_index_source(json_path), 'agents': index},
+                  index_file)
+    os.rename(temp_path, index_path)
+
+
+def load_digest_index(json_path, index_path):
+    """Return the digest index of json_path, as cached in index_path.
+
+    The index is rebuilt and saved if json_path has changed since the index
+    was written.
+    """
+    try:
+        with open(index_path) as index_file:
+            cached = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        cached = None
+    if cached is not None and cached['source'] == get_index_source(json_path):
+        return cached['agents']
+    index = make_digest_index(find_agents(json_path))
+    save_digest_index(json_path, index_path, index)
+    return index
+
+
 def check_devel_not_stable(old_agents, new_agents, purpose):
     """Return a list of errors if the version can be included in the stream.
 
@@ -198,6 +304,56 @@ def compare_agents(old_agents, new_agents, purpose,
     return errors or None
 
 
+def compare_agents_indexed(old_index, new_agents, new_index, purpose,
+                           get_old_agents, added=None, removed=None,
+                           ignored=None):
+    """Return the errors and a structured diff of two agent streams.
+
+    The old stream is represented by its digest index, so only the agents
+    whose digest changed are compared field by field.  get_old_agents is
+    only called if there are such agents.
+
+    :param old_index: the make_digest_index of the old json.
+    :param new_agents: the dict of all the products/versions/*/items
+                       in the new json.
+    :param new_index: the make_digest_index of new_agents.
+    :return: a tuple of (errors, diff).  errors is a list, or None when there
+        are none.  diff is a dict of the added and removed agent names, and
+        the changed fields of changed agents.
+    """
+    errors = []
+    errors.extend(
+        check_devel_not_stable(old_index, new_agents, purpose))
+    errors.extend(
+        check_expected_changes(new_agents, added, removed))
+    errors.extend(
+        check_expected_unchanged(
+            old_index, new_agents, added, removed, ignored))
+    added_names, removed_names, changed_names = diff_digests(
+        dict((k, v['digest']) for k, v in old_index.items()),
+        dict((k, v['digest']) for k, v in new_index.items()))
+    changed = {}
+    if changed_names:
+        old_agents = get_old_agents()
+        for name in changed_names:
+            old_tool = old_agents[name]
+            new_tool = new_agents[name]
+            fields = dict((k, [v, new_tool.get(k)])
+                          for k, v in old_tool.items()
+                          if new_tool.get(k) != v)
+            if fields:
+                changed[name] = fields
+        errors.extend(check_agents_content(
+            dict((name, old_agents[name]) for name in changed_names),
+            new_agents))
+    diff = {
+        'added': added_names,
+        'removed': removed_names,
+        'changed': changed,
+        }
+    return errors or None, diff
+
+
 def parse_args(args=None):
     """Return the argument parser for this program."""
     parser = ArgumentParser("Compare old and new stream data.")
@@ -211,12 +367,45 @@ def parse_args(args=None):
     parser.add_argument(
         '-i', '--ignored', default=None,
         help="Ignore a version that might be added")
+    parser.add_argument(
+        '--old-index', default=None,
+        help='A digest index of old_json, rebuilt if out of date.')
+    parser.add_argument(
+        '--new-index', default=None,
+        help='Write a digest index of new_json here.')
+    parser.add_argument(
+        '--report', default=None,
+        help='Write a JSON report of the added, removed and changed agents.')
     parser.add_argument('purpose', help="<{}>".format(' | '.join(PURPOSES)))
     parser.add_argument('old_json', help="The old simple streams data file")
     parser.add_argument('new_json', help="The new simple streams data file")
     return parser.parse_args(args)
 
 
+def compare_indexed(args):
+    """Compare the streams of args using digest indexes.
+
+    :return: a list of errors, or None when there are none.
+    """
+    if args.old_index is not None:
+        old_index = load_digest_index(args.old_json, args.old_index)
+    else:
+        old_index = make_digest_index(find_agents(args.old_json))
+    new_agents = find_agents(args.new_json)
+    new_index = make_digest_index(new_agents)
+    errors, diff = compare_agents_indexed(
+        old_index, new_agents, new_index, args.purpose,
+        lambda: find_agents(args.old_json), args.added, args.removed,
+        args.ignored)
+    if args.new_index is not None:
+        save_digest_index(args.new_json, args.new_index, new_index)
+    if args.report is not None:
+        with open(args.report, 'w') as report_file:
+            json.dump(dict(diff, errors=errors or []), report_file,
+                      indent=2, sort_keys=True)
+    return errors
+
+
 def main(argv):
     """Verify that the new json has all the expected changes.
 
@@ -225,11 +414,15 @@ def main(argv):
     """
     args = parse_args(argv[1:])
     try:
-        old_agents = find_agents(args.old_json)
-        new_agents = find_agents(args.new_json)
-        errors = compare_agents(
-            old_agents, new_agents, args.purpose, args.added,
-            args.removed, args.ignored)
+        if args.old_index is None and args.new_index is None and (
+                args.report is None):
+            old_agents = find_agents(args.old_json)
+            new_agents = find_agents(args.new_json)
+            errors = compare_agents(
+                old_agents, new_agents, args.purpose, args.added,
+                args.removed, args.ignored)
+        else:
+            errors = compare_indexed(args)
         if errors:
             print('\n'.join(errors))
             return 1
@@ -6,6 +6,8 @@
 # it can be shared.
 from __future__ import print_function
 
+from collections import OrderedDict
+import json
 import sys
 
 # This lists the collections and fields in those collections that need to be sanitized
@@ -20,39 +22,153 @@ to_sanitize = [
     ('statuses', ['statusinfo']),
 ]
 
-def generateScript():
-    # Create an index on the transactions so that the updates go faster
-    yield 'print(new Date().toLocaleString())'
-    yield 'db.txns.createIndex({"o.c": 1})'
-    for collection, attributes in to_sanitize:
-        # First we generate the sanitization of the collection itself
-        # (we don't use .format() because {} is used all the time in Javascript
-        yield 'print(new Date().toLocaleString())'
-        yield 'print("updating collection %s for %s")' % (collection, attributes)
-        yield 'print(db.%s.update({}, {"$set": {' % (collection,)
-        inner = ['    "%s": "REDACTED"' % (a,) for a in attributes]
-        yield ',\n'.join(inner) + '}'
-        yield '}, {"multi": 1}))'
-
-        # Now update the TXN records for insert and update
-        for attribute in attributes:
-            yield 'print(new Date().toLocaleString())'
-            yield 'print("updating insert txns for %s %s")' % (collection, attribute)
-            yield 'print(db.txns.update({"o.c": "%s", "o.i.%s": {"$exists": 1}}, {"$set": {' % (collection, attribute)
-            yield '    "o.$.i.%s": "REDACTED"}' % (attribute,)
-            yield '}, {"multi": 1}))'
-            yield 'print(new Date().toLocaleString())'
-            yield 'print("updating update txns for %s %s")' % (collection, attribute)
-            # Our TXN entries have a '$set' with a literal $ in them.
-            # Apparently Mongo is perfectly fine for you to create documents
-            # and query documents with $, but won't let you "update" documents
-            # with a $ in them. so we just unset those fields instead of setting them to 'REDACTED'.
-            yield 'print(db.txns.update({"o.c": "%s", "o.u.$set.%s": {"$exists": 1}}, {"$unset": {' % (collection, attribute)
-            yield '    "o.$.u.$set.%s": "1"}' % (attribute,)
-            yield '}, {"multi": 1}))'
-        yield ''
-    yield 'db.txns.dropIndex({"o.c": 1})'
-    yield 'print(new Date().toLocaleString())'
+# The collection the generated script records its progress in, so that an
+# interrupted run carries on from where it stopped. It is dropped once
+# everything has been sanitized.
+progress_collection = 'sanitizeProgress'
+
+default_batch_size = 1000
+
+# Each collection is sanitized with one update per batch of documents, and
+# the txns with one bulk operation per batch, rewriting every sensitive field
+# of a transaction in a single update.
+script_body = r"""
+var progress = db.getCollection(progressCollection);
+
+function report(name, count, start) {
+    var secs = (new Date() - start) / 1000;
+    var rate = secs > 0 ? Math.round(count / secs) : count;
+    print(name + ": " + count + " documents in " + secs + "s (" + rate + " docs/s)");
+}
+
+// sanitizeBatches calls sanitize with each batch of documents matching
+// query, in _id order, checkpointing after each batch.
+function sanitizeBatches(name, collection, query, projection, sanitize) {
+    var state = progress.findOne({_id: name}) || {count: 0};
+    if (state.done) {
+        print(name + ": already sanitized");
+        return;
+    }
+    if (state.last !== undefined) {
+        print(name + ": resuming after " + state.last + " (" + state.count + " done)");
+    }
+    var last = state.last;
+    var count = 0;
+    var start = new Date();
+    while (true) {
+        var batchQuery = {};
+        for (var key in query) {
+            batchQuery[key] = query[key];
+        }
+        if (last !== undefined) {
+            batchQuery._id = {"$gt": last};
+        }
+        var docs = collection.find(batchQuery, projection).sort({_id: 1}).limit(batchSize).toArray();
+        if (docs.length == 0) {
+            break;
+        }
+        sanitize(docs);
+        last = docs[docs.length - 1]._id;
+        count += docs.length;
+        progress.update({_id: name}, {"$set": {last: last, count: state.count + count}}, {upsert: true});
+        if (count % (batchSize * 100) == 0) {
+            report(name, count, start);
+        }
+    }
+    progress.update({_id: name}, {"$set": {done: true}}, {upsert: true});
+    report(name, count, start);
+}
+
+function sanitizeCollection(name, fields) {
+    var redacted = {};
+    fields.forEach(function(field) {
+        redacted[field] = "REDACTED";
+    });
+    var collection = db.getCollection(name);
+    sanitizeBatches(name, collection, {}, {_id: 1}, function(docs) {
+        collection.update(
+            {_id: {"$gte": docs[0]._id, "$lte": docs[docs.length - 1]._id}},
+            {"$set": redacted},
+            {multi: true});
+    });
+}
+
+// txnUpdate returns the update that sanitizes all the operations in txn,
+// or null if there is nothing to sanitize.
+function txnUpdate(txn) {
+    var set = {};
+    var unset = {};
+    var changed = false;
+    txn.o.forEach(function(op, i) {
+        var fields = toSanitize[op.c];
+        if (fields === undefined) {
+            return;
+        }
+        fields.forEach(function(field) {
+            if (op.i && op.i[field] !== undefined && op.i[field] !== "REDACTED") {
+                set["o." + i + ".i." + field] = "REDACTED";
+                changed = true;
+            }
+            // Our TXN entries have a '$set' with a literal $ in them.
+            // Mongo won't let you "update" documents through a $ field,
+            // so we just unset those fields instead of setting them to
+            // 'REDACTED'.
+            if (op.u && op.u["$set"] && op.u["$set"][field] !== undefined) {
+                unset["o." + i + ".u.$set." + field] = "";
+                changed = true;
+            }
+        });
+    });
+    if (!changed) {
+        return null;
+    }
+    var update = {};
+    if (Object.keys(set).length > 0) {
+        update["$set"] = set;
+    }
+    if (Object.keys(unset).length > 0) {
+        update["$unset"] = unset;
+    }
+    return update;
+}
+
+function sanitizeTxns() {
+    var txns = db.getCollection("txns");
+    var query = {"o.c": {"$in": Object.keys(toSanitize)}};
+    sanitizeBatches("txns", txns, query, {o: 1}, function(docs) {
+        var bulk = txns.initializeUnorderedBulkOp();
+        var pending = 0;
+        docs.forEach(function(txn) {
+            var update = txnUpdate(txn);
+            if (update !== null) {
+                bulk.find({_id: txn._id}).updateOne(update);
+                pending++;
+            }
+        });
+        if (pending > 0) {
+            bulk.execute();
+        }
+    });
+}
+
+print(new Date().toLocaleString());
+for (var name in toSanitize) {
+    sanitizeCollection(name, toSanitize[name]);
+}
+sanitizeTxns();
+progress.drop();
+print(new Date().toLocaleString());
+"""
+
+
+def generateScript(batch_size=default_batch_size, restart=False):
+    yield 'var progressCollection = %s;' % json.dumps(progress_collection)
+    yield 'var batchSize = %d;' % batch_size
+    yield 'var toSanitize = %s;' % json.dumps(OrderedDict(to_sanitize), indent=4)
+    if restart:
+        yield 'db.getCollection(progressCollection).drop();'
+    for line in script_body.strip().split('\n'):
+        yield line
 
 
 def main(args):
@@ -63,12 +179,20 @@ This updates both the actual collections as well as the transactions that
 updated or created them. Fields that are sensitive are either converted to
 REDACTED or removed. (we are unable to REDACT some of the update transactions,
 because of limitations with $ characters.)
-""", epilog="""
+
+Each collection is sanitized in a single pass, in batches ordered by _id.
+Progress is recorded in the %s collection, so running the script
+again after an interruption carries on from the last completed batch.
+""" % (progress_collection,), epilog="""
 Example: ./sanitize-db.py | mongo CONNECT_ARGS
 """)
+    p.add_argument('--batch-size', type=int, default=default_batch_size,
+                   help='documents to sanitize per update (default %(default)s)')
+    p.add_argument('--restart', action='store_true',
+                   help='ignore the progress of an interrupted run and start again')
     opts = p.parse_args(args)
 
-    for line in generateScript():
+    for line in generateScript(opts.batch_size, opts.restart):
         print(line)
 
 